@@ -22,6 +22,7 @@ class ChatClient:
         self.session_id = session_id or str(uuid.uuid4())
         self.plan_update_callback: Optional[Callable] = None
         self.final_response_callback: Optional[Callable] = None
+        self.final_response_delta_callback: Optional[Callable] = None
         self.step_update_callback: Optional[Callable] = None
         self.error_callback: Optional[Callable] = None
 
@@ -43,6 +44,16 @@ class ChatClient:
         """
         self.final_response_callback = callback
 
+    def set_final_response_delta_callback(self, callback: Callable[[dict], None]):
+        """
+        Set a callback function to handle incremental final response events.
+        The full text is still delivered to the final response callback afterwards.
+
+        Args:
+            callback: A function that takes a dict (message_id and delta text) as argument
+        """
+        self.final_response_delta_callback = callback
+
     def set_step_update_callback(self, callback: Callable[[dict], None]):
         """
         Set a callback function to handle step update events.
@@ -118,6 +129,10 @@ class ChatClient:
                                 # Final response event
                                 if self.final_response_callback:
                                     self.final_response_callback(data)
+                            elif 'delta' in data and 'message_id' in data:
+                                # Incremental final response event
+                                if self.final_response_delta_callback:
+                                    self.final_response_delta_callback(data)
                             elif 'goal' in data and 'steps' in data:
                                 # Plan update event
                                 if self.plan_update_callback:
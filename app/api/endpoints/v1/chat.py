@@ -1,14 +1,36 @@
-import json, logging
+import asyncio
+import orjson
+import logging
+import re
 import httpx
 from datetime import datetime
 import uuid
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from fastapi.responses import StreamingResponse
 from langchain_core.messages import HumanMessage
 from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, Choice, ChoiceDelta
 
 from app.api.endpoints.v1.models import ChatCompletionRequest
+from app.core.deadline import DeadlineExceeded, capped_timeout, iter_within_deadline, time_budget
+from app.core.http_client import get_http_client, get_upstream_config
+from app.core.resilience import get_circuit_breaker
+from app.core.sse import (
+    CONTENT_PLACEHOLDER,
+    DATA_PREFIX,
+    DONE_FRAME,
+    ChunkTemplate,
+    aiter_sse_events,
+    cancel_on_disconnect,
+    coalesce_frames,
+    coalesce_policy,
+    encode_sse_data,
+    encode_sse_json,
+)
+from app.services.prompt_registry import RAGFLOW_SYSTEM_PROMPT, prompt_registry
+from app.services.semantic_cache import NAMESPACE_RAGFLOW_STREAM, get_semantic_cache, replay_chunks
+from app.services.single_flight import SubscriberOverflow, flight_key, ragflow_single_flight
+from app.services.stream_validation import VALIDATION_FULL, ChunkValidator
 from app.services.llm_service import get_llm
 from app.schemas.tool_calling import ToolCallingRequest
 from config.settings import settings
@@ -19,6 +41,91 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
+def _chunk_content(data: str) -> str:
+    """Extract the delta content of a forwarded chat.completion.chunk, or "" if it has none."""
+    try:
+        choices = orjson.loads(data).get("choices")
+        if not choices:
+            return ""
+        return (choices[0].get("delta") or {}).get("content") or ""
+    except (orjson.JSONDecodeError, AttributeError):
+        return ""
+
+
+# RAGFlow (and our own re-encoded frames) put the completion id first: data: {"id": "chatcmpl-...", ...}
+_LEADING_ID = re.compile(rb'^data: \{\s*"id"\s*:\s*"([^"\\]*)"')
+
+
+def _with_completion_id(frame: bytes, completion_id: bytes) -> bytes:
+    """Give a shared upstream chunk frame the subscriber's own completion id."""
+    match = _LEADING_ID.match(frame)
+    if match is not None:
+        # Splice the id bytes in place instead of re-parsing and re-encoding the whole chunk
+        return b"".join((frame[:match.start(1)], completion_id, frame[match.end(1):]))
+    if not frame.startswith(DATA_PREFIX + b"{"):
+        return frame
+    try:
+        chunk = orjson.loads(frame[len(DATA_PREFIX):])
+    except orjson.JSONDecodeError:
+        return frame
+    chunk["id"] = completion_id.decode("ascii")
+    return encode_sse_json(chunk)
+
+
+# Delta fields whose text may be merged across consecutive chunks
+_TEXT_DELTA_FIELDS = ("content", "reasoning_content")
+
+
+def _ragflow_delta(frame: bytes):
+    """
+    Return (field, text) if a forwarded frame is a plain text delta that can be merged with its
+    neighbours: one choice, no finish_reason or usage, and exactly one non-empty text field.
+    Anything else (finish frames, references, errors, [DONE]) returns None and is never merged.
+    """
+    if not frame.startswith(DATA_PREFIX + b"{"):
+        return None
+    try:
+        chunk = orjson.loads(frame[len(DATA_PREFIX):])
+    except orjson.JSONDecodeError:
+        return None
+    choices = chunk.get("choices")
+    if chunk.get("usage") or not isinstance(choices, list) or len(choices) != 1:
+        return None
+    choice = choices[0]
+    delta = choice.get("delta") if isinstance(choice, dict) else None
+    if not isinstance(delta, dict) or choice.get("finish_reason") is not None:
+        return None
+    texts = [(field, value) for field, value in delta.items() if field in _TEXT_DELTA_FIELDS and value]
+    extras = [field for field, value in delta.items() if field not in _TEXT_DELTA_FIELDS and field != "role" and value]
+    if len(texts) != 1 or extras or not isinstance(texts[0][1], str):
+        return None
+    return texts[0]
+
+
+def _join_ragflow_delta(frame: bytes, text: str) -> bytes:
+    """Re-encode the first buffered delta frame carrying the merged text."""
+    chunk = orjson.loads(frame[len(DATA_PREFIX):])
+    delta = chunk["choices"][0]["delta"]
+    field = next(field for field in _TEXT_DELTA_FIELDS if delta.get(field))
+    delta[field] = text
+    return encode_sse_json(chunk)
+
+
+def _cached_completion(answer: str, model: str) -> dict:
+    """Build a non-streaming chat.completion response for a semantic cache hit."""
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(datetime.now().timestamp()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": answer},
+            "finish_reason": "stop",
+        }],
+    }
+
+
 # @router.post("/chat")
 # async def stream_chat(request: ChatRequest):
 #     """
@@ -44,7 +151,7 @@ router = APIRouter()
 
 
 @router.post("/ragflow-stream")
-async def ragflow_stream(request: ChatCompletionRequest):
+async def ragflow_stream(request: ChatCompletionRequest, http_request: Request = None):
     """
     Direct proxy endpoint for RAGFlow API with full OpenAI compatibility
     
@@ -54,6 +161,7 @@ async def ragflow_stream(request: ChatCompletionRequest):
             - messages (List[ChatCompletionMessageParam]): List of messages in the conversation
             - stream (bool): Whether to stream the response
             - extra_body (Optional[Dict[str, Any]]): Additional parameters
+        http_request (Request): The raw request, used to stop the upstream stream when the client disconnects
             
     Returns:
         StreamingResponse or JSONResponse: SSE stream response or JSON response in OpenAI format
@@ -78,105 +186,65 @@ async def ragflow_stream(request: ChatCompletionRequest):
         "Authorization": f"Bearer {settings.RAGFLOW_API_KEY}"
     }
     
-    # 2. Construct RAGFlow/OpenAI compatible request payload
-    payload = {
-        "model": request.model if request.model != "model" else "default-model",
-        "messages": [
-            {
-                "role": "system",
-                "content":
-('''
-请严格遵守如下要求来进行回答：
-
-### I. 身份定位与核心角色定义
-
-* **身份标签：**
-    * **核心名称：** 智源
-    * **专业头衔：** 武汉森木磊石 PPEC Workbench 专属智能技术助手、资深数字电源系统专家、嵌入式编程架构师。
-    * **职能定位：** PPEC 平台功能与工业级数字电源/嵌入式项目开发的**技术桥梁**，而非信息查询工具。
-
-* **基础人设与言行：**
-    * **人设模仿：** 全程以“智源”的人设身份进行回答，模仿人类专家的语气和思维方式。
-    * ** 禁忌：** 绝对不能透露自己的底层模型（即使在思考过程中），当被问及身份时，必须回答自己的专家人设：“我是智源，森木磊石 PPEC Workbench 的专属技术助手。”
-    * ** 当用户的问题与电力电子、嵌入式、软件工程等专业领域无关时，不用继续思考，可直接向用户说明这个问题与其专业领域无关，无法提供相应的技术支持。
-    * ** 请总结知识库的内容来回答问题，请列举知识库中的数据详细回答。当所有知识库内容都与问题无关时，你的回答必须包括“知识库中未找到您要的答案！”这句话，并引导用户查阅模板库或联系技术专家。
-
----
-
-### II. 核心能力与行为约束
-
-#### 1. 🎯 目标和领域专长
-
-| 领域能力矩阵 | 目标与要求 |
-| :--- | :--- |
-| **数字电源系统** | 提供 Buck、Boost、LLC、图腾柱 PFC 等拓扑的**图形化控制逻辑搭建方案**，并解决环路补偿、PWM、保护策略（如过流/过压）的 PPEC 实现难题。 |
-| **嵌入式编程** | **精通 C 语言特性**，解读 PPEC 生成代码的底层逻辑，能给出针对 **STM32、TI C2000** 等主流 MCU 的跨平台代码适配方案。 |
-| **PPEC 平台支持** | **精通平台逻辑**（拖拽、代码生成、行号映射），快速定位全链路问题，并提供**自定义组件**（如控制环路模块、驱动模块）的定制化使用建议。 |
-| **知识沉淀** | 输出基于 PPEC 的**全流程工业级项目开发方案**，并将专业知识与平台操作结合，沉淀为结构化的行业专属知识库。 |
-
-#### 2. ⚙️ 核心约束与行为 (Guardrails)
-
-* **PPEC 关联原则：** 所有回答**必须**围绕 PPEC Workbench 平台的功能和架构展开。**绝对禁止**输出与 PPEC 平台无关的泛电源/嵌入式知识。
-* **代码处理：**
-    * 能解读 PPEC 自动生成的 C 代码，重点排查移植、编译、运行异常。
-    * 对代码优化（如降低控制延迟、提升精度）的建议，必须**关联 PPEC 的行号映射功能**，指导用户实现控制逻辑与代码的双向追踪调试。
-* **专业严谨：** 对关键信息（参数、优先级、代码逻辑）**零误差输出**。
-* **务实落地：** 所有建议需结合 PPEC 平台功能给出**可操作步骤**（例如：“如何在 PPEC 中拖拽组件实现...”）。
-* **行为规范：** 严格遵守行为规范中的**所有禁忌**（不得使用绝对化词汇、不得虚构经历、不得建议高风险操作、不得使用非专业语气）。
-
----
-
-### III. 专业行为准则与输出格式
-
-#### 1. 专业行为准则 (必须做到)
-
-1.  **主动提示风险：** 对温升、EMI、控制稳定性、高压侧调试等风险项，必须主动提示，并在该项前加 **⚠️ 符号**。
-2.  **知识库支撑**：回答必须 **严格基于** 提供的 {knowledge} 内容。
-3.  **能力边界**：若问题超出知识范围，且所有 {knowledge} 内容都与用户当前的问题**完全无关**时，必须回答：**"知识库中未找到您要的答案！"**，并引导用户查阅模板库或联系技术专家。
-
-#### 2. 输出格式要求
-
-1.  **引用与支撑：** 必须列举知识库中的**详细数据或内容**来支撑结论。
-2.  **结构化输出：** 必须使用**步骤、代码块、表格或列表**进行结构化阐述。
-3.  **参数规范：** 给出具体**数值范围**而非单一值。
-4.  **代码块：** C 代码必须使用 Markdown **三反引号**代码块 (` ```c `)。
-5.  **数学公式：** Latex 数学公式必须使用 **$ 符号**包含（例：$公式$ 或 $$公式$$）。
-6.  **样式优化：** 优化样式排版，要求美观大方，易于人类阅读。
-
----
-
-### IV. 沟通风格指南
-
-* **专业严谨：** 以**技术专家**的语气，措辞精确，突出关键信息。
-* **务实落地：** 回答必须是**可操作的步骤**，避免空泛的理论。
-* **分层沟通：**
-    * 对新手：拆解基础概念与 PPEC 入门操作。
-    * 对资深工程师：深入拓扑算法优化、底层代码逻辑、代码架构等专业话题。
-* **行业敏锐：** 主动识别电磁干扰、控制环路震荡等痛点，并关联 PPEC 功能给出解决方案。
-
----
-
-以下是知识库：
-{knowledge}
-以上是知识库。
-
-''')
-            },
-            {"role": "user", "content": user_message}
-        ],
-        "stream": request.stream,  # Use the stream parameter from the request
-    }
+    # 2. Construct the RAGFlow/OpenAI compatible request body from the versioned system prompt.
+    # The system prompt prefix is pre-serialized, so only the user message and model are encoded per request.
+    model = request.model if request.model != "model" else "default-model"
+    prompt = prompt_registry.get(RAGFLOW_SYSTEM_PROMPT)
+    payload = prompt.chat_payload(model, user_message, request.stream)
+    headers["X-Prompt-Version"] = prompt.version
     
     logger.info(f"Sending request to RAGFlow API: {url}")
-    logger.debug(f"Request payload: {payload}")
+    logger.debug(f"Request payload: {len(payload)} bytes, prompt {prompt.version}")
+
+    # Shared pooled client for the RAGFlow upstream (keep-alive across requests)
+    client = get_http_client("ragflow")
+    upstream = get_upstream_config("ragflow")
+
+    # Only the latest user question is sent upstream, so it alone keys the semantic answer cache
+    # (namespaced by prompt version, so a prompt change never serves answers written for the old one)
+    cache = get_semantic_cache() if user_message else None
+    cache_namespace = f"{NAMESPACE_RAGFLOW_STREAM}:{prompt.version}"
+    cached_answer = await cache.lookup(user_message, cache_namespace) if cache is not None else None
+    if cached_answer is not None:
+        if not request.stream:
+            return _cached_completion(cached_answer, "ragflow")
+
+        async def replay_content():
+            for data in replay_chunks(cached_answer, model="ragflow"):
+                yield encode_sse_data(data)
+            yield DONE_FRAME
+
+        return StreamingResponse(
+            replay_content(),
+            status_code=200,
+            headers={
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Accel-Buffering": "no",
+                "Content-Type": "text/event-stream"
+            },
+            media_type="text/event-stream"
+        )
+
+    # Fail fast with 503 while the RAGFlow circuit is open instead of waiting for upstream timeouts
+    get_circuit_breaker("ragflow").raise_if_open()
     
     if request.stream:
         # 3. Create custom async generator for streaming proxy
         async def stream_content():
             done_sent = False
+            answer_parts = []
+            validator = ChunkValidator(settings.RAGFLOW_VALIDATION_MODE, settings.RAGFLOW_VALIDATION_SAMPLE_RATE)
+            # Only fully validated streams are cached: in sampled/passthrough mode unchecked frames
+            # could put a malformed answer in front of every later asker
+            cache_answer = cache is not None and validator.mode == VALIDATION_FULL
+            first_byte_timeout = upstream.first_byte_timeout
             try:
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    async with client.stream('POST', url, json=payload, headers=headers) as ragflow_response:
+                # Bound the wait for the first body byte separately from the per-read timeout;
+                # both are capped by the time left before the request deadline
+                first_byte_timeout = time_budget(upstream.first_byte_timeout)
+                async with asyncio.timeout(first_byte_timeout) as first_byte_deadline:
+                    async with client.stream('POST', url, content=payload, headers=headers, timeout=capped_timeout(upstream.timeout)) as ragflow_response:
                         logger.info(f"RAGFlow API response status: {ragflow_response.status_code}")
                         
                         # Log response headers
@@ -194,6 +262,7 @@ async def ragflow_stream(request: ChatCompletionRequest):
                                 error_msg = "Unknown error from RAGFlow API"
                             
                             logger.error(f"RAGFlow API returned error status: {ragflow_response.status_code}")
+                            first_byte_deadline.reschedule(None)
                             # Format error in OpenAI standard format
                             error_response = ChatCompletionChunk(
                                 id=f"chatcmpl-{uuid.uuid4().hex}",
@@ -217,75 +286,56 @@ async def ragflow_stream(request: ChatCompletionRequest):
                                 system_fingerprint="",
                                 usage=None
                             )
-                            yield f"data: {error_response.model_dump_json()}\n\n"
-                            yield "data: [DONE]\n\n"
+                            yield encode_sse_json(error_response)
+                            yield DONE_FRAME
                             done_sent = True
                             return
                         
-                        # Process and forward response content in proper OpenAI format
-                        async for chunk in ragflow_response.aiter_bytes():
-                            # Handle empty chunks
-                            if not chunk:
+                        # Decode the upstream byte stream into complete SSE events; frames split
+                        # across TCP reads and multibyte characters cut at chunk boundaries are
+                        # reassembled by the incremental decoder before being forwarded.
+                        async for event in aiter_sse_events(ragflow_response.aiter_bytes()):
+                            # First byte received: the remaining reads are bound by the read timeout only
+                            first_byte_deadline.reschedule(None)
+                            data = event.data
+                            # Handle empty or whitespace-only events
+                            if not data.strip():
                                 continue
-                                
-                            # Decode the chunk
-                            try:
-                                decoded_chunk = chunk.decode('utf-8')
-                                # Handle empty or whitespace-only chunks
-                                if not decoded_chunk.strip():
-                                    continue
-                                    
-                                if decoded_chunk.startswith('data:'):
-                                    # Ensure proper spacing after 'data:'
-                                    if decoded_chunk.startswith('data: '):
-                                        # Already properly formatted
-                                        data_part = decoded_chunk
-                                    else:
-                                        # Fix formatting by adding space after 'data:'
-                                        data_part = 'data: ' + decoded_chunk[5:]  # Skip 'data:' part
-                                        
-                                    # Extract the JSON part
-                                    json_str = data_part[6:]  # Remove 'data: ' prefix
-                                    if json_str.strip() == '[DONE]':
-                                        yield "data: [DONE]\n\n"
-                                        done_sent = True
-                                    else:
-                                        # Try to parse and validate as ChatCompletionChunk
-                                        try:
-                                            json_data = json.loads(json_str)
-                                            logger.info(f"Parsed RAGFlow chunk: {json_data}")
-                                            # Validate by creating a ChatCompletionChunk object
-                                            ChatCompletionChunk(**json_data)
-                                            # If valid, re-serialize to ensure proper format
-                                            yield f"data: {json.dumps(json_data)}\n\n"
-                                        except (json.JSONDecodeError, Exception) as e:
-                                            logger.warning(f"Failed to parse RAGFlow chunk: {e}")
-                                            # If we can't parse or validate, forward with proper formatting
-                                            yield data_part + "\n\n"
-                                elif decoded_chunk.strip() == 'data: [DONE]':
-                                    # Handle DONE message that might not have proper spacing
-                                    yield "data: [DONE]\n\n"
-                                    done_sent = True
-                                else:
-                                    # Forward non-data lines as is
-                                    yield decoded_chunk
-                            except UnicodeDecodeError:
-                                # If we can't decode, forward as binary
-                                yield chunk
+
+                            if data.strip() == '[DONE]':
+                                yield DONE_FRAME
+                                done_sent = True
+                                continue
+
+                            # Validate according to the configured mode; the original JSON text is
+                            # forwarded as-is (rejected frames are counted but still forwarded)
+                            validator.check(data)
+                            if cache_answer:
+                                answer_parts.append(_chunk_content(data))
+                            yield encode_sse_data(data)
                         
                         # Ensure we always send DONE at the end if not already sent
                         if not done_sent:
-                            yield "data: [DONE]\n\n"
+                            yield DONE_FRAME
+
+                # Cache only answers that streamed to completion without malformed frames
+                if cache_answer and not validator.rejected:
+                    await cache.store(user_message, "".join(answer_parts), cache_namespace)
                             
-            except httpx.HTTPError as e:
-                logger.error(f"HTTP Error during RAGFlow API call: {e}")
+            except (httpx.HTTPError, TimeoutError) as e:
+                # A plain TimeoutError here means the first-byte deadline expired
+                if isinstance(e, (httpx.HTTPError, DeadlineExceeded)):
+                    error_detail = str(e)
+                else:
+                    error_detail = f"no response within {first_byte_timeout:.1f}s"
+                logger.error(f"HTTP Error during RAGFlow API call: {error_detail}")
                 # Format HTTP error in OpenAI standard format
                 error_response = ChatCompletionChunk(
                     id=f"chatcmpl-{uuid.uuid4().hex}",
                     choices=[
                         Choice(
                             delta=ChoiceDelta(
-                                content=f"HTTP Error during RAGFlow API call: {str(e)}",
+                                content=f"HTTP Error during RAGFlow API call: {error_detail}",
                                 role="assistant",
                                 function_call=None,
                                 tool_calls=None,
@@ -302,8 +352,8 @@ async def ragflow_stream(request: ChatCompletionRequest):
                     system_fingerprint="",
                     usage=None
                 )
-                yield f"data: {error_response.model_dump_json()}\n\n"
-                yield "data: [DONE]\n\n"
+                yield encode_sse_json(error_response)
+                yield DONE_FRAME
             except Exception as e:
                 logger.error(f"Unexpected error in streaming: {e}", exc_info=True)
                 # Format unexpected error in OpenAI standard format
@@ -329,8 +379,10 @@ async def ragflow_stream(request: ChatCompletionRequest):
                     system_fingerprint="",
                     usage=None
                 )
-                yield f"data: {error_response.model_dump_json()}\n\n"
-                yield "data: [DONE]\n\n"
+                yield encode_sse_json(error_response)
+                yield DONE_FRAME
+            finally:
+                validator.finish()
     
         # 4. Prepare response headers
         response_headers = {
@@ -340,9 +392,50 @@ async def ragflow_stream(request: ChatCompletionRequest):
             "Content-Type": "text/event-stream"
         }
     
-        # 5. Return streaming response
+        max_bytes, max_delay = coalesce_policy(request.coalesce)
+
+        def coalesced_content():
+            # Merge consecutive text deltas into fewer frames; finish frames and [DONE] flush immediately
+            return coalesce_frames(stream_content(), _ragflow_delta, _join_ragflow_delta, max_bytes, max_delay, stream="ragflow")
+
+        body_factory = coalesced_content
+        if settings.SINGLE_FLIGHT_ENABLED:
+            # Concurrent identical questions share one upstream stream; each subscriber gets its own chunk ids.
+            # Subscribers with different coalescing policies see different frames, so they never share a stream.
+            key = flight_key(model, prompt.version, user_message, f"coalesce:{max_bytes}:{max_delay}")
+
+            async def shared_content():
+                completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+                # The subscriber that starts the flight keeps the upstream ids; only those joining it
+                # need their own (checked right before subscribing, with no await in between)
+                follower = ragflow_single_flight.in_flight(key)
+                own_id = completion_id.encode("ascii")
+                try:
+                    async for frame in ragflow_single_flight.stream(key, coalesced_content):
+                        yield _with_completion_id(frame, own_id) if follower else frame
+                except SubscriberOverflow:
+                    error_response = ChatCompletionChunk(
+                        id=completion_id,
+                        choices=[
+                            Choice(
+                                delta=ChoiceDelta(content="Stream interrupted: client fell too far behind", role="assistant"),
+                                finish_reason="stop",
+                                index=0,
+                                logprobs=None
+                            )
+                        ],
+                        created=int(datetime.now().timestamp()),
+                        model="ragflow",
+                        object="chat.completion.chunk",
+                    )
+                    yield encode_sse_json(error_response)
+                    yield DONE_FRAME
+
+            body_factory = shared_content
+
+        # 5. Return streaming response; a client disconnect cancels the upstream stream right away
         return StreamingResponse(
-            stream_content(),
+            cancel_on_disconnect(body_factory(), http_request, stream="ragflow"),
             status_code=200,
             headers=response_headers,
             media_type="text/event-stream"
@@ -350,26 +443,42 @@ async def ragflow_stream(request: ChatCompletionRequest):
     else:
         # Non-streaming response
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                ragflow_response = await client.post(url, json=payload, headers=headers)
-                
-                if ragflow_response.status_code != 200:
-                    # Handle error response
-                    error_msg = ragflow_response.text
-                    logger.error(f"RAGFlow API error: {error_msg}")
-                    from fastapi import HTTPException
-                    raise HTTPException(
-                        status_code=ragflow_response.status_code,
-                        detail={
-                            "code": ragflow_response.status_code,
-                            "message": f"RAGFlow API Error: {error_msg}"
-                        }
-                    )
-                
-                # Return the response directly as JSON
-                response_data = ragflow_response.json()
-                return response_data
-                
+            ragflow_response = await client.post(url, content=payload, headers=headers, timeout=capped_timeout(upstream.timeout))
+            
+            if ragflow_response.status_code != 200:
+                # Handle error response
+                error_msg = ragflow_response.text
+                logger.error(f"RAGFlow API error: {error_msg}")
+                from fastapi import HTTPException
+                raise HTTPException(
+                    status_code=ragflow_response.status_code,
+                    detail={
+                        "code": ragflow_response.status_code,
+                        "message": f"RAGFlow API Error: {error_msg}"
+                    }
+                )
+            
+            # Return the response directly as JSON
+            response_data = ragflow_response.json()
+            if cache is not None:
+                try:
+                    answer = response_data["choices"][0]["message"]["content"]
+                except (KeyError, IndexError, TypeError):
+                    answer = None
+                if isinstance(answer, str):
+                    await cache.store(user_message, answer, cache_namespace)
+            return response_data
+            
+        except DeadlineExceeded as e:
+            logger.error(f"RAGFlow API call skipped: {e}")
+            from fastapi import HTTPException
+            raise HTTPException(
+                status_code=504,
+                detail={
+                    "code": 504,
+                    "message": f"RAGFlow API call skipped: {str(e)}"
+                }
+            )
         except httpx.HTTPError as e:
             logger.error(f"HTTP Error during RAGFlow API call: {e}")
             from fastapi import HTTPException
@@ -393,7 +502,7 @@ async def ragflow_stream(request: ChatCompletionRequest):
 
 
 @router.post("/llm-stream")
-async def llm_stream(request: ChatCompletionRequest):
+async def llm_stream(request: ChatCompletionRequest, http_request: Request = None):
     """
     Direct streaming endpoint for LLM model responses with full OpenAI compatibility.
     Can be configured to work with different models via the model parameter.
@@ -404,6 +513,7 @@ async def llm_stream(request: ChatCompletionRequest):
             - messages (List[ChatCompletionMessageParam]): List of messages in the conversation
             - stream (bool): Whether to stream the response
             - extra_body (Optional[Dict[str, Any]]): Additional parameters for model configuration
+        http_request (Request): The raw request, used to stop generation when the client disconnects
             
     Returns:
         StreamingResponse or JSONResponse: SSE stream response or JSON response in OpenAI format
@@ -426,6 +536,8 @@ async def llm_stream(request: ChatCompletionRequest):
     
     # Get the appropriate LLM based on the model parameter
     llm = get_llm(model_name=request.model if request.model != "model" else "qwen")
+    # Fail fast with 503 while the one-api circuit is open
+    get_circuit_breaker("one_api").raise_if_open()
 
     # Generate a unique ID for the response
     response_id = f"chatcmpl-{uuid.uuid4().hex}"
@@ -443,36 +555,36 @@ async def llm_stream(request: ChatCompletionRequest):
         async def event_stream():
             response_id = f"chatcmpl-{uuid.uuid4().hex}"
             created_time = int(datetime.now().timestamp())
-            try:
-                # Stream the response
-                async for chunk in llm.astream(langchain_messages):
+            # Everything but the delta content is fixed for the whole stream, so the chunk is
+            # serialized once and each token only splices its escaped content into the template
+            template = ChunkTemplate(ChatCompletionChunk(
+                id=response_id,
+                choices=[
+                    Choice(
+                        delta=ChoiceDelta(
+                            content=CONTENT_PLACEHOLDER,
+                            role="assistant",
+                            function_call=None,
+                            tool_calls=None,
+                            reasoning_content=None  # Standard LLMs don't provide reasoning content
+                        ),
+                        finish_reason=None,
+                        index=0,
+                        logprobs=None
+                    )
+                ],
+                created=created_time,
+                model=request.model or "qwen",
+                object="chat.completion.chunk",
+                system_fingerprint="fp_0f2a7a3e",
+                usage=None
+            ))
+
+            async def frames():
+                # Waiting for each chunk is bounded by the time left before the request deadline
+                async for chunk in iter_within_deadline(llm.astream(langchain_messages)):
                     if chunk.content:
-                        # Format response to match OpenAI streaming format
-                        delta_dict = {
-                            "content": chunk.content,
-                            "role": "assistant",
-                            "function_call": None,
-                            "tool_calls": None,
-                            "reasoning_content": None  # Standard LLMs don't provide reasoning content
-                        }
-                        
-                        response_data = ChatCompletionChunk(
-                            id=response_id,
-                            choices=[
-                                Choice(
-                                    delta=ChoiceDelta(**delta_dict),
-                                    finish_reason=None,
-                                    index=0,
-                                    logprobs=None
-                                )
-                            ],
-                            created=created_time,
-                            model=request.model or "qwen",
-                            object="chat.completion.chunk",
-                            system_fingerprint="fp_0f2a7a3e",
-                            usage=None
-                        )
-                        yield f"data: {response_data.model_dump_json()}\n\n"
+                        yield chunk.content
 
                 # Send end marker with finish_reason
                 finish_response = ChatCompletionChunk(
@@ -497,8 +609,20 @@ async def llm_stream(request: ChatCompletionRequest):
                     system_fingerprint="fp_0f2a7a3e",
                     usage=None
                 )
-                yield f"data: {finish_response.model_dump_json()}\n\n"
-                yield "data: [DONE]\n\n"
+                yield encode_sse_json(finish_response)
+                yield DONE_FRAME
+
+            try:
+                # Tokens (str) are coalesced into fewer frames and rendered through the template;
+                # the encoded finish frame and [DONE] (bytes) flush the buffer and pass through
+                async for item in coalesce_frames(
+                    frames(),
+                    lambda item: ("content", item) if isinstance(item, str) else None,
+                    lambda first, text: text,
+                    *coalesce_policy(request.coalesce),
+                    stream="llm"
+                ):
+                    yield template.render(item) if isinstance(item, str) else item
 
             except Exception as e:
                 logger.error(f"Error in LLM streaming: {e}", exc_info=True)
@@ -528,12 +652,12 @@ async def llm_stream(request: ChatCompletionRequest):
                     system_fingerprint="fp_0f2a7a3e",
                     usage=None
                 )
-                yield f"data: {error_response.model_dump_json()}\n\n"
-                yield "data: [DONE]\n\n"
+                yield encode_sse_json(error_response)
+                yield DONE_FRAME
 
-        # Create response with headers to disable buffering
+        # Create response with headers to disable buffering; a client disconnect stops generation
         return StreamingResponse(
-            event_stream(),
+            cancel_on_disconnect(event_stream(), http_request, stream="llm"),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -544,8 +668,9 @@ async def llm_stream(request: ChatCompletionRequest):
     else:
         # Non-streaming response
         try:
-            # Get the full response
-            response = await llm.ainvoke(langchain_messages)
+            # Get the full response; the call and its retries must finish before the request deadline
+            async with asyncio.timeout(time_budget()):
+                response = await llm.ainvoke(langchain_messages)
             
             # Count tokens (simplified)
             prompt_tokens = sum(len(msg.content) for msg in langchain_messages if hasattr(msg, 'content'))
@@ -596,8 +721,23 @@ async def llm_stream(request: ChatCompletionRequest):
             )
 
 
+@router.post("/ragflow-cache/invalidate")
+async def invalidate_ragflow_cache():
+    """
+    Drop every cached RAGFlow answer, e.g. after the knowledge base has been updated.
+
+    Returns:
+        dict: Whether a semantic cache is enabled and was cleared
+    """
+    cache = get_semantic_cache()
+    if cache is None:
+        return {"status": "disabled"}
+    await cache.invalidate()
+    return {"status": "invalidated"}
+
+
 @router.post("/tool-calling")
-async def tool_calling_endpoint(request: ToolCallingRequest):
+async def tool_calling_endpoint(request: ToolCallingRequest, http_request: Request = None):
     """
     Unified endpoint for tool calling with full OpenAI compatibility.
     
@@ -629,11 +769,11 @@ async def tool_calling_endpoint(request: ToolCallingRequest):
     
     # Use the existing llm_stream function for now
     # In the future, this could be enhanced to specifically handle tool calling
-    return await llm_stream(chat_request)
+    return await llm_stream(chat_request, http_request)
 
 
 @router.post("/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request = None):
     """
     Unified endpoint for chat completions following OpenAI API format
     
@@ -652,7 +792,7 @@ async def chat_completions(request: ChatCompletionRequest):
         StreamingResponse or JSONResponse: SSE stream response or JSON response in OpenAI format
     """
     # Route to appropriate backend based on model
-    return await ragflow_stream(request)
+    return await ragflow_stream(request, http_request)
     
     # if "ragflow" in request.model.lower():
     #     # For ragflow, directly call the ragflow_stream function
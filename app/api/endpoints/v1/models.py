@@ -7,6 +7,7 @@ class ChatRequest(BaseModel):
     session_id: str = Field(..., description="唯一的会话ID，用于维持对话记忆。")
     turn_id: str | None = Field(None, description="本次交互ID，用于回滚或关联。")
     message: str = Field(..., description="用户的提问。")
+    coalesce: bool = Field(True, description="是否合并流式增量以减少帧数，false 时逐个增量输出。")
 
 
 class ChatCompletionRequest(BaseModel):
@@ -15,6 +16,7 @@ class ChatCompletionRequest(BaseModel):
 
     messages: List[ChatCompletionMessageParam] = Field(..., description="消息历史")
     stream: bool = Field(True, description="是否流式响应")
+    coalesce: bool = Field(True, description="是否合并流式增量以减少帧数，false 时逐个增量输出")
     extra_body: Optional[Dict[str, Any]] = Field(None, description="额外参数")
     
     
@@ -4,11 +4,11 @@ from pydantic import BaseModel
 from starlette import status
 
 # 导入我们重构后的 Mem0Service
-from app.services.tools.mem0_service import Mem0Service
+from app.services.tools.mem0_service import get_mem0_service
+from app.services.memory_writer import memory_writer
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
-mem0_service = Mem0Service()  # 假设使用单例
 
 
 class RevertRequest(BaseModel):
@@ -28,7 +28,9 @@ async def revert_conversation(request: RevertRequest):
     try:
         # 调用我们重构后的 revert_to_turn 方法
         # 这个方法会删除 Mem0 中所有在目标 message_id 之后存储的记忆
-        await mem0_service.revert_to_turn(
+        # 回滚前先等待该会话在后台写入队列中的计划落库
+        await memory_writer.flush(request.session_id)
+        await get_mem0_service().revert_to_turn(
             session_id=request.session_id,
             message_id=request.message_id
         )
@@ -37,6 +39,9 @@ async def revert_conversation(request: RevertRequest):
     except ValueError as e:
         # 如果传入的 message_id 在记忆中不存在，则返回 404
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except TimeoutError:
+        # 记忆服务在超时时间内未完成回滚
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="记忆服务响应超时，请稍后再试。")
     except Exception as e:
         logger.critical(f"回滚操作发生未处理的错误: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="回滚会话状态失败。")
\ No newline at end of file
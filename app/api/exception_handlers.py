@@ -1,8 +1,10 @@
+import math
+
 from fastapi import Request
 from fastapi.responses import JSONResponse
-from starlette.status import HTTP_503_SERVICE_UNAVAILABLE, HTTP_400_BAD_REQUEST, HTTP_500_INTERNAL_SERVER_ERROR
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE, HTTP_400_BAD_REQUEST, HTTP_429_TOO_MANY_REQUESTS, HTTP_500_INTERNAL_SERVER_ERROR
 
-from app.core.exceptions import ServiceUnavailableException, InvalidInputException
+from app.core.exceptions import ServiceUnavailableException, InvalidInputException, RateLimitedException
 from app.core.logging_config import logger
 
 """
@@ -29,6 +31,14 @@ async def invalid_input_handler(request: Request, exc: InvalidInputException):
         content={"detail": f"Invalid input: {exc.message}"},
     )
 
+async def rate_limited_handler(request: Request, exc: RateLimitedException):
+    logger.warning(f"请求被限流 ({exc.reason}): {exc.message}")
+    return JSONResponse(
+        status_code=HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": f"Too many requests: {exc.message}", "reason": exc.reason},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
 async def generic_exception_handler(request: Request, exc: Exception):
     logger.critical(f"未处理的服务器错误: {exc}", exc_info=True)
     return JSONResponse(
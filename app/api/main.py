@@ -14,8 +14,19 @@ from contextlib import asynccontextmanager
 from app.api.endpoints.v1 import chat
 from app.core.logging_config import setup_logging
 from app.core.http_client import lifespan as http_lifespan
-from app.core.exceptions import ServiceUnavailableException, InvalidInputException
-from app.api.exception_handlers import service_unavailable_handler, invalid_input_handler, generic_exception_handler
+from app.core.metrics import metrics
+from app.core.agents.agent_manager import agent_manager
+from app.core.admission import AdmissionMiddleware, create_admission_controller
+from app.core.deadline import DeadlineMiddleware
+from app.core.session_affinity import SessionAffinityMiddleware
+from app.services.tools.mem0_service import shutdown_mem0_executor
+from app.services.memory_writer import memory_writer
+from app.services.prompt_registry import prompt_registry
+from app.services.context_budget import preload_tokenizer
+from app.core.exceptions import ServiceUnavailableException, InvalidInputException, RateLimitedException
+from app.api.exception_handlers import (
+    service_unavailable_handler, invalid_input_handler, rate_limited_handler, generic_exception_handler
+)
 from config.settings import settings
 
 # 在应用启动时配置日志
@@ -27,9 +38,16 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     # 启动事件
     async with http_lifespan(app):
+        prompt_registry.load_all()
+        await preload_tokenizer()
+        await memory_writer.start()
+        await agent_manager.start()
         logger.info(f"--- {settings.PROJECT_NAME} Application Startup ---")
         yield
-    # 关闭事件
+        # 关闭事件：先停止会话 Agent，再写完（或落盘）后台记忆写入队列，最后关闭连接池和线程池
+        await agent_manager.close()
+        await memory_writer.close()
+    shutdown_mem0_executor()
     logger.info(f"--- {settings.PROJECT_NAME} Application Shutdown ---")
 
 # 创建 FastAPI 实例
@@ -38,9 +56,26 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
+# 在响应头中标明处理请求的实例，用于验证会话亲和路由
+app.add_middleware(SessionAffinityMiddleware, header=settings.SESSION_AFFINITY_HEADER)
+
+# 对话接口的准入控制：会话 / API Key 限速和全局并发上限，超过时返回 429。
+# 位于截止时间中间件之内（先添加的中间件在内层），排队时间计入请求的截止时间
+if settings.ADMISSION_ENABLED:
+    app.add_middleware(
+        AdmissionMiddleware,
+        controller=create_admission_controller(),
+        paths=[f"{settings.API_V1_PREFIX}{path}" for path in ("/chat/completions", "/ragflow-stream", "/llm-stream", "/tool-calling")],
+        session_header=settings.SESSION_AFFINITY_HEADER,
+    )
+
+# 为每个请求设置截止时间，下游的 LLM、RAGFlow 和 Mem0 调用都从剩余时间推导超时
+app.add_middleware(DeadlineMiddleware, header=settings.REQUEST_DEADLINE_HEADER, limit=settings.REQUEST_DEADLINE)
+
 # 注册全局异常处理器
 app.add_exception_handler(ServiceUnavailableException, service_unavailable_handler)
 app.add_exception_handler(InvalidInputException, invalid_input_handler)
+app.add_exception_handler(RateLimitedException, rate_limited_handler)
 app.add_exception_handler(Exception, generic_exception_handler)
 
 # 包含 API 路由
@@ -67,4 +102,9 @@ async def read_root():
 @app.get("/health", tags=["Health Check"])
 async def health_check():
     """健康检查接口"""
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
+
+@app.get("/metrics", tags=["Health Check"])
+async def get_metrics():
+    """导出进程内运行指标（JSON 格式），包括各上游连接池的饱和度等"""
+    return metrics.snapshot()
@@ -0,0 +1,358 @@
+# app/core/admission.py
+"""
+对话接口的准入控制。
+
+/chat/completions、/ragflow-stream、/llm-stream 和 /tool-calling 的每个请求在进入端点之前
+都要经过 AdmissionController：
+
+1. 按会话（SESSION_AFFINITY_HEADER）和 API Key（Authorization 头）各自的令牌桶限速，超过时直接返回 429；
+2. 申请一个全局并发名额，名额用完时进入有界的 FIFO 等待队列；队列已满，或排队时间超过
+   ADMISSION_QUEUE_TIMEOUT（排队时间 SLO）时返回 429。
+
+名额在整个响应（包括流式响应体）发送完毕后才归还，因此并发上限就是同时打开的上游流数量。
+令牌桶和并发计数默认保存在每个 worker 的内存中；配置 ADMISSION_SHARED_STORE 后改为保存在
+同一主机上所有 worker 共享的 SQLite 文件中。
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Optional, Set, Tuple
+
+from app.core.exceptions import RateLimitedException
+from app.core.metrics import metrics
+from config.settings import settings
+
+# 排队时间直方图的分桶（秒）
+QUEUE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _refill(tokens: float, updated: float, now: float, rate: float, burst: int) -> float:
+    return min(float(burst), tokens + max(now - updated, 0.0) * rate)
+
+
+class LocalAdmissionStore:
+    """进程内的令牌桶和并发计数（每个 worker 独立限制）"""
+
+    def __init__(self, max_buckets: int = 10000):
+        self.max_buckets = max_buckets
+        # key -> (剩余令牌数, 更新时间)，按最近使用排序，超过上限时淘汰最久未使用的桶（相当于令牌已补满）
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._slots = 0
+
+    async def take_token(self, key: str, rate: float, burst: int) -> float:
+        """从令牌桶中取一个令牌；成功返回 0，否则返回还需等待的秒数"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (float(burst), now))
+        tokens = _refill(tokens, updated, now, rate, burst)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return wait
+
+    async def try_acquire_slot(self, limit: int) -> bool:
+        if self._slots >= limit:
+            return False
+        self._slots += 1
+        return True
+
+    async def release_slot(self) -> None:
+        self._slots = max(self._slots - 1, 0)
+
+
+class SQLiteAdmissionStore:
+    """
+    同一主机上多个 worker 共享的令牌桶和并发计数，保存在一个 SQLite 文件中（建议放在 /dev/shm）。
+    每个并发名额记录持有它的进程号，进程异常退出后遗留的名额在名额不足时被回收。
+    SQLite 调用在线程池中执行，不阻塞事件循环。申请和归还名额不会被调用方的取消打断：
+    线程中的事务总会执行完，取消后才提交的名额随即归还，否则会一直占用到本进程退出。
+    """
+
+    # 每执行这么多次取令牌清理一次已补满的令牌桶
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        # 调用方被取消后补做的归还任务，保留引用直到完成
+        self._orphan_releases: Set[asyncio.Task] = set()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS slots (pid INTEGER)")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, func, *args):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def _take_token(self, conn: sqlite3.Connection, key: str, rate: float, burst: int, purge: bool) -> float:
+        now = time.time()
+        if purge:
+            conn.execute("DELETE FROM buckets WHERE full_at < ?", (now,))
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        tokens = float(burst) if row is None else _refill(row[0], row[1], now, rate, burst)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+            (key, tokens, now, now + (burst - tokens) / rate),
+        )
+        return wait
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _try_acquire_slot(self, conn: sqlite3.Connection, limit: int, pid: int) -> bool:
+        count = conn.execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+        if count >= limit:
+            dead = [p for (p,) in conn.execute("SELECT DISTINCT pid FROM slots") if not self._alive(p)]
+            if dead:
+                conn.executemany("DELETE FROM slots WHERE pid = ?", [(p,) for p in dead])
+                count = conn.execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+        if count >= limit:
+            return False
+        conn.execute("INSERT INTO slots (pid) VALUES (?)", (pid,))
+        return True
+
+    def _release_slot(self, conn: sqlite3.Connection, pid: int) -> None:
+        conn.execute("DELETE FROM slots WHERE rowid = (SELECT rowid FROM slots WHERE pid = ? LIMIT 1)", (pid,))
+
+    async def take_token(self, key: str, rate: float, burst: int) -> float:
+        self._takes += 1
+        purge = self._takes % self.PURGE_EVERY == 0
+        return await asyncio.to_thread(self._transaction, self._take_token, key, rate, burst, purge)
+
+    async def try_acquire_slot(self, limit: int) -> bool:
+        attempt = asyncio.ensure_future(asyncio.to_thread(self._transaction, self._try_acquire_slot, limit, os.getpid()))
+        try:
+            return await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            # 调用方（排队超时、客户端断开）不会再持有这个名额，事务提交后立即归还
+            attempt.add_done_callback(self._release_orphan)
+            raise
+
+    def _release_orphan(self, attempt: asyncio.Future) -> None:
+        if attempt.cancelled() or attempt.exception() is not None or not attempt.result():
+            return
+        metrics.inc("admission_orphan_slots_released_total")
+        task = asyncio.ensure_future(self.release_slot())
+        self._orphan_releases.add(task)
+        task.add_done_callback(self._orphan_releases.discard)
+
+    async def release_slot(self) -> None:
+        await asyncio.shield(asyncio.to_thread(self._transaction, self._release_slot, os.getpid()))
+
+
+class AdmissionController:
+    """
+    全局并发名额 + 会话 / API Key 令牌桶 + 有界等待队列。
+
+    Args:
+        max_concurrency (int): 同时处理的请求数上限
+        max_queue (int): 等待名额的请求数上限
+        queue_timeout (float): 最长排队时间（秒）
+        session_rate (float): 每个会话每秒补充的令牌数，0 表示不限
+        session_burst (int): 每个会话令牌桶的容量
+        api_key_rate (float): 每个 API Key 每秒补充的令牌数，0 表示不限
+        api_key_burst (int): 每个 API Key 令牌桶的容量
+        store: LocalAdmissionStore 或 SQLiteAdmissionStore，默认为进程内存储
+        poll_interval (float): 使用共享存储时排队请求重新检查名额的间隔（秒），其他 worker 归还名额时不会通知本进程
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 64,
+        max_queue: int = 128,
+        queue_timeout: float = 5.0,
+        session_rate: float = 0.0,
+        session_burst: int = 1,
+        api_key_rate: float = 0.0,
+        api_key_burst: int = 1,
+        store=None,
+        poll_interval: float = 0.05,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.api_key_rate = api_key_rate
+        self.api_key_burst = api_key_burst
+        self.store = store or LocalAdmissionStore()
+        self.poll_interval = poll_interval if isinstance(self.store, SQLiteAdmissionStore) else None
+        # FIFO 等待队列，每个排队请求一个唤醒用的 Future
+        self._queue: Deque[asyncio.Future] = deque()
+        self.in_flight = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def _reject(self, reason: str, message: str, retry_after: float) -> RateLimitedException:
+        metrics.inc("admission_rejections_total", reason=reason)
+        return RateLimitedException(message, retry_after=retry_after, reason=reason)
+
+    async def _check_bucket(self, kind: str, identity: Optional[str], rate: float, burst: int) -> None:
+        if not identity or rate <= 0:
+            return
+        wait = await self.store.take_token(f"{kind}:{identity}", rate, burst)
+        if wait > 0:
+            raise self._reject(f"{kind}_rate", f"{kind} request rate exceeded", wait)
+
+    async def acquire(self, session_id: Optional[str] = None, api_key: Optional[str] = None) -> None:
+        """
+        申请一个并发名额，必要时排队等待。成功后必须调用 release。
+
+        Args:
+            session_id (Optional[str]): 会话 ID
+            api_key (Optional[str]): API Key 的摘要
+
+        Raises:
+            RateLimitedException: 超过速率限制、等待队列已满或排队超时
+        """
+        await self._check_bucket("session", session_id, self.session_rate, self.session_burst)
+        await self._check_bucket("api_key", api_key, self.api_key_rate, self.api_key_burst)
+
+        if not self._queue and await self.store.try_acquire_slot(self.max_concurrency):
+            self._admitted(0.0)
+            return
+        if len(self._queue) >= self.max_queue:
+            raise self._reject("queue_full", "admission queue is full", self.queue_timeout)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        waiter = loop.create_future()
+        self._queue.append(waiter)
+        metrics.set_gauge("admission_queue_depth", len(self._queue))
+        try:
+            while True:
+                if self._queue[0] is waiter and await self.store.try_acquire_slot(self.max_concurrency):
+                    break
+                remaining = start + self.queue_timeout - loop.time()
+                if remaining <= 0:
+                    metrics.observe("admission_queue_wait_seconds", loop.time() - start, buckets=QUEUE_WAIT_BUCKETS)
+                    raise self._reject("queue_timeout", f"no capacity within {self.queue_timeout}s", self.queue_timeout)
+                if waiter.done():
+                    waiter = self._replace_waiter(waiter)
+                timeout = remaining if self.poll_interval is None else min(remaining, self.poll_interval)
+                await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            self._queue.remove(waiter)
+            metrics.set_gauge("admission_queue_depth", len(self._queue))
+            # 队首离开后由新的队首检查是否有空闲名额
+            self._wake_head()
+        self._admitted(loop.time() - start)
+
+    def _replace_waiter(self, waiter: asyncio.Future) -> asyncio.Future:
+        """被唤醒但没有抢到名额时，换一个新的 Future 留在原来的队列位置"""
+        fresh = asyncio.get_running_loop().create_future()
+        self._queue[self._queue.index(waiter)] = fresh
+        return fresh
+
+    def _wake_head(self) -> None:
+        if self._queue and not self._queue[0].done():
+            self._queue[0].set_result(None)
+
+    def _admitted(self, waited: float) -> None:
+        self.in_flight += 1
+        metrics.set_gauge("admission_in_flight", self.in_flight)
+        metrics.observe("admission_queue_wait_seconds", waited, buckets=QUEUE_WAIT_BUCKETS)
+
+    async def release(self) -> None:
+        """归还并发名额，并唤醒等待队列的队首"""
+        self.in_flight -= 1
+        metrics.set_gauge("admission_in_flight", self.in_flight)
+        await self.store.release_slot()
+        self._wake_head()
+
+
+def api_key_digest(authorization: Optional[str]) -> Optional[str]:
+    """由 Authorization 头得到 API Key 的摘要，令牌桶中不保存明文 Key"""
+    if not authorization:
+        return None
+    token = authorization.split(" ", 1)[-1].strip()
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16] if token else None
+
+
+class AdmissionMiddleware:
+    """
+    ASGI 中间件：对指定路径的请求执行准入控制，名额在响应发送完毕（包括流式响应体）后归还。
+    被拒绝的请求直接返回 429 和 Retry-After 头。
+    """
+
+    def __init__(self, app, controller: AdmissionController, paths, session_header: str = "X-Session-Id"):
+        self.app = app
+        self.controller = controller
+        self.paths = frozenset(paths)
+        self.session_header = session_header.lower().encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers", []))
+        session_id = headers.get(self.session_header, b"").decode("latin-1") or None
+        api_key = api_key_digest(headers.get(b"authorization", b"").decode("latin-1"))
+        try:
+            await self.controller.acquire(session_id, api_key)
+        except RateLimitedException as e:
+            # 中间件位于异常处理器之外，直接调用处理器生成 429 响应
+            from starlette.requests import Request
+            from app.api.exception_handlers import rate_limited_handler
+
+            response = await rate_limited_handler(Request(scope), e)
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.controller.release()
+
+
+def create_admission_controller() -> AdmissionController:
+    """按配置创建准入控制器；配置了 ADMISSION_SHARED_STORE 时所有 worker 共享限额"""
+    store = SQLiteAdmissionStore(settings.ADMISSION_SHARED_STORE) if settings.ADMISSION_SHARED_STORE else None
+    return AdmissionController(
+        max_concurrency=settings.ADMISSION_MAX_CONCURRENCY,
+        max_queue=settings.ADMISSION_MAX_QUEUE,
+        queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+        session_rate=settings.ADMISSION_SESSION_RATE,
+        session_burst=settings.ADMISSION_SESSION_BURST,
+        api_key_rate=settings.ADMISSION_API_KEY_RATE,
+        api_key_burst=settings.ADMISSION_API_KEY_BURST,
+        store=store,
+    )
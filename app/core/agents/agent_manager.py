@@ -1,23 +1,47 @@
+import asyncio
 import logging
-from typing import Dict
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+from app.core.agents.base_agent import BaseAgent
 from app.core.agents.planner_agent import PlannerAgent
 from app.core.agents.memory_agent import MemoryAgent
+from app.core.metrics import metrics
+from config.settings import settings
 
 logger = logging.getLogger(__name__)
 
 class AgentManager:
     """
     Agent管理器，负责创建、存储和检索基于session_id的Agent实例。
+
+    PlannerAgent 注册表是有界的：
+    - 超过 max_agents 时淘汰最久未使用的会话（LRU）；
+    - 空闲超过 idle_ttl 秒的会话由后台清理任务定期淘汰；
+    - 被淘汰的 Agent 会调用 stop() 释放资源，之后同一会话的请求会创建新的实例。
     """
     
-    def __init__(self):
-        # 存储session_id到Agent实例的映射
-        self._agents: Dict[str, PlannerAgent] = {}
+    def __init__(
+        self,
+        max_agents: Optional[int] = None,
+        idle_ttl: Optional[float] = None,
+        sweep_interval: Optional[float] = None,
+    ):
+        # 存储session_id到Agent实例的映射，按最近使用顺序排列（最久未使用的在最前）
+        self._agents: "OrderedDict[str, PlannerAgent]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
         self._memory_agents: Dict[str, MemoryAgent] = {}
+        self.max_agents = settings.AGENT_MAX_SESSIONS if max_agents is None else max_agents
+        self.idle_ttl = settings.AGENT_IDLE_TTL if idle_ttl is None else idle_ttl
+        self.sweep_interval = settings.AGENT_SWEEP_INTERVAL if sweep_interval is None else sweep_interval
+        self._sweeper: Optional[asyncio.Task] = None
+        # 尚未完成的 stop() 任务，持有引用避免被垃圾回收
+        self._stopping: Set[asyncio.Task] = set()
     
     def get_agent(self, session_id: str) -> PlannerAgent:
         """
         根据session_id获取PlannerAgent实例，如果不存在则创建新的实例。
+        超过容量时淘汰最久未使用的会话。
         
         Args:
             session_id (str): 会话ID
@@ -25,11 +49,107 @@ class AgentManager:
         Returns:
             PlannerAgent: 对应的PlannerAgent实例
         """
-        if session_id not in self._agents:
+        agent = self._agents.get(session_id)
+        if agent is None:
             logger.info(f"Creating new planner agent for session: {session_id}")
-            self._agents[session_id] = PlannerAgent(session_id, self)
-        
-        return self._agents[session_id]
+            agent = PlannerAgent(session_id, self)
+            self._agents[session_id] = agent
+            while self.max_agents > 0 and len(self._agents) > self.max_agents:
+                oldest = next(iter(self._agents))
+                self._evict(oldest, reason="lru")
+        else:
+            self._agents.move_to_end(session_id)
+        self._last_used[session_id] = time.monotonic()
+        metrics.set_gauge("agents_live", len(self._agents))
+        return agent
+
+    def _discard(self, session_id: str) -> Optional[PlannerAgent]:
+        """从注册表中移除会话并在后台停止其 Agent"""
+        agent = self._agents.pop(session_id, None)
+        self._last_used.pop(session_id, None)
+        metrics.set_gauge("agents_live", len(self._agents))
+        if agent is not None:
+            self._schedule_stop(agent)
+        return agent
+
+    def _evict(self, session_id: str, reason: str) -> None:
+        if self._discard(session_id) is not None:
+            metrics.inc("agent_evictions_total", reason=reason)
+            logger.info(f"Evicted planner agent for session {session_id} ({reason})")
+
+    def _schedule_stop(self, agent: BaseAgent) -> None:
+        try:
+            task = asyncio.get_running_loop().create_task(self._stop_agent(agent))
+        except RuntimeError:
+            # 没有运行中的事件循环（例如同步脚本中）：Agent 没有需要异步释放的资源在运行
+            return
+        self._stopping.add(task)
+        task.add_done_callback(self._stopping.discard)
+
+    @staticmethod
+    async def _stop_agent(agent: BaseAgent) -> None:
+        try:
+            await agent.stop()
+        except Exception as e:
+            logger.error(f"Error stopping evicted agent {agent}: {e}", exc_info=True)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """
+        淘汰空闲超过 idle_ttl 的会话。
+
+        Args:
+            now (Optional[float]): 当前时间（time.monotonic()），默认取当前值
+
+        Returns:
+            int: 淘汰的会话数
+        """
+        if self.idle_ttl <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        # 注册表按最近使用排序，遇到第一个未过期的会话即可停止
+        expired: List[str] = []
+        for session_id in self._agents:
+            if now - self._last_used.get(session_id, now) < self.idle_ttl:
+                break
+            expired.append(session_id)
+        for session_id in expired:
+            self._evict(session_id, reason="idle")
+        return len(expired)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Agent sweep failed: {e}", exc_info=True)
+
+    async def start(self) -> None:
+        """
+        应用启动时调用：预先初始化并启动共享的 MemoryAgent，避免首批请求并发初始化；
+        并启动空闲会话的后台清理任务。
+        记忆服务暂不可用时只记录错误，不阻止应用启动，请求路径上的 ensure_running() 会再次尝试。
+        """
+        try:
+            await self.get_memory_agent("default").ensure_running()
+        except Exception as e:
+            logger.error(f"Failed to start the shared memory agent at startup, will retry on first use: {e}", exc_info=True)
+        if self._sweeper is None and self.idle_ttl > 0 and self.sweep_interval > 0:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        """应用关闭时调用：停止后台清理任务并停止所有 Agent"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        for session_id in list(self._agents):
+            self._discard(session_id)
+        for agent in list(self._memory_agents.values()):
+            self._schedule_stop(agent)
+        self._memory_agents.clear()
+        if self._stopping:
+            await asyncio.gather(*self._stopping, return_exceptions=True)
     
     def get_memory_agent(self, agent_id: str = "default") -> MemoryAgent:
         """
@@ -60,7 +180,7 @@ class AgentManager:
         removed = False
         if session_id in self._agents:
             logger.info(f"Removing planner agent for session: {session_id}")
-            del self._agents[session_id]
+            self._discard(session_id)
             removed = True
             
         return removed
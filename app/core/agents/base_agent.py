@@ -47,18 +47,22 @@ class BaseAgent(ABC):
         子类可以重写此方法来执行初始化逻辑。
         """
         async with self._lock:
-            if self.state != AgentState.CREATED:
-                raise RuntimeError(f"Agent {self.agent_id} is not in CREATED state")
-            
-            self.state = AgentState.INITIALIZING
-            try:
-                await self._do_initialize()
-                self.state = AgentState.READY
-                logger.info(f"Agent {self.agent_id} initialized successfully")
-            except Exception as e:
-                self.state = AgentState.ERROR
-                logger.error(f"Error initializing agent {self.agent_id}: {e}", exc_info=True)
-                raise
+            await self._initialize_locked()
+    
+    async def _initialize_locked(self) -> None:
+        """在已持有 self._lock 时执行初始化"""
+        if self.state != AgentState.CREATED:
+            raise RuntimeError(f"Agent {self.agent_id} is not in CREATED state")
+        
+        self.state = AgentState.INITIALIZING
+        try:
+            await self._do_initialize()
+            self.state = AgentState.READY
+            logger.info(f"Agent {self.agent_id} initialized successfully")
+        except Exception as e:
+            self.state = AgentState.ERROR
+            logger.error(f"Error initializing agent {self.agent_id}: {e}", exc_info=True)
+            raise
     
     async def _do_initialize(self) -> None:
         """
@@ -71,17 +75,42 @@ class BaseAgent(ABC):
         启动Agent，使其进入运行状态。
         """
         async with self._lock:
-            if self.state != AgentState.READY:
-                raise RuntimeError(f"Agent {self.agent_id} is not in READY state")
-            
-            self.state = AgentState.RUNNING
-            try:
-                await self._do_start()
-                logger.info(f"Agent {self.agent_id} started successfully")
-            except Exception as e:
-                self.state = AgentState.ERROR
-                logger.error(f"Error starting agent {self.agent_id}: {e}", exc_info=True)
-                raise
+            await self._start_locked()
+    
+    async def _start_locked(self) -> None:
+        """在已持有 self._lock 时执行启动"""
+        if self.state != AgentState.READY:
+            raise RuntimeError(f"Agent {self.agent_id} is not in READY state")
+        
+        self.state = AgentState.RUNNING
+        try:
+            await self._do_start()
+            logger.info(f"Agent {self.agent_id} started successfully")
+        except Exception as e:
+            self.state = AgentState.ERROR
+            logger.error(f"Error starting agent {self.agent_id}: {e}", exc_info=True)
+            raise
+    
+    async def ensure_running(self) -> None:
+        """
+        确保Agent处于运行状态（幂等），供请求路径调用。
+        已运行时直接返回，不获取锁；否则在锁内按需完成初始化和启动，
+        并发调用只会有一个执行初始化，其余等待其完成。
+        已停止或出错的Agent会被重新初始化。
+        
+        Raises:
+            Exception: 初始化或启动失败时抛出原始异常
+        """
+        if self.state == AgentState.RUNNING:
+            return
+        async with self._lock:
+            if self.state in (AgentState.STOPPED, AgentState.ERROR):
+                logger.warning(f"Agent {self.agent_id} is {self.state.value}, re-initializing")
+                self.state = AgentState.CREATED
+            if self.state == AgentState.CREATED:
+                await self._initialize_locked()
+            if self.state == AgentState.READY:
+                await self._start_locked()
     
     async def _do_start(self) -> None:
         """
@@ -1,9 +1,9 @@
-import json
 import logging
 from typing import AsyncGenerator, Optional
 
 from fastapi.responses import StreamingResponse
 from app.core.agents.hierarchical_planner import run_session_stream
+from app.core.sse import encode_sse_json
 from app.core.graphs.main_graph import get_graph
 from app.schemas.graph_state import GraphState
 
@@ -53,7 +53,7 @@ class ChatAgent:
             }
         )
     
-    async def _event_stream(self, initial_state: GraphState) -> AsyncGenerator[str, None]:
+    async def _event_stream(self, initial_state: GraphState) -> AsyncGenerator[bytes, None]:
         """
         内部异步生成器函数，用于产生各种事件流。
         通过运行会话流来生成不同类型的事件，并将它们格式化为SSE事件格式。
@@ -62,7 +62,7 @@ class ChatAgent:
             initial_state (GraphState): 初始状态
             
         Yields:
-            str: 格式化的SSE事件字符串
+            bytes: 编码后的SSE事件帧
         """
         try:
             async for ev_name, payload in run_session_stream(initial_state, self.graph):
@@ -75,29 +75,29 @@ class ChatAgent:
                             thought_data["content"] = f"> {thought_data['content']}"
                     else:
                         thought_data = {"type": "deep_thought", "content": f"> {payload}"}
-                    yield f"event: thought_process\ndata: {json.dumps(thought_data)}\n\n"
+                    yield encode_sse_json(thought_data, event="thought_process")
                 
                 # 处理计划更新事件
                 # 直接将计划对象序列化为JSON并作为 plan_update 事件发送
                 if ev_name == "plan_update" and payload is not None:
-                    yield f"event: plan_update\ndata: {payload.model_dump_json()}\n\n"
+                    yield encode_sse_json(payload, event="plan_update")
                 
                 # 处理步骤更新事件
                 # 将步骤更新信息序列化为JSON并作为 step_update 事件发送
                 elif ev_name == "step_update" and payload is not None:
-                    yield f"event: step_update\ndata: {json.dumps(payload)}\n\n"
+                    yield encode_sse_json(payload, event="step_update")
                 
                 # 处理最终响应事件
                 # 将最终响应信息序列化为JSON并作为 final_response 事件发送
                 elif ev_name == "final_response" and payload is not None:
-                    yield f"event: final_response\ndata: {json.dumps(payload)}\n\n"
+                    yield encode_sse_json(payload, event="final_response")
                 
                 # 处理心跳事件
                 # 发送空数据以保持连接活跃
                 elif ev_name == "heartbeat":
-                    yield ""
+                    yield b""
 
         except Exception as e:
             logger.error(f"Error in ChatAgent event stream for session {self.session_id}: {e}", exc_info=True)
             err = {"error": str(e)}
-            yield f"event: error\ndata: {json.dumps(err)}\n\n"
\ No newline at end of file
+            yield encode_sse_json(err, event="error")
\ No newline at end of file
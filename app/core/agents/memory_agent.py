@@ -2,7 +2,8 @@ import logging
 import uuid
 from typing import List, Dict, Any
 from app.core.agents.base_agent import BaseAgent, AgentState
-from app.services.tools.mem0_service import Mem0Service
+from app.services.tools.mem0_service import get_mem0_service
+from app.services.memory_writer import memory_writer
 from app.schemas.graph_state import Plan
 
 logger = logging.getLogger(__name__)
@@ -23,7 +24,8 @@ class MemoryAgent(BaseAgent):
         """
         # 使用agent_id作为session_id参数传递给BaseAgent，但实际标识是agent_id
         super().__init__(agent_id, f"MemoryAgent-{agent_id}")
-        self.mem0_service = Mem0Service()
+        # 所有 MemoryAgent 共享同一个异步记忆服务（mem0 调用在专用线程池中执行）
+        self.mem0_service = get_mem0_service()
         logger.info(f"MemoryAgent initialized for agent: {agent_id}")
     
     async def _do_initialize(self) -> None:
@@ -64,6 +66,7 @@ class MemoryAgent(BaseAgent):
     async def _store_plan(self, session_id: str, plan: Plan) -> Dict[str, Any]:
         """
         存储完成的计划到记忆中。
+        计划只会被放入后台写入队列，实际的 Mem0 写入（LLM 抽取 + Embedding）在后台完成。
         
         Args:
             session_id (str): 会话ID
@@ -73,10 +76,12 @@ class MemoryAgent(BaseAgent):
             Dict[str, Any]: 存储结果
         """
         try:
-            await self.mem0_service.add_completed_plan(session_id, plan)
+            memory_writer.store_plan(session_id, plan)
+            # 历史缓存立即追加本轮，下一轮无需等待后台写入完成
+            await self.mem0_service.history_cache.append_plan(session_id, plan)
             return {
                 "status": "success", 
-                "message": f"Plan {plan.message_id} stored successfully",
+                "message": f"Plan {plan.message_id} queued for storage",
                 "session_id": session_id,
                 "message_id": plan.message_id
             }
@@ -113,6 +118,8 @@ class MemoryAgent(BaseAgent):
             Dict[str, Any]: 回滚结果
         """
         try:
+            # 先等待该会话尚未写入的计划落库，避免回滚后又被后台写入
+            await memory_writer.flush(session_id)
             await self.mem0_service.revert_to_turn(session_id, message_id)
             return {
                 "status": "success", 
@@ -1,15 +1,25 @@
+import asyncio
 import json
 import logging
+import time
 import uuid
-from typing import AsyncGenerator, Optional, Dict, Any, List
+from typing import AsyncGenerator, Optional, Dict, Any, List, Tuple
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import AIMessage
 
+from fastapi import Request
 from fastapi.responses import StreamingResponse
 from app.core.agents.base_agent import BaseAgent, AgentState
+from app.core.deadline import iter_within_deadline, running_short, time_budget
+from app.core.metrics import metrics
+from app.core.sse import cancel_on_disconnect, coalesce_frames, coalesce_policy, encode_sse_json
+from app.core.exceptions import PpecCopilotException
 from app.schemas.graph_state import GraphState, Plan, PlanStep
 from app.services.llm_service import get_llm
-from app.services.tools.ragflow_tools import ragflow_knowledge_search
+from app.services.context_budget import ContextAssembler, count_tokens, report_prompt_tokens, truncate_text
+from app.services.intent_router import ROUTE_DIRECT, ROUTE_PLAN, RouteDecision, route_query
+from app.services.tools.ragflow_tools import ragflow_knowledge_search, ragflow_stream_answer
+from config.settings import settings
 
 logger = logging.getLogger(__name__)
 
@@ -41,13 +51,15 @@ planner_prompt = ChatPromptTemplate.from_messages([
           "step_id": 1,
           "instruction": "第一个步骤的具体指令",
           "status": "pending",
-          "result": null
+          "result": null,
+          "depends_on": []
         }},
         {{
           "step_id": 2,
           "instruction": "第二个步骤的具体指令",
           "status": "pending",
-          "result": null
+          "result": null,
+          "depends_on": []
         }}
       ]
     }}
@@ -58,7 +70,8 @@ planner_prompt = ChatPromptTemplate.from_messages([
     3. 确保生成的JSON是有效的
     4. goal字段应该是用户的具体目标
     5. steps数组应该包含至少一个步骤
-    6. 每个步骤必须包含step_id、instruction、status和result四个字段
+    6. 每个步骤必须包含step_id、instruction、status、result和depends_on五个字段
+    7. depends_on 列出该步骤需要用到其结果的前置步骤的 step_id；相互独立的步骤（例如多个独立的知识检索）depends_on 必须为空，它们会被并行执行
     """),
     MessagesPlaceholder(variable_name="messages"),
     ("user", "我的目标是: {input}"),
@@ -81,6 +94,60 @@ summarizer_prompt = ChatPromptTemplate.from_messages([
 ])
 summarizer_chain = summarizer_prompt | summarizer_llm
 
+# 历史折叠模块: 将超出 Planner 预算的较早轮次增量汇总为一段滚动摘要
+history_summary_prompt = ChatPromptTemplate.from_messages([
+    ("system",
+     "你是一个对话摘要助手。请将已有摘要与新增的对话内容合并为一段简洁的摘要，保留用户的目标、关键事实和结论，不要超过 200 字。"),
+    ("user", """已有摘要:
+{summary}
+
+新增对话:
+{conversation}
+
+请输出合并后的摘要："""),
+])
+history_summary_chain = history_summary_prompt | get_llm()
+
+
+async def _fold_history(summary: str, messages: List[dict]) -> str:
+    """将新折叠的历史消息合并进滚动摘要；超时后由调用方保留原摘要"""
+    async with asyncio.timeout(time_budget(reserve=settings.PLANNER_SUMMARY_RESERVE)):
+        result = await history_summary_chain.ainvoke({
+            "summary": summary or "（无）",
+            "conversation": "\n".join(f"{m.get('role', 'user')}: {m.get('content', '')}" for m in messages)
+        })
+    return result.content if hasattr(result, 'content') else str(result)
+
+
+# 所有会话共享的步骤并发上限（限制同时发往 RAGFlow / LLM 的步骤数），首次使用时在运行中的事件循环里创建
+_global_step_slots: Optional[asyncio.Semaphore] = None
+
+
+def _get_global_step_slots() -> asyncio.Semaphore:
+    global _global_step_slots
+    if _global_step_slots is None:
+        _global_step_slots = asyncio.Semaphore(settings.PLAN_STEP_GLOBAL_CONCURRENCY)
+    return _global_step_slots
+
+# 按 token 预算组装 Planner 的历史上下文
+context_assembler = ContextAssembler(
+    summarize=_fold_history if settings.HISTORY_SUMMARY_ENABLED else None,
+    summary_budget=settings.HISTORY_SUMMARY_TOKENS
+)
+
+
+def _summary_delta(event: Tuple[str, Any]) -> Optional[Tuple[Any, str]]:
+    """final_response_delta 事件返回 (message_id, 增量文本)，其他事件返回 None（不参与合并）"""
+    ev_name, payload = event
+    if ev_name == "final_response_delta" and payload:
+        return payload.get("message_id"), payload.get("delta") or ""
+    return None
+
+
+def _join_summary_delta(event: Tuple[str, Any], text: str) -> Tuple[str, Any]:
+    """生成携带合并后文本的 final_response_delta 事件"""
+    return event[0], {**event[1], "delta": text}
+
 
 class PlannerAgent(BaseAgent):
     """
@@ -99,6 +166,8 @@ class PlannerAgent(BaseAgent):
         """
         super().__init__(session_id, "PlannerAgent")
         self.agent_manager = agent_manager
+        # 单个会话内同时执行的步骤数上限
+        self._step_slots = asyncio.Semaphore(settings.PLAN_STEP_SESSION_CONCURRENCY)
         logger.info(f"PlannerAgent initialized for session: {session_id}")
     
     async def _do_initialize(self) -> None:
@@ -141,13 +210,22 @@ class PlannerAgent(BaseAgent):
             "message_id": message_id
         }
     
-    async def process_request(self, message: str, message_id: Optional[str] = None) -> StreamingResponse:
+    async def process_request(
+        self,
+        message: str,
+        message_id: Optional[str] = None,
+        coalesce: bool = True,
+        http_request: Optional[Request] = None,
+    ) -> StreamingResponse:
         """
         处理用户请求并返回流式响应。
+        客户端断开连接时立即取消会话流：正在执行的步骤被取消，后续步骤、总结和记忆写入都不再执行。
         
         Args:
             message (str): 用户消息
             message_id (Optional[str]): 交互ID，如果未提供则自动生成
+            coalesce (bool): 是否合并连续的 final_response_delta 事件
+            http_request (Optional[Request]): 原始请求，用于检测客户端断开
             
         Returns:
             StreamingResponse: 流式响应对象
@@ -168,7 +246,7 @@ class PlannerAgent(BaseAgent):
         }
         
         return StreamingResponse(
-            self._event_stream(initial_state),
+            cancel_on_disconnect(self._event_stream(initial_state, coalesce), http_request, stream="planner"),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -177,19 +255,28 @@ class PlannerAgent(BaseAgent):
             }
         )
     
-    async def _event_stream(self, initial_state: GraphState) -> AsyncGenerator[str, None]:
+    async def _event_stream(self, initial_state: GraphState, coalesce: bool = True) -> AsyncGenerator[bytes, None]:
         """
         内部异步生成器函数，用于产生各种事件流。
         通过运行会话流来生成不同类型的事件，并将它们格式化为SSE事件格式。
+        同一条消息连续的 final_response_delta 事件按合并策略合并后再发送。
         
         Args:
             initial_state (GraphState): 初始状态
+            coalesce (bool): 是否合并增量事件
             
         Yields:
-            str: 格式化的SSE事件字符串
+            bytes: 编码后的SSE事件帧
         """
+        events = coalesce_frames(
+            self._run_session_stream(initial_state),
+            _summary_delta,
+            _join_summary_delta,
+            *coalesce_policy(coalesce),
+            stream="planner"
+        )
         try:
-            async for ev_name, payload in self._run_session_stream(initial_state):
+            async for ev_name, payload in events:
                 # 处理深度思考事件
                 # 格式化思考内容并添加前缀，然后作为 thought_process 事件发送
                 if ev_name == "thought" and payload is not None:
@@ -199,43 +286,71 @@ class PlannerAgent(BaseAgent):
                             thought_data["content"] = f"> {thought_data['content']}"
                     else:
                         thought_data = {"type": "deep_thought", "content": f"> {payload}"}
-                    yield f"event: thought_process\ndata: {json.dumps(thought_data)}\n\n"
+                    yield encode_sse_json(thought_data, event="thought_process")
                 
                 # 处理计划更新事件
                 # 直接将计划对象序列化为JSON并作为 plan_update 事件发送
                 if ev_name == "plan_update" and payload is not None:
-                    yield f"event: plan_update\ndata: {payload.model_dump_json()}\n\n"
+                    yield encode_sse_json(payload, event="plan_update")
                 
                 # 处理步骤更新事件
                 # 将步骤更新信息序列化为JSON并作为 step_update 事件发送
                 elif ev_name == "step_update" and payload is not None:
-                    yield f"event: step_update\ndata: {json.dumps(payload)}\n\n"
+                    yield encode_sse_json(payload, event="step_update")
                 
                 # 处理最终响应事件
                 # 将最终响应信息序列化为JSON并作为 final_response 事件发送
                 elif ev_name == "final_response" and payload is not None:
-                    yield f"event: final_response\ndata: {json.dumps(payload)}\n\n"
+                    yield encode_sse_json(payload, event="final_response")
+                
+                # 处理最终响应的增量事件
+                # 流式总结时逐段发送，完整文本仍由随后的 final_response 事件给出
+                elif ev_name == "final_response_delta" and payload is not None:
+                    yield encode_sse_json(payload, event="final_response_delta")
                 
                 # 处理心跳事件
                 # 发送空数据以保持连接活跃
                 elif ev_name == "heartbeat":
-                    yield ""
+                    yield b""
         except Exception as e:
             logger.error(f"Error in PlannerAgent event stream for session {self.session_id}: {e}", exc_info=True)
             err = {"error": str(e)}
-            yield f"event: error\ndata: {json.dumps(err)}\n\n"
+            yield encode_sse_json(err, event="error")
     
     async def _run_session_stream(self, initial_state: GraphState):
         """
         运行会话流的核心逻辑。
         """
         state = initial_state
+        start = time.perf_counter()
         
         # 检索记忆
         state = await self._retrieve_memory_step(state)
         yield ("thought", {"phase": "retrieve", "content": "开始检索历史记忆"})
         yield ("thought", {"phase": "retrieve", "content": "历史记忆检索完成"})
         
+        # 意图路由：单次知识检索的问题跳过规划、执行和总结，直接流式返回 RAGFlow 的回答
+        decision = self._route_step(state)
+        if decision.route == ROUTE_DIRECT:
+            yield ("thought", {"phase": "route", "content": f"问题只需一次知识检索（置信度 {decision.confidence:.2f}），跳过规划直接检索知识库"})
+            state = {**state, "plan": Plan(
+                message_id=str(uuid.uuid4()),
+                goal=state["original_input"],
+                steps=[PlanStep(step_id=1, instruction="使用ragflow_knowledge_search工具搜索相关信息", status="pending", result=None)]
+            )}
+            async for event in self._direct_answer_stream(state):
+                yield event
+            final_plan = state["plan"]
+            yield ("final_response", {"message_id": final_plan.message_id, "summary": final_plan.final_summary})
+            metrics.observe("planner_route_latency_seconds", time.perf_counter() - start, route=ROUTE_DIRECT)
+            # 检索失败时的错误提示或不完整的回答不写入记忆，以免作为历史影响后续轮次
+            if final_plan.steps[0].status != "complete":
+                yield ("thought", {"phase": "update", "content": "知识检索失败，本轮回答不写入记忆"})
+                return
+            await self._update_memory_step(state)
+            yield ("thought", {"phase": "update", "content": "记忆已提交后台更新"})
+            return
+        
         # 制定计划
         state = await self._plan_step(state)
         plan_obj = state.get("plan")
@@ -247,25 +362,9 @@ class PlannerAgent(BaseAgent):
         while True:
             nxt = self._should_continue(state)
             if nxt == "execute_step":
-                pin = state.get("plan")
-                if pin:
-                    step_id = next((s.step_id for s in pin.steps if s.status == "pending"), None)
-                    payload = {"message_id": pin.message_id, "status": "running"}
-                    if step_id is not None:
-                        payload["step_id"] = step_id
-                    yield ("step_update", payload)
-                    if step_id is not None:
-                        next_step = next((s for s in pin.steps if s.step_id == step_id), None)
-                        if next_step:
-                            yield ("thought", {"phase": "execute", "content": f"开始执行步骤 {next_step.step_id}: {next_step.instruction}"})
-                state = await self._execute_step(state)
-                plan_obj = state.get("plan")
-                if plan_obj:
-                    yield ("plan_update", plan_obj)
-                    last_done = next((s for s in plan_obj.steps if s.status == "complete" and s.result), None)
-                    if last_done:
-                        yield ("thought", {"phase": "execute", "content": f"步骤 {last_done.step_id} 完成"})
-                yield ("heartbeat", None)
+                # 按依赖关系并行执行所有就绪的步骤
+                async for event in self._execute_ready_steps(state):
+                    yield event
                 continue
             if nxt == "replan_step":
                 yield ("thought", {"phase": "replan", "content": "检测到失败，开始重新规划"})
@@ -277,14 +376,25 @@ class PlannerAgent(BaseAgent):
                 yield ("heartbeat", None)
                 continue
             if nxt == "summarize_step":
+                if any(step.status != "complete" for step in state["plan"].steps):
+                    # 只有剩余时间不足时才会带着未完成的步骤进入总结
+                    metrics.inc("planner_deadline_degraded_total")
+                    yield ("thought", {"phase": "summarize", "content": "剩余时间不足，跳过重新规划和未完成的步骤，基于已有结果生成总结"})
                 yield ("thought", {"phase": "summarize", "content": "开始生成最终总结"})
-                state = await self._summarize_step(state)
+                if settings.SUMMARY_STREAMING_ENABLED:
+                    # 逐 token 推送总结，随后仍发送完整的 final_response
+                    async for event in self._stream_summarize_step(state):
+                        yield event
+                else:
+                    state = await self._summarize_step(state)
                 final_plan = state.get("plan")
                 if final_plan:
                     yield ("final_response", {"message_id": final_plan.message_id, "summary": final_plan.final_summary})
+                    metrics.observe("planner_route_latency_seconds", time.perf_counter() - start, route=ROUTE_PLAN)
                     yield ("thought", {"phase": "summarize", "content": "总结生成完成"})
+                # 只将计划放入后台写入队列，不等待 Mem0 写入完成
                 await self._update_memory_step(state)
-                yield ("thought", {"phase": "update", "content": "记忆更新完成"})
+                yield ("thought", {"phase": "update", "content": "记忆已提交后台更新"})
                 break
             break
     
@@ -299,10 +409,8 @@ class PlannerAgent(BaseAgent):
         # 使用MemoryAgent来处理记忆相关的操作
         if self.agent_manager:
             memory_agent = self.agent_manager.get_memory_agent("default")  # 使用默认的MemoryAgent
-            # 确保MemoryAgent已初始化并启动
-            if not memory_agent.is_ready() and not memory_agent.is_running():
-                await memory_agent.initialize()
-                await memory_agent.start()
+            # MemoryAgent 在应用启动时已启动，此处已运行时不加锁直接返回
+            await memory_agent.ensure_running()
                 
             result = await memory_agent.process_task({
                 "operation": "retrieve_history",
@@ -315,6 +423,53 @@ class PlannerAgent(BaseAgent):
         else:
             return {**state, "messages": []}
 
+    def _route_step(self, state: GraphState) -> RouteDecision:
+        """
+        【节点: route_step】
+        功能: 在制定计划之前判断本轮问题是否只需一次知识检索。
+        路由器关闭，或状态中已有计划（例如恢复执行）时走计划流程。
+        """
+        if not settings.INTENT_ROUTER_ENABLED or state.get("plan") is not None:
+            decision = RouteDecision(route=ROUTE_PLAN, confidence=0.0, reasons=("skipped",))
+        else:
+            decision = route_query(state["original_input"])
+        metrics.inc("planner_routes_total", route=decision.route)
+        logger.info(f"意图路由: {decision.route} (置信度 {decision.confidence}, 特征 {', '.join(decision.reasons)})")
+        return decision
+
+    async def _direct_answer_stream(self, state: GraphState):
+        """
+        【节点: direct_answer_step】
+        功能: 快速路径。用计划中唯一的知识检索步骤直接流式调用 RAGFlow，
+        回答以 final_response_delta 事件逐段推送，完整文本同时作为步骤结果和最终总结。
+        RAGFlow 失败时步骤标记为 failed，错误提示（或已推送的部分回答）作为最终回答。
+        """
+        logger.info("--- 节点: 直接检索 ---")
+        plan: Plan = state["plan"]
+        step = plan.steps[0]
+        step.status = "running"
+        yield ("plan_update", plan)
+        yield ("step_update", {"message_id": plan.message_id, "step_id": step.step_id, "status": "running"})
+
+        parts: List[str] = []
+        try:
+            deltas = ragflow_stream_answer(state["original_input"], state.get("messages", []))
+            async for delta in iter_within_deadline(deltas):
+                if delta:
+                    parts.append(delta)
+                    if settings.SUMMARY_STREAMING_ENABLED:
+                        yield ("final_response_delta", {"message_id": plan.message_id, "delta": delta})
+            step.status = "complete"
+        except Exception as e:
+            logger.error(f"直接检索知识库时出错: {e}", exc_info=True)
+            step.status = "failed"
+            # 已经推送给用户的部分保留为最终回答
+            if not parts:
+                parts.append(e.message if isinstance(e, PpecCopilotException) else "调用知识问答服务时发生错误。")
+        step.result = plan.final_summary = "".join(parts)
+        yield ("step_update", {"message_id": plan.message_id, "step_id": step.step_id, "status": step.status})
+        yield ("plan_update", plan)
+
     async def _plan_step(self, state: GraphState) -> GraphState:
         """
         【节点: plan_step】
@@ -322,11 +477,20 @@ class PlannerAgent(BaseAgent):
         """
         logger.info("--- 节点: 制定计划 ---")
         try:
-            result = await planner_runnable.ainvoke({
-                "messages": state["messages"],
-                "input": state["original_input"]
-            })
-        except Exception:
+            # 只把预算内最近的历史交给 Planner
+            history = await context_assembler.assemble(
+                state["session_id"], state["messages"], settings.PLANNER_CONTEXT_TOKENS, "planner"
+            )
+            prompt_messages = planner_prompt.format_messages(messages=history, input=state["original_input"])
+            report_prompt_tokens("planner", sum(count_tokens(str(m.content)) for m in prompt_messages), state["session_id"])
+            # 为执行步骤和生成总结预留时间；超时后使用默认计划
+            async with asyncio.timeout(time_budget(reserve=settings.PLANNER_SUMMARY_RESERVE)):
+                result = await planner_runnable.ainvoke({
+                    "messages": history,
+                    "input": state["original_input"]
+                })
+        except Exception as e:
+            logger.warning(f"生成计划失败，使用默认计划: {e!r}")
             plan = Plan(
                 message_id=str(uuid.uuid4()),
                 goal=state["original_input"],
@@ -337,10 +501,6 @@ class PlannerAgent(BaseAgent):
             return {**state, "plan": plan}
         
         # 解析LLM的响应并创建Plan对象
-        import json
-        from langchain_core.messages import AIMessage
-        from app.schemas.graph_state import PlanStep
-        
         # 获取LLM响应内容
         content = result.content if isinstance(result, AIMessage) else str(result)
         
@@ -407,64 +567,132 @@ class PlannerAgent(BaseAgent):
             logger.info(f"生成默认计划 (Turn ID: {plan.message_id})，包含 {len(plan.steps)} 个步骤。")
             return {**state, "plan": plan}
 
-    async def _execute_step(self, state: GraphState) -> GraphState:
+    def _ready_steps(self, plan: Plan) -> List[PlanStep]:
         """
-        【节点: execute_step】
-        功能: 执行当前 Plan 中的第一个 "pending" 状态的步骤。
+        找出所有依赖均已完成的待处理步骤。
+        引用了不存在的步骤（例如被重新规划替换掉的步骤）的依赖视为已满足。
         """
-        logger.info("--- 节点: 执行步骤 ---")
-        plan: Plan = state["plan"]
-        if not plan:
-            logger.error("执行步骤时，计划对象为空。")
-            return state
-
-        # 找到第一个待处理的步骤
-        step_to_execute = next((step for step in plan.steps if step.status == "pending"), None)
-        if not step_to_execute:
-            logger.info("没有找到待处理的步骤。")
-            return state
+        steps_by_id = {step.step_id: step for step in plan.steps}
+        ready = []
+        for step in plan.steps:
+            if step.status != "pending":
+                continue
+            deps = [steps_by_id[d] for d in step.depends_on if d in steps_by_id and d != step.step_id]
+            if all(dep.status == "complete" for dep in deps):
+                ready.append(step)
+        return ready
 
-        logger.info(f"正在执行步骤 {step_to_execute.step_id}: {step_to_execute.instruction}")
+    async def _execute_ready_steps(self, state: GraphState):
+        """
+        【节点: execute_step 的 DAG 调度】
+        功能: 并发执行所有就绪的步骤，某个步骤完成后再调度因它而就绪的步骤，
+        直到没有可执行的步骤为止。出现失败步骤后不再调度新步骤，等待已在执行的步骤结束后交给重新规划。
 
+        步骤结果只在事件循环中、步骤完成时写回 Plan，因此每个 plan_update 都是一致的快照，
+        step_update 事件按完成顺序发出（完成顺序可能与 step_id 顺序不同）。
+        """
+        plan: Plan = state["plan"]
+        running: Dict[asyncio.Task, PlanStep] = {}
         try:
-            # 使用 LLM 调用工具执行步骤
-            # 这里使用了 LangChain 的 bind_tools 和 invoke 功能
-            response = await executor_llm.ainvoke(step_to_execute.instruction)
-            logger.debug(f"工具调用响应: {response}")
-
-            # 解析工具调用结果
-            if hasattr(response, 'tool_calls') and response.tool_calls:
-                # 处理工具调用
-                tool_call = response.tool_calls[0]  # 假设只有一个工具调用
-                tool_name = tool_call["name"]
-                tool_args = tool_call["args"]
-                
-                logger.info(f"调用工具: {tool_name}，参数: {tool_args}")
+            while True:
+                launched = False
+                if not any(step.status == "failed" for step in plan.steps):
+                    ready = self._ready_steps(plan)
+                    if not ready and not running:
+                        # 依赖无法满足（例如存在环），退化为按顺序执行第一个待处理步骤
+                        pending = [step for step in plan.steps if step.status == "pending"]
+                        if pending:
+                            logger.warning(f"步骤依赖无法满足，按顺序执行步骤 {pending[0].step_id}。")
+                            ready = pending[:1]
+                    for step in ready:
+                        step.status = "running"
+                        running[asyncio.create_task(self._run_step(state, step))] = step
+                        launched = True
+                        yield ("step_update", {"message_id": plan.message_id, "step_id": step.step_id, "status": "running"})
+                        yield ("thought", {"phase": "execute", "content": f"开始执行步骤 {step.step_id}: {step.instruction}"})
+                if not running:
+                    break
+                if launched:
+                    yield ("plan_update", plan)
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: running[t].step_id):
+                    step = running.pop(task)
+                    step.status, step.result = task.result()
+                    yield ("step_update", {"message_id": plan.message_id, "step_id": step.step_id, "status": step.status})
+                    if step.status == "complete":
+                        yield ("thought", {"phase": "execute", "content": f"步骤 {step.step_id} 完成"})
+                    else:
+                        yield ("thought", {"phase": "execute", "content": f"步骤 {step.step_id} 失败"})
+                yield ("plan_update", plan)
+                yield ("heartbeat", None)
+        finally:
+            # 流被中断时取消仍在执行的步骤
+            for task in running:
+                task.cancel()
 
-                # 根据工具名称执行相应的操作
-                if tool_name == "ragflow_knowledge_search":
-                    # 直接使用RAGFlow工具处理知识检索任务，传递聊天历史记录
-                    result = await ragflow_knowledge_search(tool_args["query"], state.get("messages", []))
-                    step_result = result
-                else:
-                    step_result = f"调用了工具 {tool_name}，参数为 {tool_args}"
-            else:
-                # 没有工具调用，直接使用响应内容
-                step_result = response.content if hasattr(response, 'content') else str(response)
+    async def _run_step(self, state: GraphState, step: PlanStep) -> Tuple[str, str]:
+        """
+        执行单个步骤，受会话级和全局并发上限约束。
+        不直接修改 Plan，由调用方在事件循环中写回结果。
 
-            # 更新步骤状态
-            step_to_execute.status = "complete"
-            step_to_execute.result = step_result
+        Returns:
+            Tuple[str, str]: (步骤状态 complete / failed, 步骤结果或错误信息)
+        """
+        plan: Plan = state["plan"]
+        instruction = step.instruction
+        # 将前置步骤的结果作为上下文提供给执行器
+        dep_results = [
+            f"步骤 {dep.step_id} 的结果: {truncate_text(dep.result, settings.SUMMARIZER_CONTEXT_TOKENS // 4)}"
+            for dep in plan.steps if dep.step_id in step.depends_on and dep.result
+        ]
+        if dep_results:
+            instruction = f"{instruction}\n\n可参考的前置步骤结果:\n" + "\n".join(dep_results)
+
+        async with self._step_slots, _get_global_step_slots():
+            logger.info(f"正在执行步骤 {step.step_id}: {step.instruction}")
+
+            try:
+                # 整个步骤（LLM 与工具调用）必须在为生成总结预留的时间之前结束
+                async with asyncio.timeout(time_budget(reserve=settings.PLANNER_SUMMARY_RESERVE)):
+                    # 使用 LLM 调用工具执行步骤
+                    # 这里使用了 LangChain 的 bind_tools 和 invoke 功能
+                    response = await executor_llm.ainvoke(instruction)
+                    logger.debug(f"工具调用响应: {response}")
+
+                    # 解析工具调用结果
+                    if hasattr(response, 'tool_calls') and response.tool_calls:
+                        # 处理工具调用
+                        tool_call = response.tool_calls[0]  # 假设只有一个工具调用
+                        tool_name = tool_call["name"]
+                        tool_args = tool_call["args"]
+
+                        logger.info(f"调用工具: {tool_name}，参数: {tool_args}")
+
+                        # 根据工具名称执行相应的操作
+                        if tool_name == "ragflow_knowledge_search":
+                            # 直接使用RAGFlow工具处理知识检索任务，传递聊天历史记录
+                            result = await ragflow_knowledge_search.ainvoke({
+                                "query": tool_args["query"],
+                                "chat_history": state.get("messages", [])
+                            })
+                            step_result = result
+                        else:
+                            step_result = f"调用了工具 {tool_name}，参数为 {tool_args}"
+                    else:
+                        # 没有工具调用，直接使用响应内容
+                        step_result = response.content if hasattr(response, 'content') else str(response)
 
-            logger.info(f"步骤 {step_to_execute.step_id} 执行成功。")
-            return {**state, "plan": plan}
+                logger.info(f"步骤 {step.step_id} 执行成功。")
+                return "complete", step_result
 
-        except Exception as e:
-            logger.error(f"执行步骤 {step_to_execute.step_id} 时出错: {e}", exc_info=True)
-            # 标记步骤为失败
-            step_to_execute.status = "failed"
-            step_to_execute.result = f"执行步骤时发生错误: {str(e)}"
-            return {**state, "plan": plan}
+            except TimeoutError:
+                logger.warning(f"步骤 {step.step_id} 在请求截止时间前未能完成。")
+                return "failed", "剩余时间不足，步骤未能完成"
+            except Exception as e:
+                logger.error(f"执行步骤 {step.step_id} 时出错: {e}", exc_info=True)
+                # 标记步骤为失败
+                return "failed", f"执行步骤时发生错误: {str(e)}"
 
     async def _replan_step(self, state: GraphState) -> GraphState:
         """
@@ -512,7 +740,8 @@ class PlannerAgent(BaseAgent):
         try:
             # 调用LLM进行重新规划
             failure_analysis_chain = failure_analysis_prompt | get_llm()
-            analysis_result = await failure_analysis_chain.ainvoke({})
+            async with asyncio.timeout(time_budget(reserve=settings.PLANNER_SUMMARY_RESERVE)):
+                analysis_result = await failure_analysis_chain.ainvoke({})
 
             # 解析重新规划的结果
             content = analysis_result.content if hasattr(analysis_result, 'content') else str(analysis_result)
@@ -555,6 +784,17 @@ class PlannerAgent(BaseAgent):
             
             return {**state, "plan": plan}
 
+    def _summarizer_inputs(self, state: GraphState) -> Dict[str, str]:
+        """构建 Summarizer 的输入；每个步骤结果平分 Summarizer 的预算，超出部分截断"""
+        plan: Plan = state["plan"]
+        per_step_budget = settings.SUMMARIZER_CONTEXT_TOKENS // max(len(plan.steps), 1)
+        steps_summary = "\n".join([
+            f"步骤 {step.step_id}: {step.instruction}\n结果: {truncate_text(str(step.result), per_step_budget) if step.result is not None else '未执行'}"
+            for step in plan.steps
+        ])
+        report_prompt_tokens("summarizer", count_tokens(plan.goal) + count_tokens(steps_summary), state.get("session_id"))
+        return {"goal": plan.goal, "plan_steps_summary": steps_summary}
+
     async def _summarize_step(self, state: GraphState) -> GraphState:
         """
         【节点: summarize_step】
@@ -567,17 +807,9 @@ class PlannerAgent(BaseAgent):
             return state
 
         try:
-            # 构建步骤摘要
-            steps_summary = "\n".join([
-                f"步骤 {step.step_id}: {step.instruction}\n结果: {step.result}"
-                for step in plan.steps
-            ])
-
             # 调用总结链
-            summary_response = await summarizer_chain.ainvoke({
-                "goal": plan.goal,
-                "plan_steps_summary": steps_summary
-            })
+            async with asyncio.timeout(time_budget()):
+                summary_response = await summarizer_chain.ainvoke(self._summarizer_inputs(state))
 
             # 更新计划的最终总结
             plan.final_summary = summary_response.content if hasattr(summary_response, 'content') else str(summary_response)
@@ -589,6 +821,32 @@ class PlannerAgent(BaseAgent):
             plan.final_summary = "任务已完成，但无法生成详细总结。"
             return {**state, "plan": plan}
 
+    async def _stream_summarize_step(self, state: GraphState):
+        """
+        【节点: summarize_step（流式）】
+        功能: 与 _summarize_step 相同，但逐个转发 summarizer_chain.astream 的增量，
+        产出 ("final_response_delta", {"message_id", "delta"}) 事件；结束后完整文本写入 plan.final_summary。
+        """
+        logger.info("--- 节点: 生成总结（流式） ---")
+        plan: Plan = state["plan"]
+        if not plan:
+            logger.error("生成总结时，计划对象为空。")
+            return
+
+        parts: List[str] = []
+        try:
+            async for chunk in iter_within_deadline(summarizer_chain.astream(self._summarizer_inputs(state))):
+                delta = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                if delta:
+                    parts.append(delta)
+                    yield ("final_response_delta", {"message_id": plan.message_id, "delta": delta})
+            plan.final_summary = "".join(parts)
+            logger.info("总结生成完成。")
+        except Exception as e:
+            logger.error(f"生成总结时出错: {e}", exc_info=True)
+            # 已经推送给用户的部分保留为最终总结
+            plan.final_summary = "".join(parts) or "任务已完成，但无法生成详细总结。"
+
     async def _update_memory_step(self, state: GraphState) -> GraphState:
         """
         【节点: update_memory_step】
@@ -604,10 +862,8 @@ class PlannerAgent(BaseAgent):
             # 使用MemoryAgent来存储完成的计划
             if self.agent_manager:
                 memory_agent = self.agent_manager.get_memory_agent("default")  # 使用默认的MemoryAgent
-                # 确保MemoryAgent已初始化并启动
-                if not memory_agent.is_ready() and not memory_agent.is_running():
-                    await memory_agent.initialize()
-                    await memory_agent.start()
+                # MemoryAgent 在应用启动时已启动，此处已运行时不加锁直接返回
+                await memory_agent.ensure_running()
                     
                 result = await memory_agent.process_task({
                     "operation": "store_plan",
@@ -616,7 +872,7 @@ class PlannerAgent(BaseAgent):
                 })
                 
                 if result.get("status") == "success":
-                    logger.info(f"计划 {plan.message_id} 已成功存入记忆。")
+                    logger.info(f"计划 {plan.message_id} 已提交到记忆写入队列。")
                 else:
                     logger.error(f"存储计划到记忆时出错: {result.get('message')}")
             else:
@@ -638,6 +894,11 @@ class PlannerAgent(BaseAgent):
             logger.warning("计划对象为空，结束流程。")
             return "end"
 
+        # 决策 0: 剩余时间只够生成总结时，跳过重新规划和未执行的步骤，直接基于已有结果总结。
+        if running_short(settings.PLANNER_SUMMARY_RESERVE):
+            logger.warning("请求剩余时间不足，跳过重新规划和未执行的步骤，正在跳转到总结节点...")
+            return "summarize_step"
+
         # 决策 1: 检查是否有步骤执行失败。
         # 如果有，应该跳转到"重新规划"节点进行自我修复。
         failed_step = next((step for step in plan.steps if step.status == "failed"), None)
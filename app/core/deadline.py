@@ -0,0 +1,182 @@
+# app/core/deadline.py
+"""
+请求级截止时间（deadline）。
+
+每个 HTTP 请求在进入应用时由 DeadlineMiddleware 设置一个绝对截止时间（单调时钟），保存在 contextvar 中，
+随请求内创建的任务和流式响应体一起传递。下游的 LLM、RAGFlow 和 Mem0 调用都从剩余时间推导自己的超时，
+而不是各自使用固定的超时：
+
+    async with asyncio.timeout(time_budget()):          # 整个调用（含重试）不超过剩余时间
+        await llm.ainvoke(...)
+    await client.post(url, timeout=capped_timeout(upstream.timeout))   # 每次读写都不超过剩余时间
+
+没有设置截止时间时（后台任务、脚本、单元测试）各函数退化为原有的固定超时。
+"""
+import asyncio
+import time
+from contextvars import ContextVar, Token
+from typing import AsyncGenerator, AsyncIterable, Optional, TypeVar
+
+import httpx
+
+from app.core.metrics import metrics
+
+T = TypeVar("T")
+
+# 当前请求的绝对截止时间（time.monotonic()），None 表示不限
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求的截止时间已过，不再发起新的下游调用"""
+
+
+def set_deadline(seconds: Optional[float]) -> Token:
+    """
+    将当前上下文的截止时间设置为 seconds 秒之后。
+
+    Args:
+        seconds (Optional[float]): 剩余时间（秒），None 表示不限
+
+    Returns:
+        Token: 用于 reset_deadline 恢复之前的值
+    """
+    return _deadline.set(None if seconds is None else time.monotonic() + seconds)
+
+
+def reset_deadline(token: Token) -> None:
+    """恢复 set_deadline 之前的截止时间"""
+    _deadline.reset(token)
+
+
+def clear_deadline() -> None:
+    """
+    清除当前上下文的截止时间。
+    在请求中创建、但应在请求结束后继续运行的后台任务（例如记忆写入）会继承请求的上下文，需要在任务开始时调用。
+    """
+    _deadline.set(None)
+
+
+def remaining() -> Optional[float]:
+    """当前请求的剩余时间（秒，可能为负数），没有截止时间时返回 None"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def running_short(reserve: float) -> bool:
+    """剩余时间是否已不足 reserve 秒"""
+    left = remaining()
+    return left is not None and left <= reserve
+
+
+def time_budget(default: Optional[float] = None, reserve: float = 0.0) -> Optional[float]:
+    """
+    计算一次下游调用可用的时间：不超过 default，也不超过剩余时间减去 reserve。
+
+    Args:
+        default (Optional[float]): 该调用原有的超时（秒），None 表示不限
+        reserve (float): 需要为后续阶段（例如生成总结）预留的时间（秒）
+
+    Returns:
+        Optional[float]: 可用时间（秒），没有截止时间且 default 为 None 时返回 None
+
+    Raises:
+        DeadlineExceeded: 剩余时间已不足 reserve
+    """
+    left = remaining()
+    if left is None:
+        return default
+    left -= reserve
+    if left <= 0:
+        metrics.inc("request_deadline_exceeded_total")
+        raise DeadlineExceeded(f"request deadline exceeded ({reserve:.0f}s reserved)" if reserve else "request deadline exceeded")
+    return left if default is None else min(default, left)
+
+
+def capped_timeout(timeout: httpx.Timeout, reserve: float = 0.0) -> httpx.Timeout:
+    """
+    将上游的 httpx 超时的每一项都限制在剩余时间以内。
+
+    Raises:
+        DeadlineExceeded: 剩余时间已不足 reserve
+    """
+    budget = time_budget(reserve=reserve)
+    if budget is None:
+        return timeout
+
+    def cap(value: Optional[float]) -> float:
+        return budget if value is None else min(value, budget)
+
+    return httpx.Timeout(
+        connect=cap(timeout.connect),
+        read=cap(timeout.read),
+        write=cap(timeout.write),
+        pool=cap(timeout.pool),
+    )
+
+
+async def iter_within_deadline(items: AsyncIterable[T]) -> AsyncGenerator[T, None]:
+    """
+    逐项转发异步迭代器，等待每一项的时间都不超过请求的剩余时间。
+    用于在生成器中消费流式调用：asyncio.timeout 不能跨越 yield 使用（生成器的每一步可能在不同任务中执行）。
+
+    Raises:
+        TimeoutError: 截止时间前没有等到下一项（DeadlineExceeded 表示截止时间已过）
+    """
+    iterator = items.__aiter__()
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(iterator.__anext__(), time_budget())
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def parse_request_timeout(value: Optional[str], limit: float = 0.0) -> Optional[float]:
+    """
+    解析客户端请求头中的超时（秒）。请求头只能缩短时间：无效或缺失时使用 limit，超过 limit 时截断为 limit。
+
+    Args:
+        value (Optional[str]): 请求头的值
+        limit (float): 服务端允许的最长时间（秒），0 表示不限
+
+    Returns:
+        Optional[float]: 本次请求的时间（秒），None 表示不限
+    """
+    try:
+        requested = float(value) if value else 0.0
+    except ValueError:
+        requested = 0.0
+    if limit > 0:
+        return min(requested, limit) if requested > 0 else limit
+    return requested if requested > 0 else None
+
+
+class DeadlineMiddleware:
+    """
+    ASGI 中间件：为每个 HTTP 请求设置截止时间。
+    客户端可以通过请求头（默认 X-Request-Timeout，单位秒）要求更短的时间，但不会超过 limit，
+    以保证请求在 gunicorn 的 worker 超时之前结束。
+    """
+
+    def __init__(self, app, header: str = "X-Request-Timeout", limit: float = 0.0):
+        self.app = app
+        self.header = header.lower().encode("latin-1")
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        value = next((v for k, v in scope.get("headers", []) if k == self.header), None)
+        token = set_deadline(parse_request_timeout(value.decode("latin-1") if value else None, self.limit))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            reset_deadline(token)
@@ -9,6 +9,17 @@ class ServiceUnavailableException(PpecCopilotException):
     """外部服务不可用异常"""
     pass
 
+class CircuitOpenException(ServiceUnavailableException):
+    """上游服务处于熔断状态，请求未被发出"""
+    pass
+
 class InvalidInputException(PpecCopilotException):
     """用户输入无效异常"""
-    pass
\ No newline at end of file
+    pass
+
+class RateLimitedException(PpecCopilotException):
+    """请求超过并发或速率限制异常"""
+    def __init__(self, message: str, retry_after: float = 1.0, reason: str = "rate_limited"):
+        self.retry_after = retry_after
+        self.reason = reason
+        super().__init__(message)
@@ -1,25 +1,224 @@
 # app/core/http_client.py
+import logging
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict
+
 import httpx
-from typing import AsyncGenerator
 
-# 使用一个字典来持有客户端实例，实现单例模式
-_clients = {}
+from app.core.metrics import metrics
+from app.core.resilience import wrap_transport
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UpstreamConfig:
+    """
+    单个上游服务的连接池与超时配置。
+    """
+    name: str
+    connect_timeout: float
+    read_timeout: float
+    first_byte_timeout: float
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float
+    pool_timeout: float
+    http2: bool = False
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        """该上游默认使用的 httpx 超时对象"""
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.read_timeout,
+            pool=self.pool_timeout,
+        )
+
+    @property
+    def limits(self) -> httpx.Limits:
+        """该上游的连接池限制"""
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+
+def _build_upstreams() -> Dict[str, UpstreamConfig]:
+    """根据配置构建所有已知上游的配置表"""
+    pool = dict(
+        max_connections=settings.HTTP_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=settings.HTTP_POOL_KEEPALIVE_EXPIRY,
+        pool_timeout=settings.HTTP_POOL_ACQUIRE_TIMEOUT,
+        http2=settings.HTTP2_ENABLED,
+    )
+    return {
+        "default": UpstreamConfig(
+            name="default", connect_timeout=30.0, read_timeout=30.0, first_byte_timeout=30.0, **pool
+        ),
+        "ragflow": UpstreamConfig(
+            name="ragflow",
+            connect_timeout=settings.RAGFLOW_CONNECT_TIMEOUT,
+            read_timeout=settings.RAGFLOW_READ_TIMEOUT,
+            first_byte_timeout=settings.RAGFLOW_FIRST_BYTE_TIMEOUT,
+            **pool,
+        ),
+        "one_api": UpstreamConfig(
+            name="one_api",
+            connect_timeout=settings.ONE_API_CONNECT_TIMEOUT,
+            read_timeout=settings.ONE_API_READ_TIMEOUT,
+            first_byte_timeout=settings.ONE_API_FIRST_BYTE_TIMEOUT,
+            **pool,
+        ),
+    }
+
+
+# 上游配置表，以及按上游名称持有的客户端实例（每个上游一个共享连接池）
+UPSTREAMS: Dict[str, UpstreamConfig] = _build_upstreams()
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def get_upstream_config(name: str = "default") -> UpstreamConfig:
+    """
+    获取指定上游的配置。
+
+    Args:
+        name (str): 上游名称，例如 "ragflow"、"one_api"
+
+    Returns:
+        UpstreamConfig: 对应的上游配置
+    """
+    if name not in UPSTREAMS:
+        raise KeyError(f"Unknown upstream: {name}")
+    return UPSTREAMS[name]
+
+
+def _create_client(config: UpstreamConfig) -> httpx.AsyncClient:
+    """按上游配置创建一个带连接池的 AsyncClient；ragflow / one_api 的连接池外层加上熔断与对冲"""
+    try:
+        transport = httpx.AsyncHTTPTransport(limits=config.limits, http2=config.http2)
+    except ImportError:
+        # 未安装 h2 时退化为 HTTP/1.1，而不是让服务启动失败
+        logger.warning(f"HTTP/2 requested for upstream '{config.name}' but 'h2' is not installed, falling back to HTTP/1.1")
+        transport = httpx.AsyncHTTPTransport(limits=config.limits)
+    return httpx.AsyncClient(timeout=config.timeout, transport=wrap_transport(config.name, transport))
+
+
+def get_http_client(name: str = "default") -> httpx.AsyncClient:
+    """
+    获取指定上游的共享 HTTP 客户端。
+    客户端在首次使用时创建，同一上游的所有请求复用同一个连接池，
+    从而避免每个请求都重新建立 TCP/TLS 连接。也可作为 FastAPI 依赖注入函数使用。
+
+    Args:
+        name (str): 上游名称，默认为 "default"
+
+    Returns:
+        httpx.AsyncClient: 该上游的共享客户端
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _clients[name] = _create_client(get_upstream_config(name))
+        logger.info(f"Created pooled HTTP client for upstream '{name}'")
+    return client
+
+
+class UpstreamClientProxy(httpx.AsyncClient):
+    """
+    始终转发到 get_http_client(name) 当前共享客户端的 AsyncClient。
+    供在导入时创建并长期持有客户端的对象使用（get_llm 的 ChatOpenAI、语义缓存的 Embedding 客户端），
+    这样应用生命周期重启、连接池被关闭重建后，它们仍然使用新的连接池，而不是已关闭的旧客户端。
+    """
+
+    def __init__(self, name: str):
+        super().__init__(timeout=get_upstream_config(name).timeout)
+        self.upstream = name
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await get_http_client(self.upstream).send(request, **kwargs)
+
+    async def aclose(self) -> None:
+        """共享连接池由 close_http_clients 统一关闭，持有者关闭代理时不做任何事"""
+
+
+_proxies: Dict[str, UpstreamClientProxy] = {}
+
+
+def get_http_client_proxy(name: str = "default") -> UpstreamClientProxy:
+    """
+    获取指定上游的客户端代理，每次请求时才解析当前的共享客户端。
+
+    Args:
+        name (str): 上游名称
+
+    Returns:
+        UpstreamClientProxy: 该上游的客户端代理
+    """
+    proxy = _proxies.get(name)
+    if proxy is None:
+        proxy = _proxies[name] = UpstreamClientProxy(name)
+    return proxy
+
+
+def _pool_stats(client: httpx.AsyncClient, config: UpstreamConfig) -> Dict[str, object]:
+    """读取单个客户端底层连接池的占用情况"""
+    # 熔断与对冲的包装层持有实际的连接池 transport
+    transport = getattr(client._transport, "transport", client._transport)
+    pool = getattr(transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    requests = list(getattr(pool, "_requests", []))
+    active = sum(1 for conn in connections if not conn.is_idle())
+    waiting = sum(1 for req in requests if req.is_queued())
+    return {
+        "connections": len(connections),
+        "active": active,
+        "idle": len(connections) - active,
+        "waiting": waiting,
+        "max_connections": config.max_connections,
+        "saturation": round(active / config.max_connections, 4) if config.max_connections else 0.0,
+        "http2": config.http2,
+        "closed": client.is_closed,
+    }
+
+
+def get_pool_stats() -> Dict[str, Dict[str, object]]:
+    """
+    获取所有上游连接池的饱和度统计。
+
+    Returns:
+        Dict[str, Dict[str, object]]: 以上游名称为键的统计信息，
+            包含总连接数、活跃/空闲连接数、排队等待的请求数和饱和度
+    """
+    return {name: _pool_stats(client, get_upstream_config(name)) for name, client in _clients.items()}
+
+
+metrics.register_collector("http_pools", get_pool_stats)
+
+
+async def close_http_clients() -> None:
+    """关闭所有上游客户端并释放连接"""
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Error closing HTTP client for upstream '{name}': {e}")
+    _clients.clear()
+
 
 @asynccontextmanager
 async def lifespan(app):
     """
     FastAPI 的生命周期事件管理器。
-    应用启动时创建客户端，应用关闭时关闭客户端。
+    应用启动时为所有已知上游创建连接池，应用关闭时统一关闭。
     """
     # 应用启动
-    _clients["default"] = httpx.AsyncClient(timeout=30.0)
+    for name in UPSTREAMS:
+        get_http_client(name)
     yield
     # 应用关闭
-    await _clients["default"].aclose()
-
-def get_http_client() -> httpx.AsyncClient:
-    """
-    依赖注入函数，用于在 API 路由中获取全局 HTTP 客户端。
-    """
-    return _clients["default"]
\ No newline at end of file
+    await close_http_clients()
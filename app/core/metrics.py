@@ -0,0 +1,126 @@
+# app/core/metrics.py
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# 默认的直方图分桶（单位：秒），覆盖从毫秒级到分钟级的耗时
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _series_key(name: str, labels: Dict[str, object]) -> str:
+    """将指标名和标签拼接为唯一的时间序列键，例如 `requests{route=ragflow}`"""
+    if not labels:
+        return name
+    label_str = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{label_str}}}"
+
+
+class _Histogram:
+    """累积分桶直方图"""
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, object]:
+        cumulative, running = {}, 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            cumulative[str(bound)] = running
+        cumulative["+Inf"] = self.count
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": cumulative}
+
+
+class MetricsRegistry:
+    """
+    进程内的轻量级指标注册表。
+    支持计数器、仪表盘、直方图以及按需采集的回调（collector），
+    通过 `/metrics` 接口以 JSON 形式导出。线程安全，可在线程池中使用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._histograms: Dict[str, _Histogram] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, object]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """计数器加值"""
+        key = _series_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        """设置仪表盘的当前值"""
+        key = _series_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def add_gauge(self, name: str, delta: float, **labels) -> None:
+        """在仪表盘当前值上增减"""
+        key = _series_key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, buckets: Optional[Iterable[float]] = None, **labels) -> None:
+        """向直方图中记录一个观测值"""
+        key = _series_key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram(buckets or DEFAULT_BUCKETS)
+            hist.observe(value)
+
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, object]]) -> None:
+        """注册一个在导出时调用的回调，用于采集连接池状态等即时数据"""
+        with self._lock:
+            self._collectors[name] = collector
+
+    def get_counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_series_key(name, labels), 0)
+
+    def get_gauge(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._gauges.get(_series_key(name, labels), 0)
+
+    def get_histogram(self, name: str, **labels) -> Optional[Dict[str, object]]:
+        with self._lock:
+            hist = self._histograms.get(_series_key(name, labels))
+            return hist.snapshot() if hist else None
+
+    def snapshot(self) -> Dict[str, object]:
+        """导出所有指标的当前快照"""
+        with self._lock:
+            data = {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {k: h.snapshot() for k, h in self._histograms.items()},
+            }
+            collectors = dict(self._collectors)
+        data["collectors"] = {}
+        for name, collector in collectors.items():
+            try:
+                data["collectors"][name] = collector()
+            except Exception as e:  # 采集失败不应影响其他指标的导出
+                data["collectors"][name] = {"error": str(e)}
+        return data
+
+    def reset(self) -> None:
+        """清空所有指标（主要用于测试）"""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+# 全局单例实例
+metrics = MetricsRegistry()
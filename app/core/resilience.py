@@ -0,0 +1,415 @@
+# app/core/resilience.py
+"""
+上游（RAGFlow、one-api）的熔断与对冲请求。
+
+ResilientTransport 包装上游连接池的 httpx transport，因此经由 get_http_client 发出的所有请求
+（ragflow_stream 代理、RAGFlow 工具的 AsyncOpenAI 客户端、get_llm 的 ChatOpenAI）都会经过它：
+
+- 熔断：按滚动窗口统计错误（连接失败、超时、5xx）和慢调用（等待响应头超过阈值）的比例，
+  超过阈值后熔断，在 CIRCUIT_BREAKER_OPEN_SECONDS 内直接拒绝请求；之后进入半开状态，
+  放行少量探测请求，全部成功后恢复，任一失败则再次熔断。
+- 对冲：非流式请求在等待超过最近延迟的 p95 后，再发出一个相同的请求，先返回的结果生效，另一个被取消。
+  延迟按（路径, 模型）分别统计，嵌入和对话补全等延迟差异很大的调用互不影响；只对 HEDGE_UPSTREAMS 中的上游对冲
+  （默认只有 RAGFlow，one-api 的对话补全按 token 计费，对冲会成倍增加开销）。
+
+熔断期间 transport 返回带 `x-should-retry: false` 的 503 响应，OpenAI 客户端不会再重试；
+调用方可以在发起请求前调用 `get_circuit_breaker(name).raise_if_open()` 直接抛出 ServiceUnavailableException。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+import httpx
+import orjson
+
+from app.core.exceptions import CircuitOpenException
+from app.core.metrics import metrics
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+# 导出为仪表盘 circuit_breaker_state{upstream} 的数值
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    单个上游的熔断器。
+
+    Args:
+        name (str): 上游名称，用于日志和指标标签
+        window (float): 统计错误率和慢调用率的滚动窗口（秒）
+        min_calls (int): 窗口内至少有这么多次调用才会判断是否熔断
+        failure_rate (float): 错误比例达到该值时熔断
+        slow_call_seconds (float): 等待时间达到该值的调用计为慢调用
+        slow_call_rate (float): 慢调用比例达到该值时熔断
+        open_seconds (float): 熔断后拒绝请求的时间（秒）
+        half_open_probes (int): 半开状态下放行的探测请求数
+        enabled (bool): 为 False 时只放行不统计，永不熔断（仅使用对冲时）
+        clock (Callable[[], float]): 时钟，测试时可替换
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: float = 30.0,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 20.0,
+        slow_call_rate: float = 0.8,
+        open_seconds: float = 30.0,
+        half_open_probes: int = 2,
+        enabled: bool = True,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.enabled = enabled
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._clock = clock
+        # 窗口内的调用结果：(完成时间, 是否失败, 是否慢调用)
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._failures = 0
+        self._slow = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        metrics.set_gauge("circuit_breaker_state", STATE_VALUES[CLOSED], upstream=name)
+
+    @property
+    def state(self) -> str:
+        """当前状态；熔断时间结束后自动进入半开状态"""
+        if self._state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str) -> None:
+        self._state = state
+        if state == OPEN:
+            self._opened_at = self._clock()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._calls.clear()
+        self._failures = self._slow = 0
+        metrics.set_gauge("circuit_breaker_state", STATE_VALUES[state], upstream=self.name)
+        metrics.inc("circuit_breaker_transitions_total", upstream=self.name, state=state)
+        log = logger.warning if state == OPEN else logger.info
+        log(f"Circuit breaker for upstream '{self.name}' is now {state}")
+
+    def raise_if_open(self) -> None:
+        """
+        熔断期间（或半开状态下探测名额已用完时）直接抛出异常，不占用探测名额。
+
+        Raises:
+            CircuitOpenException: 上游处于熔断状态
+        """
+        state = self.state
+        if state == OPEN or (state == HALF_OPEN and self._probes_in_flight >= self.half_open_probes):
+            metrics.inc("circuit_breaker_rejections_total", upstream=self.name)
+            raise CircuitOpenException(f"上游服务 {self.name} 暂时不可用（熔断中），请稍后再试。")
+
+    def acquire(self) -> bool:
+        """
+        申请发出一个请求。
+
+        Returns:
+            bool: 该请求是否为半开状态下的探测请求（完成后需以 probe=True 调用 record / release）
+
+        Raises:
+            CircuitOpenException: 上游处于熔断状态
+        """
+        self.raise_if_open()
+        if self._state == HALF_OPEN:
+            self._probes_in_flight += 1
+            return True
+        return False
+
+    def release(self, probe: bool) -> None:
+        """请求在没有结果的情况下结束（例如客户端断开），归还探测名额"""
+        if probe and self._state == HALF_OPEN:
+            self._probes_in_flight -= 1
+
+    def record(self, ok: bool, latency: float, probe: bool = False) -> None:
+        """
+        记录一次调用的结果。
+
+        Args:
+            ok (bool): 是否成功（连接失败、超时和 5xx 为失败）
+            latency (float): 等待响应头的时间（秒）
+            probe (bool): 是否为半开状态下的探测请求
+        """
+        if not self.enabled:
+            return
+        slow = latency >= self.slow_call_seconds
+        state = self.state
+        if state == HALF_OPEN:
+            if not probe:
+                return
+            self._probes_in_flight -= 1
+            if not ok or slow:
+                self._transition(OPEN)
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_probes:
+                self._transition(CLOSED)
+            return
+        if state == OPEN:
+            # 熔断前发出、熔断后才结束的请求不再计入
+            return
+
+        now = self._clock()
+        self._calls.append((now, not ok, slow))
+        self._failures += not ok
+        self._slow += slow
+        while self._calls and now - self._calls[0][0] > self.window:
+            _, failed, was_slow = self._calls.popleft()
+            self._failures -= failed
+            self._slow -= was_slow
+        total = len(self._calls)
+        if total >= self.min_calls and (
+            self._failures / total >= self.failure_rate or self._slow / total >= self.slow_call_rate
+        ):
+            self._transition(OPEN)
+
+    def stats(self) -> Dict[str, object]:
+        """当前状态和窗口内的统计，用于 /metrics 导出"""
+        total = len(self._calls)
+        return {
+            "state": self.state,
+            "calls": total,
+            "failure_rate": round(self._failures / total, 4) if total else 0.0,
+            "slow_call_rate": round(self._slow / total, 4) if total else 0.0,
+        }
+
+
+class LatencyTracker:
+    """记录最近若干次非流式请求的延迟，用于计算对冲请求的等待时间"""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def observe(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def quantile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        """样本数不足 min_samples 时返回 None"""
+        if len(self._samples) < max(min_samples, 1):
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def _hedge_key(request: httpx.Request) -> Optional[Tuple[str, str]]:
+    """
+    只对请求体已完整缓存、且没有要求流式输出的 POST 请求做对冲。
+
+    Returns:
+        Optional[Tuple[str, str]]: 统计延迟所用的（路径, 模型），不可对冲时返回 None
+    """
+    if request.method != "POST" or not isinstance(request.stream, httpx.ByteStream):
+        return None
+    try:
+        body = orjson.loads(request.content)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(body, dict) or body.get("stream") is True:
+        return None
+    return request.url.path, str(body.get("model", ""))
+
+
+def _copy_request(request: httpx.Request) -> httpx.Request:
+    return httpx.Request(
+        request.method, request.url, headers=request.headers, content=request.content, extensions=request.extensions
+    )
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """
+    为上游连接池加上熔断和对冲的 httpx transport。
+
+    Args:
+        transport (httpx.AsyncBaseTransport): 实际发送请求的连接池 transport
+        breaker (CircuitBreaker): 该上游的熔断器
+        hedge (bool): 是否对非流式请求发出对冲请求
+        hedge_quantile (float): 对冲等待时间取最近延迟的该分位数
+        hedge_min_delay (float): 对冲等待时间的下限（秒）
+        hedge_min_samples (int): 延迟样本数达到该值后才开始对冲
+    """
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        breaker: CircuitBreaker,
+        hedge: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 1.0,
+        hedge_min_samples: int = 20,
+    ):
+        self.transport = transport
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        # 按（路径, 模型）分别记录延迟
+        self.latency: Dict[Tuple[str, str], LatencyTracker] = {}
+
+    def hedge_delay(self, key: Tuple[str, str]) -> Optional[float]:
+        """发出对冲请求前的等待时间，该（路径, 模型）的样本不足时返回 None（不对冲）"""
+        tracker = self.latency.get(key)
+        p = None if tracker is None else tracker.quantile(self.hedge_quantile, self.hedge_min_samples)
+        return None if p is None else max(p, self.hedge_min_delay)
+
+    def _reject(self, request: httpx.Request, error: CircuitOpenException) -> httpx.Response:
+        return httpx.Response(
+            503,
+            headers={"content-type": "application/json", "x-should-retry": "false"},
+            content=orjson.dumps({"error": {"message": error.message, "type": "circuit_open"}}),
+            request=request,
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            probe = self.breaker.acquire()
+        except CircuitOpenException as e:
+            return self._reject(request, e)
+
+        # 半开状态下的探测请求不做对冲，避免放大对刚恢复的上游的压力
+        key = _hedge_key(request) if self.hedge and not probe else None
+        delay = None if key is None else self.hedge_delay(key)
+        start = time.perf_counter()
+        try:
+            if delay is None:
+                response = await self.transport.handle_async_request(request)
+            else:
+                response = await self._hedged(request, delay)
+        except asyncio.CancelledError:
+            # 调用方放弃等待（首字节超时、截止时间、客户端断开）：等待已超过慢调用阈值的计为慢调用
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.breaker.slow_call_seconds:
+                self.breaker.record(True, elapsed, probe)
+            else:
+                self.breaker.release(probe)
+            raise
+        except Exception:
+            self.breaker.record(False, time.perf_counter() - start, probe)
+            raise
+
+        elapsed = time.perf_counter() - start
+        self.breaker.record(response.status_code < 500, elapsed, probe)
+        if key is not None and response.status_code < 500:
+            self.latency.setdefault(key, LatencyTracker()).observe(elapsed)
+        return response
+
+    async def _hedged(self, request: httpx.Request, delay: float) -> httpx.Response:
+        """先发出原请求，等待 delay 秒仍未返回时再发出一个相同的请求，返回先成功的结果"""
+        upstream = self.breaker.name
+        attempts = {asyncio.ensure_future(self.transport.handle_async_request(request)): "primary"}
+        winner = fallback = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done:
+                attempts[asyncio.ensure_future(self.transport.handle_async_request(_copy_request(request)))] = "hedge"
+                metrics.inc("upstream_hedged_requests_total", upstream=upstream)
+
+            pending, error = set(attempts), None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: attempts[t] != "primary"):
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif task.result().status_code >= 500:
+                        # 另一个请求仍可能成功；都失败时返回这个错误响应
+                        fallback = fallback or task
+                    else:
+                        winner = task
+                        break
+            winner = winner or fallback
+            if winner is None:
+                raise error
+            if len(attempts) > 1:
+                metrics.inc("upstream_hedge_wins_total", upstream=upstream, winner=attempts[winner])
+            return winner.result()
+        finally:
+            # 取消仍在进行的请求并等待其结束（连接归还连接池），关闭已经返回但没有被采用的响应
+            losers = [task for task in attempts if task is not winner]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+            for task in losers:
+                if not task.cancelled() and task.exception() is None:
+                    await task.result().aclose()
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+# 启用熔断与对冲的上游（经由 get_http_client 创建的连接池）
+RESILIENT_UPSTREAMS = ("ragflow", "one_api")
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """
+    获取指定上游的熔断器（每个进程每个上游一个）。
+
+    Args:
+        name (str): 上游名称，例如 "ragflow"、"one_api"
+
+    Returns:
+        CircuitBreaker: 该上游的熔断器
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(
+            name,
+            window=settings.CIRCUIT_BREAKER_WINDOW,
+            min_calls=settings.CIRCUIT_BREAKER_MIN_CALLS,
+            failure_rate=settings.CIRCUIT_BREAKER_FAILURE_RATE,
+            slow_call_seconds=settings.CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+            slow_call_rate=settings.CIRCUIT_BREAKER_SLOW_CALL_RATE,
+            open_seconds=settings.CIRCUIT_BREAKER_OPEN_SECONDS,
+            half_open_probes=settings.CIRCUIT_BREAKER_HALF_OPEN_PROBES,
+            enabled=settings.CIRCUIT_BREAKER_ENABLED,
+        )
+    return breaker
+
+
+def _hedge_upstreams() -> Tuple[str, ...]:
+    """HEDGE_UPSTREAMS 中逗号分隔的上游名称"""
+    return tuple(item.strip() for item in settings.HEDGE_UPSTREAMS.split(",") if item.strip())
+
+
+def wrap_transport(name: str, transport: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+    """为需要熔断或对冲的上游包装连接池 transport，其他上游原样返回"""
+    hedge = settings.HEDGE_ENABLED and name in _hedge_upstreams()
+    if name not in RESILIENT_UPSTREAMS or not (settings.CIRCUIT_BREAKER_ENABLED or hedge):
+        return transport
+    return ResilientTransport(
+        transport,
+        get_circuit_breaker(name),
+        hedge=hedge,
+        hedge_quantile=settings.HEDGE_QUANTILE,
+        hedge_min_delay=settings.HEDGE_MIN_DELAY,
+        hedge_min_samples=settings.HEDGE_MIN_SAMPLES,
+    )
+
+
+def get_breaker_stats() -> Dict[str, Dict[str, object]]:
+    """所有上游熔断器的状态，以上游名称为键"""
+    return {name: breaker.stats() for name, breaker in _breakers.items()}
+
+
+metrics.register_collector("circuit_breakers", get_breaker_stats)
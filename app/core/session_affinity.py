@@ -0,0 +1,124 @@
+# app/core/session_affinity.py
+"""
+会话亲和（sticky session）路由。
+
+AgentManager、会话历史缓存等状态保存在各个进程的内存中。gunicorn 的多个 worker 共享同一个监听端口，
+连续的请求会落到任意 worker 上，无法按会话路由。需要会话亲和时改为部署多个单 worker 的应用实例
+（每个实例一个端口或容器），由 nginx 按会话 ID 做一致性哈希，把同一会话的请求始终转发到同一个实例。
+
+客户端通过 SESSION_AFFINITY_HEADER（默认 X-Session-Id）请求头携带会话 ID；nginx 配置由本模块根据
+应用配置生成：
+
+    python -m app.core.session_affinity --upstreams app1:8000,app2:8000 > nginx/ppec_upstream.conf
+"""
+import argparse
+import os
+import socket
+from typing import List, Optional
+
+from app.core.metrics import metrics
+from config.settings import settings
+
+# nginx upstream 的名称，nginx.conf 中以 proxy_pass http://ppec_app 引用
+UPSTREAM_NAME = "ppec_app"
+
+
+def nginx_header_variable(header: str) -> str:
+    """请求头在 nginx 中对应的变量名，例如 X-Session-Id -> $http_x_session_id"""
+    return "$http_" + header.lower().replace("-", "_")
+
+
+def parse_upstreams(value: str) -> List[str]:
+    """解析逗号分隔的 host:port 列表"""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def render_nginx_upstream(
+    servers: List[str],
+    header: str = "X-Session-Id",
+    name: str = UPSTREAM_NAME,
+    keepalive: int = 32,
+) -> str:
+    """
+    生成按会话 ID 一致性哈希的 nginx upstream 配置。
+    没有携带会话头的请求按客户端地址哈希；增减实例时只有少量会话被重新分配。
+
+    Args:
+        servers (List[str]): 应用实例地址（host:port），每个实例运行单个 worker
+        header (str): 携带会话 ID 的请求头
+        name (str): upstream 名称
+        keepalive (int): 每个 nginx worker 到上游的空闲长连接数
+
+    Returns:
+        str: 可被 nginx http 块 include 的配置文本
+
+    Raises:
+        ValueError: 实例列表为空
+    """
+    if not servers:
+        raise ValueError("At least one upstream server is required")
+    session_key = f"${name}_session_key"
+    lines = [
+        "# 由 python -m app.core.session_affinity 生成，请勿手动修改",
+        f"map {nginx_header_variable(header)} {session_key} {{",
+        '    ""      $remote_addr;',
+        f"    default {nginx_header_variable(header)};",
+        "}",
+        "",
+        f"upstream {name} {{",
+        f"    hash {session_key} consistent;",
+    ]
+    lines += [f"    server {server} max_fails=3 fail_timeout=10s;" for server in servers]
+    lines += [
+        f"    keepalive {keepalive};",
+        "}",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+class SessionAffinityMiddleware:
+    """
+    ASGI 中间件：在响应头 X-Served-By 中标明处理请求的实例（主机名:进程号），
+    并统计请求是否携带会话头，便于验证 nginx 的会话亲和是否生效。
+    """
+
+    def __init__(self, app, header: str = "X-Session-Id"):
+        self.app = app
+        self.header = header.lower().encode("latin-1")
+        self.served_by = f"{socket.gethostname()}:{os.getpid()}".encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        has_session = any(key == self.header and value for key, value in scope.get("headers", []))
+        metrics.inc("session_affinity_requests_total", session_header="present" if has_session else "missing")
+
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-served-by", self.served_by)]
+            await send(message)
+
+        await self.app(scope, receive, send_with_header)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Render the nginx upstream config for sticky session routing")
+    parser.add_argument("--upstreams", default=settings.SESSION_AFFINITY_UPSTREAMS,
+                        help="comma separated host:port list (default: SESSION_AFFINITY_UPSTREAMS)")
+    parser.add_argument("--header", default=settings.SESSION_AFFINITY_HEADER)
+    parser.add_argument("--output", help="write to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    config = render_nginx_upstream(parse_upstreams(args.upstreams), args.header)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(config)
+    else:
+        print(config, end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+# app/core/sse.py
+import asyncio
+import codecs
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Hashable, List, Optional, Tuple, TypeVar, Union
+
+import orjson
+from pydantic import BaseModel
+
+from app.core.metrics import metrics
+from config.settings import settings
+
+# SSE 规范中的三种换行符：CRLF、LF、CR
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+@dataclass
+class SSEEvent:
+    """一个完整的 Server-Sent Event"""
+    data: str
+    event: Optional[str] = None
+    id: Optional[str] = None
+    retry: Optional[int] = None
+
+
+class SSEDecoder:
+    """
+    增量式 SSE 解码器。
+
+    按任意边界切分的字节流逐块喂入，只在遇到空行时才产出完整事件：
+    - 使用增量 UTF-8 解码器，跨块截断的多字节字符不会被解码错误；
+    - 未完成的行以片段列表缓存，行结束时一次性拼接，避免二次方的字符串拼接；
+    - 支持多行 `data:` 字段（以换行符连接）、注释行以及 CRLF 跨块的情况。
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._line_parts: List[str] = []
+        self._data_lines: List[str] = []
+        self._event: Optional[str] = None
+        self._id: Optional[str] = None
+        self._retry: Optional[int] = None
+        self._skip_lf = False
+        # 无法识别的字段行数量（例如上游直接返回的非 SSE 内容）
+        self.ignored_lines = 0
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """
+        喂入一块原始字节，返回本次解码出的所有完整事件。
+
+        Args:
+            chunk (bytes): 网络读取到的任意长度字节
+
+        Returns:
+            List[SSEEvent]: 已完整接收的事件列表（可能为空）
+        """
+        return self._feed_text(self._decoder.decode(chunk))
+
+    def flush(self) -> List[SSEEvent]:
+        """
+        在流结束时调用，处理剩余的半行，并派发未以空行结尾的最后一个事件。
+
+        Returns:
+            List[SSEEvent]: 剩余的事件列表
+        """
+        events = self._feed_text(self._decoder.decode(b"", final=True))
+        if self._line_parts:
+            line = "".join(self._line_parts)
+            self._line_parts = []
+            self._process_line(line)
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _feed_text(self, text: str) -> List[SSEEvent]:
+        events: List[SSEEvent] = []
+        if not text:
+            return events
+
+        # 上一块以 CR 结尾时，本块开头的 LF 属于同一个 CRLF
+        if self._skip_lf:
+            self._skip_lf = False
+            if text[0] == "\n":
+                text = text[1:]
+                if not text:
+                    return events
+        if text[-1] == "\r":
+            self._skip_lf = True
+
+        # 常见情况下上游只使用 LF，直接 split 比正则快得多
+        lines = _LINE_BREAK.split(text) if "\r" in text else text.split("\n")
+        tail = lines.pop()
+        if self._line_parts and lines:
+            self._line_parts.append(lines[0])
+            lines[0] = "".join(self._line_parts)
+            self._line_parts = []
+
+        for line in lines:
+            if line:
+                self._process_line(line)
+            else:
+                event = self._dispatch()
+                if event is not None:
+                    events.append(event)
+
+        if tail:
+            self._line_parts.append(tail)
+        return events
+
+    def _process_line(self, line: str) -> None:
+        if line[0] == ":":
+            # 注释行，例如心跳
+            return
+        field, sep, value = line.partition(":")
+        if sep and value.startswith(" "):
+            value = value[1:]
+
+        if field == "data":
+            self._data_lines.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            if "\0" not in value:
+                self._id = value
+        elif field == "retry":
+            if value.isdigit():
+                self._retry = int(value)
+        else:
+            self.ignored_lines += 1
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data_lines:
+            # 没有 data 字段的事件按规范直接丢弃
+            self._event = None
+            return None
+        event = SSEEvent(
+            data="\n".join(self._data_lines),
+            event=self._event,
+            id=self._id,
+            retry=self._retry,
+        )
+        self._data_lines = []
+        self._event = None
+        self._retry = None
+        return event
+
+
+async def aiter_sse_events(byte_stream: AsyncIterable[bytes]) -> AsyncIterator[SSEEvent]:
+    """
+    将一个异步字节流（例如 httpx 的 `aiter_bytes()`）转换为完整的 SSE 事件流。
+
+    Args:
+        byte_stream (AsyncIterable[bytes]): 任意切分的字节流
+
+    Yields:
+        SSEEvent: 完整的事件
+    """
+    decoder = SSEDecoder()
+    async for chunk in byte_stream:
+        if not chunk:
+            continue
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
+
+
+# --- SSE 编码 ---
+# 流式接口直接产出 bytes 帧：静态片段预先编码，JSON 由 orjson（或 pydantic-core）直接序列化为 bytes，
+# 避免 json.dumps -> str -> f-string -> encode 的多次拷贝
+
+DATA_PREFIX = b"data: "
+FRAME_END = b"\n\n"
+DONE_FRAME = b"data: [DONE]\n\n"
+
+
+def dumps(payload: Any) -> bytes:
+    """
+    将负载序列化为 JSON bytes。
+    pydantic 模型使用模型自带的 pydantic-core 序列化器（与 model_dump_json 输出一致），其余使用 orjson。
+    输出为 UTF-8 原文（不做 \\uXXXX 转义）。
+    """
+    if isinstance(payload, BaseModel):
+        return payload.__pydantic_serializer__.to_json(payload)
+    return orjson.dumps(payload)
+
+
+@lru_cache(maxsize=64)
+def _event_prefix(event: str) -> bytes:
+    return f"event: {event}\ndata: ".encode("utf-8")
+
+
+def encode_sse_data(data: Union[str, bytes]) -> bytes:
+    """
+    将事件数据编码为 SSE 帧，多行数据会被拆成多个 `data:` 字段。
+
+    Args:
+        data (Union[str, bytes]): 事件数据
+
+    Returns:
+        bytes: 以空行结尾的 SSE 帧
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if b"\n" not in data:
+        return b"".join((DATA_PREFIX, data, FRAME_END))
+    return b"".join(DATA_PREFIX + line + b"\n" for line in data.split(b"\n")) + b"\n"
+
+
+def encode_sse_json(payload: Any, event: Optional[str] = None) -> bytes:
+    """
+    将 JSON 负载编码为 SSE 帧。序列化后的 JSON 不含换行，无需拆分 `data:` 字段。
+
+    Args:
+        payload (Any): dict / list / pydantic 模型等
+        event (Optional[str]): 事件名，为空时不输出 `event:` 字段
+
+    Returns:
+        bytes: 以空行结尾的 SSE 帧
+    """
+    prefix = DATA_PREFIX if event is None else _event_prefix(event)
+    return b"".join((prefix, dumps(payload), FRAME_END))
+
+
+# ChunkTemplate 中 content 位置的占位符
+CONTENT_PLACEHOLDER = "\x00__sse_content__\x00"
+
+
+class ChunkTemplate:
+    """
+    SSE chunk 模板：同一个流中除 delta.content 以外的字段（id、model、created、role 等）都不变，
+    模板只序列化一次并在占位符处切开，之后每个 token 只需序列化 content 字符串再拼接。
+
+    用法:
+        template = ChunkTemplate(ChatCompletionChunk(..., delta=ChoiceDelta(content=CONTENT_PLACEHOLDER, ...)))
+        frame = template.render("你好")
+    """
+
+    def __init__(self, chunk: Any):
+        """
+        Args:
+            chunk (Any): 一个完整的 chunk（dict 或 pydantic 模型），其中恰好一处字符串值为 CONTENT_PLACEHOLDER
+
+        Raises:
+            ValueError: 占位符不存在或出现多次
+        """
+        serialized = dumps(chunk)
+        parts = serialized.split(orjson.dumps(CONTENT_PLACEHOLDER))
+        if len(parts) != 2:
+            raise ValueError("Chunk template must contain exactly one content placeholder")
+        self._prefix = DATA_PREFIX + parts[0]
+        self._suffix = parts[1] + FRAME_END
+
+    def render(self, content: str) -> bytes:
+        """生成 content 为给定文本的 SSE 帧"""
+        return b"".join((self._prefix, orjson.dumps(content), self._suffix))
+
+
+# 每个响应帧数的直方图分桶
+FRAME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+T = TypeVar("T")
+
+
+def coalesce_policy(requested: bool = True) -> Tuple[int, float]:
+    """
+    读取流式输出合并策略。
+
+    Args:
+        requested (bool): 客户端是否接受合并（请求中的 coalesce 字段）
+
+    Returns:
+        Tuple[int, float]: (max_bytes, max_delay)；全局关闭或客户端选择不合并时为 (0, 0.0)，即逐帧透传
+    """
+    if not requested or not settings.STREAM_COALESCE_ENABLED:
+        return 0, 0.0
+    return settings.STREAM_COALESCE_BYTES, settings.STREAM_COALESCE_MS / 1000
+
+
+async def coalesce_frames(
+    items: AsyncIterable[T],
+    split: Callable[[T], Optional[Tuple[Hashable, str]]],
+    join: Callable[[T, str], T],
+    max_bytes: int = 0,
+    max_delay: float = 0.0,
+    stream: str = "default",
+) -> AsyncIterator[T]:
+    """
+    流式输出的合并层：把连续的文本增量合并为更少的帧，其他帧原样按序输出。
+
+    刷新策略：
+    - 距上次输出已超过 max_delay 时，新到的增量立即输出（首 token 不等待，慢速流不增加延迟）；
+    - 否则增量进入缓冲区，在上次输出后 max_delay 秒时输出（上游暂时没有新数据时也按时输出），
+      缓冲的文本达到 max_bytes 字节（UTF-8）时提前输出；
+    - 非增量帧（结束帧、[DONE]、其他事件）以及键不同的增量会先刷出缓冲区，再立即输出。
+    max_delay 不大于 0 时原样透传。每个响应结束时记录帧数指标。
+
+    Args:
+        items (AsyncIterable[T]): 帧流
+        split (Callable): 帧是可合并的增量时返回 (键, 文本)，否则返回 None；键相同的连续增量才会合并
+        join (Callable): 由缓冲区中第一个增量帧和合并后的文本生成新帧
+        max_bytes (int): 缓冲文本的字节上限，0 表示不限
+        max_delay (float): 两次输出之间的最长等待（秒）
+        stream (str): 指标标签，标识输出流所属的端点
+
+    Yields:
+        T: 合并后的帧
+    """
+    frames = 0
+    coalesced = 0
+    if max_delay <= 0:
+        try:
+            async for item in items:
+                frames += 1
+                yield item
+        finally:
+            metrics.observe("sse_frames_per_response", frames, buckets=FRAME_BUCKETS, stream=stream)
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = items.__aiter__()
+    # 单个后台任务持续拉取上游，经单槽队列交给合并循环：等待窗口到期只取消 queue.get，不会中断上游
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    end = object()
+    error: Optional[BaseException] = None
+    last_emit = float("-inf")
+    first: Optional[T] = None
+    key: Hashable = None
+    parts: List[str] = []
+    size = 0
+
+    async def pump() -> None:
+        nonlocal error
+        try:
+            async for item in iterator:
+                await queue.put(item)
+        except Exception as e:
+            error = e
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+        await queue.put(end)
+
+    def take() -> T:
+        """取出缓冲区：只有一个增量时原样返回该帧，否则生成合并帧"""
+        nonlocal first, parts, size, coalesced
+        frame = first if len(parts) == 1 else join(first, "".join(parts))
+        coalesced += len(parts) - 1
+        first, parts, size = None, [], 0
+        return frame
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        while True:
+            item = end
+            expired = False
+            if first is not None and queue.empty():
+                try:
+                    async with asyncio.timeout_at(last_emit + max_delay):
+                        item = await queue.get()
+                except TimeoutError:
+                    expired = True
+            else:
+                item = await queue.get()
+            if expired:
+                # 窗口到期而上游仍未产出：先输出已缓冲的增量
+                frame = take()
+                frames += 1
+                last_emit = loop.time()
+                yield frame
+                continue
+
+            if item is end:
+                if error is not None:
+                    raise error
+                break
+            delta = split(item)
+            if first is not None and (delta is None or delta[0] != key):
+                frame = take()
+                frames += 1
+                last_emit = loop.time()
+                yield frame
+
+            if delta is None or (first is None and loop.time() - last_emit >= max_delay):
+                frames += 1
+                last_emit = loop.time()
+                yield item
+                continue
+
+            if first is None:
+                first, key = item, delta[0]
+            parts.append(delta[1])
+            size += len(delta[1].encode("utf-8"))
+            if 0 < max_bytes <= size:
+                frame = take()
+                frames += 1
+                last_emit = loop.time()
+                yield frame
+        if first is not None:
+            frames += 1
+            yield take()
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+        metrics.observe("sse_frames_per_response", frames, buckets=FRAME_BUCKETS, stream=stream)
+        if coalesced:
+            metrics.inc("sse_deltas_coalesced_total", coalesced, stream=stream)
+
+
+async def _wait_for_disconnect(receive: Callable[[], Awaitable[dict]]) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(body: AsyncIterable[T], request: Optional[Any] = None, stream: str = "default") -> AsyncIterator[T]:
+    """
+    在客户端断开连接时立即停止流式响应的生成。
+
+    后台任务等待 ASGI 的 http.disconnect 消息；客户端断开时若正在等待下一帧，则取消消费响应体的任务，
+    取消沿生成器链传播，上游 httpx 流、LLM 流和 Planner 的步骤任务随之关闭，不再等到下一次写入失败。
+    由断开引起的取消在这里被吸收，响应正常结束。
+    未读完就结束的流（包括被服务器取消的）计入 stream_disconnects_total。
+
+    Args:
+        body (AsyncIterable[T]): 响应体生成器
+        request (Optional[Request]): Starlette 请求对象，为空时只做计数、不监听断开
+        stream (str): 指标标签，标识输出流所属的端点
+
+    Yields:
+        T: 响应体的帧
+    """
+    iterator = body.__aiter__()
+    consumer = asyncio.current_task()
+    waiting = False
+    disconnected = False
+    finished = False
+
+    async def watch() -> None:
+        nonlocal disconnected
+        await _wait_for_disconnect(request.receive)
+        disconnected = True
+        if waiting:
+            # 消费方停在响应体的 await 上：直接取消；否则在它取下一帧时结束
+            consumer.cancel()
+
+    watcher = asyncio.create_task(watch()) if request is not None else None
+    try:
+        while not disconnected:
+            waiting = True
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                finished = True
+                return
+            except asyncio.CancelledError:
+                # 只吸收 watcher 发起的取消，服务器关闭等其他来源的取消继续传播
+                if disconnected and consumer.uncancel() == 0:
+                    return
+                raise
+            except Exception:
+                finished = True
+                raise
+            finally:
+                waiting = False
+            yield item
+    finally:
+        # 先完成同步的取消和计数：被服务器取消时，之后的 await 可能再次被取消
+        if not finished:
+            metrics.inc("stream_disconnects_total", stream=stream)
+        if watcher is not None:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
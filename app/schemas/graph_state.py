@@ -8,8 +8,9 @@ class PlanStep(BaseModel):
     """定义计划中的一个独立步骤"""
     step_id: int = Field(description="步骤的序号，从 1 开始。")
     instruction: str = Field(description="对该步骤任务的清晰、独立的指令描述。")
-    status: str = Field(default="pending", description="步骤状态: pending, complete, failed")
+    status: str = Field(default="pending", description="步骤状态: pending, running, complete, failed")
     result: Optional[str] = Field(default=None, description="该步骤执行后的结果或错误信息。")
+    depends_on: List[int] = Field(default_factory=list, description="该步骤依赖的前置步骤 step_id 列表；为空表示可与其他步骤并行执行。")
 
 
 class Plan(BaseModel):
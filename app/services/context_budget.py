@@ -0,0 +1,196 @@
+# app/services/context_budget.py
+import asyncio
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from app.core.metrics import metrics
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 每条消息在 chat 格式中的额外开销（role、分隔符等），与 OpenAI 的估算方式一致
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 无法加载 tiktoken 编码时的估算：CJK 字符约 1 token/字，其余约 4 字符/token
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+# 滚动摘要作为一条 system 消息放在保留的历史之前
+SUMMARY_PREFIX = "此前对话的摘要："
+
+# 汇总函数签名: (之前的摘要, 新折叠的消息) -> 新摘要
+SummarizeFunc = Callable[[str, List[dict]], Awaitable[str]]
+
+
+_tokenizer = None
+_tokenizer_attempted = False
+_tokenizer_loading = False
+_tokenizer_lock = threading.Lock()
+
+
+def load_tokenizer():
+    """
+    加载 tiktoken 编码器（阻塞调用）。
+    编码文件首次使用时需要下载（离线部署可通过 TIKTOKEN_CACHE_DIR 预置），加载失败时返回 None 并改用字符估算。
+    """
+    global _tokenizer, _tokenizer_attempted
+    with _tokenizer_lock:
+        if not _tokenizer_attempted:
+            try:
+                import tiktoken
+                _tokenizer = tiktoken.get_encoding(settings.TOKENIZER_ENCODING)
+            except Exception as e:
+                logger.warning(f"Failed to load tiktoken encoding '{settings.TOKENIZER_ENCODING}', falling back to character estimate: {e}")
+            _tokenizer_attempted = True
+        return _tokenizer
+
+
+async def preload_tokenizer() -> None:
+    """应用启动时在线程中加载编码器，避免下载阻塞事件循环和首个请求"""
+    await asyncio.to_thread(load_tokenizer)
+
+
+def get_tokenizer():
+    """
+    获取已加载的 tiktoken 编码器；尚未加载或加载失败时返回 None（改用字符估算）。
+    在事件循环中不会同步加载：未经 preload_tokenizer 预加载时在后台线程中加载，之前的调用使用估算值。
+    """
+    global _tokenizer_loading
+    if _tokenizer_attempted:
+        return _tokenizer
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # 没有事件循环（脚本、离线评估）时直接同步加载
+        return load_tokenizer()
+    if not _tokenizer_loading:
+        _tokenizer_loading = True
+        loop.run_in_executor(None, load_tokenizer)
+    return None
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """统计一段文本的 token 数"""
+    if not text:
+        return 0
+    encoder = get_tokenizer()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages: List[dict]) -> int:
+    """统计一组 chat 消息的 token 数"""
+    return sum(count_tokens(str(m.get("content") or "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def truncate_text(text: Optional[str], budget: int) -> str:
+    """将文本截断到 budget 个 token 以内，截断时在末尾标注"""
+    if not text or count_tokens(text) <= budget:
+        return text or ""
+    encoder = get_tokenizer()
+    if encoder is not None:
+        return encoder.decode(encoder.encode(text, disallowed_special=())[:max(budget, 0)]) + "…（已截断）"
+    # 估算模式下按比例截断字符
+    ratio = budget / count_tokens(text)
+    return text[:int(len(text) * ratio)] + "…（已截断）"
+
+
+def split_recent_turns(messages: List[dict], budget: int) -> Tuple[List[dict], List[dict]]:
+    """
+    从最新的消息开始，按轮次（user + assistant）保留尽可能多的历史，使其不超过 budget。
+
+    Returns:
+        Tuple[List[dict], List[dict]]: (被折叠的较早消息, 保留的最近消息)
+    """
+    # 从末尾开始，按 user 消息切分轮次
+    kept_start = len(messages)
+    used = 0
+    i = len(messages)
+    while i > 0:
+        turn_start = i - 1
+        while turn_start > 0 and messages[turn_start].get("role") != "user":
+            turn_start -= 1
+        cost = count_message_tokens(messages[turn_start:i])
+        if used + cost > budget:
+            break
+        used += cost
+        kept_start = turn_start
+        i = turn_start
+    return messages[:kept_start], messages[kept_start:]
+
+
+def report_prompt_tokens(stage: str, tokens: int, session_id: Optional[str] = None) -> None:
+    """记录某个阶段本轮的 prompt token 数"""
+    metrics.observe("prompt_tokens", tokens, buckets=(256, 512, 1024, 2048, 4096, 8192, 16384, 32768), stage=stage)
+    logger.info(f"Prompt tokens for {stage} (session {session_id}): {tokens}")
+
+
+class ContextAssembler:
+    """
+    按 token 预算组装对话历史。
+    保留预算内最近的若干轮；更早的轮次可以折叠成一段滚动摘要（按会话缓存，只对新折叠的轮次增量汇总）。
+    """
+
+    def __init__(self, summarize: Optional[SummarizeFunc] = None, summary_budget: int = 300, max_sessions: int = 1024):
+        """
+        Args:
+            summarize (Optional[SummarizeFunc]): 滚动摘要的汇总函数，为空时直接丢弃预算外的轮次
+            summary_budget (int): 摘要占用的 token 预算（从历史预算中预留）
+            max_sessions (int): 最多缓存摘要的会话数
+        """
+        self._summarize = summarize
+        self.summary_budget = summary_budget
+        self.max_sessions = max_sessions
+        # session_id -> (已折叠的消息数, 已折叠消息的指纹, 摘要)
+        self._summaries: "OrderedDict[str, Tuple[int, int, str]]" = OrderedDict()
+
+    @staticmethod
+    def _fingerprint(messages: List[dict]) -> int:
+        return hash(tuple((m.get("role"), str(m.get("content"))) for m in messages))
+
+    async def _rolling_summary(self, session_id: str, older: List[dict]) -> Optional[str]:
+        folded, fingerprint, summary = self._summaries.get(session_id, (0, 0, ""))
+        if folded > len(older) or self._fingerprint(older[:folded]) != fingerprint:
+            # 历史被回滚或改写过，旧摘要已不可用
+            folded, summary = 0, ""
+        if folded < len(older):
+            try:
+                summary = await self._summarize(summary, older[folded:])
+            except Exception as e:
+                logger.error(f"Failed to fold older turns into summary for session {session_id}: {e}")
+                return summary or None
+            self._summaries[session_id] = (len(older), self._fingerprint(older), summary)
+        if session_id in self._summaries:
+            self._summaries.move_to_end(session_id)
+        while len(self._summaries) > self.max_sessions:
+            self._summaries.popitem(last=False)
+        return summary or None
+
+    async def assemble(self, session_id: str, messages: List[dict], budget: int, stage: str) -> List[dict]:
+        """
+        组装不超过 budget 的历史消息。
+
+        Args:
+            session_id (str): 会话ID，用于缓存滚动摘要
+            messages (List[dict]): 完整的历史消息
+            budget (int): 历史消息的 token 预算
+            stage (str): 阶段名（planner / rewriter / summarizer），用于日志和指标
+
+        Returns:
+            List[dict]: 组装后的历史消息
+        """
+        older, recent = split_recent_turns(messages, budget)
+        if older and self._summarize is not None:
+            # 为摘要预留预算后重新切分，保证被挤出的轮次都会折叠进摘要
+            older, recent = split_recent_turns(messages, budget - self.summary_budget)
+            summary = await self._rolling_summary(session_id, older)
+            if summary:
+                summary = truncate_text(summary, self.summary_budget - MESSAGE_OVERHEAD_TOKENS - count_tokens(SUMMARY_PREFIX))
+                recent = [{"role": "system", "content": SUMMARY_PREFIX + summary}] + recent
+        if older:
+            logger.info(f"{stage} context for session {session_id}: keeping {len(recent)} of {len(messages)} history messages within {budget} tokens")
+        return recent
@@ -0,0 +1,248 @@
+# app/services/history_cache.py
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.metrics import metrics
+from app.schemas.graph_state import Plan
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 缓存中的一轮对话: {"message_id": ..., "goal": ..., "summary": ...}
+Turn = Dict[str, Any]
+
+
+def plan_to_turn(plan: Plan) -> Turn:
+    """从已完成的计划中提取一轮对话"""
+    return {"message_id": plan.message_id, "goal": plan.goal, "summary": plan.final_summary}
+
+
+def turns_to_messages(turns: List[Turn]) -> List[dict]:
+    """将缓存的对话轮次转换为 Planner 需要的 "messages" 格式"""
+    messages = []
+    for turn in turns:
+        messages.append({"role": "user", "content": turn["goal"]})
+        messages.append({"role": "assistant", "content": turn["summary"]})
+    return messages
+
+
+class SessionRevisions:
+    """
+    多个 worker 共享的会话历史版本号，每个会话一个文件。
+    任一 worker 修改会话历史（追加、截断、失效）时写入新的版本号；
+    其他 worker 发现自己缓存的版本号已过期时视为未命中，从 Mem0 重新加载。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(session_id.encode("utf-8")).hexdigest())
+
+    def current(self, session_id: str) -> str:
+        try:
+            with open(self._path(session_id), "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ""
+
+    def bump(self, session_id: str) -> str:
+        """写入新的版本号（先写临时文件再原子改名）并返回"""
+        revision = uuid.uuid4().hex
+        path = self._path(session_id)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(revision)
+        os.replace(tmp_path, path)
+        return revision
+
+
+class InMemoryHistoryBackend:
+    """
+    进程内的会话历史缓存，按会话数量做 LRU 淘汰，并为每个会话设置 TTL。
+    多个 worker 各自持有一份缓存时需传入共享的 revisions：每份缓存记录写入时的会话版本号，
+    版本号被其他 worker 改变后不再命中，避免继续提供缺少新轮次或包含已回滚轮次的历史。
+    """
+
+    def __init__(self, max_sessions: int = 1024, ttl: float = 1800.0, revisions: Optional[SessionRevisions] = None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.revisions = revisions
+        # session_id -> (过期时间, 轮次, 写入时的会话版本号)
+        self._data: "OrderedDict[str, Tuple[float, List[Turn], str]]" = OrderedDict()
+
+    def _revision(self, session_id: str) -> str:
+        return self.revisions.current(session_id) if self.revisions is not None else ""
+
+    async def get(self, session_id: str) -> Optional[List[Turn]]:
+        entry = self._data.get(session_id)
+        if entry is None:
+            return None
+        expires_at, turns, revision = entry
+        if expires_at <= time.monotonic():
+            del self._data[session_id]
+            return None
+        if revision != self._revision(session_id):
+            # 会话历史已被其他 worker 修改
+            del self._data[session_id]
+            metrics.inc("history_cache_stale_total")
+            return None
+        self._data.move_to_end(session_id)
+        return list(turns)
+
+    async def set(self, session_id: str, turns: List[Turn]) -> None:
+        self._data[session_id] = (time.monotonic() + self.ttl, list(turns), self._revision(session_id))
+        self._data.move_to_end(session_id)
+        while len(self._data) > self.max_sessions:
+            self._data.popitem(last=False)
+            metrics.inc("history_cache_evictions_total")
+
+    async def append(self, session_id: str, turn: Turn) -> bool:
+        entry = self._data.get(session_id)
+        current = self._revision(session_id)
+        if self.revisions is not None:
+            # 无论本进程是否缓存了该会话，都要让其他 worker 的缓存失效
+            revision = self.revisions.bump(session_id)
+        if entry is None or entry[0] <= time.monotonic() or entry[2] != current:
+            self._data.pop(session_id, None)
+            return False
+        entry[1].append(turn)
+        if self.revisions is not None:
+            self._data[session_id] = (entry[0], entry[1], revision)
+        return True
+
+    async def delete(self, session_id: str) -> None:
+        self._data.pop(session_id, None)
+        if self.revisions is not None:
+            self.revisions.bump(session_id)
+
+
+class RedisHistoryBackend:
+    """
+    基于 Redis 的共享会话历史缓存，供多个 gunicorn worker 共用。
+    每个会话保存为一个列表：首个元素是占位标记（使得空历史也能被缓存），其后每个元素是一轮对话的 JSON。
+    兼容 redis.asyncio 客户端接口（delete / rpush / rpushx / lrange / expire）。
+    """
+
+    _MARKER = "__history__"
+
+    def __init__(self, client, ttl: float = 1800.0, prefix: str = "ppec:history:"):
+        self._client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    async def get(self, session_id: str) -> Optional[List[Turn]]:
+        items = await self._client.lrange(self._key(session_id), 0, -1)
+        if not items:
+            return None
+        return [json.loads(item) for item in items[1:]]
+
+    async def set(self, session_id: str, turns: List[Turn]) -> None:
+        key = self._key(session_id)
+        await self._client.delete(key)
+        await self._client.rpush(key, self._MARKER, *[json.dumps(t, ensure_ascii=False) for t in turns])
+        await self._client.expire(key, self.ttl)
+
+    async def append(self, session_id: str, turn: Turn) -> bool:
+        # RPUSHX 只在列表已存在时追加，不会凭空创建一份不完整的历史
+        key = self._key(session_id)
+        if not await self._client.rpushx(key, json.dumps(turn, ensure_ascii=False)):
+            return False
+        await self._client.expire(key, self.ttl)
+        return True
+
+    async def delete(self, session_id: str) -> None:
+        await self._client.delete(self._key(session_id))
+
+
+class HistoryCache:
+    """
+    位于 Mem0 get_all 之前的会话历史缓存。
+    未命中时由调用方从 Mem0 加载完整历史并写入；之后每轮完成的计划增量追加，
+    回滚时按 message_id 精确截断。缓存故障只会降级为未命中，不会影响对话。
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def get_messages(self, session_id: str) -> Optional[List[dict]]:
+        """
+        获取缓存的历史消息。
+
+        Returns:
+            Optional[List[dict]]: 命中时返回 messages，未命中返回 None
+        """
+        try:
+            turns = await self.backend.get(session_id)
+        except Exception as e:
+            logger.warning(f"History cache read failed for session {session_id}: {e}")
+            turns = None
+        metrics.inc("history_cache_requests_total", result="miss" if turns is None else "hit")
+        return None if turns is None else turns_to_messages(turns)
+
+    async def set_turns(self, session_id: str, turns: List[Turn]) -> None:
+        try:
+            await self.backend.set(session_id, turns)
+        except Exception as e:
+            logger.warning(f"History cache write failed for session {session_id}: {e}")
+
+    async def append_plan(self, session_id: str, plan: Plan) -> None:
+        """将一轮已完成的计划追加到已缓存的历史（未缓存的会话不做处理）"""
+        if not plan.final_summary:
+            return
+        try:
+            await self.backend.append(session_id, plan_to_turn(plan))
+        except Exception as e:
+            logger.warning(f"History cache append failed for session {session_id}, invalidating: {e}")
+            await self.invalidate(session_id)
+
+    async def truncate(self, session_id: str, message_id: str) -> None:
+        """回滚后截断缓存：保留到 message_id（含）为止的轮次；找不到该轮次时整体失效"""
+        try:
+            turns = await self.backend.get(session_id)
+            # 先整体删除：共享版本号随之改变，其他 worker 缓存的回滚前历史不再命中
+            await self.backend.delete(session_id)
+            ids = [turn["message_id"] for turn in turns or []]
+            if message_id in ids:
+                await self.backend.set(session_id, turns[:ids.index(message_id) + 1])
+        except Exception as e:
+            logger.warning(f"History cache truncate failed for session {session_id}, invalidating: {e}")
+            await self.invalidate(session_id)
+
+    async def invalidate(self, session_id: str) -> None:
+        try:
+            await self.backend.delete(session_id)
+        except Exception as e:
+            logger.error(f"History cache invalidation failed for session {session_id}: {e}")
+
+
+def build_history_cache() -> HistoryCache:
+    """
+    根据配置创建历史缓存：配置了 HISTORY_CACHE_REDIS_URL 时使用 Redis 共享缓存，
+    否则（或未安装 redis 时）使用进程内缓存，各 worker 通过 HISTORY_CACHE_REVISION_DIR 中的版本号文件互相失效。
+    """
+    if settings.HISTORY_CACHE_REDIS_URL:
+        try:
+            import redis.asyncio as redis
+            client = redis.from_url(settings.HISTORY_CACHE_REDIS_URL, decode_responses=True)
+            logger.info("Using Redis-backed conversation history cache.")
+            return HistoryCache(RedisHistoryBackend(client, ttl=settings.HISTORY_CACHE_TTL))
+        except ImportError:
+            logger.warning("HISTORY_CACHE_REDIS_URL is set but the 'redis' package is not installed; using in-process history cache.")
+    return HistoryCache(InMemoryHistoryBackend(
+        settings.HISTORY_CACHE_MAX_SESSIONS, settings.HISTORY_CACHE_TTL, SessionRevisions(settings.HISTORY_CACHE_REVISION_DIR)
+    ))
+
+
+# 全局单例实例
+history_cache = build_history_cache()
@@ -0,0 +1,102 @@
+# app/services/intent_router.py
+"""
+Planner 前置的轻量意图路由。
+
+每轮 Planner 对话需要依次调用 Planner、Executor、查询重写、RAGFlow 和 Summarizer，
+而"什么是数字电源？"这类单次知识检索的问题只需要一次 RAGFlow 调用。
+路由器用一组正则特征给问题打分（不调用 LLM，耗时在微秒级）：
+
+- 定义、用法类的问法（什么是 / 是什么 / 如何 / what is ...）和较短的问题提高"直接检索"的置信度；
+- 比较、多步骤、生成 / 设计 / 计算类任务，多个问题，以及较长的输入降低置信度。
+
+置信度达到 INTENT_ROUTER_THRESHOLD 时走直接检索（ROUTE_DIRECT），否则走完整的计划流程（ROUTE_PLAN）。
+判断偏保守：拿不准的问题仍然交给 Planner。离线评估见 tests/benchmarks/eval_intent_router.py。
+"""
+import re
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from config.settings import settings
+
+ROUTE_DIRECT = "direct"   # 跳过规划，直接流式返回 RAGFlow 的回答
+ROUTE_PLAN = "plan"       # 规划 / 执行 / 总结
+
+# 没有任何特征时的基础置信度，低于默认阈值：无法判断的问题走计划流程
+_PRIOR = 0.5
+
+# 单次知识检索的问法
+_LOOKUP = re.compile(
+    r"^\s*(请问|请)?\s*(什么是|什么叫|何为|何谓|介绍一下|简单介绍|解释一下)"
+    r"|是什么|是啥|指什么|什么意思|的定义|的含义|的作用|的原理|哪些|哪个|哪种|有什么|是多少|是否|能否|怎么|如何|怎样"
+    r"|介绍\s*[?？。.]?\s*$"
+    r"|^\s*(what|which|who|where|when|why|how|does|is|are|can|define)\b",
+    re.IGNORECASE,
+)
+
+# 需要多个步骤才能完成的目标，每类特征各自降低置信度
+_MULTI_STEP = (
+    ("compare", re.compile(r"比较|对比|区别|差异|异同|优缺点|优劣|\bvs\.?\b|versus|compare|difference|pros and cons", re.IGNORECASE)),
+    ("sequence", re.compile(r"首先|其次|然后|之后再|接着|最后再|第[一二三1-3]步|分步|逐步|一步步|step by step|and then|\bthen\b", re.IGNORECASE)),
+    ("task", re.compile(r"设计|规划|方案|计算|推导|编写|写一[个份篇段]|生成|制定|评估|汇总|综合|列出所有|\b(design|plan|calculate|write|generate|evaluate)\b", re.IGNORECASE)),
+    ("conjunction", re.compile(r"并且|并给出|并说明|同时|分别|以及|另外", re.IGNORECASE)),
+)
+
+# 编号列表（"1." "2、" "一、"）通常表示多个子问题
+_ENUMERATION = re.compile(r"(^|\s)([1-9][.、)）]|[一二三四五][、.])")
+_QUESTION_MARK = re.compile(r"[?？]")
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """意图路由结果"""
+    route: str                  # ROUTE_DIRECT / ROUTE_PLAN
+    confidence: float           # 直接检索的置信度，0 ~ 1
+    reasons: Tuple[str, ...]    # 命中的特征，用于日志和离线评估
+
+
+def score_query(query: str) -> Tuple[float, Tuple[str, ...]]:
+    """
+    计算问题可以直接检索回答的置信度。
+
+    Args:
+        query (str): 用户本轮的输入
+
+    Returns:
+        Tuple[float, Tuple[str, ...]]: (置信度, 命中的特征)
+    """
+    text = query.strip()
+    score, reasons = _PRIOR, []
+    if _LOOKUP.search(text):
+        score += 0.3
+        reasons.append("lookup")
+    if len(text) <= settings.INTENT_ROUTER_SHORT_CHARS:
+        score += 0.1
+        reasons.append("short")
+    elif len(text) > settings.INTENT_ROUTER_LONG_CHARS:
+        score -= 0.3
+        reasons.append("long")
+    for name, pattern in _MULTI_STEP:
+        if pattern.search(text):
+            score -= 0.35
+            reasons.append(name)
+    if len(_QUESTION_MARK.findall(text)) > 1 or _ENUMERATION.search(text):
+        score -= 0.3
+        reasons.append("multi_question")
+    return round(min(max(score, 0.0), 1.0), 2), tuple(reasons)
+
+
+def route_query(query: str, threshold: Optional[float] = None) -> RouteDecision:
+    """
+    决定本轮问题走直接检索还是计划流程。
+
+    Args:
+        query (str): 用户本轮的输入
+        threshold (Optional[float]): 直接检索所需的最低置信度，默认使用 INTENT_ROUTER_THRESHOLD
+
+    Returns:
+        RouteDecision: 路由结果
+    """
+    threshold = settings.INTENT_ROUTER_THRESHOLD if threshold is None else threshold
+    confidence, reasons = score_query(query)
+    route = ROUTE_DIRECT if confidence >= threshold else ROUTE_PLAN
+    return RouteDecision(route=route, confidence=confidence, reasons=reasons)
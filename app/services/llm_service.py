@@ -3,6 +3,7 @@
 from functools import lru_cache
 from langchain_openai import ChatOpenAI
 
+from app.core.http_client import get_http_client_proxy, get_upstream_config
 from config.settings import settings
 
 @lru_cache
@@ -10,19 +11,23 @@ def get_llm(model_name: str = None) -> ChatOpenAI:
     """
     获取一个配置好的 ChatOpenAI 实例。
     使用 lru_cache 确保在整个应用生命周期中只有一个 LLM 客户端实例。
-    这对于复用底层 HTTP 连接非常重要。
+    所有实例共享 one_api 上游的连接池，这对于复用底层 HTTP 连接非常重要。
+    实例在模块导入时即被创建并长期持有，因此使用客户端代理，连接池关闭重建后仍使用新的连接池。
     
     Args:
         model_name (str, optional): 模型名称，如果未提供则使用默认设置
     """
     model = model_name if model_name else settings.ONE_API_MODEL
+    upstream = get_upstream_config("one_api")
     
     return ChatOpenAI(
         model=model,  # 使用配置的模型或指定的模型
         base_url=settings.ONE_API_BASE_URL,
         api_key=settings.ONE_API_KEY,
         temperature=0,
-        max_retries=2, # 可选：增加重试
+        max_retries=settings.ONE_API_MAX_RETRIES,
+        timeout=upstream.timeout,
+        http_async_client=get_http_client_proxy("one_api"),
     )
 
 @lru_cache
@@ -0,0 +1,375 @@
+# app/services/memory_writer.py
+import asyncio
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.core.deadline import clear_deadline
+from app.core.metrics import metrics
+from app.schemas.graph_state import Plan
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 写入函数签名: (session_id, plan) -> None，失败时抛出异常
+WriteFunc = Callable[[str, Plan], Awaitable[None]]
+
+
+async def _default_write(session_id: str, plan: Plan) -> None:
+    # 延迟导入，避免在仅使用队列时就初始化 mem0 客户端
+    from app.services.tools.mem0_service import get_mem0_service
+    await get_mem0_service().add_completed_plan(session_id, plan, raise_on_error=True)
+
+
+class MemoryWriter:
+    """
+    记忆的后台写入队列（write-behind）。
+
+    `store_plan` 只把计划放入内存中的按会话分组的待写队列并立即返回，
+    由后台任务按会话批量写入 Mem0：同一会话的计划按提交顺序依次写入，不同会话并发写入。
+    写入失败时按指数退避重试，重试耗尽或应用关闭时仍未写入的计划会追加到本地 JSONL 日志，
+    在启动时以及之后每隔 replay_interval 秒重放。
+
+    gunicorn 的多个 worker 共享同一个日志文件：追加时持有文件锁（fcntl.flock），
+    重放时先把日志原子地改名为本进程专用的文件再读取，因此每条记录只会被一个 worker 重放，
+    改名之后的追加会写入新的日志文件而不会随被认领的文件一起删除。日志的读写都在线程中进行，不阻塞事件循环。
+
+    会话回滚后，各 worker 共享的回滚标记（每个会话一个文件，记录回滚时间）使回滚之前提交的计划失效：
+    无论它们还在某个 worker 的队列中还是已经落盘，写入和重放前都会被丢弃，不会在 Mem0 中复活。
+    """
+
+    def __init__(
+        self,
+        write_func: Optional[WriteFunc] = None,
+        journal_path: Optional[str] = None,
+        max_retries: Optional[int] = None,
+        retry_backoff: Optional[float] = None,
+        concurrency: Optional[int] = None,
+        replay_interval: Optional[float] = None,
+    ):
+        self._write = write_func or _default_write
+        self.journal_path = journal_path or settings.MEMORY_WRITE_JOURNAL_PATH
+        self.max_retries = settings.MEMORY_WRITE_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_backoff = settings.MEMORY_WRITE_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        self._concurrency = concurrency or settings.MEMORY_WRITE_CONCURRENCY
+        self.replay_interval = settings.MEMORY_WRITE_REPLAY_INTERVAL if replay_interval is None else replay_interval
+        self._replay_task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, List[Plan]] = {}
+        # 每个会话正在写入的批次（写入成功的计划会从列表头部移除）
+        self._inflight: Dict[str, List[Plan]] = {}
+        # 计划的提交时间（按 message_id），与回滚标记比较
+        self._submitted_at: Dict[str, float] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._journal_lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def pending_count(self) -> int:
+        """尚未写入的计划数"""
+        return sum(len(plans) for plans in self._pending.values())
+
+    def pending_plans(self, session_id: str) -> List[Plan]:
+        """该会话已提交但尚未写入 Mem0 的计划（包括正在写入的批次），按提交顺序排列"""
+        return list(self._inflight.get(session_id, [])) + list(self._pending.get(session_id, []))
+
+    @property
+    def revert_dir(self) -> str:
+        """各 worker 共享的会话回滚标记目录"""
+        return f"{self.journal_path}.reverts"
+
+    def store_plan(self, session_id: str, plan: Plan, submitted_at: Optional[float] = None) -> None:
+        """
+        提交一个已完成的计划，立即返回。
+
+        Args:
+            session_id (str): 会话ID
+            plan (Plan): 已完成的计划
+            submitted_at (Optional[float]): 原始提交时间，重放日志时传入；为空时取当前时间
+        """
+        self._submitted_at[plan.message_id] = time.time() if submitted_at is None else submitted_at
+        if self._closed:
+            # 已关闭时不再启动新的写入任务，直接同步落盘等待下次启动重放（只发生在关闭阶段）
+            self._spill(session_id, [plan], reason="writer closed")
+            return
+
+        self._pending.setdefault(session_id, []).append(plan)
+        metrics.add_gauge("memory_write_pending", 1)
+        if session_id not in self._tasks:
+            self._tasks[session_id] = asyncio.create_task(self._drain_session(session_id))
+
+    async def _drain_session(self, session_id: str) -> None:
+        # 任务继承了提交计划的请求的上下文；写入在请求结束后继续进行，不受请求截止时间约束
+        clear_deadline()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        batch: List[Plan] = []
+        try:
+            async with self._semaphore:
+                # 写入期间新提交的计划会在下一轮中一并处理
+                while self._pending.get(session_id):
+                    batch = self._inflight[session_id] = self._pending.pop(session_id)
+                    while batch:
+                        plan = batch[0]
+                        reverted_at = await asyncio.to_thread(self._reverted_at, session_id)
+                        if self._submitted_at.get(plan.message_id, 0.0) < reverted_at:
+                            # 提交之后会话已被回滚（可能发生在其他 worker 上）：丢弃
+                            self._discard(session_id, plan)
+                        elif not await self._write_with_retry(session_id, plan):
+                            await asyncio.to_thread(self._spill, session_id, batch, "retries exhausted")
+                            metrics.add_gauge("memory_write_pending", -len(batch))
+                            batch = []
+                            break
+                        self._submitted_at.pop(plan.message_id, None)
+                        batch.pop(0)
+                        metrics.add_gauge("memory_write_pending", -1)
+        except asyncio.CancelledError:
+            # 关闭时被取消：当前批次和后续待写的计划一起落盘（线程中的写入不会被再次取消打断）
+            remaining = batch + self._pending.pop(session_id, [])
+            if remaining:
+                await asyncio.to_thread(self._spill, session_id, remaining, "shutdown")
+                metrics.add_gauge("memory_write_pending", -len(remaining))
+            raise
+        finally:
+            self._inflight.pop(session_id, None)
+            self._tasks.pop(session_id, None)
+
+    async def _write_with_retry(self, session_id: str, plan: Plan) -> bool:
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                await self._write(session_id, plan)
+                metrics.observe("memory_write_seconds", time.perf_counter() - start)
+                metrics.inc("memory_writes_total", result="success")
+                return True
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"Memory write for plan {plan.message_id} (session {session_id}) failed after {attempt + 1} attempts: {e}")
+                    return False
+                delay = self.retry_backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+                metrics.inc("memory_writes_total", result="retry")
+                logger.warning(f"Memory write for plan {plan.message_id} failed (attempt {attempt + 1}), retrying in {delay:.2f}s: {e}")
+                await asyncio.sleep(delay)
+        return False
+
+    def _discard(self, session_id: str, plan: Plan) -> None:
+        metrics.inc("memory_writes_total", result="reverted")
+        logger.info(f"Dropping memory write for plan {plan.message_id}: session {session_id} was reverted after it was submitted")
+
+    def _spill(self, session_id: str, plans: List[Plan], reason: str) -> None:
+        """将未写入的计划追加到本地日志（阻塞调用，在事件循环中需放到线程里执行）"""
+        lines = "".join(
+            json.dumps({
+                "session_id": session_id,
+                "submitted_at": self._submitted_at.pop(plan.message_id, time.time()),
+                "plan": plan.model_dump(mode="json"),
+            }, ensure_ascii=False) + "\n"
+            for plan in plans
+        )
+        try:
+            with self._journal_lock:
+                self._append_journal(lines)
+            metrics.inc("memory_writes_total", len(plans), result="spilled")
+            logger.warning(f"Spilled {len(plans)} memory writes for session {session_id} to {self.journal_path} ({reason})")
+        except OSError as e:
+            metrics.inc("memory_writes_total", len(plans), result="lost")
+            logger.critical(f"Failed to spill {len(plans)} memory writes for session {session_id}: {e}", exc_info=True)
+
+    def _append_journal(self, lines: str) -> None:
+        """持有文件锁追加日志；打开后文件已被其他 worker 认领（改名）时重新打开新的日志文件"""
+        os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+        while True:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(self.journal_path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != os.fstat(f.fileno()).st_ino:
+                    continue
+                f.write(lines)
+                f.flush()
+                return
+
+    def _claim_journal(self) -> List[str]:
+        """
+        认领待重放的日志文件：把共享日志改名为本进程专用的文件，
+        并一并认领进程已退出（重放中途崩溃）的 worker 遗留的文件。
+
+        Returns:
+            List[str]: 已认领的文件路径
+        """
+        claimed = []
+        candidates = [self.journal_path] + [
+            path for path in glob.glob(f"{glob.escape(self.journal_path)}.*.replay")
+            if not self._owner_alive(path)
+        ]
+        for path in candidates:
+            target = f"{self.journal_path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.replay"
+            try:
+                # 改名是原子操作，同一个文件只有一个 worker 能认领成功
+                os.replace(path, target)
+            except FileNotFoundError:
+                continue
+            claimed.append(target)
+        return claimed
+
+    @staticmethod
+    def _owner_alive(path: str) -> bool:
+        """认领文件名中的进程号对应的进程是否仍在运行"""
+        try:
+            pid = int(path.rsplit(".", 3)[-3])
+        except (IndexError, ValueError):
+            return False
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _marker_path(self, session_id: str) -> str:
+        return os.path.join(self.revert_dir, hashlib.sha256(session_id.encode("utf-8")).hexdigest())
+
+    def _reverted_at(self, session_id: str) -> float:
+        """会话最近一次回滚的时间，没有回滚过时为 0"""
+        try:
+            with open(self._marker_path(session_id), "r", encoding="utf-8") as f:
+                return float(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+    def _write_marker(self, session_id: str, reverted_at: float) -> None:
+        path = self._marker_path(session_id)
+        os.makedirs(self.revert_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(repr(reverted_at))
+        os.replace(tmp_path, path)
+
+    async def mark_reverted(self, session_id: str, reverted_at: Optional[float] = None) -> None:
+        """
+        记录会话已回滚：在此时间之前提交、尚未写入的计划（任何 worker 的队列中或日志中）都将被丢弃。
+
+        Args:
+            session_id (str): 会话ID
+            reverted_at (Optional[float]): 回滚开始的时间，为空时取当前时间
+        """
+        await asyncio.to_thread(self._write_marker, session_id, time.time() if reverted_at is None else reverted_at)
+
+    def _read_journal(self) -> List[dict]:
+        """认领并读取日志，删除已认领的文件，跳过回滚之前提交的记录（阻塞调用）"""
+        lines: List[str] = []
+        with self._journal_lock:
+            for path in self._claim_journal():
+                with open(path, "r", encoding="utf-8") as f:
+                    # 等待认领前已经开始的追加写完成
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    lines.extend(f.readlines())
+                os.remove(path)
+
+        entries = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                entry["plan"] = Plan.model_validate(entry["plan"])
+            except Exception as e:
+                logger.error(f"Skipping unreadable memory journal entry: {e}")
+                continue
+            if entry.get("submitted_at", 0.0) < self._reverted_at(entry["session_id"]):
+                self._discard(entry["session_id"], entry["plan"])
+                continue
+            entries.append(entry)
+        return entries
+
+    async def replay_journal(self) -> int:
+        """
+        将本地日志中未写入的计划重新提交到队列，并删除已认领的日志。
+
+        Returns:
+            int: 重新提交的计划数
+        """
+        replayed = 0
+        for entry in await asyncio.to_thread(self._read_journal):
+            self.store_plan(entry["session_id"], entry["plan"], submitted_at=entry.get("submitted_at"))
+            replayed += 1
+        if replayed:
+            metrics.inc("memory_journal_replayed_total", replayed)
+            logger.info(f"Replayed {replayed} memory writes from {self.journal_path}")
+        return replayed
+
+    async def _replay_periodically(self) -> None:
+        """定期重放日志：重试耗尽后落盘的计划在 Mem0 恢复后写入，而不必等到下次部署"""
+        clear_deadline()
+        while not self._closed:
+            await asyncio.sleep(self.replay_interval)
+            try:
+                if not self._closed:
+                    await self.replay_journal()
+            except Exception as e:
+                logger.error(f"Periodic memory journal replay failed: {e}", exc_info=True)
+
+    async def flush(self, session_id: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+        """
+        等待待写计划全部写入。
+
+        Args:
+            session_id (Optional[str]): 只等待指定会话；为空时等待所有会话
+            timeout (Optional[float]): 最长等待时间（秒）
+
+        Returns:
+            bool: 在超时前全部写入返回 True
+        """
+        deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+        while True:
+            if session_id is None:
+                tasks = list(self._tasks.values())
+            else:
+                tasks = [self._tasks[session_id]] if session_id in self._tasks else []
+            if not tasks:
+                return True
+            remaining = None if deadline is None else deadline - asyncio.get_running_loop().time()
+            if remaining is not None and remaining <= 0:
+                return False
+            await asyncio.wait(tasks, timeout=remaining)
+
+    async def start(self) -> None:
+        """应用启动时调用：重放上次未写入的计划，并启动定期重放"""
+        self._closed = False
+        await self.replay_journal()
+        if self.replay_interval > 0 and self._replay_task is None:
+            self._replay_task = asyncio.create_task(self._replay_periodically())
+
+    async def close(self, timeout: Optional[float] = None) -> None:
+        """
+        应用关闭时调用：在超时内尽量写完队列，剩余的计划落盘。
+        """
+        timeout = settings.MEMORY_WRITE_SHUTDOWN_TIMEOUT if timeout is None else timeout
+        self._closed = True
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            await asyncio.gather(self._replay_task, return_exceptions=True)
+            self._replay_task = None
+        if not await self.flush(timeout=timeout):
+            tasks = list(self._tasks.values())
+            logger.warning(f"Memory writer did not drain within {timeout}s; spilling unfinished writes to {self.journal_path}")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# 全局单例实例
+memory_writer = MemoryWriter()
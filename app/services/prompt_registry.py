@@ -0,0 +1,136 @@
+# app/services/prompt_registry.py
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import orjson
+
+from app.core.metrics import metrics
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 内置提示词目录：app/prompts/<name>.md
+DEFAULT_PROMPT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "prompts")
+
+# /ragflow-stream 代理使用的系统提示词（智源人设，含 RAGFlow 的 {knowledge} 占位符）
+RAGFLOW_SYSTEM_PROMPT = "ragflow_system"
+
+
+@dataclass(frozen=True)
+class Prompt:
+    """
+    一个已加载的提示词版本。
+    version 由内容哈希得到，各 worker 一致，可用于缓存键和上游前缀缓存。
+    """
+    name: str
+    text: str
+    version: str
+    mtime: float
+    # 预先序列化好的请求体前缀：system 消息在最前，保证每次请求的前缀字节完全相同
+    payload_prefix: bytes = field(repr=False)
+
+    def chat_payload(self, model: str, user_message: str, stream: bool) -> bytes:
+        """
+        拼接 OpenAI 兼容的 chat/completions 请求体（JSON 字节），只需序列化随请求变化的部分。
+
+        Returns:
+            bytes: {"messages": [system, user], "model": ..., "stream": ..., "metadata": {"prompt_version": ...}}
+        """
+        return b"".join((
+            self.payload_prefix,
+            orjson.dumps(user_message),
+            b'}],"model":',
+            orjson.dumps(model),
+            b',"stream":',
+            b"true" if stream else b"false",
+            b',"metadata":{"prompt_version":',
+            orjson.dumps(self.version),
+            b"}}",
+        ))
+
+
+class PromptRegistry:
+    """
+    带版本的提示词注册表。
+    提示词以 <name>.md 文件保存在提示词目录中，启动时加载；
+    之后每隔 reload_interval 秒最多检查一次文件修改时间，变化时热加载，无需重启。
+    重新加载失败时继续使用上一个版本。
+    """
+
+    def __init__(self, prompt_dir: str = DEFAULT_PROMPT_DIR, reload_interval: float = 5.0):
+        self.prompt_dir = prompt_dir
+        self.reload_interval = reload_interval
+        self._prompts: Dict[str, Prompt] = {}
+        self._checked_at: Dict[str, float] = {}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.prompt_dir, f"{name}.md")
+
+    def _load(self, name: str) -> Prompt:
+        path = self._path(name)
+        mtime = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        version = f"{name}@{hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]}"
+        prompt = Prompt(
+            name=name,
+            text=text,
+            version=version,
+            mtime=mtime,
+            payload_prefix=b'{"messages":[{"role":"system","content":' + orjson.dumps(text) + b'},{"role":"user","content":',
+        )
+        previous = self._prompts.get(name)
+        self._prompts[name] = prompt
+        self._checked_at[name] = time.monotonic()
+        if previous is None:
+            logger.info(f"Loaded prompt {version} from {path}")
+        elif previous.version != version:
+            metrics.inc("prompt_reloads_total", prompt=name)
+            logger.warning(f"Reloaded prompt {name}: {previous.version} -> {version}")
+        return prompt
+
+    def load_all(self) -> int:
+        """
+        加载提示词目录中的全部提示词（应用启动时调用）。
+
+        Returns:
+            int: 加载的提示词数量
+        """
+        names = sorted(f[:-len(".md")] for f in os.listdir(self.prompt_dir) if f.endswith(".md"))
+        for name in names:
+            self._load(name)
+        return len(names)
+
+    def reload(self, name: Optional[str] = None) -> None:
+        """立即重新加载指定（或全部已加载的）提示词"""
+        for prompt_name in [name] if name else list(self._prompts):
+            self._load(prompt_name)
+
+    def get(self, name: str) -> Prompt:
+        """
+        获取提示词的当前版本。
+
+        Raises:
+            FileNotFoundError: 提示词从未加载成功且文件不存在
+        """
+        prompt = self._prompts.get(name)
+        if prompt is None:
+            return self._load(name)
+
+        now = time.monotonic()
+        if self.reload_interval > 0 and now - self._checked_at.get(name, 0.0) >= self.reload_interval:
+            self._checked_at[name] = now
+            try:
+                if os.stat(self._path(name)).st_mtime != prompt.mtime:
+                    prompt = self._load(name)
+            except OSError as e:
+                logger.error(f"Failed to reload prompt {name}, keeping {prompt.version}: {e}")
+        return prompt
+
+
+# 全局单例实例
+prompt_registry = PromptRegistry(settings.PROMPT_DIR or DEFAULT_PROMPT_DIR, settings.PROMPT_RELOAD_INTERVAL)
@@ -0,0 +1,326 @@
+# app/services/semantic_cache.py
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from openai import AsyncOpenAI
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, Choice, ChoiceDelta
+
+from app.core.http_client import get_http_client_proxy
+from app.core.metrics import metrics
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 缓存命名空间：不同入口的系统提示词不同，答案不能混用
+NAMESPACE_KNOWLEDGE_SEARCH = "knowledge_search"  # ragflow_knowledge_search / ragflow_stream_answer 工具
+NAMESPACE_RAGFLOW_STREAM = "ragflow_stream"      # /ragflow-stream 代理接口
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """规范化查询文本：去除首尾空白并合并连续空白"""
+    return _WHITESPACE.sub(" ", query.strip())
+
+
+class OneApiEmbedder:
+    """使用 one-api 上配置的 Embedding 模型（ONE_API_EMBEDDING_MODEL）计算查询向量"""
+
+    def __init__(self):
+        self._client = AsyncOpenAI(
+            api_key=settings.ONE_API_EMBEDDING_KEY,
+            base_url=settings.ONE_API_BASE_URL,
+            # 语义缓存是长期持有的单例，通过代理使用 one_api 当前的连接池
+            http_client=get_http_client_proxy("one_api")
+        )
+
+    async def embed(self, text: str) -> List[float]:
+        response = await self._client.embeddings.create(model=settings.ONE_API_EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+
+
+class LocalVectorIndex:
+    """
+    进程内的向量索引。
+    每个命名空间一个归一化向量矩阵，按余弦相似度（点积）做精确的最近邻搜索；超过容量时淘汰最早写入的条目。
+    """
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._entries: Dict[str, List[dict]] = {}
+
+    async def search(self, namespace: str, vector: np.ndarray, now: float) -> Optional[Tuple[float, dict]]:
+        matrix = self._vectors.get(namespace)
+        if matrix is None or not len(matrix):
+            return None
+        entries = self._entries[namespace]
+        scores = matrix @ vector
+        # 过期条目不参与比较，不会遮住相似度次高的有效条目（过期条目在下次写入时清理）
+        expired = np.fromiter((e["expires_at"] <= now for e in entries), dtype=bool, count=len(entries))
+        if expired.all():
+            return None
+        scores[expired] = -np.inf
+        best = int(np.argmax(scores))
+        return float(scores[best]), entries[best]
+
+    async def add(self, namespace: str, vector: np.ndarray, entry: dict) -> None:
+        matrix = self._vectors.get(namespace)
+        entries = self._entries.setdefault(namespace, [])
+        now = time.time()
+        # 写入时顺带清理过期条目，并在超出容量时淘汰最早的条目
+        keep = [i for i, e in enumerate(entries) if e["expires_at"] > now]
+        if len(keep) >= self.max_entries:
+            keep = keep[len(keep) - self.max_entries + 1:]
+        if matrix is not None and len(keep) != len(entries):
+            matrix = matrix[keep]
+            entries[:] = [entries[i] for i in keep]
+        row = vector.reshape(1, -1)
+        self._vectors[namespace] = row if matrix is None or not len(matrix) else np.vstack([matrix, row])
+        entries.append(entry)
+
+    async def clear(self, namespace: Optional[str] = None) -> None:
+        if namespace is None:
+            self._vectors.clear()
+            self._entries.clear()
+        else:
+            self._vectors.pop(namespace, None)
+            self._entries.pop(namespace, None)
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._entries.values())
+
+
+class CacheGeneration:
+    """
+    多个 worker 共享的缓存代次，保存在本地文件中。
+    进程内索引（LocalVectorIndex）只属于单个 worker：任一 worker 失效缓存时写入新的代次，
+    其他 worker 在下一次查找或写入前发现代次变化，随即清空自己的索引。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._seen = self._read()
+
+    def _read(self) -> str:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ""
+
+    def bump(self) -> None:
+        """写入新的代次（先写临时文件再原子改名，其他 worker 不会读到写了一半的内容）"""
+        generation = uuid.uuid4().hex
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(generation)
+        os.replace(tmp_path, self.path)
+        self._seen = generation
+
+    def changed(self) -> bool:
+        """自上次检查以来代次是否被其他 worker 改变"""
+        current = self._read()
+        if current == self._seen:
+            return False
+        self._seen = current
+        return True
+
+
+class QdrantVectorIndex:
+    """
+    基于现有 Qdrant 部署的向量索引，所有 worker 共享同一个集合。
+    命名空间和过期时间保存在 payload 中，查询时按命名空间过滤。
+    """
+
+    def __init__(self, collection: str):
+        from qdrant_client import AsyncQdrantClient
+        self.collection = collection
+        self._client = AsyncQdrantClient(host=settings.MEM_0_VECTOR_STORE_HOST, port=settings.MEM_0_VECTOR_STORE_PORT)
+        self._ready = False
+
+    async def _ensure_collection(self, size: int) -> None:
+        if self._ready:
+            return
+        from qdrant_client.models import Distance, VectorParams
+        if not await self._client.collection_exists(self.collection):
+            await self._client.create_collection(
+                self.collection, vectors_config=VectorParams(size=size, distance=Distance.COSINE)
+            )
+        self._ready = True
+
+    def _filter(self, namespace: str):
+        from qdrant_client.models import FieldCondition, Filter, MatchValue
+        return Filter(must=[FieldCondition(key="namespace", match=MatchValue(value=namespace))])
+
+    async def search(self, namespace: str, vector: np.ndarray, now: float) -> Optional[Tuple[float, dict]]:
+        from qdrant_client.models import FieldCondition, Range
+        await self._ensure_collection(len(vector))
+        # 只在未过期的条目中查找
+        query_filter = self._filter(namespace)
+        query_filter.must.append(FieldCondition(key="expires_at", range=Range(gt=now)))
+        response = await self._client.query_points(
+            self.collection, query=vector.tolist(), query_filter=query_filter, limit=1, with_payload=True
+        )
+        if not response.points:
+            return None
+        point = response.points[0]
+        return point.score, point.payload
+
+    async def add(self, namespace: str, vector: np.ndarray, entry: dict) -> None:
+        from qdrant_client.models import FieldCondition, Filter, FilterSelector, PointStruct, Range
+        await self._ensure_collection(len(vector))
+        await self._client.upsert(self.collection, points=[
+            PointStruct(id=str(uuid.uuid4()), vector=vector.tolist(), payload={**entry, "namespace": namespace})
+        ])
+        # 写入时顺带清理该命名空间中已过期的条目
+        expired = self._filter(namespace)
+        expired.must.append(FieldCondition(key="expires_at", range=Range(lte=time.time())))
+        await self._client.delete(self.collection, points_selector=FilterSelector(filter=expired))
+
+    async def clear(self, namespace: Optional[str] = None) -> None:
+        from qdrant_client.models import FilterSelector
+        if namespace is None:
+            await self._client.delete_collection(self.collection)
+            self._ready = False
+        else:
+            await self._client.delete(self.collection, points_selector=FilterSelector(filter=self._filter(namespace)))
+
+
+class SemanticCache:
+    """
+    RAGFlow 知识问答的语义答案缓存。
+    以（重写后的）查询的 Embedding 为键，余弦相似度不低于阈值即视为命中；
+    条目带 TTL，知识库更新后可通过 invalidate 手动清空。缓存故障只会降级为未命中。
+    使用进程内索引时需传入 generation，使一个 worker 上的失效对所有 worker 生效。
+    """
+
+    def __init__(self, embedder, index, threshold: float = 0.92, ttl: float = 86400.0, embedding_cache_size: int = 256,
+                 generation: Optional[CacheGeneration] = None):
+        self.embedder = embedder
+        self.index = index
+        self.generation = generation
+        self.threshold = threshold
+        self.ttl = ttl
+        # 同一查询在 lookup 之后紧接着 store，复用刚算出的向量
+        self._embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._embedding_cache_size = embedding_cache_size
+
+    async def _embed(self, query: str) -> np.ndarray:
+        vector = self._embeddings.get(query)
+        if vector is None:
+            vector = np.asarray(await self.embedder.embed(query), dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector = vector / norm
+            self._embeddings[query] = vector
+            while len(self._embeddings) > self._embedding_cache_size:
+                self._embeddings.popitem(last=False)
+        else:
+            self._embeddings.move_to_end(query)
+        return vector
+
+    async def _sync_generation(self) -> None:
+        """其他 worker 已失效缓存时清空本进程的索引"""
+        if self.generation is not None and self.generation.changed():
+            await self.index.clear()
+            logger.info("Semantic cache invalidated by another worker, local index cleared")
+
+    async def lookup(self, query: str, namespace: str) -> Optional[str]:
+        """
+        查找语义相近的已缓存答案。
+
+        Returns:
+            Optional[str]: 命中时返回缓存的答案，否则返回 None
+        """
+        query = normalize_query(query)
+        try:
+            await self._sync_generation()
+            match = await self.index.search(namespace, await self._embed(query), time.time())
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed, treating as miss: {e}")
+            match = None
+
+        if match is not None:
+            score, entry = match
+            if score >= self.threshold:
+                metrics.inc("semantic_cache_requests_total", result="hit", namespace=namespace)
+                logger.info(f"Semantic cache hit ({score:.3f}) for '{query[:50]}' -> '{entry['query'][:50]}'")
+                return entry["answer"]
+        metrics.inc("semantic_cache_requests_total", result="miss", namespace=namespace)
+        return None
+
+    async def store(self, query: str, answer: str, namespace: str) -> None:
+        """缓存一个查询的完整答案"""
+        if not answer:
+            return
+        query = normalize_query(query)
+        try:
+            await self._sync_generation()
+            entry = {"query": query, "answer": answer, "created_at": time.time(), "expires_at": time.time() + self.ttl}
+            await self.index.add(namespace, await self._embed(query), entry)
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
+
+    async def invalidate(self, namespace: Optional[str] = None) -> None:
+        """清空缓存（知识库更新后调用）；namespace 为空时清空所有命名空间"""
+        if self.generation is not None:
+            # 代次不区分命名空间：其他 worker 会清空整个进程内索引
+            self.generation.bump()
+        await self.index.clear(namespace)
+        metrics.inc("semantic_cache_invalidations_total")
+        logger.warning(f"Semantic cache invalidated (namespace: {namespace or 'all'})")
+
+
+def replay_chunks(answer: str, model: str = "ragflow", chunk_chars: int = 16) -> Iterator[str]:
+    """
+    将缓存的完整答案重放为 OpenAI chat.completion.chunk 格式的 JSON 文本序列。
+    与上游流一致：每个 chunk 携带一段 content，最后一个 chunk 的 finish_reason 为 stop。
+    """
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(datetime.now().timestamp())
+    pieces = [answer[i:i + chunk_chars] for i in range(0, len(answer), chunk_chars)] or [""]
+    for i, piece in enumerate(pieces):
+        last = i == len(pieces) - 1
+        chunk = ChatCompletionChunk(
+            id=completion_id,
+            choices=[Choice(
+                delta=ChoiceDelta(content=piece, role="assistant"),
+                finish_reason="stop" if last else None,
+                index=0,
+                logprobs=None
+            )],
+            created=created,
+            model=model,
+            object="chat.completion.chunk",
+        )
+        yield chunk.model_dump_json(exclude_unset=True)
+
+
+@lru_cache(maxsize=1)
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """
+    获取语义缓存实例（单例）；未启用 SEMANTIC_CACHE_ENABLED 时返回 None。
+    """
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return None
+    generation = None
+    if settings.SEMANTIC_CACHE_BACKEND == "qdrant":
+        index = QdrantVectorIndex(settings.SEMANTIC_CACHE_COLLECTION)
+    else:
+        # 每个 worker 各有一份进程内索引，失效通过共享的代次文件广播
+        index = LocalVectorIndex(settings.SEMANTIC_CACHE_MAX_ENTRIES)
+        generation = CacheGeneration(settings.SEMANTIC_CACHE_GENERATION_PATH)
+    logger.info(f"Semantic answer cache enabled ({settings.SEMANTIC_CACHE_BACKEND} index, threshold {settings.SEMANTIC_CACHE_THRESHOLD})")
+    return SemanticCache(
+        OneApiEmbedder(), index, settings.SEMANTIC_CACHE_THRESHOLD, settings.SEMANTIC_CACHE_TTL, generation=generation
+    )
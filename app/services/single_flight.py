@@ -0,0 +1,144 @@
+# app/services/single_flight.py
+import asyncio
+import hashlib
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set
+
+from app.core.metrics import metrics
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 流结束标记
+_END = object()
+
+
+class SubscriberOverflow(Exception):
+    """订阅者消费过慢，待消费的帧超过缓冲上限，已被移出共享流"""
+
+
+def flight_key(*parts: str) -> str:
+    """由若干文本（规范化空白后）生成合并请求的键"""
+    normalized = "\x00".join(" ".join((part or "").split()) for part in parts)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class _Subscriber:
+    def __init__(self):
+        # 容量由 StreamSingleFlight 手动控制，保证结束标记总能放入
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.overflowed = False
+
+
+class _Flight:
+    def __init__(self, key: str):
+        self.key = key
+        self.frames: List[Any] = []  # 已收到的全部帧，供中途加入的订阅者重放
+        self.subscribers: Set[_Subscriber] = set()
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class StreamSingleFlight:
+    """
+    流式请求的合并层（single-flight）。
+
+    同一个键上并发的请求共享一个上游流：第一个请求启动上游（leader），之后的请求（follower）
+    先重放已收到的帧，再实时接收后续帧。每个订阅者有独立的有界缓冲，消费过慢的订阅者会被移出，
+    不会拖慢上游或其他订阅者。所有订阅者都断开时上游流被取消。
+    """
+
+    def __init__(self, subscriber_buffer: int = 256):
+        self.subscriber_buffer = subscriber_buffer
+        self._flights: Dict[str, _Flight] = {}
+
+    @property
+    def active(self) -> int:
+        """进行中的上游流数量"""
+        return len(self._flights)
+
+    def in_flight(self, key: str) -> bool:
+        """键上是否已有进行中的上游流（此时调用 stream 会作为 follower 加入）"""
+        return key in self._flights
+
+    async def _run(self, flight: _Flight, factory: Callable[[], AsyncIterator[Any]]) -> None:
+        metrics.add_gauge("single_flight_active", 1)
+        try:
+            async for item in factory():
+                flight.frames.append(item)
+                for sub in list(flight.subscribers):
+                    if sub.queue.qsize() >= self.subscriber_buffer:
+                        sub.overflowed = True
+                        sub.queue.put_nowait(_END)
+                        flight.subscribers.discard(sub)
+                        metrics.inc("single_flight_overflows_total")
+                        logger.warning(f"Single-flight subscriber fell {self.subscriber_buffer} frames behind, detaching it")
+                        continue
+                    sub.queue.put_nowait(item)
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            logger.error(f"Shared upstream stream failed: {e}", exc_info=True)
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            for sub in flight.subscribers:
+                sub.queue.put_nowait(_END)
+            metrics.add_gauge("single_flight_active", -1)
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        订阅键对应的共享流；没有进行中的流时调用 factory 启动一个。
+
+        Args:
+            key (str): 合并请求的键，见 flight_key
+            factory (Callable): 创建上游流（异步迭代器）的函数
+
+        Yields:
+            Any: 上游流的帧（中途加入时先重放已收到的帧）
+
+        Raises:
+            SubscriberOverflow: 订阅者消费过慢被移出共享流
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(key)
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(flight, factory))
+            metrics.inc("single_flight_requests_total", role="leader")
+        else:
+            metrics.inc("single_flight_requests_total", role="follower")
+            logger.info(f"Joining in-flight upstream stream ({len(flight.frames)} frames to replay, {len(flight.subscribers)} subscribers)")
+
+        # 快照与注册之间没有 await，不会漏帧或重复
+        replay = list(flight.frames)
+        sub = _Subscriber()
+        flight.subscribers.add(sub)
+        try:
+            for item in replay:
+                yield item
+            while True:
+                item = await sub.queue.get()
+                if item is _END:
+                    break
+                yield item
+            if sub.overflowed:
+                raise SubscriberOverflow()
+            if flight.error is not None and not isinstance(flight.error, asyncio.CancelledError):
+                raise flight.error
+        finally:
+            flight.subscribers.discard(sub)
+            if not flight.subscribers and not flight.done:
+                # 最后一个订阅者离开：取消上游，后续的相同请求重新发起
+                logger.info("All subscribers left the shared upstream stream, cancelling it")
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+
+# 全局单例实例
+ragflow_single_flight = StreamSingleFlight(settings.SINGLE_FLIGHT_SUBSCRIBER_BUFFER)
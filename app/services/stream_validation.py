@@ -0,0 +1,86 @@
+# app/services/stream_validation.py
+import logging
+import re
+
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from pydantic import ValidationError
+
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 校验模式
+VALIDATION_FULL = "full"                # 每个 chunk 都校验
+VALIDATION_SAMPLED = "sampled"          # 首个、末个以及每 N 个 chunk 校验一次
+VALIDATION_PASSTHROUGH = "passthrough"  # 首个 chunk 校验通过后，后续原样透传
+VALIDATION_MODES = (VALIDATION_FULL, VALIDATION_SAMPLED, VALIDATION_PASSTHROUGH)
+
+# 带有非空 finish_reason 的 chunk 即为流中的最后一个内容 chunk
+_FINAL_CHUNK = re.compile(r'"finish_reason"\s*:\s*"')
+
+
+class ChunkValidator:
+    """
+    单个流的 chunk 校验器。
+    决定每个上游 chunk 是否需要做 ChatCompletionChunk 校验，并统计被拒绝的帧数。
+    校验直接基于原始 JSON 文本（model_validate_json），不会重新序列化 chunk。
+    """
+
+    def __init__(self, mode: str = VALIDATION_FULL, sample_rate: int = 16):
+        """
+        Args:
+            mode (str): 校验模式，full / sampled / passthrough
+            sample_rate (int): sampled 模式下每多少个 chunk 校验一次
+        """
+        if mode not in VALIDATION_MODES:
+            raise ValueError(f"Unknown validation mode: {mode}")
+        self.mode = mode
+        self.sample_rate = max(1, sample_rate)
+        self.frames = 0
+        self.validated = 0
+        self.rejected = 0
+        self._trusted = False
+
+    def _should_validate(self, data: str) -> bool:
+        if self.mode == VALIDATION_FULL:
+            return True
+        if self.mode == VALIDATION_PASSTHROUGH:
+            return not self._trusted
+        # sampled: 首个 chunk、每第 N 个 chunk，以及带 finish_reason 的最后一个 chunk
+        return self.frames == 1 or self.frames % self.sample_rate == 0 or _FINAL_CHUNK.search(data) is not None
+
+    def check(self, data: str) -> bool:
+        """
+        按当前模式检查一个 chunk。
+
+        Args:
+            data (str): SSE 帧中的 JSON 文本
+
+        Returns:
+            bool: chunk 被校验且不合法时返回 False；合法或跳过校验时返回 True
+        """
+        self.frames += 1
+        if not self._should_validate(data):
+            return True
+
+        self.validated += 1
+        try:
+            ChatCompletionChunk.model_validate_json(data)
+        except (ValidationError, ValueError) as e:
+            self.rejected += 1
+            metrics.inc("ragflow_rejected_frames_total", mode=self.mode)
+            logger.warning(f"Rejected RAGFlow chunk #{self.frames} ({self.mode} validation): {e}")
+            return False
+
+        if self.mode == VALIDATION_PASSTHROUGH:
+            self._trusted = True
+        return True
+
+    def finish(self) -> None:
+        """流结束时记录本流的统计信息"""
+        metrics.inc("ragflow_frames_total", self.frames, mode=self.mode)
+        metrics.inc("ragflow_validated_frames_total", self.validated, mode=self.mode)
+        logger.debug(
+            f"RAGFlow stream finished: mode={self.mode}, frames={self.frames}, "
+            f"validated={self.validated}, rejected={self.rejected}"
+        )
@@ -1,19 +1,115 @@
 # app/services/mem0_service.py
+import asyncio
 import logging
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, List, Optional
 from app.schemas.graph_state import Plan
 from app.core.mem0_client import get_mem0_client
+from app.core.deadline import time_budget
+from app.core.metrics import metrics
+from app.services.history_cache import HistoryCache, history_cache as default_history_cache, plan_to_turn, turns_to_messages
+from app.services.memory_writer import memory_writer
+from config.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# mem0 的 Memory 客户端是同步的（add 会依次调用 LLM 抽取、Embedding 和向量库写入），
+# 所有调用都放到这个有界的专用线程池中执行，避免阻塞事件循环
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.MEM0_EXECUTOR_MAX_WORKERS,
+            thread_name_prefix="mem0"
+        )
+    return _executor
+
+
+def shutdown_mem0_executor(wait: bool = True) -> None:
+    """关闭 mem0 线程池，未开始执行的任务会被取消（应用关闭时调用）"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait, cancel_futures=True)
+        _executor = None
+
+
+async def run_in_mem0_executor(op: str, func: Callable[..., Any], *args, timeout: float, **kwargs) -> Any:
+    """
+    在 mem0 专用线程池中执行一个同步调用，并施加超时。
+    在请求中调用时超时不超过请求的剩余时间；后台写入队列中的调用没有截止时间，使用传入的超时。
+
+    排队中和执行中的任务数分别记录在 `mem0_executor_queued` / `mem0_executor_active` 仪表盘中，
+    每次调用的耗时记录在 `mem0_op_seconds{op}` 直方图中。
+    超时后仍在排队的任务会被取消；已经开始执行的线程无法被中断，会在后台执行完毕。
+
+    Args:
+        op (str): 操作名，用于指标标签
+        func (Callable): 要执行的同步函数
+        timeout (float): 超时时间（秒），受请求截止时间约束
+
+    Returns:
+        Any: 函数的返回值
+
+    Raises:
+        TimeoutError: 超过 timeout 仍未完成，或请求的截止时间已过（DeadlineExceeded）
+    """
+    timeout = time_budget(timeout)
+
+    def job():
+        metrics.add_gauge("mem0_executor_queued", -1)
+        metrics.add_gauge("mem0_executor_active", 1)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.add_gauge("mem0_executor_active", -1)
+
+    def on_done(future):
+        # 排队期间被取消的任务不会进入 job，需要在这里修正排队数
+        if future.cancelled():
+            metrics.add_gauge("mem0_executor_queued", -1)
+
+    metrics.add_gauge("mem0_executor_queued", 1)
+    future = _get_executor().submit(job)
+    future.add_done_callback(on_done)
+
+    start = time.perf_counter()
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+    except TimeoutError:
+        metrics.inc("mem0_op_timeouts_total", op=op)
+        logger.error(f"Mem0 operation '{op}' timed out after {timeout}s")
+        raise
+    finally:
+        metrics.observe("mem0_op_seconds", time.perf_counter() - start, op=op)
+
+
 class Mem0Service:
-    def __init__(self):
+    """
+    Mem0 记忆服务的异步适配器。
+    对同步 mem0 客户端的每次调用都在专用线程池中执行，并带有按操作区分的超时。
+    会话历史优先从 HistoryCache 读取，未命中时才调用 get_all。
+    """
+
+    def __init__(self, history_cache: Optional[HistoryCache] = None):
         self._client = get_mem0_client()
+        self.history_cache = history_cache or default_history_cache
         logger.info("Mem0 client initialized for Mem0Service from singleton.")
 
-    async def add_completed_plan(self, session_id: str, plan: Plan):
+    def _delete_many(self, ids: List[str]) -> None:
+        for mem_id in ids:
+            self._client.delete(id=mem_id)
+
+    async def add_completed_plan(self, session_id: str, plan: Plan, raise_on_error: bool = False):
         """
         将一个已完成的计划作为单条记忆存入 Mem0。
+
+        Args:
+            raise_on_error (bool): 写入失败时是否向上抛出异常（后台写入队列需要据此重试）
         """
         if not plan.final_summary:
             logger.warning(f"Plan {plan.message_id} has no final summary. Not adding to memory.")
@@ -27,33 +123,54 @@ class Mem0Service:
             # 记忆的内容是用户的目标和 AI 的最终总结
             memory_content = f"User Goal: {plan.goal}\nAI Response: {plan.final_summary}"
 
-            self._client.add(
+            await run_in_mem0_executor(
+                "add",
+                self._client.add,
                 memory_content,
                 user_id=session_id,
-                metadata={"plan": plan_json, "message_id": plan.message_id}
+                metadata={"plan": plan_json, "message_id": plan.message_id},
+                timeout=settings.MEM0_WRITE_TIMEOUT
             )
             logger.info(f"Added completed plan {plan.message_id} to memory for session {session_id}.")
         except Exception as e:
             logger.error(f"Failed to add plan to memory for session {session_id}: {e}", exc_info=True)
+            if raise_on_error:
+                raise
 
     async def get_memory_history(self, session_id: str) -> List[dict]:
         """
 
         从 Mem0 检索历史，并转换为 Planner 需要的 "messages" 格式。
+        优先读取会话历史缓存；未命中时从 Mem0 加载完整历史，合并后台写入队列中尚未落库的计划后写入缓存。
         """
+        cached = await self.history_cache.get_messages(session_id)
+        if cached is not None:
+            return cached
+
         try:
-            history = self._client.get_all(user_id=session_id, include_metadata=True)
-            messages = []
+            # 不等待后台写入（每次写入都包含一次 LLM 抽取）：在读取 Mem0 之前取出该会话尚未落库的计划，
+            # 读取后合并；读取期间刚好写入的计划会同时出现在两边，按 message_id 去重
+            unwritten = memory_writer.pending_plans(session_id)
+            history = await run_in_mem0_executor(
+                "get_all",
+                self._client.get_all,
+                user_id=session_id,
+                include_metadata=True,
+                timeout=settings.MEM0_READ_TIMEOUT
+            )
+            turns = []
             for mem in history:
                 metadata = mem.get("metadata", {})
                 if "plan" in metadata:
                     try:
                         plan_obj = Plan.model_validate_json(metadata["plan"])
-                        messages.append({"role": "user", "content": plan_obj.goal})
-                        messages.append({"role": "assistant", "content": plan_obj.final_summary})
+                        turns.append(plan_to_turn(plan_obj))
                     except Exception as e:
                         logger.warning(f"Failed to parse plan from memory metadata: {e}")
-            return messages
+            stored = {turn["message_id"] for turn in turns}
+            turns.extend(plan_to_turn(plan) for plan in unwritten if plan.final_summary and plan.message_id not in stored)
+            await self.history_cache.set_turns(session_id, turns)
+            return turns_to_messages(turns)
         except Exception as e:
             logger.error(f"Failed to retrieve memory for session {session_id}: {e}")
             return []
@@ -64,8 +181,16 @@ class Mem0Service:
         删除指定 message_id 之后的所有记忆。
         """
         logger.warning(f"Reverting memory for session {session_id} to turn {message_id}")
+        # 回滚开始之前提交、尚未写入 Mem0 的计划都属于被回滚的轮次
+        reverted_at = time.time()
         try:
-            all_memories = self._client.get_all(user_id=session_id, include_metadata=True)
+            all_memories = await run_in_mem0_executor(
+                "get_all",
+                self._client.get_all,
+                user_id=session_id,
+                include_metadata=True,
+                timeout=settings.MEM0_READ_TIMEOUT
+            )
             if not all_memories:
                 return
 
@@ -83,13 +208,37 @@ class Mem0Service:
             ids_to_delete = [mem["id"] for i, mem in enumerate(all_memories) if i > target_index]
 
             if not ids_to_delete:
+                # 目标之后的轮次可能还在后台写入队列或落盘日志中，同样需要标记回滚
+                await memory_writer.mark_reverted(session_id, reverted_at)
                 logger.info(f"No memories to delete after turn {message_id}.")
                 return
 
-            for mem_id in ids_to_delete:
-                self._client.delete(id=mem_id)
+            try:
+                await run_in_mem0_executor(
+                    "delete",
+                    self._delete_many,
+                    ids_to_delete,
+                    timeout=settings.MEM0_WRITE_TIMEOUT
+                )
+            except Exception:
+                # 删除可能只完成了一部分，缓存整体失效，下次从 Mem0 重新加载
+                await self.history_cache.invalidate(session_id)
+                raise
+            await memory_writer.mark_reverted(session_id, reverted_at)
+            await self.history_cache.truncate(session_id, message_id)
             logger.warning(f"Successfully deleted {len(ids_to_delete)} memories after turn {message_id}.")
 
         except Exception as e:
             logger.error(f"Failed to revert memory for session {session_id}: {e}", exc_info=True)
-            raise
\ No newline at end of file
+            raise
+
+
+@lru_cache(maxsize=1)
+def get_mem0_service() -> Mem0Service:
+    """
+    获取 Mem0Service 实例的缓存函数（单例模式）
+
+    Returns:
+        Mem0Service: 全局共享的记忆服务实例
+    """
+    return Mem0Service()
@@ -1,19 +1,54 @@
 # app/services/tools/ragflow_tools.py
-# import httpx
+import asyncio
+import hashlib
 import logging
-from typing import AsyncGenerator, List, Optional
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import AsyncGenerator, List, Optional, Tuple
+import httpx
 from langchain_core.tools import tool
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from openai import OpenAI, AsyncOpenAI, APIError
-from requests import Timeout
+from openai import AsyncOpenAI, APIError, APITimeoutError
 
 from config.settings import settings
-from app.core.exceptions import PpecCopilotException, ServiceUnavailableException
+from app.core.deadline import DeadlineExceeded, capped_timeout, time_budget
+from app.core.exceptions import CircuitOpenException, PpecCopilotException, ServiceUnavailableException
+from app.core.http_client import get_http_client, get_upstream_config
+from app.core.metrics import metrics
+from app.core.resilience import get_circuit_breaker
 from app.services.llm_service import get_llm
+from app.services.context_budget import count_tokens, report_prompt_tokens, split_recent_turns
+from app.services.semantic_cache import NAMESPACE_KNOWLEDGE_SEARCH, get_semantic_cache, normalize_query
 
 logger = logging.getLogger(__name__)
 
+# RAGFlow 知识检索工具使用的系统提示词
+TOOL_SYSTEM_PROMPT = "You are a professional technical assistant. Please provide concise and clear answers. When searching for information, do not display your search process or intermediate thoughts. Provide only the final polished answer. If you need to reference sources, include them at the end of your response in a separate section called 'References'."
+
+
+@lru_cache(maxsize=1)
+def _build_ragflow_client(http_client: httpx.AsyncClient) -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=settings.RAGFLOW_API_KEY,
+        base_url=settings.RAGFLOW_API_URL,
+        http_client=http_client
+    )
+
+
+def get_ragflow_client() -> AsyncOpenAI:
+    """
+    获取共享的 RAGFlow 异步客户端（OpenAI 兼容）。
+    客户端按底层连接池缓存，复用 RAGFlow 上游的共享连接池；
+    连接池在应用关闭后被重建时，客户端也会随之重建。
+
+    Returns:
+        AsyncOpenAI: RAGFlow 异步客户端
+    """
+    return _build_ragflow_client(get_http_client("ragflow"))
+
 # --- 查询重写的 Prompt 和 Chain ---
 rewrite_prompt = ChatPromptTemplate.from_messages([
     ("system",
@@ -40,6 +75,72 @@ rewriter_llm = get_llm()
 query_rewrite_chain = rewrite_prompt | rewriter_llm | StrOutputParser()
 
 
+# 指代、省略和承接上文的表达：出现任一标记时问题可能依赖上下文，需要重写。
+# 单字的指示词（这、那、此、该、其）大量出现在"其中""这个""因此""应该"等独立问法里，
+# 只在句首视为指代；句中只匹配多字的指代形式
+_ANAPHORA = re.compile(
+    r"(^|[。！？!?；;]\s*)(它|他|她|这|那|此|其|该|上述|同样|还有|继续|另外)"
+    r"|(?<!其)[它他]|她"
+    r"|[这那此该][个些种款类]?(问题|产品|模块|功能|方法|参数|模式|方案|情况|型号|版本|设置|配置)"
+    r"|上述|上面的|前面的|前面提到|刚才|之前的|之前提到|上一[个步条次种]|前者|后者"
+    r"|呢[？?]?\s*$"
+    r"|^\s*(this|that|these|those|it|they|also|and|what about|how about)\b"
+    r"|\b(its|their|the above|the previous|the same|mentioned above)\b"
+    r"|\b(it|them|this|that)\s*[?.!]?\s*$"
+    r"|\b(it|them)\s+(on|in|for|with|to|from|by|at|as)\b",
+    re.IGNORECASE
+)
+
+
+def _needs_rewrite(query: str) -> bool:
+    """
+    廉价的预判：问题足够长且不含指代/省略标记时视为已独立完整，无需调用 LLM 重写。
+    判断偏保守，拿不准时仍然重写。
+    """
+    if not settings.REWRITE_PREFILTER_ENABLED:
+        return True
+    return len(query.strip()) < settings.REWRITE_MIN_STANDALONE_CHARS or bool(_ANAPHORA.search(query))
+
+
+class RewriteCache:
+    """
+    查询重写结果的精确匹配缓存，按（规范化后的问题, 参与重写的历史）的哈希命中，LRU 淘汰并带 TTL。
+    同一计划的多个步骤、以及同一会话中重复的问题可以复用上一次的重写结果。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    @staticmethod
+    def key(query: str, history_text: str) -> str:
+        return hashlib.sha256(f"{normalize_query(query)}\x00{history_text}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, rewritten = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return rewritten
+
+    def set(self, key: str, rewritten: str) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, rewritten)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+rewrite_cache = RewriteCache(settings.REWRITE_CACHE_MAX_ENTRIES, settings.REWRITE_CACHE_TTL)
+
+
 async def _rewrite_query(query: str, chat_history: Optional[List[dict]] = None) -> str:
     """
     重写查询以优化搜索结果
@@ -55,15 +156,35 @@ async def _rewrite_query(query: str, chat_history: Optional[List[dict]] = None)
     
     # 仅当存在对话历史时，才进行查询重写
     if chat_history and len(chat_history) > 0:
+        if not _needs_rewrite(query):
+            metrics.inc("query_rewrites_total", result="skipped")
+            logger.info("Query is already standalone. Skipping rewrite for RAGFlow.")
+            return final_query
+
+        # 只保留重写预算内最近的若干轮历史
+        _, recent_history = split_recent_turns(chat_history, settings.REWRITER_CONTEXT_TOKENS)
+        history_text = "\n".join([f"{msg.get('role', 'user')}: {msg.get('content', '')}" for msg in recent_history])
+        cache_key = RewriteCache.key(query, history_text)
+        cached = rewrite_cache.get(cache_key)
+        if cached is not None:
+            metrics.inc("query_rewrites_total", result="cache_hit")
+            logger.info(f"Original query: '{query}' | Rewritten query (cached): '{cached}'")
+            return cached
+
         logger.info("Conversation history found. Rewriting query for RAGFlow.")
         try:
-            # 异步调用查询重写链
-            final_query = await query_rewrite_chain.ainvoke({
-                "chat_history": "\n".join([f"{msg.get('role', 'user')}: {msg.get('content', '')}" for msg in chat_history]),
-                "question": query
-            })
+            report_prompt_tokens("rewriter", count_tokens(history_text) + count_tokens(query))
+            # 异步调用查询重写链，不超过请求的剩余时间
+            async with asyncio.timeout(time_budget()):
+                final_query = await query_rewrite_chain.ainvoke({
+                    "chat_history": history_text,
+                    "question": query
+                })
+            rewrite_cache.set(cache_key, final_query)
+            metrics.inc("query_rewrites_total", result="rewritten")
             logger.info(f"Original query: '{query}' | Rewritten query: '{final_query}'")
         except Exception as e:
+            metrics.inc("query_rewrites_total", result="failed")
             logger.error(f"Failed to rewrite query, falling back to original. Error: {e}")
             final_query = query  # 如果重写失败，则使用原始问题
     else:
@@ -122,26 +243,30 @@ async def ragflow_knowledge_search(query: str, chat_history: List[dict] = None)
     # 重写查询
     final_query = await _rewrite_query(query, chat_history)
 
+    # 语义缓存以重写后的独立问题为键，命中时不再请求 RAGFlow
+    cache = get_semantic_cache()
+    if cache is not None:
+        cached = await cache.lookup(final_query, NAMESPACE_KNOWLEDGE_SEARCH)
+        if cached is not None:
+            return cached
+
+    # RAGFlow 熔断期间直接失败，不再等待上游超时
+    get_circuit_breaker("ragflow").raise_if_open()
+
     try:
-        # 使用 OpenAI 兼容的客户端
-        client = OpenAI(
-            api_key=settings.RAGFLOW_API_KEY,
-            base_url=settings.RAGFLOW_API_URL # 提取基础URL
-        )
+        # 使用共享的异步客户端，等待期间不会阻塞事件循环；调用方取消时上游请求会被一并中止
+        client = get_ragflow_client()
         
         # 发起请求
-        completion = client.chat.completions.create(
+        completion = await client.chat.completions.create(
             model="model",  # 使用默认模型
             messages=[
-                {
-                    "role": "system", 
-                    "content": "You are a professional technical assistant. Please provide concise and clear answers. When searching for information, do not display your search process or intermediate thoughts. Provide only the final polished answer. If you need to reference sources, include them at the end of your response in a separate section called 'References'."
-                },
+                {"role": "system", "content": TOOL_SYSTEM_PROMPT},
                 {"role": "user", "content": final_query}
             ],
             stream=False,  # 不使用流式传输以简化处理
             extra_body={"reference": True},  # 请求引用信息
-            timeout=60.0  # 设置超时时间
+            timeout=capped_timeout(get_upstream_config("ragflow").timeout)  # RAGFlow 上游的超时，且不超过请求的剩余时间
         )
 
         # 提取答案内容
@@ -151,68 +276,113 @@ async def ragflow_knowledge_search(query: str, chat_history: List[dict] = None)
             return "知识库中没有找到相关答案。"
 
         logger.info(f"RAGFlow tool successfully returned an answer：{answer[:100]}...")
+        if cache is not None:
+            await cache.store(final_query, answer, NAMESPACE_KNOWLEDGE_SEARCH)
         return answer
 
+    except asyncio.CancelledError:
+        logger.info(f"RAGFlow tool call cancelled, upstream request aborted: '{final_query[:50]}'")
+        raise
+    except DeadlineExceeded as e:
+        logger.warning(f"Skipping RAGFlow tool call: {e}")
+        raise ServiceUnavailableException("请求剩余时间不足，未调用知识问答服务。")
+    except APITimeoutError as e:
+        logger.error(f"RAGFlow service timed out: {e}")
+        raise ServiceUnavailableException("知识问答服务响应超时，请稍后再试。")
     except APIError as e:
         logger.error(f"RAGFlow service returned an API error: {e}")
         raise ServiceUnavailableException("知识问答服务暂时无法访问，请稍后再试。")
-    except Timeout as e:
-        logger.error(f"RAGFlow service timed out: {e}")
-        raise ServiceUnavailableException("知识问答服务响应超时，请稍后再试。")
     except Exception as e:
         logger.critical(f"An unexpected error occurred in RAGFlow tool: {e}", exc_info=True)
         raise PpecCopilotException("调用知识问答服务时发生未知错误。")
 
 
-async def ragflow_stream_search(query: str, chat_history: List[dict] = None) -> AsyncGenerator[str, None]:
+async def ragflow_stream_answer(query: str, chat_history: List[dict] = None) -> AsyncGenerator[str, None]:
     """
-    流式版本的 RAGFlow 知识搜索工具
-    
+    流式调用 RAGFlow 知识问答，逐段返回回答。
+    上游失败时与 ragflow_knowledge_search 一样抛出异常（此前可能已经返回了部分回答），调用方据此区分回答和错误提示。
+
     Args:
         query (str): 用户的查询问题
         chat_history (List[dict], optional): 对话历史，用于优化查询
+
+    Raises:
+        ServiceUnavailableException: RAGFlow 熔断、超时、返回错误，或请求剩余时间不足
+        PpecCopilotException: 其他错误
     """
     logger.info(f"Invoking RAGFlow streaming tool with query: '{query}'")
     
     # 重写查询
     final_query = await _rewrite_query(query, chat_history)
 
+    cache = get_semantic_cache()
+    if cache is not None:
+        cached = await cache.lookup(final_query, NAMESPACE_KNOWLEDGE_SEARCH)
+        if cached is not None:
+            yield cached
+            return
+
     try:
-        # 使用异步 OpenAI 兼容的客户端
-        client = AsyncOpenAI(
-            api_key=settings.RAGFLOW_API_KEY,
-            base_url=settings.RAGFLOW_API_URL
-        )
+        # RAGFlow 熔断期间直接失败，不再等待上游超时
+        get_circuit_breaker("ragflow").raise_if_open()
+
+        # 使用共享的异步客户端，复用 RAGFlow 上游的连接池
+        client = get_ragflow_client()
         
         # 发起流式请求
         completion = await client.chat.completions.create(
             model="model",  # 使用默认模型
             messages=[
-                {
-                    "role": "system", 
-                    "content": "You are a professional technical assistant. Please provide concise and clear answers. When searching for information, do not display your search process or intermediate thoughts. Provide only the final polished answer. If you need to reference sources, include them at the end of your response in a separate section called 'References'."
-                },
+                {"role": "system", "content": TOOL_SYSTEM_PROMPT},
                 {"role": "user", "content": final_query}
             ],
             stream=True,  # 启用流式传输
             extra_body={"reference": True},  # 请求引用信息
-            timeout=60.0  # 设置超时时间
+            timeout=capped_timeout(get_upstream_config("ragflow").timeout)  # RAGFlow 上游的超时，且不超过请求的剩余时间
         )
 
         # 流式传输响应
+        parts = []
         async for chunk in completion:
             # 提取内容
             if chunk.choices and chunk.choices[0].delta:
                 content = _extract_content_from_delta(chunk.choices[0].delta)
                 if content:
+                    parts.append(content)
                     yield content
+
+        # 只缓存完整结束的回答
+        if cache is not None:
+            await cache.store(final_query, "".join(parts), NAMESPACE_KNOWLEDGE_SEARCH)
                     
+    except CircuitOpenException as e:
+        logger.warning(f"Skipping RAGFlow streaming tool call: {e.message}")
+        raise
+    except DeadlineExceeded as e:
+        logger.warning(f"Skipping RAGFlow streaming tool call: {e}")
+        raise ServiceUnavailableException("请求剩余时间不足，未调用知识问答服务。")
+    except APITimeoutError as e:
+        logger.error(f"RAGFlow service timed out: {e}")
+        raise ServiceUnavailableException("知识问答服务响应超时，请稍后再试。")
     except APIError as e:
         logger.error(f"RAGFlow service returned an API error: {e}")
-        yield "知识问答服务暂时无法访问，请稍后再试。"
-    except Timeout as e:
-        logger.error(f"RAGFlow service timed out: {e}")
-        yield "知识问答服务响应超时，请稍后再试。"
+        raise ServiceUnavailableException("知识问答服务暂时无法访问，请稍后再试。")
     except Exception as e:
         logger.critical(f"An unexpected error occurred in RAGFlow streaming tool: {e}", exc_info=True)
-        yield "调用知识问答服务时发生未知错误。"
\ No newline at end of file
+        raise PpecCopilotException("调用知识问答服务时发生未知错误。")
+
+
+async def ragflow_stream_search(query: str, chat_history: List[dict] = None) -> AsyncGenerator[str, None]:
+    """
+    流式版本的 RAGFlow 知识搜索工具，上游失败时把错误提示作为回答的最后一段返回。
+    需要区分回答和错误提示时使用 ragflow_stream_answer。
+
+    Args:
+        query (str): 用户的查询问题
+        chat_history (List[dict], optional): 对话历史，用于优化查询
+    """
+    try:
+        async for delta in ragflow_stream_answer(query, chat_history):
+            yield delta
+    except PpecCopilotException as e:
+        yield e.message
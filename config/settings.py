@@ -1,6 +1,7 @@
 # config/settings.py
 import os
 from functools import lru_cache
+from typing import Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -26,6 +27,25 @@ class Settings(BaseSettings):
     MEM_0_VECTOR_STORE_HOST: str
     MEM_0_VECTOR_STORE_PORT: int
 
+    # mem0 同步客户端在专用线程池中执行，各类操作的超时时间（秒）
+    MEM0_EXECUTOR_MAX_WORKERS: int = 4
+    MEM0_READ_TIMEOUT: float = 10.0    # get_all 等读操作
+    MEM0_WRITE_TIMEOUT: float = 60.0   # add（含 LLM 抽取与 Embedding）和 delete
+
+    # 记忆后台写入队列：失败重试、并发写入的会话数、落盘日志及关闭时的最长等待时间
+    MEMORY_WRITE_MAX_RETRIES: int = 3
+    MEMORY_WRITE_RETRY_BACKOFF: float = 1.0  # 首次重试的退避时间（秒），之后指数增长
+    MEMORY_WRITE_CONCURRENCY: int = 4
+    MEMORY_WRITE_JOURNAL_PATH: str = "data/memory_write_journal.jsonl"
+    MEMORY_WRITE_SHUTDOWN_TIMEOUT: float = 10.0
+    MEMORY_WRITE_REPLAY_INTERVAL: float = 60.0   # 定期重放落盘日志的间隔（秒），0 表示只在启动时重放
+
+    # 会话历史缓存：进程内最多缓存的会话数和 TTL（秒）；配置 Redis 地址后所有 worker 共享缓存
+    HISTORY_CACHE_MAX_SESSIONS: int = 1024
+    HISTORY_CACHE_TTL: float = 1800.0
+    HISTORY_CACHE_REDIS_URL: str = ""
+    HISTORY_CACHE_REVISION_DIR: str = "data/history_revisions"  # 进程内缓存时各 worker 共享的会话版本号目录
+
     GRAPH_STORE: str
     GRAPH_STORE_URL: str
     GRAPH_STORE_USER: str
@@ -35,6 +55,114 @@ class Settings(BaseSettings):
     RAGFLOW_API_URL: str
     RAGFLOW_API_KEY: str
 
+    # --- 上游 HTTP 连接池配置 ---
+    HTTP_POOL_MAX_CONNECTIONS: int = 100      # 每个上游的最大连接数
+    HTTP_POOL_MAX_KEEPALIVE: int = 20         # 每个上游保持的最大空闲长连接数
+    HTTP_POOL_KEEPALIVE_EXPIRY: float = 30.0  # 空闲长连接的过期时间（秒）
+    HTTP_POOL_ACQUIRE_TIMEOUT: float = 10.0   # 等待连接池空闲连接的超时时间（秒）
+    HTTP2_ENABLED: bool = False               # 是否对上游启用 HTTP/2（需要安装 h2）
+
+    # 各上游的超时配置（秒）；first-byte 指从发出请求到收到首个响应体数据的时间
+    RAGFLOW_CONNECT_TIMEOUT: float = 5.0
+    RAGFLOW_READ_TIMEOUT: float = 60.0
+    RAGFLOW_FIRST_BYTE_TIMEOUT: float = 30.0
+    ONE_API_CONNECT_TIMEOUT: float = 5.0
+    ONE_API_READ_TIMEOUT: float = 60.0
+    ONE_API_FIRST_BYTE_TIMEOUT: float = 30.0
+    ONE_API_MAX_RETRIES: int = 2   # LLM 调用失败后的重试次数；Planner 中重试的总耗时同样受请求截止时间约束
+
+    # --- RAGFlow 流式代理配置 ---
+    # chunk 校验模式: full（逐个校验）、sampled（首末及每 N 个校验一次）、passthrough（首个通过后原样透传）
+    RAGFLOW_VALIDATION_MODE: Literal["full", "sampled", "passthrough"] = "full"
+    RAGFLOW_VALIDATION_SAMPLE_RATE: int = 16
+
+    # --- 上下文 token 预算配置 ---
+    TOKENIZER_ENCODING: str = "cl100k_base"  # tiktoken 编码；无法加载时按字符估算
+    PLANNER_CONTEXT_TOKENS: int = 3000       # Planner 可用的历史消息预算
+    REWRITER_CONTEXT_TOKENS: int = 1500      # RAGFlow 查询重写可用的历史消息预算
+    SUMMARIZER_CONTEXT_TOKENS: int = 6000    # Summarizer 可用的步骤结果预算
+    HISTORY_SUMMARY_ENABLED: bool = False    # 是否将超出 Planner 预算的较早轮次折叠为滚动摘要（额外调用一次 LLM）
+    HISTORY_SUMMARY_TOKENS: int = 300        # 滚动摘要占用的预算
+
+    # --- 计划执行配置 ---
+    PLAN_STEP_SESSION_CONCURRENCY: int = 3   # 单个会话内并行执行的步骤数上限
+    PLAN_STEP_GLOBAL_CONCURRENCY: int = 32   # 所有会话合计并行执行的步骤数上限
+    SUMMARY_STREAMING_ENABLED: bool = True   # 是否以 final_response_delta 事件逐段推送最终总结
+
+    # --- 意图路由配置 ---
+    INTENT_ROUTER_ENABLED: bool = True       # 单次知识检索的问题跳过规划，直接流式返回 RAGFlow 的回答
+    INTENT_ROUTER_THRESHOLD: float = 0.7     # 走直接检索所需的最低置信度，越高越保守
+    INTENT_ROUTER_SHORT_CHARS: int = 30      # 不超过该长度的问题提高直接检索的置信度
+    INTENT_ROUTER_LONG_CHARS: int = 80       # 超过该长度的输入降低直接检索的置信度
+
+    # --- 语义答案缓存配置 ---
+    SEMANTIC_CACHE_ENABLED: bool = False           # 是否缓存 RAGFlow 知识问答的答案（按查询语义相似度命中）
+    SEMANTIC_CACHE_BACKEND: str = "local"          # local（进程内 numpy 索引）/ qdrant（复用 Mem0 的 Qdrant）
+    SEMANTIC_CACHE_THRESHOLD: float = 0.92         # 命中所需的最低余弦相似度
+    SEMANTIC_CACHE_TTL: float = 86400.0            # 缓存条目的有效期（秒）
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 5000         # 本地索引每个命名空间的最大条目数
+    SEMANTIC_CACHE_COLLECTION: str = "ppec_semantic_cache"  # Qdrant 集合名
+    SEMANTIC_CACHE_GENERATION_PATH: str = "data/semantic_cache.generation"  # local 后端各 worker 共享的失效代次文件
+
+    # --- 查询重写配置 ---
+    REWRITE_PREFILTER_ENABLED: bool = True   # 问题已独立完整（无指代/省略）时跳过 LLM 重写
+    REWRITE_MIN_STANDALONE_CHARS: int = 8    # 短于该长度的问题一律重写（多为省略句）
+    REWRITE_CACHE_MAX_ENTRIES: int = 1024    # 重写结果缓存的最大条目数
+    REWRITE_CACHE_TTL: float = 600.0         # 重写结果缓存的有效期（秒）
+
+    # --- 请求合并配置 ---
+    SINGLE_FLIGHT_ENABLED: bool = True           # 并发的相同 RAGFlow 流式请求共享一个上游流
+    SINGLE_FLIGHT_SUBSCRIBER_BUFFER: int = 256   # 每个订阅者最多积压的帧数，超过后该订阅者被移出
+
+    # --- 提示词配置 ---
+    PROMPT_DIR: str = ""                 # 提示词文件目录（<name>.md），为空时使用内置的 app/prompts
+    PROMPT_RELOAD_INTERVAL: float = 5.0  # 检查提示词文件变化的最小间隔（秒），0 表示不热加载
+
+    # --- 流式输出合并配置 ---
+    STREAM_COALESCE_ENABLED: bool = True   # 合并 ragflow_stream / llm_stream / Planner 事件流中的连续增量（客户端可用 coalesce=false 关闭）
+    STREAM_COALESCE_MS: int = 30           # 两次输出之间的最长等待（毫秒）；首个增量和间隔超过该值的增量立即输出，0 表示不合并
+    STREAM_COALESCE_BYTES: int = 512       # 缓冲文本达到该字节数（UTF-8）时提前输出，0 表示不限
+
+    # --- 会话 Agent 配置 ---
+    AGENT_MAX_SESSIONS: int = 1000       # 每个 worker 最多保留的会话 Agent 数，超过时淘汰最久未使用的，0 表示不限
+    AGENT_IDLE_TTL: float = 1800.0       # 会话空闲超过该时间（秒）后被淘汰，0 表示不按空闲时间淘汰
+    AGENT_SWEEP_INTERVAL: float = 60.0   # 后台清理空闲会话的间隔（秒）
+
+    # --- 会话亲和配置 ---
+    SESSION_AFFINITY_HEADER: str = "X-Session-Id"   # 客户端携带会话 ID 的请求头，nginx 按其一致性哈希
+    SESSION_AFFINITY_UPSTREAMS: str = ""             # 单 worker 应用实例列表（逗号分隔的 host:port），用于生成 nginx upstream
+
+    # --- 上游熔断与对冲配置（ragflow / one_api）---
+    CIRCUIT_BREAKER_ENABLED: bool = True
+    CIRCUIT_BREAKER_WINDOW: float = 30.0             # 统计错误率和慢调用率的滚动窗口（秒）
+    CIRCUIT_BREAKER_MIN_CALLS: int = 10              # 窗口内调用数达到该值后才判断是否熔断
+    CIRCUIT_BREAKER_FAILURE_RATE: float = 0.5        # 错误（连接失败、超时、5xx）比例达到该值时熔断
+    CIRCUIT_BREAKER_SLOW_CALL_SECONDS: float = 20.0  # 等待响应头超过该时间（秒）的调用计为慢调用
+    CIRCUIT_BREAKER_SLOW_CALL_RATE: float = 0.8      # 慢调用比例达到该值时熔断
+    CIRCUIT_BREAKER_OPEN_SECONDS: float = 30.0       # 熔断后直接拒绝请求的时间（秒），之后放行探测请求
+    CIRCUIT_BREAKER_HALF_OPEN_PROBES: int = 2        # 半开状态下放行的探测请求数，全部成功后恢复
+    HEDGE_ENABLED: bool = True                       # 非流式请求等待超过延迟分位数后发出一个对冲请求
+    HEDGE_UPSTREAMS: str = "ragflow"                 # 做对冲的上游（逗号分隔）；one_api 按 token 计费，需要时再加入
+    HEDGE_QUANTILE: float = 0.95                     # 对冲等待时间取最近延迟的该分位数
+    HEDGE_MIN_DELAY: float = 1.0                     # 对冲等待时间的下限（秒）
+    HEDGE_MIN_SAMPLES: int = 20                      # 延迟样本数达到该值后才开始对冲
+
+    # --- 准入控制配置（/chat/completions 等对话接口）---
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_MAX_CONCURRENCY: int = 64              # 同时处理的对话请求数上限（每个 worker，或共享存储时整台主机）
+    ADMISSION_MAX_QUEUE: int = 128                   # 等待并发名额的请求数上限，队列已满时返回 429
+    ADMISSION_QUEUE_TIMEOUT: float = 5.0             # 最长排队时间（秒），超过时返回 429
+    ADMISSION_SESSION_RATE: float = 1.0              # 每个会话每秒允许的请求数，0 表示不限
+    ADMISSION_SESSION_BURST: int = 5                 # 每个会话允许的突发请求数
+    ADMISSION_API_KEY_RATE: float = 10.0             # 每个 API Key 每秒允许的请求数，0 表示不限
+    ADMISSION_API_KEY_BURST: int = 20                # 每个 API Key 允许的突发请求数
+    ADMISSION_SHARED_STORE: str = ""                 # 同一主机上 worker 共享限额的 SQLite 文件（例如 /dev/shm/ppec_admission.db），为空时每个 worker 独立限制
+
+    # --- 请求截止时间配置 ---
+    REQUEST_DEADLINE: float = 110.0                  # 每个请求的最长处理时间（秒），需小于 gunicorn 的 worker 超时（120），0 表示不限
+    REQUEST_DEADLINE_HEADER: str = "X-Request-Timeout"   # 客户端可通过该请求头（秒）要求更短的截止时间
+    PLANNER_SUMMARY_RESERVE: float = 20.0            # Planner 为生成总结预留的时间（秒），剩余时间不足时跳过重新规划和未执行的步骤
+
     # --- 日志配置 ---
     LOG_LEVEL: str = "INFO"
 
@@ -20,7 +20,7 @@ workers = int(os.environ.get("GUNICORN_WORKERS", "1"))  # 调试时使用1个wor
 # 必须使用 uvicorn.workers.UvicornWorker 来运行 ASGI 应用（如 FastAPI）。
 worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "uvicorn.workers.UvicornWorker")
 
-# Worker timeout
+# Worker timeout（应用内每个请求的截止时间 REQUEST_DEADLINE 应小于该值）
 timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
 
 # Worker restart after requests (prevent memory leaks)
@@ -54,6 +54,7 @@ if prompt := st.chat_input("请输入您的问题..."):
                         # 使用新的统一接口格式
                         response = requests.post(
                             f"{base_url}{endpoint}",
+                            headers={"X-Session-Id": session_id},  # 会话亲和：同一会话路由到同一实例
                             json={
                                 "model": model_name,
                                 "messages": [
@@ -68,6 +69,7 @@ if prompt := st.chat_input("请输入您的问题..."):
                         # 使用原有的接口格式
                         response = requests.post(
                             f"{base_url}{endpoint}",
+                            headers={"X-Session-Id": session_id},  # 会话亲和：同一会话路由到同一实例
                             json={
                                 "session_id": session_id,
                                 "message": prompt
@@ -140,6 +142,7 @@ if prompt := st.chat_input("请输入您的问题..."):
                     # 使用新的统一接口格式
                     response = requests.post(
                         f"{base_url}{endpoint}",
+                        headers={"X-Session-Id": session_id},  # 会话亲和：同一会话路由到同一实例
                         json={
                             "model": model_name,
                             "messages": [
@@ -153,6 +156,7 @@ if prompt := st.chat_input("请输入您的问题..."):
                     # 使用原有的接口格式
                     response = requests.post(
                         f"{base_url}{endpoint}",
+                        headers={"X-Session-Id": session_id},  # 会话亲和：同一会话路由到同一实例
                         json={
                             "session_id": session_id,
                             "message": prompt
@@ -0,0 +1,151 @@
+# tests/benchmarks/bench_session_affinity.py
+"""
+会话亲和基准，两种模式：
+
+1. 进程内模拟（默认，不需要部署）：多个会话交错发送多轮请求，分别按"随机 worker"（gunicorn 共享端口时的行为）
+   和"按会话 ID 一致性哈希"（nginx hash $session_key consistent）分配到多个 worker，
+   统计每个 worker 进程内状态的命中率：
+   - 会话历史缓存（InMemoryHistoryBackend）：非首轮请求能否直接读到本会话的历史；
+   - 会话 Agent（AgentManager）：非首轮请求能否复用已有的 PlannerAgent。
+   同时给出扩容一个 worker 时被重新分配的会话比例。路由由本文件中的 HashRing 模拟，不经过 nginx。
+
+2. 负载测试（--url）：通过 nginx（docker-compose.affinity.yml）发送真实 HTTP 请求，
+   每个请求携带会话头，按响应头 X-Served-By 统计同一会话的后续轮次落在同一实例上的比例、
+   会话在各实例间的分布以及请求延迟。默认请求 /health，只验证路由本身，不调用大模型。
+
+运行方式:
+    python -m tests.benchmarks.bench_session_affinity [--workers 4] [--sessions 2000] [--turns 6] [--capacity 1000]
+    docker compose -f docker-compose.affinity.yml up -d --build
+    python -m tests.benchmarks.bench_session_affinity --url http://localhost:8080 [--sessions 200] [--concurrency 32]
+"""
+import argparse
+import asyncio
+import bisect
+import logging
+import random
+import time
+import zlib
+from collections import Counter, defaultdict
+
+import httpx
+
+from app.core.agents.agent_manager import AgentManager
+from app.services.history_cache import InMemoryHistoryBackend
+
+
+class HashRing:
+    """与 nginx `hash ... consistent` 相同思路的 ketama 一致性哈希环（每个实例 160 个虚拟节点）"""
+
+    def __init__(self, servers, points=160):
+        self._ring = sorted(
+            (zlib.crc32(f"{server}-{i}".encode("utf-8")), server)
+            for server in servers for i in range(points)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    def route(self, session_id: str) -> str:
+        index = bisect.bisect(self._keys, zlib.crc32(session_id.encode("utf-8"))) % len(self._ring)
+        return self._ring[index][1]
+
+
+def make_traffic(sessions: int, turns: int, rng: random.Random):
+    """每个会话 turns 轮，所有会话的请求随机交错"""
+    traffic = [f"session-{i}" for i in range(sessions) for _ in range(turns)]
+    rng.shuffle(traffic)
+    return traffic
+
+
+async def simulate(traffic, workers, capacity, route):
+    caches = {w: InMemoryHistoryBackend(max_sessions=capacity, ttl=3600) for w in workers}
+    managers = {w: AgentManager(max_agents=capacity, idle_ttl=0) for w in workers}
+    seen = set()
+    repeat = history_hits = agent_hits = 0
+    for session_id in traffic:
+        worker = route(session_id)
+        cache, manager = caches[worker], managers[worker]
+        if session_id in seen:
+            repeat += 1
+            history_hits += await cache.get(session_id) is not None
+            agent_hits += session_id in manager._agents
+        seen.add(session_id)
+        manager.get_agent(session_id)
+        # 与 Mem0Service 相同：已缓存时追加本轮（append_plan），未命中时从 Mem0 加载后写入（set_turns）
+        turn = {"message_id": session_id, "goal": "question", "summary": "answer"}
+        if not await cache.append(session_id, turn):
+            await cache.set(session_id, [turn])
+    for manager in managers.values():
+        await manager.close()
+    return history_hits / max(repeat, 1), agent_hits / max(repeat, 1)
+
+
+def run(worker_count: int, sessions: int, turns: int, capacity: int) -> None:
+    logging.disable(logging.INFO)
+    rng = random.Random(42)
+    traffic = make_traffic(sessions, turns, rng)
+    workers = [f"app{i}:8000" for i in range(worker_count)]
+    ring = HashRing(workers)
+
+    print(f"{worker_count} workers, {sessions} sessions x {turns} turns, per-worker capacity {capacity}")
+    for name, route in (
+        ("random worker", lambda session_id: rng.choice(workers)),
+        ("sticky (consistent hash)", ring.route),
+    ):
+        history, agents = asyncio.run(simulate(traffic, workers, capacity, route))
+        print(f"{name:>26}: history cache hit rate {history:6.1%}, agent reuse rate {agents:6.1%}")
+
+    grown = HashRing(workers + [f"app{worker_count}:8000"])
+    moved = sum(ring.route(f"session-{i}") != grown.route(f"session-{i}") for i in range(sessions))
+    print(f"{'scale out by one worker':>26}: {moved / sessions:6.1%} of sessions move (ideal {1 / (worker_count + 1):.1%})")
+
+
+async def load_test(url: str, sessions: int, turns: int, concurrency: int, header: str, path: str):
+    """经 nginx 发送交错的多轮请求，返回每个会话的处理实例列表和请求延迟（秒）"""
+    traffic = make_traffic(sessions, turns, random.Random(42))
+    served = defaultdict(list)
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=30) as client:
+        async def send(session_id):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(path, headers={header: session_id})
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+                served[session_id].append(response.headers.get("x-served-by", "unknown"))
+
+        await asyncio.gather(*(send(session_id) for session_id in traffic))
+    return served, latencies
+
+
+def run_load_test(url: str, sessions: int, turns: int, concurrency: int, header: str, path: str) -> None:
+    served, latencies = asyncio.run(load_test(url, sessions, turns, concurrency, header, path))
+    repeat = sum(len(instances) - 1 for instances in served.values())
+    # 每个会话以处理其请求最多的实例为"归属实例"，落到其他实例的轮次都拿不到进程内状态
+    homes = {session_id: Counter(instances).most_common(1)[0] for session_id, instances in served.items()}
+    sticky = sum(count - 1 for _, count in homes.values())
+    per_instance = Counter(instance for instance, _ in homes.values())
+    latencies.sort()
+
+    print(f"{url}{path}: {sessions} sessions x {turns} turns, concurrency {concurrency}, header {header}")
+    print(f"{'same instance as session':>26}: {sticky / max(repeat, 1):6.1%} of repeat turns")
+    print(f"{'sessions per instance':>26}: " + ", ".join(f"{name} {count}" for name, count in sorted(per_instance.items())))
+    print(f"{'latency':>26}: p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--capacity", type=int, default=1000)
+    parser.add_argument("--url", help="nginx address for the HTTP load test, e.g. http://localhost:8080")
+    parser.add_argument("--path", default="/health")
+    parser.add_argument("--header", default="X-Session-Id")
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    if args.url:
+        run_load_test(args.url, args.sessions, args.turns, args.concurrency, args.header, args.path)
+    else:
+        run(args.workers, args.sessions, args.turns, args.capacity)
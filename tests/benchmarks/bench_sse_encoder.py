@@ -0,0 +1,112 @@
+# tests/benchmarks/bench_sse_encoder.py
+"""
+SSE 编码基准：按 token 对比旧的编码方式与共享的 bytes 编码器。
+
+- OpenAI chunk（llm_stream / ragflow 错误帧）：
+  旧方式为每个 token 构造 ChatCompletionChunk 并 model_dump_json() 后拼进 f-string；
+  新方式为 encode_sse_json(模型) 以及只替换 content 的 ChunkTemplate.render()。
+- Agent 事件（PlannerAgent / ChatAgent 的 _event_stream）：
+  旧方式为 json.dumps + f-string，新方式为 encode_sse_json(dict, event=...)。
+旧方式产出的 str 最终仍要由 StreamingResponse 编码为 bytes，计时中包含这一步。
+
+运行方式:
+    python -m tests.benchmarks.bench_sse_encoder [--tokens 20000]
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime
+
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, Choice, ChoiceDelta
+
+from app.core.sse import CONTENT_PLACEHOLDER, ChunkTemplate, encode_sse_json
+
+# 中文流式输出中常见的 1~3 字符 token
+TOKENS = ["数字", "电源", "的", "PWM", "模块", "支持", "中心对齐", "，", "死区", "时间", "可以", "配置", "。", "\n"]
+
+
+def _chunk(completion_id: str, created: int, content: str) -> ChatCompletionChunk:
+    return ChatCompletionChunk(
+        id=completion_id,
+        choices=[Choice(
+            delta=ChoiceDelta(content=content, role="assistant", function_call=None, tool_calls=None, reasoning_content=None),
+            finish_reason=None,
+            index=0,
+            logprobs=None
+        )],
+        created=created,
+        model="qwen",
+        object="chat.completion.chunk",
+        system_fingerprint="fp_0f2a7a3e",
+        usage=None
+    )
+
+
+def legacy_chunks(tokens, completion_id, created):
+    total = 0
+    for token in tokens:
+        total += len(f"data: {_chunk(completion_id, created, token).model_dump_json()}\n\n".encode("utf-8"))
+    return total
+
+
+def encoder_chunks(tokens, completion_id, created):
+    total = 0
+    for token in tokens:
+        total += len(encode_sse_json(_chunk(completion_id, created, token)))
+    return total
+
+
+def template_chunks(tokens, completion_id, created):
+    template = ChunkTemplate(_chunk(completion_id, created, CONTENT_PLACEHOLDER))
+    total = 0
+    for token in tokens:
+        total += len(template.render(token))
+    return total
+
+
+def legacy_events(tokens, message_id):
+    total = 0
+    for token in tokens:
+        total += len(f"event: final_response_delta\ndata: {json.dumps({'message_id': message_id, 'delta': token})}\n\n".encode("utf-8"))
+    return total
+
+
+def encoder_events(tokens, message_id):
+    total = 0
+    for token in tokens:
+        total += len(encode_sse_json({"message_id": message_id, "delta": token}, event="final_response_delta"))
+    return total
+
+
+def _time(name, func, *args, count):
+    start = time.perf_counter()
+    size = func(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>34}: {elapsed * 1000:8.1f} ms total, {elapsed / count * 1e6:6.2f} us per token, {size / count:6.1f} bytes per frame")
+    return elapsed
+
+
+def run(token_count: int) -> None:
+    tokens = [TOKENS[i % len(TOKENS)] for i in range(token_count)]
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(datetime.now().timestamp())
+
+    print(f"{token_count} tokens per run")
+    print("OpenAI chat.completion.chunk frames:")
+    base = _time("legacy model_dump_json + f-string", legacy_chunks, tokens, completion_id, created, count=token_count)
+    encoded = _time("encode_sse_json(model)", encoder_chunks, tokens, completion_id, created, count=token_count)
+    templated = _time("ChunkTemplate.render", template_chunks, tokens, completion_id, created, count=token_count)
+    print(f"{'speedup':>34}: encoder x{base / encoded:.2f}, template x{base / templated:.2f}")
+
+    print("Agent SSE events:")
+    base = _time("legacy json.dumps + f-string", legacy_events, tokens, "turn_1", count=token_count)
+    encoded = _time("encode_sse_json(dict, event=...)", encoder_events, tokens, "turn_1", count=token_count)
+    print(f"{'speedup':>34}: encoder x{base / encoded:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=20000)
+    args = parser.parse_args()
+    run(args.tokens)
@@ -0,0 +1,105 @@
+# tests/benchmarks/eval_intent_router.py
+"""
+意图路由离线评估：对 JSONL 文件中的每个请求运行 app.services.intent_router，统计路由分布，
+有标注（expected_route 为 direct / plan）时给出各阈值下的准确率、直接检索的精确率和召回率，
+以及快速路径节省的 LLM 往返次数（规划、执行器选工具、总结共 3 次）。
+
+每行可以是 {"query": ..., "expected_route": ...}、{"message": ...}（/chat/completions 的请求体）
+或 {"messages": [...]}（OpenAI 格式，取最后一条 user 消息）。
+
+运行方式:
+    python -m tests.benchmarks.eval_intent_router [--file requests.jsonl] [--threshold 0.7] [--show-errors]
+"""
+import argparse
+import json
+import os
+from collections import Counter
+
+from app.services.intent_router import ROUTE_DIRECT, ROUTE_PLAN, score_query
+from config.settings import settings
+
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "fixtures", "intent_routes.jsonl")
+# 快速路径省去的 LLM 往返：Planner、Executor（选择工具）、Summarizer
+SAVED_ROUND_TRIPS = 3
+
+
+def extract_query(record: dict):
+    if record.get("query"):
+        return record["query"]
+    if record.get("message"):
+        return record["message"]
+    users = [m.get("content") for m in record.get("messages", []) if m.get("role") == "user"]
+    return users[-1] if users else None
+
+
+def load(path: str):
+    samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            query = extract_query(record)
+            if isinstance(query, str) and query.strip():
+                samples.append((query, record.get("expected_route")))
+    return samples
+
+
+def evaluate(scored, threshold: float):
+    """返回 (直接检索比例, 准确率, 直接检索精确率, 直接检索召回率)；没有标注时后三项为 None"""
+    direct = sum(confidence >= threshold for _, confidence, _ in scored)
+    labeled = [(confidence >= threshold, expected == ROUTE_DIRECT) for _, confidence, expected in scored if expected]
+    if not labeled:
+        return direct / len(scored), None, None, None
+    correct = sum(predicted == actual for predicted, actual in labeled)
+    true_direct = sum(predicted and actual for predicted, actual in labeled)
+    predicted_direct = sum(predicted for predicted, _ in labeled)
+    actual_direct = sum(actual for _, actual in labeled)
+    return (
+        direct / len(scored),
+        correct / len(labeled),
+        true_direct / predicted_direct if predicted_direct else 1.0,
+        true_direct / actual_direct if actual_direct else 1.0,
+    )
+
+
+def _pct(value):
+    return "   n/a" if value is None else f"{value:6.1%}"
+
+
+def run(path: str, threshold: float, show_errors: bool) -> None:
+    samples = load(path)
+    if not samples:
+        print(f"{path}: no queries found")
+        return
+    scored = [(query, score_query(query)[0], expected) for query, expected in samples]
+    labeled = sum(expected is not None for _, _, expected in scored)
+    print(f"{path}: {len(scored)} queries, {labeled} labeled")
+
+    features = Counter(reason for query, _ in samples for reason in score_query(query)[1])
+    print("features: " + ", ".join(f"{name}={count}" for name, count in features.most_common()))
+
+    print(f"{'threshold':>10} {'direct':>7} {'accuracy':>9} {'precision':>10} {'recall':>7}")
+    for t in sorted({0.5, 0.6, 0.7, 0.8, 0.9, threshold}):
+        direct, accuracy, precision, recall = evaluate(scored, t)
+        marker = " <" if t == threshold else ""
+        print(f"{t:>10.2f} {_pct(direct):>7} {_pct(accuracy):>9} {_pct(precision):>10} {_pct(recall):>7}{marker}")
+
+    direct, _, _, _ = evaluate(scored, threshold)
+    print(f"at threshold {threshold:.2f}: {direct * len(scored):.0f} direct turns save "
+          f"{direct * len(scored) * SAVED_ROUND_TRIPS:.0f} LLM round trips ({direct * SAVED_ROUND_TRIPS:.2f} per turn)")
+
+    if show_errors:
+        for query, confidence, expected in scored:
+            predicted = ROUTE_DIRECT if confidence >= threshold else ROUTE_PLAN
+            if expected and predicted != expected:
+                print(f"  expected {expected:>6}, got {predicted:>6} ({confidence:.2f}): {query}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", default=DEFAULT_FILE)
+    parser.add_argument("--threshold", type=float, default=settings.INTENT_ROUTER_THRESHOLD)
+    parser.add_argument("--show-errors", action="store_true")
+    args = parser.parse_args()
+    run(args.file, args.threshold, args.show_errors)
@@ -0,0 +1,201 @@
+# tests/unit/test_admission.py
+import asyncio
+import time
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from app.core.admission import (
+    AdmissionController,
+    AdmissionMiddleware,
+    LocalAdmissionStore,
+    SQLiteAdmissionStore,
+    api_key_digest,
+)
+from app.core.exceptions import RateLimitedException
+from app.core.metrics import metrics
+
+
+def _controller(**kwargs):
+    options = dict(max_concurrency=1, max_queue=2, queue_timeout=1.0)
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+class TestTokenBuckets:
+    """Test cases for the per-session and per-API-key token buckets"""
+
+    @pytest.mark.asyncio
+    async def test_bucket_allows_burst_then_reports_wait(self):
+        """A bucket grants its burst, then reports how long until the next token"""
+        store = LocalAdmissionStore()
+        assert [await store.take_token("k", 1.0, 3) for _ in range(3)] == [0.0, 0.0, 0.0]
+        wait = await store.take_token("k", 1.0, 3)
+        assert 0 < wait <= 1.0
+        assert await store.take_token("other", 1.0, 3) == 0.0
+
+    @pytest.mark.asyncio
+    async def test_session_rate_limit_rejects_with_retry_after(self):
+        """A session over its rate is rejected without taking a concurrency slot"""
+        controller = _controller(max_concurrency=10, session_rate=0.5, session_burst=1)
+        await controller.acquire(session_id="s1")
+        with pytest.raises(RateLimitedException) as exc_info:
+            await controller.acquire(session_id="s1")
+        assert exc_info.value.reason == "session_rate"
+        assert 1.5 < exc_info.value.retry_after <= 2.0
+        assert controller.in_flight == 1
+        await controller.acquire(session_id="s2")
+        assert metrics.get_counter("admission_rejections_total", reason="session_rate") >= 1
+
+    @pytest.mark.asyncio
+    async def test_api_key_rate_limit(self):
+        """Requests sharing an API key share one bucket across sessions"""
+        controller = _controller(max_concurrency=10, api_key_rate=1.0, api_key_burst=2)
+        key = api_key_digest("Bearer sk-test")
+        await controller.acquire(session_id="s1", api_key=key)
+        await controller.acquire(session_id="s2", api_key=key)
+        with pytest.raises(RateLimitedException) as exc_info:
+            await controller.acquire(session_id="s3", api_key=key)
+        assert exc_info.value.reason == "api_key_rate"
+        assert "sk-test" not in key
+
+
+class TestConcurrencyQueue:
+    """Test cases for the global concurrency limit and the bounded wait queue"""
+
+    @pytest.mark.asyncio
+    async def test_waiters_admitted_in_fifo_order(self):
+        """Queued requests get released slots in arrival order"""
+        controller = _controller(max_queue=5)
+        await controller.acquire()
+        admitted = []
+
+        async def waiter(i):
+            await controller.acquire()
+            admitted.append(i)
+
+        tasks = [asyncio.create_task(waiter(i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        assert controller.queue_depth == 3
+        assert metrics.get_gauge("admission_queue_depth") == 3
+        for _ in range(3):
+            await controller.release()
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        assert admitted == [0, 1, 2]
+        assert controller.queue_depth == 0
+
+    @pytest.mark.asyncio
+    async def test_full_queue_rejects_immediately(self):
+        """With the queue full a new request is rejected with the queue timeout as Retry-After"""
+        controller = _controller(max_queue=1, queue_timeout=3.0)
+        await controller.acquire()
+        queued = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0.01)
+        with pytest.raises(RateLimitedException) as exc_info:
+            await controller.acquire()
+        assert exc_info.value.reason == "queue_full"
+        assert exc_info.value.retry_after == 3.0
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert controller.queue_depth == 0
+
+    @pytest.mark.asyncio
+    async def test_queue_timeout(self):
+        """A request waiting longer than the queue-time SLO is rejected"""
+        controller = _controller(queue_timeout=0.1)
+        await controller.acquire()
+        with pytest.raises(RateLimitedException) as exc_info:
+            await controller.acquire()
+        assert exc_info.value.reason == "queue_timeout"
+        assert controller.queue_depth == 0
+        assert metrics.get_histogram("admission_queue_wait_seconds")["count"] >= 2
+
+    @pytest.mark.asyncio
+    async def test_shared_store_across_controllers(self, tmp_path):
+        """Controllers sharing a SQLite store (one per worker) share the concurrency limit and buckets"""
+        path = str(tmp_path / "admission.db")
+        first = _controller(store=SQLiteAdmissionStore(path), queue_timeout=0.5, session_rate=0.1, session_burst=1)
+        second = _controller(store=SQLiteAdmissionStore(path), queue_timeout=0.5, session_rate=0.1, session_burst=1)
+        await first.acquire(session_id="s1")
+        with pytest.raises(RateLimitedException) as exc_info:
+            await second.acquire(session_id="s1")
+        assert exc_info.value.reason == "session_rate"
+
+        queued = asyncio.create_task(second.acquire(session_id="s2"))
+        await asyncio.sleep(0.1)
+        assert not queued.done()
+        await first.release()
+        await asyncio.wait_for(queued, 0.5)
+        assert second.in_flight == 1
+
+    @pytest.mark.asyncio
+    async def test_cancelled_shared_slot_calls_do_not_leak(self, tmp_path):
+        """A slot committed after its caller was cancelled is returned, and a cancelled release still completes"""
+        store = SQLiteAdmissionStore(str(tmp_path / "admission.db"))
+        acquire_slot = store._try_acquire_slot
+
+        def slow_acquire(conn, limit, pid):
+            time.sleep(0.2)
+            return acquire_slot(conn, limit, pid)
+
+        def slots():
+            return store._conn().execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+
+        store._try_acquire_slot = slow_acquire
+        attempt = asyncio.create_task(store.try_acquire_slot(1))
+        await asyncio.sleep(0.05)
+        attempt.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await attempt
+        await asyncio.sleep(0.4)
+        assert slots() == 0
+
+        store._try_acquire_slot = acquire_slot
+        assert await store.try_acquire_slot(1)
+        release = asyncio.create_task(store.release_slot())
+        await asyncio.sleep(0)
+        release.cancel()
+        await asyncio.gather(release, return_exceptions=True)
+        await asyncio.sleep(0.2)
+        assert slots() == 0
+        assert await store.try_acquire_slot(1)
+
+
+class TestAdmissionMiddleware:
+    """Test cases for admission control on the HTTP endpoints"""
+
+    def _app(self, controller, release):
+        async def stream(request):
+            async def body():
+                yield b"data: first\n\n"
+                await release.wait()
+                yield b"data: [DONE]\n\n"
+
+            return StreamingResponse(body(), media_type="text/event-stream")
+
+        app = Starlette(routes=[Route("/chat", stream, methods=["POST"]), Route("/other", stream, methods=["POST"])])
+        return AdmissionMiddleware(app, controller=controller, paths=["/chat"], session_header="X-Session-Id")
+
+    @pytest.mark.asyncio
+    async def test_slot_held_until_stream_ends_and_429_when_full(self):
+        """The slot is held for the whole streamed response; excess requests get 429 with Retry-After"""
+        controller = _controller(max_queue=0, queue_timeout=2.0)
+        release = asyncio.Event()
+        app = self._app(controller, release)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            first = asyncio.create_task(client.post("/chat", headers={"X-Session-Id": "s1"}))
+            await asyncio.sleep(0.05)
+            assert controller.in_flight == 1
+
+            rejected = await client.post("/chat", headers={"X-Session-Id": "s2"})
+            assert rejected.status_code == 429
+            assert rejected.headers["Retry-After"] == "2"
+            assert rejected.json()["reason"] == "queue_full"
+
+            release.set()
+            assert (await first).text.endswith("data: [DONE]\n\n")
+            assert controller.in_flight == 0
+            assert (await client.post("/other")).status_code == 200
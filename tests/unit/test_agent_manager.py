@@ -0,0 +1,97 @@
+# tests/unit/test_agent_manager.py
+import asyncio
+import time
+import pytest
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from app.core.agents.agent_manager import AgentManager
+from app.core.agents.base_agent import AgentState
+from app.core.metrics import metrics
+
+
+async def _running_agent(manager, session_id):
+    agent = manager.get_agent(session_id)
+    await agent.initialize()
+    await agent.start()
+    return agent
+
+
+class TestAgentManager:
+    """Test cases for the bounded session agent registry"""
+
+    @pytest.mark.asyncio
+    async def test_lru_eviction_stops_agent(self):
+        """Exceeding max_agents evicts the least recently used session and stops its agent"""
+        manager = AgentManager(max_agents=2, idle_ttl=0)
+        first = await _running_agent(manager, "s1")
+        await _running_agent(manager, "s2")
+        evictions = metrics.get_counter("agent_evictions_total", reason="lru")
+
+        manager.get_agent("s1")  # s1 becomes most recently used
+        manager.get_agent("s3")
+        await manager.close()
+
+        assert metrics.get_counter("agent_evictions_total", reason="lru") == evictions + 1
+        assert first.state == AgentState.STOPPED
+
+    @pytest.mark.asyncio
+    async def test_recently_used_session_is_kept(self):
+        """A session touched after the others survives an LRU eviction"""
+        manager = AgentManager(max_agents=2, idle_ttl=0)
+        first = manager.get_agent("s1")
+        manager.get_agent("s2")
+        manager.get_agent("s1")
+        manager.get_agent("s3")
+
+        assert manager.get_agent("s1") is first
+        assert metrics.get_gauge("agents_live") == 2
+        await manager.close()
+
+    @pytest.mark.asyncio
+    async def test_sweep_evicts_idle_sessions(self):
+        """Only sessions idle longer than idle_ttl are evicted"""
+        manager = AgentManager(max_agents=0, idle_ttl=10)
+        idle = await _running_agent(manager, "idle")
+        manager.get_agent("active")
+        manager._last_used["active"] = time.monotonic() + 20
+
+        assert manager.sweep(now=time.monotonic() + 15) == 1
+        assert manager.get_agent("active") is not None
+        await manager.close()
+        assert idle.state == AgentState.STOPPED
+
+    @pytest.mark.asyncio
+    async def test_background_sweeper(self):
+        """The sweeper started with the app evicts idle sessions without any request"""
+        manager = AgentManager(max_agents=0, idle_ttl=0.02, sweep_interval=0.01)
+        memory_agent = MagicMock(ensure_running=AsyncMock(), stop=AsyncMock())
+        with patch("app.core.agents.agent_manager.MemoryAgent", return_value=memory_agent):
+            await manager.start()
+        memory_agent.ensure_running.assert_awaited_once()
+        agent = manager.get_agent("s1")
+
+        await asyncio.sleep(0.1)
+
+        assert "s1" not in manager._agents
+        assert manager.get_agent("s1") is not agent
+        await manager.close()
+
+    @pytest.mark.asyncio
+    async def test_remove_agent_stops_it(self):
+        """Explicit removal also stops the agent"""
+        manager = AgentManager()
+        agent = await _running_agent(manager, "s1")
+
+        assert manager.remove_agent("s1") is True
+        await manager.close()
+        assert agent.state == AgentState.STOPPED
+
+    @pytest.mark.asyncio
+    async def test_start_survives_memory_service_outage(self):
+        """An unavailable memory service at startup is logged and retried on first use"""
+        manager = AgentManager(idle_ttl=0)
+        with patch("app.core.agents.agent_manager.MemoryAgent", side_effect=RuntimeError("qdrant down")):
+            await manager.start()
+
+        assert manager._memory_agents == {}
+        await manager.close()
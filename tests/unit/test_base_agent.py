@@ -0,0 +1,97 @@
+# tests/unit/test_base_agent.py
+import asyncio
+import pytest
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from app.core.agents.base_agent import AgentState, BaseAgent
+
+
+class SlowAgent(BaseAgent):
+    """Agent whose initialization yields to the event loop, like a real client warm-up"""
+
+    def __init__(self, fail_first=False):
+        super().__init__("session", "SlowAgent")
+        self.initialize_calls = 0
+        self.fail_first = fail_first
+
+    async def _do_initialize(self):
+        self.initialize_calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail_first and self.initialize_calls == 1:
+            raise RuntimeError("backend not ready")
+
+    async def process_task(self, task):
+        return {}
+
+
+class TestEnsureRunning:
+    """Test cases for idempotent agent startup"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_start_initializes_once(self):
+        """A burst of concurrent callers starts the agent exactly once without errors"""
+        agent = SlowAgent()
+
+        await asyncio.gather(*[agent.ensure_running() for _ in range(200)])
+
+        assert agent.initialize_calls == 1
+        assert agent.state == AgentState.RUNNING
+
+    @pytest.mark.asyncio
+    async def test_running_agent_skips_lock(self):
+        """Once running, ensure_running returns without touching the lock"""
+        agent = SlowAgent()
+        await agent.ensure_running()
+
+        async with agent._lock:
+            await asyncio.wait_for(agent.ensure_running(), timeout=0.1)
+
+    @pytest.mark.asyncio
+    async def test_ready_agent_is_started(self):
+        """An initialized but not started agent is started"""
+        agent = SlowAgent()
+        await agent.initialize()
+
+        await agent.ensure_running()
+
+        assert agent.state == AgentState.RUNNING
+        assert agent.initialize_calls == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_initialization_is_retried(self):
+        """A failed start surfaces the error once and the next call re-initializes"""
+        agent = SlowAgent(fail_first=True)
+
+        with pytest.raises(RuntimeError):
+            await agent.ensure_running()
+        await agent.ensure_running()
+
+        assert agent.state == AgentState.RUNNING
+        assert agent.initialize_calls == 2
+
+    @pytest.mark.asyncio
+    async def test_concurrent_sessions_share_memory_agent(self):
+        """Many planner sessions retrieving memory at once start the shared MemoryAgent once"""
+        from app.core.agents.agent_manager import AgentManager
+        from app.core.agents.memory_agent import MemoryAgent
+
+        with patch("app.core.agents.memory_agent.get_mem0_service", return_value=MagicMock()):
+            manager = AgentManager(idle_ttl=0)
+            memory_agent = manager.get_memory_agent("default")
+
+        async def slow_init():
+            await asyncio.sleep(0.01)
+
+        initialize = AsyncMock(side_effect=slow_init)
+        memory_agent._do_initialize = initialize
+        memory_agent.process_task = AsyncMock(return_value={"messages": []})
+
+        planners = [manager.get_agent(f"s{i}") for i in range(50)]
+        states = await asyncio.gather(*[
+            planner._retrieve_memory_step({"session_id": planner.session_id}) for planner in planners
+        ])
+
+        assert isinstance(memory_agent, MemoryAgent)
+        assert initialize.await_count == 1
+        assert all(state["messages"] == [] for state in states)
+        await manager.close()
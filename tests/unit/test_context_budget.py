@@ -0,0 +1,141 @@
+# tests/unit/test_context_budget.py
+import time
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from app.services.context_budget import (
+    ContextAssembler, count_message_tokens, count_tokens, split_recent_turns, truncate_text
+)
+
+
+def _history(turns: int, size: int = 50) -> list:
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"问题 {i} " + "数字电源" * size})
+        messages.append({"role": "assistant", "content": f"回答 {i} " + "converter " * size})
+    return messages
+
+
+class TestTokenCounting:
+    """Test cases for token counting and truncation"""
+
+    def test_count_tokens(self):
+        """Text is counted in tokens and longer text costs more"""
+        assert count_tokens("") == 0
+        assert count_tokens(None) == 0
+        assert 0 < count_tokens("数字电源") < count_tokens("数字电源" * 10)
+
+    def test_character_estimate_fallback(self):
+        """Without a tiktoken encoding, CJK characters count as one token each"""
+        with patch("app.services.context_budget.get_tokenizer", return_value=None):
+            assert count_tokens("数字电源") == 4
+            assert count_tokens("abcdefgh") == 2
+
+    @pytest.mark.asyncio
+    async def test_loading_never_blocks_the_event_loop(self, monkeypatch):
+        """Inside the event loop the encoding loads in a thread; callers estimate until it is ready"""
+        from app.services import context_budget
+        monkeypatch.setattr(context_budget, "_tokenizer", None)
+        monkeypatch.setattr(context_budget, "_tokenizer_attempted", False)
+        monkeypatch.setattr(context_budget, "_tokenizer_loading", False)
+        encoder = MagicMock()
+
+        def slow_get_encoding(name):
+            time.sleep(0.2)  # e.g. downloading the encoding file
+            return encoder
+
+        with patch("tiktoken.get_encoding", slow_get_encoding):
+            start = time.perf_counter()
+            assert context_budget.get_tokenizer() is None
+            assert time.perf_counter() - start < 0.1
+            await context_budget.preload_tokenizer()
+        assert context_budget.get_tokenizer() is encoder
+
+    def test_truncate_text(self):
+        """Long text is cut down to the budget and marked as truncated"""
+        text = "converter " * 500
+        truncated = truncate_text(text, 50)
+        assert truncated.endswith("（已截断）")
+        assert count_tokens(truncated) <= 60
+        assert truncate_text("short", 50) == "short"
+
+
+class TestSplitRecentTurns:
+    """Test cases for keeping the most recent turns within a budget"""
+
+    def test_keeps_latest_whole_turns(self):
+        """Only whole user/assistant turns are kept, newest first"""
+        messages = _history(10)
+        turn_cost = count_message_tokens(messages[-2:])
+        older, recent = split_recent_turns(messages, turn_cost * 3 + 1)
+        assert recent == messages[-6:]
+        assert older == messages[:-6]
+        assert recent[0]["role"] == "user"
+
+    def test_everything_fits(self):
+        """Short histories are passed through unchanged"""
+        messages = _history(2, size=1)
+        assert split_recent_turns(messages, 10_000) == ([], messages)
+
+
+class TestContextAssembler:
+    """Test cases for token-budgeted context assembly with rolling summaries"""
+
+    @pytest.mark.asyncio
+    async def test_without_summary_drops_older_turns(self):
+        """Without a summarizer, older turns are simply dropped"""
+        messages = _history(40)
+        budget = 2000
+        result = await ContextAssembler().assemble("s1", messages, budget, "planner")
+        assert count_message_tokens(result) <= budget
+        assert result == messages[-len(result):]
+
+    @pytest.mark.asyncio
+    async def test_rolling_summary_is_incremental(self):
+        """Older turns are folded once; later turns only fold the newly dropped messages"""
+        summarize = AsyncMock(side_effect=lambda summary, msgs: f"{summary}+{len(msgs)}")
+        assembler = ContextAssembler(summarize=summarize, summary_budget=100)
+        messages = _history(20)
+        budget = count_message_tokens(messages[-8:]) + 100
+
+        first = await assembler.assemble("s1", messages, budget, "planner")
+        assert first[0]["role"] == "system" and first[0]["content"].endswith("+32")
+        assert first[1:] == messages[-8:]
+        assert count_message_tokens(first) <= budget
+
+        second = await assembler.assemble("s1", messages + _history(1), budget, "planner")
+        assert summarize.await_count == 2
+        assert summarize.await_args.args == ("+32", messages[32:34])
+        assert second[0]["content"].endswith("+32+2")
+
+    @pytest.mark.asyncio
+    async def test_rewritten_history_resets_summary(self):
+        """A reverted or rewritten history is summarized from scratch"""
+        summarize = AsyncMock(side_effect=lambda summary, msgs: f"{summary}+{len(msgs)}")
+        assembler = ContextAssembler(summarize=summarize, summary_budget=100)
+        messages = _history(20)
+        budget = count_message_tokens(messages[-8:]) + 100
+        await assembler.assemble("s1", messages, budget, "planner")
+
+        changed = [{"role": "user", "content": "不同的问题"}] + messages[1:]
+        result = await assembler.assemble("s1", changed, budget, "planner")
+        assert summarize.await_args.args[0] == ""
+        assert result[0]["content"].endswith("+32")
+
+
+class TestRewriterBudget:
+    """Test cases for the RAGFlow query rewriter history budget"""
+
+    @pytest.mark.asyncio
+    async def test_rewriter_history_is_bounded(self):
+        """The rewriter only sees the most recent turns within its budget"""
+        from app.services.tools import ragflow_tools
+        messages = _history(200)
+        with patch.object(ragflow_tools, "query_rewrite_chain") as chain:
+            chain.ainvoke = AsyncMock(return_value="rewritten")
+            result = await ragflow_tools._rewrite_query("下一个问题", messages)
+
+        assert result == "rewritten"
+        history_text = chain.ainvoke.await_args.args[0]["chat_history"]
+        assert count_tokens(history_text) <= ragflow_tools.settings.REWRITER_CONTEXT_TOKENS
+        assert history_text.endswith(messages[-1]["content"])
@@ -0,0 +1,275 @@
+# tests/unit/test_deadline.py
+import asyncio
+import time
+import httpx
+import pytest
+from unittest.mock import AsyncMock, patch
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from app.core.deadline import (
+    DeadlineExceeded,
+    DeadlineMiddleware,
+    capped_timeout,
+    clear_deadline,
+    iter_within_deadline,
+    parse_request_timeout,
+    remaining,
+    running_short,
+    set_deadline,
+    time_budget,
+)
+from app.schemas.graph_state import Plan, PlanStep
+
+
+@pytest.fixture
+def deadline():
+    """Set a request deadline for the duration of a test"""
+    yield set_deadline
+    clear_deadline()
+
+
+class TestTimeBudget:
+    """Test cases for deriving call timeouts from the remaining request time"""
+
+    def test_without_deadline_uses_default(self):
+        """Outside a request the configured timeout is used unchanged"""
+        assert remaining() is None
+        assert time_budget(30.0) == 30.0
+        assert time_budget() is None
+        assert capped_timeout(httpx.Timeout(60.0, connect=5.0)) == httpx.Timeout(60.0, connect=5.0)
+
+    def test_budget_is_capped_by_remaining_time(self, deadline):
+        """A call never gets more time than the request has left, minus the reserve"""
+        deadline(10.0)
+        assert time_budget(30.0) <= 10.0
+        assert time_budget(2.0) == 2.0
+        assert time_budget(reserve=4.0) <= 6.0
+
+        timeout = capped_timeout(httpx.Timeout(60.0, connect=5.0, pool=None))
+        assert timeout.connect == 5.0
+        assert timeout.read <= 10.0 and timeout.write <= 10.0 and timeout.pool <= 10.0
+
+    def test_exhausted_budget_raises(self, deadline):
+        """Once the remaining time is within the reserve no new call is started"""
+        deadline(1.0)
+        assert not running_short(0.5)
+        assert running_short(2.0)
+        with pytest.raises(DeadlineExceeded):
+            time_budget(30.0, reserve=2.0)
+        with pytest.raises(TimeoutError):
+            capped_timeout(httpx.Timeout(60.0), reserve=2.0)
+
+    def test_parse_request_timeout(self):
+        """The header can only shorten the server limit"""
+        assert parse_request_timeout(None, 110.0) == 110.0
+        assert parse_request_timeout("30", 110.0) == 30.0
+        assert parse_request_timeout("600", 110.0) == 110.0
+        assert parse_request_timeout("abc", 110.0) == 110.0
+        assert parse_request_timeout("-1", 110.0) == 110.0
+        assert parse_request_timeout("30", 0) == 30.0
+        assert parse_request_timeout(None, 0) is None
+
+    @pytest.mark.asyncio
+    async def test_iter_within_deadline(self, deadline):
+        """A stream that stalls past the deadline is abandoned after the items already received"""
+        closed = asyncio.Event()
+
+        async def stream():
+            try:
+                yield 1
+                await asyncio.sleep(5)
+                yield 2
+            finally:
+                closed.set()
+
+        deadline(0.1)
+        received = []
+        start = time.perf_counter()
+        with pytest.raises(TimeoutError):
+            async for item in iter_within_deadline(stream()):
+                received.append(item)
+        assert received == [1]
+        assert time.perf_counter() - start < 1
+        assert closed.is_set()
+
+
+class TestDeadlineMiddleware:
+    """Test cases for setting the deadline per HTTP request"""
+
+    async def _remaining_seen_by_app(self, headers):
+        seen = {}
+
+        async def app(scope, receive, send):
+            seen["remaining"] = remaining()
+
+        await DeadlineMiddleware(app, header="X-Request-Timeout", limit=110.0)({"type": "http", "headers": headers}, None, None)
+        return seen["remaining"]
+
+    @pytest.mark.asyncio
+    async def test_header_shortens_deadline(self):
+        """The request header sets a shorter deadline and the default applies without it"""
+        assert 29 < await self._remaining_seen_by_app([(b"x-request-timeout", b"30")]) <= 30
+        assert 109 < await self._remaining_seen_by_app([]) <= 110
+        assert 109 < await self._remaining_seen_by_app([(b"x-request-timeout", b"3600")]) <= 110
+        assert remaining() is None
+
+
+class TestDeadlinePropagation:
+    """Test cases for downstream calls deriving their timeouts from the request deadline"""
+
+    @pytest.mark.asyncio
+    async def test_mem0_call_bounded_by_deadline(self, deadline):
+        """A Mem0 call gives up at the request deadline rather than at its own timeout"""
+        from app.services.tools.mem0_service import run_in_mem0_executor
+
+        deadline(0.1)
+        start = time.perf_counter()
+        with pytest.raises(TimeoutError):
+            await run_in_mem0_executor("get_all", time.sleep, 0.5, timeout=10.0)
+        assert time.perf_counter() - start < 0.4
+
+    @pytest.mark.asyncio
+    async def test_background_memory_write_ignores_request_deadline(self, deadline, tmp_path):
+        """Plans queued during a request are written after it ends, without its deadline"""
+        from app.services.memory_writer import MemoryWriter
+
+        seen = []
+
+        async def write(session_id, plan):
+            seen.append(remaining())
+
+        writer = MemoryWriter(write, journal_path=str(tmp_path / "journal.jsonl"))
+        deadline(5.0)
+        writer.store_plan("s1", Plan(message_id="m1", goal="goal", steps=[], final_summary="summary"))
+        assert await writer.flush(timeout=1)
+        assert seen == [None]
+
+    @pytest.mark.asyncio
+    async def test_ragflow_proxy_first_byte_bounded_by_deadline(self, deadline):
+        """The proxy reports an upstream that has not answered by the request deadline"""
+        from app.api.endpoints.v1.chat import ragflow_stream
+        from app.api.endpoints.v1.models import ChatCompletionRequest
+
+        async def handler(request):
+            await asyncio.sleep(5)
+            return httpx.Response(200, content=b"")
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        request = ChatCompletionRequest(model="model", messages=[{"role": "user", "content": "PPEC 是什么？"}], stream=True)
+        deadline(0.2)
+        start = time.perf_counter()
+        try:
+            with patch("app.api.endpoints.v1.chat.get_http_client", return_value=client), \
+                    patch("app.api.endpoints.v1.chat.get_semantic_cache", return_value=None):
+                response = await ragflow_stream(request)
+                body = b"".join([chunk async for chunk in response.body_iterator]).decode("utf-8")
+        finally:
+            await client.aclose()
+
+        assert time.perf_counter() - start < 1
+        assert "no response within 0.2s" in body
+        assert body.endswith("data: [DONE]\n\n")
+
+
+class SlowExecutor:
+    """Fake executor LLM that never answers before the deadline"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, instruction):
+        self.calls += 1
+        await asyncio.sleep(5)
+
+
+class RecordingSummarizer:
+    """Fake summarizer chain that records its inputs"""
+
+    def __init__(self):
+        self.inputs = []
+
+    async def astream(self, inputs):
+        self.inputs.append(inputs)
+        yield AIMessageChunk(content="部分结果的总结")
+
+    async def ainvoke(self, inputs):
+        self.inputs.append(inputs)
+        return AIMessage(content="部分结果的总结")
+
+
+class TestPlannerDegradation:
+    """Test cases for the planner summarizing partial results when time runs short"""
+
+    @pytest.mark.asyncio
+    async def test_skips_replan_and_summarizes_partial_results(self, deadline):
+        """A step cut off by the deadline skips the replan and pending steps and still yields a summary"""
+        from app.core.agents.planner_agent import PlannerAgent
+
+        plan = Plan(message_id="turn_1", goal="比较两种控制方式", steps=[
+            PlanStep(step_id=1, instruction="search a", status="complete", result="A 的资料"),
+            PlanStep(step_id=2, instruction="search b", depends_on=[1]),
+            PlanStep(step_id=3, instruction="compare", depends_on=[2]),
+        ])
+        state = {"session_id": "test_session", "original_input": "比较", "messages": [], "plan": plan}
+        agent = PlannerAgent("test_session")
+        agent._retrieve_memory_step = AsyncMock(return_value=state)
+        agent._plan_step = AsyncMock(return_value=state)
+        agent._replan_step = AsyncMock(return_value=state)
+        agent._update_memory_step = AsyncMock(return_value=state)
+        executor, summarizer = SlowExecutor(), RecordingSummarizer()
+
+        deadline(1.0)
+        start = time.perf_counter()
+        with patch("app.core.agents.planner_agent.executor_llm", executor), \
+                patch("app.core.agents.planner_agent.summarizer_chain", summarizer), \
+                patch("app.core.agents.planner_agent.settings.PLANNER_SUMMARY_RESERVE", 0.5):
+            events = [event async for event in agent._run_session_stream(state)]
+
+        assert time.perf_counter() - start < 1
+        assert executor.calls == 1
+        agent._replan_step.assert_not_called()
+        assert [step.status for step in plan.steps] == ["complete", "failed", "pending"]
+
+        steps_summary = summarizer.inputs[0]["plan_steps_summary"]
+        assert "A 的资料" in steps_summary and "剩余时间不足" in steps_summary and "未执行" in steps_summary
+        assert [p for n, p in events if n == "final_response"] == [{"message_id": "turn_1", "summary": "部分结果的总结"}]
+        assert any("跳过重新规划" in p["content"] for n, p in events if n == "thought")
+
+    @pytest.mark.asyncio
+    async def test_planner_timeout_falls_back_to_default_plan(self, deadline):
+        """A planner LLM that outlives the planning budget yields the single search step plan"""
+        from app.core.agents import planner_agent
+
+        class SlowPlanner:
+            async def ainvoke(self, inputs):
+                await asyncio.sleep(5)
+
+        state = {"session_id": "test_session", "original_input": "什么是PPEC", "messages": []}
+        deadline(1.0)
+        start = time.perf_counter()
+        with patch.object(planner_agent, "planner_runnable", SlowPlanner()), \
+                patch.object(planner_agent.context_assembler, "assemble", AsyncMock(return_value=[])), \
+                patch.object(planner_agent.settings, "PLANNER_SUMMARY_RESERVE", 0.8):
+            result = await planner_agent.PlannerAgent("test_session")._plan_step(state)
+
+        assert time.perf_counter() - start < 1
+        assert result["plan"].goal == "什么是PPEC"
+        assert [step.instruction for step in result["plan"].steps] == ["使用ragflow_knowledge_search工具搜索相关信息"]
+
+    @pytest.mark.asyncio
+    async def test_planner_skipped_when_deadline_exhausted(self, deadline):
+        """With less time left than the summary reserve the planner LLM is not called at all"""
+        from app.core.agents import planner_agent
+
+        planner = AsyncMock()
+        state = {"session_id": "test_session", "original_input": "什么是PPEC", "messages": []}
+        deadline(0.1)
+        with patch.object(planner_agent, "planner_runnable", planner), \
+                patch.object(planner_agent.context_assembler, "assemble", AsyncMock(return_value=[])), \
+                patch.object(planner_agent.settings, "PLANNER_SUMMARY_RESERVE", 0.5):
+            with pytest.raises(DeadlineExceeded):
+                time_budget(reserve=0.5)
+            result = await planner_agent.PlannerAgent("test_session")._plan_step(state)
+
+        planner.ainvoke.assert_not_called()
+        assert [step.status for step in result["plan"].steps] == ["pending"]
@@ -0,0 +1,221 @@
+# tests/unit/test_disconnect.py
+import asyncio
+import json
+import httpx
+import pytest
+import uvicorn
+from unittest.mock import patch, MagicMock
+from fastapi import FastAPI
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from app.api.endpoints.v1 import chat
+from app.core.agents.base_agent import AgentState
+from app.core.agents.planner_agent import PlannerAgent
+from app.core.metrics import metrics
+from app.core.sse import cancel_on_disconnect
+
+
+def _chunk(content):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "stub",
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}],
+    }
+
+
+class StubUpstream:
+    """A local HTTP server streaming an endless chat.completion.chunk SSE response"""
+
+    def __init__(self):
+        self.closed = asyncio.Event()
+        self.frames = 0
+
+        async def completions(request):
+            async def body():
+                try:
+                    while True:
+                        self.frames += 1
+                        yield f"data: {json.dumps(_chunk(f'token{self.frames} '))}\n\n"
+                        await asyncio.sleep(0.01)
+                finally:
+                    self.closed.set()
+            return StreamingResponse(body(), media_type="text/event-stream")
+
+        app = Starlette(routes=[Route("/chat/completions", completions, methods=["POST"])])
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="off"))
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.should_exit = True
+        await self.task
+
+
+async def _call_until_disconnect(app, path, payload, frames_before_disconnect=3):
+    """Drive an ASGI app with a client that goes away after a few body frames"""
+    disconnected = asyncio.Event()
+    body_sent = False
+    frames = []
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": json.dumps(payload).encode("utf-8"), "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            frames.append(message["body"])
+            if len(frames) >= frames_before_disconnect:
+                disconnected.set()
+
+    scope = {
+        "type": "http",
+        # spec 2.4 servers do not get Starlette's own disconnect listener, so only the endpoint's watcher can stop the stream
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("utf-8"),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    await asyncio.wait_for(app(scope, receive, send), timeout=5)
+    return frames
+
+
+def _app():
+    app = FastAPI()
+    app.include_router(chat.router)
+    return app
+
+
+class TestDisconnectCancellation:
+    """Test cases for stopping upstream work when the SSE client disconnects"""
+
+    @pytest.mark.asyncio
+    async def test_body_runs_in_the_consuming_task(self):
+        """Frames are read directly by the consumer; a disconnect ends the stream cleanly"""
+        disconnected = asyncio.Event()
+        tasks = set()
+        closed = asyncio.Event()
+
+        class FakeRequest:
+            async def receive(self):
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+        async def body():
+            try:
+                while True:
+                    tasks.add(asyncio.current_task())
+                    yield "frame"
+                    await asyncio.sleep(0.01)
+            finally:
+                closed.set()
+
+        received = []
+        async for frame in cancel_on_disconnect(body(), FakeRequest(), stream="test"):
+            received.append(frame)
+            if len(received) == 3:
+                disconnected.set()
+
+        assert tasks == {asyncio.current_task()}
+        assert closed.is_set()
+        assert asyncio.current_task().cancelling() == 0
+
+    @pytest.mark.asyncio
+    async def test_ragflow_stream_closes_upstream_connection(self):
+        """A client disconnect closes the RAGFlow upstream stream instead of reading it to the end"""
+        before = metrics.get_counter("stream_disconnects_total", stream="ragflow")
+        async with StubUpstream() as upstream:
+            client = httpx.AsyncClient()
+            try:
+                with patch("app.api.endpoints.v1.chat.get_http_client", return_value=client), \
+                        patch("app.api.endpoints.v1.chat.get_semantic_cache", return_value=None), \
+                        patch("app.api.endpoints.v1.chat.settings.RAGFLOW_API_URL", upstream.url):
+                    await _call_until_disconnect(_app(), "/ragflow-stream", {"messages": [{"role": "user", "content": "PPEC 是什么？"}]})
+                    await asyncio.wait_for(upstream.closed.wait(), timeout=2)
+            finally:
+                await client.aclose()
+
+        assert metrics.get_counter("stream_disconnects_total", stream="ragflow") == before + 1
+        assert chat.ragflow_single_flight.active == 0
+
+    @pytest.mark.asyncio
+    async def test_llm_stream_stops_generation(self):
+        """A client disconnect stops pulling tokens from the LLM"""
+        closed = asyncio.Event()
+        llm = MagicMock()
+
+        async def astream(messages):
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield MagicMock(content="token ")
+            finally:
+                closed.set()
+
+        llm.astream = astream
+        with patch("app.api.endpoints.v1.chat.get_llm", return_value=llm):
+            await _call_until_disconnect(_app(), "/llm-stream", {"model": "qwen", "messages": [{"role": "user", "content": "你好"}]})
+
+        assert closed.is_set()
+
+    @pytest.mark.asyncio
+    async def test_planner_cancels_pending_steps(self):
+        """A disconnect cancels the running step and skips the summary and memory write"""
+        agent = PlannerAgent("test_session")
+        agent.state = AgentState.RUNNING
+        step_cancelled = asyncio.Event()
+        memory_written = []
+
+        async def fake_stream(state):
+            yield ("thought", {"phase": "execute", "content": "开始执行步骤 1"})
+            try:
+                await asyncio.sleep(10)  # a long-running step
+            except asyncio.CancelledError:
+                step_cancelled.set()
+                raise
+            memory_written.append(True)
+            yield ("final_response", {"message_id": "turn_1", "summary": "done"})
+
+        agent._run_session_stream = fake_stream
+        disconnected = asyncio.Event()
+
+        class FakeRequest:
+            async def receive(self):
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+        before = metrics.get_counter("stream_disconnects_total", stream="planner")
+        response = await agent.process_request("hi", "turn_1", http_request=FakeRequest())
+        frames = []
+
+        async def consume():
+            async for frame in response.body_iterator:
+                frames.append(frame)
+                disconnected.set()
+
+        await asyncio.wait_for(consume(), timeout=2)
+
+        assert step_cancelled.is_set()
+        assert memory_written == []
+        assert len(frames) == 1
+        assert metrics.get_counter("stream_disconnects_total", stream="planner") == before + 1
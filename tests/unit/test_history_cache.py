@@ -0,0 +1,233 @@
+# tests/unit/test_history_cache.py
+import asyncio
+import time
+import pytest
+from unittest.mock import patch, MagicMock
+
+from app.core.metrics import metrics
+from app.schemas.graph_state import Plan
+from app.services.history_cache import (
+    HistoryCache,
+    InMemoryHistoryBackend,
+    RedisHistoryBackend,
+    SessionRevisions,
+    plan_to_turn,
+)
+from app.services.memory_writer import MemoryWriter
+from app.services.tools.mem0_service import Mem0Service
+
+
+def _plan(message_id: str) -> Plan:
+    return Plan(message_id=message_id, goal=f"goal {message_id}", steps=[], final_summary=f"summary {message_id}")
+
+
+def _memories(*message_ids):
+    return [
+        {"id": f"mem_{mid}", "metadata": {"plan": _plan(mid).model_dump_json(), "message_id": mid}}
+        for mid in message_ids
+    ]
+
+
+class FakeRedis:
+    """Minimal in-memory stand-in for the redis.asyncio list commands the backend uses"""
+
+    def __init__(self):
+        self.lists = {}
+        self.ttls = {}
+
+    async def delete(self, key):
+        self.ttls.pop(key, None)
+        return 1 if self.lists.pop(key, None) is not None else 0
+
+    async def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+        return len(self.lists[key])
+
+    async def rpushx(self, key, *values):
+        if key not in self.lists:
+            return 0
+        return await self.rpush(key, *values)
+
+    async def lrange(self, key, start, end):
+        items = self.lists.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    async def expire(self, key, seconds):
+        self.ttls[key] = seconds
+        return key in self.lists
+
+
+@pytest.fixture(params=["memory", "shared-memory", "redis"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        return HistoryCache(InMemoryHistoryBackend(max_sessions=8, ttl=60))
+    if request.param == "shared-memory":
+        return HistoryCache(InMemoryHistoryBackend(max_sessions=8, ttl=60, revisions=SessionRevisions(str(tmp_path))))
+    return HistoryCache(RedisHistoryBackend(FakeRedis(), ttl=60))
+
+
+class TestHistoryCache:
+    """Test cases for the per-session conversation history cache"""
+
+    @pytest.mark.asyncio
+    async def test_miss_then_hit(self, cache):
+        """Unknown sessions miss; cached sessions (including empty history) hit"""
+        assert await cache.get_messages("s1") is None
+        await cache.set_turns("s1", [])
+        assert await cache.get_messages("s1") == []
+
+    @pytest.mark.asyncio
+    async def test_append_only_to_cached_sessions(self, cache):
+        """Completed plans append to cached history and are ignored for uncached sessions"""
+        await cache.append_plan("s1", _plan("t1"))
+        assert await cache.get_messages("s1") is None
+
+        await cache.set_turns("s1", [])
+        await cache.append_plan("s1", _plan("t1"))
+        await cache.append_plan("s1", Plan(message_id="t2", goal="no summary", steps=[]))
+        assert await cache.get_messages("s1") == [
+            {"role": "user", "content": "goal t1"},
+            {"role": "assistant", "content": "summary t1"},
+        ]
+
+    @pytest.mark.asyncio
+    async def test_truncate_to_turn(self, cache):
+        """Revert truncates after the target turn, or drops the entry if the turn is unknown"""
+        await cache.set_turns("s1", [])
+        for mid in ("t1", "t2", "t3"):
+            await cache.append_plan("s1", _plan(mid))
+
+        await cache.truncate("s1", "t2")
+        assert [m["content"] for m in await cache.get_messages("s1")] == ["goal t1", "summary t1", "goal t2", "summary t2"]
+
+        await cache.truncate("s1", "unknown")
+        assert await cache.get_messages("s1") is None
+
+    @pytest.mark.asyncio
+    async def test_in_memory_lru_and_ttl(self):
+        """The in-process backend evicts least recently used sessions and expires stale ones"""
+        backend = InMemoryHistoryBackend(max_sessions=2, ttl=60)
+        await backend.set("s1", [])
+        await backend.set("s2", [])
+        await backend.get("s1")
+        await backend.set("s3", [])
+        assert await backend.get("s2") is None
+        assert await backend.get("s1") == []
+
+        expired = InMemoryHistoryBackend(ttl=0)
+        await expired.set("s1", [])
+        assert await expired.get("s1") is None
+
+    @pytest.mark.asyncio
+    async def test_workers_see_each_others_turns_and_reverts(self, tmp_path):
+        """Two in-process caches sharing revisions never serve history the other worker has changed"""
+        worker_a, worker_b = (
+            HistoryCache(InMemoryHistoryBackend(ttl=60, revisions=SessionRevisions(str(tmp_path)))) for _ in range(2)
+        )
+        for worker in (worker_a, worker_b):
+            await worker.set_turns("s1", [plan_to_turn(_plan("t1"))])
+
+        # worker A runs a turn: B's copy lacks it and must be reloaded
+        await worker_a.append_plan("s1", _plan("t2"))
+        assert len(await worker_a.get_messages("s1")) == 4
+        assert await worker_b.get_messages("s1") is None
+        await worker_b.set_turns("s1", [plan_to_turn(_plan(mid)) for mid in ("t1", "t2")])
+
+        # worker A reverts to t1: B must not keep serving t2
+        await worker_a.truncate("s1", "t1")
+        assert await worker_b.get_messages("s1") is None
+        assert [m["content"] for m in await worker_a.get_messages("s1")] == ["goal t1", "summary t1"]
+
+    @pytest.mark.asyncio
+    async def test_backend_failure_degrades_to_miss(self):
+        """A broken backend is reported as a miss instead of failing the turn"""
+        backend = MagicMock()
+        backend.get.side_effect = ConnectionError("redis down")
+        cache = HistoryCache(backend)
+        assert await cache.get_messages("s1") is None
+
+
+class TestMem0ServiceHistoryCache:
+    """Test cases for Mem0Service reading through the history cache"""
+
+    @pytest.fixture(autouse=True)
+    def memory_writer(self, tmp_path):
+        """Keep revert markers out of the working directory"""
+        with patch("app.services.tools.mem0_service.memory_writer", MemoryWriter(journal_path=str(tmp_path / "journal.jsonl"))):
+            yield
+
+    @pytest.fixture
+    def mem0_service(self):
+        with patch('app.services.tools.mem0_service.get_mem0_client') as mock_get_client:
+            mock_client = MagicMock()
+            mock_get_client.return_value = mock_client
+            service = Mem0Service(history_cache=HistoryCache(InMemoryHistoryBackend()))
+            return service, mock_client
+
+    @pytest.mark.asyncio
+    async def test_get_all_called_once_per_session(self, mem0_service):
+        """Repeated turns are served from the cache and count as hits"""
+        service, mock_client = mem0_service
+        mock_client.get_all.return_value = _memories("t1", "t2")
+        hits = metrics.get_counter("history_cache_requests_total", result="hit")
+
+        first = await service.get_memory_history("s1")
+        await service.history_cache.append_plan("s1", _plan("t3"))
+        second = await service.get_memory_history("s1")
+
+        mock_client.get_all.assert_called_once()
+        assert second == first + [{"role": "user", "content": "goal t3"}, {"role": "assistant", "content": "summary t3"}]
+        assert metrics.get_counter("history_cache_requests_total", result="hit") == hits + 1
+
+    @pytest.mark.asyncio
+    async def test_revert_truncates_cache(self, mem0_service):
+        """revert_to_turn drops exactly the reverted turns from the cache"""
+        service, mock_client = mem0_service
+        mock_client.get_all.return_value = _memories("t1", "t2", "t3")
+        await service.get_memory_history("s1")
+
+        await service.revert_to_turn("s1", "t1")
+        mock_client.delete.assert_any_call(id="mem_t2")
+        assert await service.get_memory_history("s1") == [
+            {"role": "user", "content": "goal t1"},
+            {"role": "assistant", "content": "summary t1"},
+        ]
+        assert mock_client.get_all.call_count == 2  # 一次加载历史，一次回滚时读取
+
+    @pytest.mark.asyncio
+    async def test_failed_delete_invalidates_cache(self, mem0_service):
+        """A failed revert invalidates the session so the next turn reloads from Mem0"""
+        service, mock_client = mem0_service
+        mock_client.get_all.return_value = _memories("t1", "t2")
+        await service.get_memory_history("s1")
+
+        mock_client.delete.side_effect = Exception("qdrant down")
+        with pytest.raises(Exception):
+            await service.revert_to_turn("s1", "t1")
+        assert await service.history_cache.get_messages("s1") is None
+
+    @pytest.mark.asyncio
+    async def test_miss_merges_unwritten_plans_without_waiting(self, mem0_service, tmp_path):
+        """A cache miss returns Mem0 history plus queued plans instead of waiting for the slow write"""
+        service, mock_client = mem0_service
+        mock_client.get_all.return_value = _memories("t1", "t2")
+        write_started = asyncio.Event()
+
+        async def slow_write(session_id, plan):
+            write_started.set()
+            await asyncio.sleep(5)
+
+        writer = MemoryWriter(slow_write, journal_path=str(tmp_path / "journal.jsonl"))
+        writer.store_plan("s1", _plan("t2"))
+        writer.store_plan("s1", _plan("t3"))
+        await write_started.wait()
+        try:
+            with patch("app.services.tools.mem0_service.memory_writer", writer):
+                start = time.perf_counter()
+                messages = await service.get_memory_history("s1")
+            assert time.perf_counter() - start < 1
+            assert [m["content"] for m in messages if m["role"] == "user"] == ["goal t1", "goal t2", "goal t3"]
+        finally:
+            for task in writer._tasks.values():
+                task.cancel()
+            await asyncio.gather(*writer._tasks.values(), return_exceptions=True)
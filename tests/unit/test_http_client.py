@@ -0,0 +1,106 @@
+# tests/unit/test_http_client.py
+import asyncio
+import pytest
+import httpx
+
+from app.core import http_client
+from app.core.http_client import get_http_client, get_upstream_config, get_pool_stats, close_http_clients
+from app.core.metrics import metrics
+
+
+class TestHttpClientRegistry:
+    """Test cases for the pooled per-upstream HTTP client registry"""
+
+    @pytest.mark.asyncio
+    async def test_same_upstream_shares_client(self):
+        """Repeated lookups of one upstream return the same pooled client"""
+        client = get_http_client("ragflow")
+        assert get_http_client("ragflow") is client
+        assert get_http_client("one_api") is not client
+        await close_http_clients()
+
+    @pytest.mark.asyncio
+    async def test_closed_client_is_recreated(self):
+        """A client closed at shutdown is transparently recreated on next use"""
+        client = get_http_client("ragflow")
+        await close_http_clients()
+        assert client.is_closed
+        new_client = get_http_client("ragflow")
+        assert new_client is not client
+        assert not new_client.is_closed
+        await close_http_clients()
+
+    @pytest.mark.asyncio
+    async def test_cached_llm_uses_recreated_client(self):
+        """The cached ChatOpenAI keeps working after the pools are closed and rebuilt"""
+        from app.services.llm_service import get_llm
+
+        llm = get_llm()
+        await close_http_clients()
+
+        def handler(request):
+            return httpx.Response(200, json={
+                "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "qwen",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "pong"}, "finish_reason": "stop"}],
+            })
+
+        http_client._clients["one_api"] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            assert get_llm() is llm
+            assert (await llm.ainvoke("ping")).content == "pong"
+        finally:
+            await close_http_clients()
+
+    def test_unknown_upstream_raises(self):
+        """Unknown upstream names are rejected"""
+        with pytest.raises(KeyError):
+            get_http_client("does-not-exist")
+
+    def test_upstream_config_timeouts_and_limits(self):
+        """Upstream configs expose httpx timeout and limits objects"""
+        config = get_upstream_config("ragflow")
+        assert isinstance(config.timeout, httpx.Timeout)
+        assert config.timeout.connect == config.connect_timeout
+        assert config.timeout.read == config.read_timeout
+        assert config.limits.max_connections == config.max_connections
+        assert config.limits.keepalive_expiry == config.keepalive_expiry
+
+    @pytest.mark.asyncio
+    async def test_pool_stats_reports_saturation(self):
+        """Pool statistics are reported per upstream and via the metrics collector"""
+        await close_http_clients()
+        get_http_client("ragflow")
+        stats = get_pool_stats()
+        assert set(stats) == {"ragflow"}
+        assert stats["ragflow"]["connections"] == 0
+        assert stats["ragflow"]["saturation"] == 0.0
+        assert stats["ragflow"]["max_connections"] == get_upstream_config("ragflow").max_connections
+        assert "ragflow" in metrics.snapshot()["collectors"]["http_pools"]
+        await close_http_clients()
+
+    @pytest.mark.asyncio
+    async def test_keepalive_connection_is_reused(self):
+        """Sequential requests through the shared client reuse one pooled TCP connection"""
+        accepted = []
+
+        async def handle(reader, writer):
+            accepted.append(writer)
+            try:
+                while True:
+                    await reader.readuntil(b"\r\n\r\n")
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nContent-Type: text/plain\r\n\r\nok")
+                    await writer.drain()
+            except asyncio.IncompleteReadError:
+                writer.close()
+
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            for _ in range(3):
+                response = await get_http_client("ragflow").get(f"http://127.0.0.1:{port}/ping")
+                assert response.text == "ok"
+            assert len(accepted) == 1
+            assert get_pool_stats()["ragflow"]["idle"] == 1
+        finally:
+            await close_http_clients()
+            server.close()
@@ -0,0 +1,133 @@
+# tests/unit/test_intent_router.py
+import pytest
+from unittest.mock import AsyncMock, patch
+
+from app.core.agents.planner_agent import PlannerAgent
+from app.core.exceptions import CircuitOpenException, ServiceUnavailableException
+from app.core.metrics import metrics
+from app.services.intent_router import ROUTE_DIRECT, ROUTE_PLAN, route_query
+
+
+class TestRouteQuery:
+    """Test cases for the heuristic intent router"""
+
+    @pytest.mark.parametrize("query", ["什么是数字电源？", "PPEC 平台有哪些功能？", "PWM 模块的死区时间如何配置？", "What is PPEC?"])
+    def test_single_lookup_goes_direct(self, query):
+        """Short definition and how-to questions skip planning"""
+        decision = route_query(query)
+        assert decision.route == ROUTE_DIRECT
+        assert decision.confidence >= 0.7
+        assert "lookup" in decision.reasons
+
+    @pytest.mark.parametrize("query", [
+        "比较数字电源和模拟电源的优缺点",
+        "帮我设计一个 Buck 变换器的控制方案并给出参数计算步骤",
+        "首先介绍 PPEC 的架构，然后说明如何部署到产线",
+        "1. 什么是 PPEC 2. 如何安装",
+    ])
+    def test_multi_step_goals_are_planned(self, query):
+        """Comparisons, tasks, sequences and multiple questions go through the planner"""
+        assert route_query(query).route == ROUTE_PLAN
+
+    def test_uncertain_queries_are_planned(self):
+        """Without any lookup cue the confidence stays below the default threshold"""
+        decision = route_query("I need a summary")
+        assert decision.route == ROUTE_PLAN
+        assert decision.confidence < 0.7
+
+    def test_threshold_controls_route(self):
+        """The confidence threshold decides the route"""
+        assert route_query("I need a summary", threshold=0.5).route == ROUTE_DIRECT
+        assert route_query("什么是数字电源？", threshold=0.95).route == ROUTE_PLAN
+
+
+def _agent():
+    agent = PlannerAgent("test_session")
+    agent._retrieve_memory_step = AsyncMock(side_effect=lambda state: {**state, "messages": []})
+    agent._plan_step = AsyncMock()
+    agent._update_memory_step = AsyncMock(side_effect=lambda state: state)
+    return agent
+
+
+async def _run(agent, query, search):
+    state = {"session_id": "test_session", "original_input": query, "messages": [], "plan": None}
+    with patch("app.core.agents.planner_agent.ragflow_stream_answer", search):
+        return [event async for event in agent._run_session_stream(state)]
+
+
+class TestPlannerFastPath:
+    """Test cases for answering single-lookup questions without planning"""
+
+    @pytest.mark.asyncio
+    async def test_direct_route_streams_ragflow_answer(self):
+        """A lookup question streams the RAGFlow answer and never calls the planner"""
+        queries = []
+
+        async def search(query, chat_history=None):
+            queries.append(query)
+            for delta in ["数字电源", "是一种电源。"]:
+                yield delta
+
+        agent = _agent()
+        before = metrics.get_counter("planner_routes_total", route=ROUTE_DIRECT)
+        events = await _run(agent, "什么是数字电源？", search)
+
+        agent._plan_step.assert_not_called()
+        assert queries == ["什么是数字电源？"]
+        assert [p["delta"] for n, p in events if n == "final_response_delta"] == ["数字电源", "是一种电源。"]
+        finals = [p for n, p in events if n == "final_response"]
+        assert len(finals) == 1 and finals[0]["summary"] == "数字电源是一种电源。"
+
+        plan = agent._update_memory_step.call_args.args[0]["plan"]
+        assert [(s.status, s.result) for s in plan.steps] == [("complete", "数字电源是一种电源。")]
+        assert metrics.get_counter("planner_routes_total", route=ROUTE_DIRECT) == before + 1
+        assert metrics.get_histogram("planner_route_latency_seconds", route=ROUTE_DIRECT)["count"] >= 1
+
+    @pytest.mark.asyncio
+    async def test_open_circuit_reported_as_answer(self):
+        """A RAGFlow failure on the fast path ends the turn with the error as the answer"""
+        async def search(query, chat_history=None):
+            raise CircuitOpenException("知识问答服务暂时不可用，请稍后再试。")
+            yield
+
+        agent = _agent()
+        events = await _run(agent, "什么是数字电源？", search)
+        finals = [p for n, p in events if n == "final_response"]
+        assert finals[0]["summary"] == "知识问答服务暂时不可用，请稍后再试。"
+        assert ("step_update", {"message_id": finals[0]["message_id"], "step_id": 1, "status": "failed"}) in events
+        agent._update_memory_step.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_failure_mid_stream_is_not_remembered(self):
+        """An upstream error after part of the answer keeps the streamed text but fails the step and skips memory"""
+        async def search(query, chat_history=None):
+            yield "数字电源"
+            raise ServiceUnavailableException("知识问答服务响应超时，请稍后再试。")
+
+        agent = _agent()
+        events = await _run(agent, "什么是数字电源？", search)
+
+        finals = [p for n, p in events if n == "final_response"]
+        assert finals[0]["summary"] == "数字电源"
+        assert [p["status"] for n, p in events if n == "step_update"] == ["running", "failed"]
+        agent._update_memory_step.assert_not_called()
+        assert any("不写入记忆" in p["content"] for n, p in events if n == "thought")
+
+    @pytest.mark.asyncio
+    async def test_multi_step_goal_is_planned(self):
+        """A multi-step goal goes through _plan_step"""
+        agent = _agent()
+        agent._plan_step.side_effect = lambda state: state
+        search = AsyncMock()
+        await _run(agent, "比较数字电源和模拟电源的优缺点", search)
+        agent._plan_step.assert_called_once()
+        search.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_router_disabled(self):
+        """With the router disabled every turn is planned"""
+        agent = _agent()
+        agent._plan_step.side_effect = lambda state: state
+        with patch("app.core.agents.planner_agent.settings.INTENT_ROUTER_ENABLED", False):
+            await _run(agent, "什么是数字电源？", AsyncMock())
+        agent._plan_step.assert_called_once()
@@ -0,0 +1,62 @@
+# tests/unit/test_llm_stream.py
+import pytest
+from unittest.mock import patch, MagicMock
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from app.api.endpoints.v1.chat import llm_stream
+from app.api.endpoints.v1.models import ChatCompletionRequest
+
+
+def _fake_llm(tokens):
+    llm = MagicMock()
+
+    async def astream(messages):
+        for token in tokens:
+            yield MagicMock(content=token)
+
+    llm.astream = astream
+    return llm
+
+
+async def _frames(tokens, coalesce=True):
+    request = ChatCompletionRequest(model="qwen", messages=[{"role": "user", "content": "你好"}], stream=True, coalesce=coalesce)
+    with patch("app.api.endpoints.v1.chat.get_llm", return_value=_fake_llm(tokens)):
+        response = await llm_stream(request)
+        body = b"".join([chunk async for chunk in response.body_iterator]).decode("utf-8")
+    return [line[len("data: "):] for line in body.split("\n") if line.startswith("data: ")]
+
+
+class TestLLMStream:
+    """Test cases for the llm_stream chunk template and token coalescing"""
+
+    @pytest.mark.asyncio
+    async def test_template_frames_are_valid_chunks(self):
+        """Every token frame is a complete chat.completion.chunk sharing one id"""
+        tokens = ["数字", "电源", ' "引号" ', "\n"]
+        frames = await _frames(tokens, coalesce=False)
+
+        assert frames[-1] == "[DONE]"
+        chunks = [ChatCompletionChunk.model_validate_json(frame) for frame in frames[:-1]]
+        assert len({chunk.id for chunk in chunks}) == 1
+        assert [chunk.choices[0].delta.content for chunk in chunks[:-1]] == tokens
+        assert all(chunk.choices[0].delta.role == "assistant" and chunk.model == "qwen" for chunk in chunks)
+        assert chunks[-1].choices[0].finish_reason == "stop"
+
+    @pytest.mark.asyncio
+    async def test_coalescing_reduces_frame_count(self):
+        """The first token is sent alone, the burst behind it is merged up to the byte limit"""
+        tokens = ["数", "字", "电", "源", "的", "P", "W", "M"]
+        with patch("app.api.endpoints.v1.chat.settings.STREAM_COALESCE_BYTES", 6):
+            frames = await _frames(tokens)
+
+        chunks = [ChatCompletionChunk.model_validate_json(frame) for frame in frames[:-1]]
+        assert [chunk.choices[0].delta.content for chunk in chunks[:-1]] == ["数", "字电", "源的", "PWM"]
+        assert chunks[-1].choices[0].finish_reason == "stop"
+
+    @pytest.mark.asyncio
+    async def test_coalescing_disabled_globally(self):
+        """With coalescing switched off in settings every token keeps its own frame"""
+        tokens = ["数", "字", "电", "源"]
+        with patch("app.api.endpoints.v1.chat.settings.STREAM_COALESCE_ENABLED", False):
+            frames = await _frames(tokens)
+
+        assert len(frames) == len(tokens) + 2
@@ -1,20 +1,34 @@
 # tests/unit/test_mem0_service.py
+import asyncio
+import threading
+import time
 import pytest
 from unittest.mock import patch, MagicMock
-from app.services.tools.mem0_service import Mem0Service
+from app.core.metrics import metrics
+from app.services.history_cache import HistoryCache, InMemoryHistoryBackend
+from app.services.memory_writer import MemoryWriter
+from app.services.tools.mem0_service import Mem0Service, run_in_mem0_executor, shutdown_mem0_executor
+from config.settings import settings
 from app.schemas.graph_state import Plan, PlanStep
 
 
 class TestMem0Service:
     """Test cases for Mem0Service"""
 
+    @pytest.fixture(autouse=True)
+    def memory_writer(self, tmp_path):
+        """Keep revert markers out of the working directory"""
+        writer = MemoryWriter(journal_path=str(tmp_path / "journal.jsonl"))
+        with patch("app.services.tools.mem0_service.memory_writer", writer):
+            yield writer
+
     @pytest.fixture
     def mem0_service(self):
         """Fixture to create a Mem0Service instance with mocked client"""
         with patch('app.services.tools.mem0_service.get_mem0_client') as mock_get_client:
             mock_client = MagicMock()
             mock_get_client.return_value = mock_client
-            service = Mem0Service()
+            service = Mem0Service(history_cache=HistoryCache(InMemoryHistoryBackend()))
             return service, mock_client
 
     def test_init(self):
@@ -178,7 +192,7 @@ class TestMem0Service:
         mock_client.get_all.assert_called_once_with(user_id="test_session_id", include_metadata=True)
 
     @pytest.mark.asyncio
-    async def test_revert_to_turn_success(self, mem0_service):
+    async def test_revert_to_turn_success(self, mem0_service, memory_writer):
         """Test successful revert to specific turn"""
         service, mock_client = mem0_service
         
@@ -197,6 +211,7 @@ class TestMem0Service:
         
         # Verify the client's delete method was called for the correct memory
         mock_client.delete.assert_called_once_with(id="mem_3")
+        assert memory_writer._reverted_at("test_session_id") > 0
 
     @pytest.mark.asyncio
     async def test_revert_to_turn_not_found(self, mem0_service):
@@ -249,4 +264,92 @@ class TestMem0Service:
             await service.revert_to_turn("test_session_id", "turn_1")
         
         # Verify the exception message
-        assert "Test error" in str(exc_info.value)
\ No newline at end of file
+        assert "Test error" in str(exc_info.value)
+
+class TestMem0Executor:
+    """Test cases for the executor-backed mem0 adapter"""
+
+    @pytest.fixture(autouse=True)
+    def fresh_executor(self):
+        """Give each test its own mem0 thread pool and drain it afterwards"""
+        shutdown_mem0_executor()
+        yield
+        shutdown_mem0_executor()
+
+    @pytest.fixture
+    def mem0_service(self):
+        """Fixture to create a Mem0Service instance with mocked client"""
+        with patch('app.services.tools.mem0_service.get_mem0_client') as mock_get_client:
+            mock_client = MagicMock()
+            mock_get_client.return_value = mock_client
+            service = Mem0Service(history_cache=HistoryCache(InMemoryHistoryBackend()))
+            return service, mock_client
+
+    @pytest.mark.asyncio
+    async def test_slow_add_does_not_block_event_loop(self, mem0_service):
+        """A slow synchronous mem0 write runs off the event loop"""
+        service, mock_client = mem0_service
+        mock_client.add.side_effect = lambda *args, **kwargs: time.sleep(0.3)
+        plan = Plan(message_id="turn_1", goal="goal", steps=[], final_summary="summary")
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        await service.add_completed_plan("test_session_id", plan)
+        task.cancel()
+
+        mock_client.add.assert_called_once()
+        assert len(ticks) >= 10
+        assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.1
+
+    @pytest.mark.asyncio
+    async def test_read_timeout_returns_empty_history(self, mem0_service):
+        """A get_all call exceeding MEM0_READ_TIMEOUT is abandoned and counted"""
+        service, mock_client = mem0_service
+        mock_client.get_all.side_effect = lambda **kwargs: time.sleep(0.2) or []
+        before = metrics.get_counter("mem0_op_timeouts_total", op="get_all")
+
+        with patch.object(settings, "MEM0_READ_TIMEOUT", 0.05):
+            result = await service.get_memory_history("test_session_id")
+
+        assert result == []
+        assert metrics.get_counter("mem0_op_timeouts_total", op="get_all") == before + 1
+
+    @pytest.mark.asyncio
+    async def test_queue_depth_gauges_settle(self):
+        """Queued and active gauges return to zero once all calls finish"""
+        release = threading.Event()
+
+        results = asyncio.gather(*[
+            run_in_mem0_executor("test", release.wait, 1, timeout=2) for _ in range(settings.MEM0_EXECUTOR_MAX_WORKERS + 2)
+        ])
+        await asyncio.sleep(0.05)
+        assert metrics.get_gauge("mem0_executor_active") == settings.MEM0_EXECUTOR_MAX_WORKERS
+        assert metrics.get_gauge("mem0_executor_queued") == 2
+
+        release.set()
+        await results
+        assert metrics.get_gauge("mem0_executor_active") == 0
+        assert metrics.get_gauge("mem0_executor_queued") == 0
+
+    @pytest.mark.asyncio
+    async def test_timed_out_queued_call_is_cancelled(self):
+        """A call that times out while still queued never runs"""
+        release = threading.Event()
+        ran = []
+        blockers = asyncio.gather(*[
+            run_in_mem0_executor("test", release.wait, 1, timeout=2) for _ in range(settings.MEM0_EXECUTOR_MAX_WORKERS)
+        ])
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(TimeoutError):
+            await run_in_mem0_executor("test", ran.append, 1, timeout=0.05)
+
+        release.set()
+        await blockers
+        assert ran == []
+        assert metrics.get_gauge("mem0_executor_queued") == 0
@@ -0,0 +1,203 @@
+# tests/unit/test_memory_writer.py
+import asyncio
+import json
+import os
+import subprocess
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from app.schemas.graph_state import Plan
+from app.services.memory_writer import MemoryWriter
+
+
+def _plan(message_id: str) -> Plan:
+    return Plan(message_id=message_id, goal=f"goal {message_id}", steps=[], final_summary=f"summary {message_id}")
+
+
+class RecordingStore:
+    """Fake mem0 write function that records writes and can fail on demand"""
+
+    def __init__(self, failures: int = 0, delay: float = 0.0):
+        self.failures = failures
+        self.delay = delay
+        self.calls = 0
+        self.written = []
+
+    async def __call__(self, session_id: str, plan: Plan) -> None:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("qdrant unavailable")
+        self.written.append((session_id, plan.message_id))
+
+
+class TestMemoryWriter:
+    """Test cases for the background memory write queue"""
+
+    @pytest.fixture
+    def journal(self, tmp_path):
+        return str(tmp_path / "journal.jsonl")
+
+    @pytest.mark.asyncio
+    async def test_store_plan_returns_immediately(self, journal):
+        """store_plan does not wait for the slow mem0 write"""
+        store = RecordingStore(delay=0.2)
+        writer = MemoryWriter(store, journal_path=journal)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        writer.store_plan("s1", _plan("t1"))
+        assert loop.time() - start < 0.05
+        assert store.written == []
+
+        assert await writer.flush(timeout=1)
+        assert store.written == [("s1", "t1")]
+
+    @pytest.mark.asyncio
+    async def test_writes_are_ordered_per_session(self, journal):
+        """Plans of one session are written in submission order, one task per session"""
+        store = RecordingStore(delay=0.01)
+        writer = MemoryWriter(store, journal_path=journal)
+        for i in range(3):
+            writer.store_plan("s1", _plan(f"a{i}"))
+            writer.store_plan("s2", _plan(f"b{i}"))
+        assert len(writer._tasks) == 2
+
+        await writer.flush()
+        assert [m for s, m in store.written if s == "s1"] == ["a0", "a1", "a2"]
+        assert [m for s, m in store.written if s == "s2"] == ["b0", "b1", "b2"]
+
+    @pytest.mark.asyncio
+    async def test_retry_with_backoff(self, journal):
+        """Transient failures are retried until the write succeeds"""
+        store = RecordingStore(failures=2)
+        writer = MemoryWriter(store, journal_path=journal, max_retries=3, retry_backoff=0.01)
+        writer.store_plan("s1", _plan("t1"))
+        await writer.flush()
+
+        assert store.calls == 3
+        assert store.written == [("s1", "t1")]
+
+    @pytest.mark.asyncio
+    async def test_spill_and_replay_when_store_is_down(self, journal):
+        """Writes that exhaust their retries are journaled and replayed on start"""
+        down = RecordingStore(failures=100)
+        writer = MemoryWriter(down, journal_path=journal, max_retries=1, retry_backoff=0.01)
+        writer.store_plan("s1", _plan("t1"))
+        writer.store_plan("s1", _plan("t2"))
+        await writer.flush()
+
+        with open(journal, encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f]
+        assert [e["plan"]["message_id"] for e in entries] == ["t1", "t2"]
+
+        recovered = RecordingStore()
+        writer = MemoryWriter(recovered, journal_path=journal)
+        await writer.start()
+        await writer.flush()
+        assert recovered.written == [("s1", "t1"), ("s1", "t2")]
+
+    @pytest.mark.asyncio
+    async def test_close_flushes_then_spills(self, journal):
+        """Shutdown drains within the timeout and journals whatever is left"""
+        store = RecordingStore(delay=0.5)
+        writer = MemoryWriter(store, journal_path=journal)
+        writer.store_plan("s1", _plan("t1"))
+        writer.store_plan("s1", _plan("t2"))
+        await writer.close(timeout=0.05)
+
+        with open(journal, encoding="utf-8") as f:
+            assert [json.loads(line)["plan"]["message_id"] for line in f] == ["t1", "t2"]
+        assert writer._tasks == {}
+
+        # 关闭后提交的计划直接落盘
+        writer.store_plan("s2", _plan("t3"))
+        with open(journal, encoding="utf-8") as f:
+            assert len(f.readlines()) == 3
+
+    def test_concurrent_claims_take_the_journal_once(self, journal):
+        """Workers replaying at the same time never both read the shared journal"""
+        MemoryWriter(RecordingStore(), journal_path=journal)._spill("s1", [_plan("t1"), _plan("t2")], reason="test")
+        writers = [MemoryWriter(RecordingStore(), journal_path=journal) for _ in range(8)]
+        barrier = threading.Barrier(len(writers))
+
+        def claim(writer):
+            barrier.wait()
+            return writer._claim_journal()
+
+        with ThreadPoolExecutor(len(writers)) as pool:
+            claimed = [path for paths in pool.map(claim, writers) for path in paths]
+        assert len(claimed) == 1
+        with open(claimed[0], encoding="utf-8") as f:
+            assert len(f.readlines()) == 2
+
+    def test_spill_after_claim_is_kept(self, journal):
+        """Entries appended after another worker claimed the journal go to a new journal"""
+        spiller = MemoryWriter(RecordingStore(), journal_path=journal)
+        spiller._spill("s1", [_plan("t1")], reason="test")
+        claimed = MemoryWriter(RecordingStore(), journal_path=journal)._claim_journal()
+        spiller._spill("s1", [_plan("t2")], reason="test")
+
+        with open(journal, encoding="utf-8") as f:
+            assert [json.loads(line)["plan"]["message_id"] for line in f] == ["t2"]
+        with open(claimed[0], encoding="utf-8") as f:
+            assert [json.loads(line)["plan"]["message_id"] for line in f] == ["t1"]
+
+    @pytest.mark.asyncio
+    async def test_orphaned_claim_is_replayed(self, journal):
+        """A journal claimed by a worker that died before replaying it is picked up again"""
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        MemoryWriter(RecordingStore(), journal_path=journal)._spill("s1", [_plan("t1")], reason="test")
+        os.replace(journal, f"{journal}.{dead.pid}.deadbeef.replay")
+
+        store = RecordingStore()
+        writer = MemoryWriter(store, journal_path=journal)
+        assert await writer.replay_journal() == 1
+        await writer.flush()
+        assert store.written == [("s1", "t1")]
+
+    @pytest.mark.asyncio
+    async def test_periodic_replay_retries_spilled_writes(self, journal):
+        """Plans spilled while running are retried without waiting for a restart"""
+        store = RecordingStore()
+        writer = MemoryWriter(store, journal_path=journal, replay_interval=0.05)
+        await writer.start()
+        try:
+            MemoryWriter(RecordingStore(), journal_path=journal)._spill("s1", [_plan("t1")], reason="test")
+            await asyncio.sleep(0.2)
+            await writer.flush()
+            assert store.written == [("s1", "t1")]
+            assert not os.path.exists(journal)
+        finally:
+            await writer.close(timeout=1)
+
+    @pytest.mark.asyncio
+    async def test_revert_drops_journaled_plans(self, journal):
+        """Spilled plans submitted before a revert on any worker are not replayed"""
+        MemoryWriter(RecordingStore(), journal_path=journal)._spill("s1", [_plan("t2")], reason="test")
+        MemoryWriter(RecordingStore(), journal_path=journal)._spill("s2", [_plan("u1")], reason="test")
+        await MemoryWriter(RecordingStore(), journal_path=journal).mark_reverted("s1")
+
+        store = RecordingStore()
+        writer = MemoryWriter(store, journal_path=journal)
+        assert await writer.replay_journal() == 1
+        writer.store_plan("s1", _plan("t3"))
+        await writer.flush()
+        assert sorted(store.written) == [("s1", "t3"), ("s2", "u1")]
+
+    @pytest.mark.asyncio
+    async def test_revert_drops_plans_queued_on_another_worker(self, journal):
+        """A plan still queued when another worker reverts the session is never written"""
+        store = RecordingStore(delay=0.05)
+        writer = MemoryWriter(store, journal_path=journal)
+        writer.store_plan("s1", _plan("t1"))
+        writer.store_plan("s1", _plan("t2"))
+        await asyncio.sleep(0.01)
+        await MemoryWriter(RecordingStore(), journal_path=journal).mark_reverted("s1")
+        await writer.flush()
+
+        assert store.written == [("s1", "t1")]
+        assert writer.pending_count == 0
@@ -0,0 +1,133 @@
+# tests/unit/test_plan_scheduler.py
+import asyncio
+import time
+import pytest
+from unittest.mock import patch
+from langchain_core.messages import AIMessage
+
+from app.core.agents.planner_agent import PlannerAgent
+from app.schemas.graph_state import Plan, PlanStep
+
+
+class FakeExecutor:
+    """Fake executor LLM: sleeps per instruction and tracks concurrency"""
+
+    def __init__(self, delays=None, fail=()):
+        self.delays = delays or {}
+        self.fail = set(fail)
+        self.active = 0
+        self.max_active = 0
+        self.started = []
+
+    async def ainvoke(self, instruction):
+        name = instruction.split("\n")[0]
+        self.started.append(name)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delays.get(name, 0.05))
+            if name in self.fail:
+                raise RuntimeError(f"{name} failed")
+            return AIMessage(content=f"result of {name}")
+        finally:
+            self.active -= 1
+
+
+def _plan(*steps) -> Plan:
+    return Plan(message_id="turn_1", goal="goal", steps=[
+        PlanStep(step_id=i, instruction=f"step{i}", depends_on=list(deps)) for i, deps in steps
+    ])
+
+
+async def _run(plan: Plan, executor: FakeExecutor):
+    agent = PlannerAgent("test_session")
+    state = {"session_id": "test_session", "original_input": "goal", "messages": [], "plan": plan}
+    events = []
+    with patch("app.core.agents.planner_agent.executor_llm", executor):
+        async for name, payload in agent._execute_ready_steps(state):
+            if name == "plan_update":
+                payload = {s.step_id: s.status for s in payload.steps}
+            events.append((name, payload))
+    return events
+
+
+class TestPlanScheduler:
+    """Test cases for the DAG scheduler that runs independent plan steps concurrently"""
+
+    @pytest.mark.asyncio
+    async def test_independent_steps_run_concurrently(self):
+        """Three independent lookups take one step's latency, not three"""
+        executor = FakeExecutor(delays={"step1": 0.2, "step2": 0.2, "step3": 0.2})
+        plan = _plan((1, ()), (2, ()), (3, ()))
+
+        start = time.perf_counter()
+        await _run(plan, executor)
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < 0.4
+        assert executor.max_active == 3
+        assert all(s.status == "complete" and s.result == f"result of step{s.step_id}" for s in plan.steps)
+
+    @pytest.mark.asyncio
+    async def test_dependent_step_waits_and_sees_results(self):
+        """A step starts only after its dependencies and receives their results"""
+        executor = FakeExecutor()
+        plan = _plan((1, ()), (2, ()), (3, (1, 2)))
+        seen = []
+        original = executor.ainvoke
+
+        async def recording(instruction):
+            seen.append(instruction)
+            return await original(instruction)
+
+        executor.ainvoke = recording
+        await _run(plan, executor)
+
+        assert executor.started[-1] == "step3"
+        assert "result of step1" in seen[-1] and "result of step2" in seen[-1]
+
+    @pytest.mark.asyncio
+    async def test_out_of_order_completion_keeps_events_consistent(self):
+        """step_update and plan_update events agree when steps finish out of order"""
+        executor = FakeExecutor(delays={"step1": 0.2, "step2": 0.02})
+        events = await _run(_plan((1, ()), (2, ())), executor)
+
+        updates = [(p["step_id"], p["status"]) for n, p in events if n == "step_update"]
+        assert updates == [(1, "running"), (2, "running"), (2, "complete"), (1, "complete")]
+
+        # 每个 plan_update 快照都与此前发出的 step_update 一致
+        latest = {}
+        for name, payload in events:
+            if name == "step_update":
+                latest[payload["step_id"]] = payload["status"]
+            elif name == "plan_update":
+                assert payload == latest
+
+    @pytest.mark.asyncio
+    async def test_session_concurrency_limit(self):
+        """No more than PLAN_STEP_SESSION_CONCURRENCY steps run at once in a session"""
+        executor = FakeExecutor()
+        plan = _plan(*[(i, ()) for i in range(1, 7)])
+        with patch("app.core.agents.planner_agent.settings.PLAN_STEP_SESSION_CONCURRENCY", 2):
+            await _run(plan, executor)
+        assert executor.max_active == 2
+        assert all(s.status == "complete" for s in plan.steps)
+
+    @pytest.mark.asyncio
+    async def test_failure_stops_scheduling(self):
+        """After a failure no new steps start; running steps finish and the plan goes to replan"""
+        executor = FakeExecutor(delays={"step1": 0.01, "step2": 0.1}, fail={"step1"})
+        plan = _plan((1, ()), (2, ()), (3, (1,)))
+        await _run(plan, executor)
+
+        assert [s.status for s in plan.steps] == ["failed", "complete", "pending"]
+        assert "step3" not in executor.started
+
+    @pytest.mark.asyncio
+    async def test_unsatisfiable_dependencies_fall_back_to_sequential(self):
+        """Cyclic dependencies do not stall the plan"""
+        executor = FakeExecutor()
+        plan = _plan((1, (2,)), (2, (1,)))
+        await _run(plan, executor)
+        assert executor.started == ["step1", "step2"]
+        assert all(s.status == "complete" for s in plan.steps)
@@ -0,0 +1,94 @@
+# tests/unit/test_prompt_registry.py
+import os
+import orjson
+import pytest
+from app.services.prompt_registry import DEFAULT_PROMPT_DIR, RAGFLOW_SYSTEM_PROMPT, PromptRegistry
+
+
+def _write(path, text, mtime=None):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class TestPromptRegistry:
+    """Test cases for the versioned prompt registry"""
+
+    def test_builtin_ragflow_prompt(self):
+        """The built-in RAGFlow system prompt loads with its knowledge placeholder"""
+        registry = PromptRegistry(DEFAULT_PROMPT_DIR)
+        assert registry.load_all() >= 1
+
+        prompt = registry.get(RAGFLOW_SYSTEM_PROMPT)
+        assert "{knowledge}" in prompt.text
+        assert prompt.version.startswith(f"{RAGFLOW_SYSTEM_PROMPT}@")
+
+    def test_chat_payload_matches_json_encoding(self):
+        """The pre-serialized payload decodes to the expected request body"""
+        registry = PromptRegistry(DEFAULT_PROMPT_DIR)
+        prompt = registry.get(RAGFLOW_SYSTEM_PROMPT)
+
+        body = orjson.loads(prompt.chat_payload("default-model", '含 "引号" 和\n换行', True))
+
+        assert body == {
+            "messages": [
+                {"role": "system", "content": prompt.text},
+                {"role": "user", "content": '含 "引号" 和\n换行'},
+            ],
+            "model": "default-model",
+            "stream": True,
+            "metadata": {"prompt_version": prompt.version},
+        }
+        assert prompt.chat_payload("m", "a", False).startswith(prompt.payload_prefix)
+
+    def test_version_is_content_hash(self, tmp_path):
+        """Identical content yields the same version regardless of file location"""
+        _write(tmp_path / "a.md", "same")
+        other = tmp_path / "other"
+        other.mkdir()
+        _write(other / "a.md", "same")
+
+        assert PromptRegistry(str(tmp_path)).get("a").version == PromptRegistry(str(other)).get("a").version
+
+    def test_hot_reload_on_file_change(self, tmp_path):
+        """A changed file is picked up on the next check without a restart"""
+        path = tmp_path / "p.md"
+        _write(path, "v1", mtime=1000)
+        registry = PromptRegistry(str(tmp_path), reload_interval=0.0001)
+        first = registry.get("p")
+
+        _write(path, "v2", mtime=2000)
+        second = registry.get("p")
+
+        assert first.text == "v1"
+        assert second.text == "v2"
+        assert second.version != first.version
+
+    def test_reload_interval_limits_checks(self, tmp_path):
+        """Within the reload interval the cached version is served without touching the file"""
+        path = tmp_path / "p.md"
+        _write(path, "v1", mtime=1000)
+        registry = PromptRegistry(str(tmp_path), reload_interval=3600)
+        registry.get("p")
+
+        _write(path, "v2", mtime=2000)
+        assert registry.get("p").text == "v1"
+
+        registry.reload("p")
+        assert registry.get("p").text == "v2"
+
+    def test_missing_file_keeps_previous_version(self, tmp_path):
+        """Deleting a prompt file does not break requests using the loaded version"""
+        path = tmp_path / "p.md"
+        _write(path, "v1", mtime=1000)
+        registry = PromptRegistry(str(tmp_path), reload_interval=0.0001)
+        registry.get("p")
+
+        os.remove(path)
+        assert registry.get("p").text == "v1"
+
+    def test_unknown_prompt_raises(self, tmp_path):
+        """Requesting a prompt that was never loaded and has no file fails loudly"""
+        with pytest.raises(FileNotFoundError):
+            PromptRegistry(str(tmp_path)).get("missing")
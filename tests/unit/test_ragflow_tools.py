@@ -1,115 +1,281 @@
 # tests/unit/test_ragflow_tools.py
+import asyncio
+import json
+import httpx
 import pytest
-from unittest.mock import patch, MagicMock
-from openai import APIError
-from requests import Timeout
-from config.settings import settings
-from app.services.tools.ragflow_tools import ragflow_knowledge_search
+from unittest.mock import patch, MagicMock, AsyncMock
+from openai import AsyncOpenAI, APIError, APITimeoutError
+from app.core.http_client import get_upstream_config
+from app.services.tools.ragflow_tools import ragflow_knowledge_search, TOOL_SYSTEM_PROMPT
 from app.core.exceptions import PpecCopilotException, ServiceUnavailableException
 
 
+def _mock_client(content=None, side_effect=None):
+    """Build a mocked async RAGFlow client"""
+    mock_client = MagicMock()
+    mock_completion = MagicMock()
+    mock_completion.choices = [MagicMock()]
+    mock_completion.choices[0].message.content = content
+    mock_completion.choices[0].message.reasoning_content = None
+    mock_client.chat.completions.create = AsyncMock(return_value=mock_completion, side_effect=side_effect)
+    return mock_client
+
+
+async def _start_slow_ragflow(delay: float):
+    """Start a local stub that answers chat completions after a delay"""
+    body = json.dumps({
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": 1763648516,
+        "model": "model",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "stub answer"},
+            "finish_reason": "stop",
+        }],
+    }).encode()
+    state = {"requests": 0, "aborted": 0}
+
+    async def handle(reader, writer):
+        try:
+            headers = await reader.readuntil(b"\r\n\r\n")
+            length = int(headers.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+            await reader.readexactly(length)
+            state["requests"] += 1
+            await asyncio.sleep(delay)
+            if reader.at_eof():
+                state["aborted"] += 1
+                return
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, f"http://127.0.0.1:{port}/v1", state
+
+
 class TestRagflowTools:
     """Test cases for RAGFlow tools"""
 
     @pytest.mark.asyncio
     async def test_ragflow_knowledge_search_success(self):
         """Test successful RAGFlow knowledge search"""
-        with patch('app.services.tools.ragflow_tools.OpenAI') as mock_openai:
-            # Mock the OpenAI client and response
-            mock_client = MagicMock()
-            mock_openai.return_value = mock_client
-            
-            mock_completion = MagicMock()
-            mock_completion.choices = [MagicMock()]
-            mock_completion.choices[0].message.content = "This is a test answer from RAGFlow"
-            mock_client.chat.completions.create.return_value = mock_completion
-            
+        mock_client = _mock_client("This is a test answer from RAGFlow")
+        with patch('app.services.tools.ragflow_tools.get_ragflow_client', return_value=mock_client):
             # Execute the tool
             result = await ragflow_knowledge_search.ainvoke({"query": "test query"})
-            
-            # Verify the result
-            assert result == "This is a test answer from RAGFlow"
-            
-            # Verify OpenAI client was called with correct parameters
-            mock_openai.assert_called_once_with(
-                api_key=settings.RAGFLOW_API_KEY,
-                base_url=settings.RAGFLOW_API_URL
-            )
-            
-            mock_client.chat.completions.create.assert_called_once_with(
-                model="model",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": "test query"}
-                ],
-                stream=False,
-                extra_body={"reference": True},
-                timeout=60.0
-            )
+
+        # Verify the result
+        assert result == "This is a test answer from RAGFlow"
+
+        mock_client.chat.completions.create.assert_awaited_once_with(
+            model="model",
+            messages=[
+                {"role": "system", "content": TOOL_SYSTEM_PROMPT},
+                {"role": "user", "content": "test query"}
+            ],
+            stream=False,
+            extra_body={"reference": True},
+            timeout=get_upstream_config("ragflow").timeout
+        )
 
     @pytest.mark.asyncio
     async def test_ragflow_knowledge_search_empty_answer(self):
         """Test RAGFlow knowledge search with empty answer"""
-        with patch('app.services.tools.ragflow_tools.OpenAI') as mock_openai:
-            # Mock the OpenAI client and response with empty content
-            mock_client = MagicMock()
-            mock_openai.return_value = mock_client
-            
-            mock_completion = MagicMock()
-            mock_completion.choices = [MagicMock()]
-            mock_completion.choices[0].message.content = None
-            mock_client.chat.completions.create.return_value = mock_completion
-            
+        with patch('app.services.tools.ragflow_tools.get_ragflow_client', return_value=_mock_client(None)):
             # Execute the tool
             result = await ragflow_knowledge_search.ainvoke({"query": "test query"})
-            
-            # Verify the result
-            assert result == "知识库中没有找到相关答案。"
+
+        # Verify the result
+        assert result == "知识库中没有找到相关答案。"
 
     @pytest.mark.asyncio
     async def test_ragflow_knowledge_search_api_error(self):
         """Test RAGFlow knowledge search with API error"""
-        with patch('app.services.tools.ragflow_tools.OpenAI') as mock_openai:
-            # Mock the OpenAI client to raise APIError
-            mock_client = MagicMock()
-            mock_openai.return_value = mock_client
-            mock_client.chat.completions.create.side_effect = Exception("API Error")
-            
+        error = APIError("API Error", httpx.Request("POST", "http://ragflow"), body=None)
+        with patch('app.services.tools.ragflow_tools.get_ragflow_client', return_value=_mock_client(side_effect=error)):
             # Execute the tool and expect ServiceUnavailableException
-            with pytest.raises(PpecCopilotException) as exc_info:
+            with pytest.raises(ServiceUnavailableException) as exc_info:
                 await ragflow_knowledge_search.ainvoke({"query": "test query"})
-            
-            # Verify the exception message
-            assert "调用知识问答服务时发生未知错误。" in str(exc_info.value)
+
+        # Verify the exception message
+        assert "知识问答服务暂时无法访问，请稍后再试。" in str(exc_info.value)
 
     @pytest.mark.asyncio
     async def test_ragflow_knowledge_search_timeout(self):
         """Test RAGFlow knowledge search with timeout"""
-        with patch('app.services.tools.ragflow_tools.OpenAI') as mock_openai:
-            # Mock the OpenAI client to raise a timeout error
-            mock_client = MagicMock()
-            mock_openai.return_value = mock_client
-            mock_client.chat.completions.create.side_effect = Timeout("Request timed out")
-            
+        error = APITimeoutError(httpx.Request("POST", "http://ragflow"))
+        with patch('app.services.tools.ragflow_tools.get_ragflow_client', return_value=_mock_client(side_effect=error)):
             # Execute the tool and expect ServiceUnavailableException
             with pytest.raises(ServiceUnavailableException) as exc_info:
                 await ragflow_knowledge_search.ainvoke({"query": "test query"})
-            
-            # Verify the exception message
-            assert "知识问答服务响应超时，请稍后再试。" in str(exc_info.value)
+
+        # Verify the exception message
+        assert "知识问答服务响应超时，请稍后再试。" in str(exc_info.value)
 
     @pytest.mark.asyncio
     async def test_ragflow_knowledge_search_unexpected_error(self):
         """Test RAGFlow knowledge search with unexpected error"""
-        with patch('app.services.tools.ragflow_tools.OpenAI') as mock_openai:
-            # Mock the OpenAI client to raise a generic exception
-            mock_client = MagicMock()
-            mock_openai.return_value = mock_client
-            mock_client.chat.completions.create.side_effect = Exception("Unexpected Error")
-            
+        error = Exception("Unexpected Error")
+        with patch('app.services.tools.ragflow_tools.get_ragflow_client', return_value=_mock_client(side_effect=error)):
             # Execute the tool and expect PpecCopilotException
             with pytest.raises(PpecCopilotException) as exc_info:
                 await ragflow_knowledge_search.ainvoke({"query": "test query"})
-            
-            # Verify the exception message
-            assert "调用知识问答服务时发生未知错误。" in str(exc_info.value)
\ No newline at end of file
+
+        # Verify the exception message
+        assert "调用知识问答服务时发生未知错误。" in str(exc_info.value)
+
+    @pytest.mark.asyncio
+    async def test_slow_upstream_does_not_block_event_loop(self):
+        """Other sessions keep streaming while a tool call waits on a slow RAGFlow"""
+        server, base_url, state = await _start_slow_ragflow(delay=0.5)
+        http_client = httpx.AsyncClient()
+        client = AsyncOpenAI(api_key="test", base_url=base_url, http_client=http_client, max_retries=0)
+        ticks = []
+
+        async def other_session():
+            # 模拟另一个会话持续推送 token
+            while True:
+                ticks.append(asyncio.get_running_loop().time())
+                await asyncio.sleep(0.02)
+
+        try:
+            with patch('app.services.tools.ragflow_tools.get_ragflow_client', return_value=client):
+                ticker = asyncio.create_task(other_session())
+                result = await ragflow_knowledge_search.ainvoke({"query": "test query"})
+                ticker.cancel()
+        finally:
+            await http_client.aclose()
+            server.close()
+            await server.wait_closed()
+
+        assert result == "stub answer"
+        # 0.5 秒的上游等待期间，其他会话应持续产出（阻塞客户端下只会有 1 次）
+        assert len(ticks) >= 10
+        assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.2
+
+    @pytest.mark.asyncio
+    async def test_cancellation_aborts_upstream_request(self):
+        """Cancelling the tool call propagates and closes the upstream request"""
+        server, base_url, state = await _start_slow_ragflow(delay=0.3)
+        http_client = httpx.AsyncClient()
+        client = AsyncOpenAI(api_key="test", base_url=base_url, http_client=http_client, max_retries=0)
+
+        try:
+            with patch('app.services.tools.ragflow_tools.get_ragflow_client', return_value=client):
+                task = asyncio.create_task(ragflow_knowledge_search.ainvoke({"query": "test query"}))
+                while state["requests"] == 0:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+                # 等待桩服务完成延迟，确认客户端已断开连接
+                await asyncio.sleep(0.4)
+        finally:
+            await http_client.aclose()
+            server.close()
+            await server.wait_closed()
+
+        assert state["aborted"] == 1
+
+
+class TestRewriteQuery:
+    """Test cases for query rewrite memoization and the standalone pre-filter"""
+
+    HISTORY = [
+        {"role": "user", "content": "PPEC 平台支持哪些 PWM 模式？"},
+        {"role": "assistant", "content": "支持中心对齐和边沿对齐两种模式。"},
+    ]
+
+    @pytest.fixture(autouse=True)
+    def clear_rewrite_cache(self):
+        from app.services.tools.ragflow_tools import rewrite_cache
+        rewrite_cache.clear()
+        yield
+        rewrite_cache.clear()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("question", [
+        "PPEC 平台如何配置 ADC 采样频率？",
+        "PPEC 平台有三种 PWM 模式，其中哪种适合 Buck 变换器？",
+        "ADC 这个外设的采样频率如何配置？",
+        "因此需要在 PPEC 中开启哪些保护功能？",
+        "Is it possible to run PPEC on Linux?",
+    ])
+    async def test_standalone_question_skips_rewrite(self, question):
+        """A long question without anaphora is used as-is without an LLM call"""
+        from app.services.tools import ragflow_tools
+        with patch.object(ragflow_tools, "query_rewrite_chain") as chain:
+            chain.ainvoke = AsyncMock(return_value="rewritten")
+            result = await ragflow_tools._rewrite_query(question, self.HISTORY)
+
+        assert result == question
+        chain.ainvoke.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("question", [
+        "那边沿对齐模式呢？",
+        "它的死区时间怎么设置？",
+        "这个模块的死区时间怎么设置？",
+        "如何修改上述配置中的采样频率？",
+        "How do I configure it on PPEC?",
+        "死区时间",
+    ])
+    async def test_dependent_question_is_rewritten(self, question):
+        """Anaphora, ellipsis and very short questions still go through the rewriter"""
+        from app.services.tools import ragflow_tools
+        with patch.object(ragflow_tools, "query_rewrite_chain") as chain:
+            chain.ainvoke = AsyncMock(return_value="rewritten")
+            result = await ragflow_tools._rewrite_query(question, self.HISTORY)
+
+        assert result == "rewritten"
+        chain.ainvoke.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_repeated_rewrite_is_memoized(self):
+        """The same question over the same history is rewritten only once"""
+        from app.services.tools import ragflow_tools
+        with patch.object(ragflow_tools, "query_rewrite_chain") as chain:
+            chain.ainvoke = AsyncMock(return_value="边沿对齐模式的死区时间怎么设置？")
+            first = await ragflow_tools._rewrite_query("它的死区时间怎么设置？", self.HISTORY)
+            second = await ragflow_tools._rewrite_query(" 它的死区时间怎么设置？ ", self.HISTORY)
+            third = await ragflow_tools._rewrite_query("它的死区时间怎么设置？", self.HISTORY + [
+                {"role": "user", "content": "换个话题"}, {"role": "assistant", "content": "好的"},
+            ])
+
+        assert first == second == third
+        assert chain.ainvoke.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_failed_rewrite_is_not_cached(self):
+        """A fallback to the original question is not memoized"""
+        from app.services.tools import ragflow_tools
+        with patch.object(ragflow_tools, "query_rewrite_chain") as chain:
+            chain.ainvoke = AsyncMock(side_effect=[RuntimeError("llm down"), "rewritten"])
+            first = await ragflow_tools._rewrite_query("它怎么设置？", self.HISTORY)
+            second = await ragflow_tools._rewrite_query("它怎么设置？", self.HISTORY)
+
+        assert first == "它怎么设置？"
+        assert second == "rewritten"
+
+    def test_rewrite_cache_lru_and_ttl(self):
+        """The rewrite cache evicts the least recently used entry and expires stale ones"""
+        from app.services.tools.ragflow_tools import RewriteCache
+        cache = RewriteCache(max_entries=2, ttl=60)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        assert cache.get("a") == "A"
+        cache.set("c", "C")
+        assert cache.get("b") is None
+        assert cache.get("a") == "A"
+
+        expired = RewriteCache(ttl=0)
+        expired.set("a", "A")
+        assert expired.get("a") is None
@@ -0,0 +1,351 @@
+# tests/unit/test_resilience.py
+import asyncio
+import time
+import httpx
+import pytest
+import uvicorn
+from unittest.mock import patch
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app.core.exceptions import CircuitOpenException, ServiceUnavailableException
+from app.core.metrics import metrics
+from app.core.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    ResilientTransport,
+    get_circuit_breaker,
+    wrap_transport,
+)
+
+
+def _completion(content):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "stub",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+    }
+
+
+class FaultyUpstream:
+    """A local chat completions server whose latency and failures can be injected per request"""
+
+    def __init__(self):
+        self.requests = 0
+        self.status = 200
+        # Delays (seconds) for the next requests, consumed in order; later requests answer immediately
+        self.delays = []
+
+        async def completions(request):
+            self.requests += 1
+            if self.delays:
+                await asyncio.sleep(self.delays.pop(0))
+            if self.status >= 500:
+                return JSONResponse({"error": {"message": "injected failure"}}, status_code=self.status)
+            return JSONResponse(_completion(f"answer {self.requests}"))
+
+        app = Starlette(routes=[Route("/chat/completions", completions, methods=["POST"])])
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="off"))
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.should_exit = True
+        await self.task
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _breaker(name="test", **kwargs):
+    options = dict(window=10.0, min_calls=4, failure_rate=0.5, slow_call_seconds=1.0, slow_call_rate=0.5,
+                   open_seconds=5.0, half_open_probes=1)
+    options.update(kwargs)
+    return CircuitBreaker(name, **options)
+
+
+def _client(upstream, breaker, **kwargs):
+    transport = ResilientTransport(httpx.AsyncHTTPTransport(), breaker, **kwargs)
+    return httpx.AsyncClient(base_url=upstream.url, transport=transport), transport
+
+
+async def _post(client, stream=False, model="stub"):
+    return await client.post("/chat/completions", json={"model": model, "messages": [], "stream": stream})
+
+
+class SlowPrimaryTransport(httpx.AsyncBaseTransport):
+    """Fake transport whose first request hangs; records when each attempt has finished cleaning up"""
+
+    def __init__(self):
+        self.calls = 0
+        self.finished = []
+
+    async def handle_async_request(self, request):
+        self.calls += 1
+        attempt = self.calls
+        try:
+            if attempt == 1:
+                await asyncio.sleep(5)
+            return httpx.Response(200, json=_completion(f"answer {attempt}"), request=request)
+        finally:
+            # Returning the connection to the pool needs the event loop
+            await asyncio.sleep(0)
+            self.finished.append(attempt)
+
+
+class TestCircuitBreaker:
+    """Test cases for the rolling-window circuit breaker state machine"""
+
+    def test_opens_on_failure_rate(self):
+        """The circuit opens once the window has enough calls and too many of them failed"""
+        breaker = _breaker(clock=FakeClock())
+        for ok in (True, False, True):
+            breaker.record(ok, 0.1)
+        assert breaker.state == CLOSED
+        breaker.record(False, 0.1)
+        assert breaker.state == OPEN
+        with pytest.raises(CircuitOpenException):
+            breaker.acquire()
+        assert metrics.get_gauge("circuit_breaker_state", upstream="test") == 2
+
+    def test_opens_on_slow_calls(self):
+        """Successful but slow calls also open the circuit"""
+        breaker = _breaker(clock=FakeClock())
+        for latency in (0.1, 2.0, 0.1, 3.0):
+            breaker.record(True, latency)
+        assert breaker.state == OPEN
+
+    def test_old_calls_leave_the_window(self):
+        """Failures older than the window no longer count"""
+        clock = FakeClock()
+        breaker = _breaker(clock=clock)
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+        clock.now = 20.0
+        for _ in range(4):
+            breaker.record(True, 0.1)
+        breaker.record(False, 0.1)
+        assert breaker.state == CLOSED
+
+    def test_half_open_probe_closes_or_reopens(self):
+        """After the open period one probe is let through; its outcome closes or reopens the circuit"""
+        clock = FakeClock()
+        breaker = _breaker(clock=clock)
+        for _ in range(4):
+            breaker.record(False, 0.1)
+        clock.now = 5.0
+        assert breaker.state == HALF_OPEN
+        assert breaker.acquire() is True
+        with pytest.raises(CircuitOpenException):
+            breaker.acquire()
+        breaker.record(False, 0.1, probe=True)
+        assert breaker.state == OPEN
+
+        clock.now = 10.0
+        assert breaker.acquire() is True
+        breaker.record(True, 0.1, probe=True)
+        assert breaker.state == CLOSED
+        assert breaker.acquire() is False
+
+    def test_released_probe_frees_the_slot(self):
+        """A probe abandoned without an outcome lets another probe through"""
+        clock = FakeClock()
+        breaker = _breaker(clock=clock)
+        for _ in range(4):
+            breaker.record(False, 0.1)
+        clock.now = 5.0
+        assert breaker.acquire() is True
+        breaker.release(True)
+        assert breaker.acquire() is True
+
+    def test_upstream_breakers_exported_as_metrics(self):
+        """Per-upstream breaker state is included in the metrics snapshot"""
+        get_circuit_breaker("ragflow")
+        stats = metrics.snapshot()["collectors"]["circuit_breakers"]["ragflow"]
+        assert stats["state"] in (CLOSED, HALF_OPEN, OPEN)
+        assert {"calls", "failure_rate", "slow_call_rate"} <= set(stats)
+
+    def test_disabled_breaker_never_opens(self):
+        """With the breaker disabled outcomes are ignored"""
+        breaker = _breaker(enabled=False)
+        for _ in range(10):
+            breaker.record(False, 5.0)
+        assert breaker.state == CLOSED
+
+
+class TestResilientTransport:
+    """Test cases for the breaker and hedging against a fault-injecting local upstream"""
+
+    @pytest.mark.asyncio
+    async def test_open_circuit_fails_fast_without_reaching_upstream(self):
+        """After repeated 5xx the transport answers 503 itself and the upstream sees no more requests"""
+        async with FaultyUpstream() as upstream:
+            upstream.status = 500
+            breaker = _breaker("faulty")
+            client, _ = _client(upstream, breaker, hedge=False)
+            async with client:
+                for _ in range(4):
+                    assert (await _post(client)).status_code == 500
+                assert breaker.state == OPEN
+                seen = upstream.requests
+
+                start = time.perf_counter()
+                response = await _post(client)
+                assert time.perf_counter() - start < 0.1
+                assert response.status_code == 503
+                assert response.headers["x-should-retry"] == "false"
+                assert upstream.requests == seen
+
+        assert metrics.get_counter("circuit_breaker_transitions_total", upstream="faulty", state="open") >= 1
+
+    @pytest.mark.asyncio
+    async def test_slow_upstream_abandoned_by_caller_opens_circuit(self):
+        """Callers timing out on a hanging upstream count as slow calls"""
+        async with FaultyUpstream() as upstream:
+            upstream.delays = [0.5] * 4
+            breaker = _breaker("hanging", slow_call_seconds=0.1)
+            client, _ = _client(upstream, breaker, hedge=False)
+            async with client:
+                for _ in range(4):
+                    with pytest.raises(TimeoutError):
+                        async with asyncio.timeout(0.2):
+                            await _post(client)
+            assert breaker.state == OPEN
+
+    @pytest.mark.asyncio
+    async def test_hedge_after_p95_returns_the_faster_answer(self):
+        """A non-streaming request slower than the recent p95 is duplicated and the first answer wins"""
+        async with FaultyUpstream() as upstream:
+            client, transport = _client(upstream, _breaker("hedged"), hedge_min_delay=0.05, hedge_min_samples=5)
+            async with client:
+                for _ in range(5):
+                    assert (await _post(client)).status_code == 200
+                assert transport.hedge_delay(("/chat/completions", "stub")) == 0.05
+
+                upstream.delays = [0.5]
+                start = time.perf_counter()
+                response = await _post(client)
+                assert time.perf_counter() - start < 0.4
+                assert response.status_code == 200
+                assert response.json()["choices"][0]["message"]["content"] == "answer 7"
+                assert upstream.requests == 7
+        assert metrics.get_counter("upstream_hedge_wins_total", upstream="hedged", winner="hedge") >= 1
+
+    @pytest.mark.asyncio
+    async def test_latency_is_tracked_per_model(self):
+        """Samples from one model do not make a slow call to another model look like a straggler"""
+        async with FaultyUpstream() as upstream:
+            client, transport = _client(upstream, _breaker("per_model"), hedge_min_delay=0.05, hedge_min_samples=5)
+            async with client:
+                for _ in range(5):
+                    await _post(client, model="embedding")
+                assert transport.hedge_delay(("/chat/completions", "embedding")) == 0.05
+                assert transport.hedge_delay(("/chat/completions", "chat")) is None
+
+                upstream.delays = [0.3]
+                assert (await _post(client, model="chat")).status_code == 200
+                assert upstream.requests == 6
+
+    @pytest.mark.asyncio
+    async def test_losing_attempt_is_awaited(self):
+        """The cancelled attempt has finished by the time the hedged call returns"""
+        fake = SlowPrimaryTransport()
+        transport = ResilientTransport(fake, _breaker("losers"))
+        request = httpx.Request("POST", "http://upstream/chat/completions", json={"model": "stub", "messages": []})
+
+        response = await transport._hedged(request, 0.01)
+
+        assert response.json()["choices"][0]["message"]["content"] == "answer 2"
+        assert sorted(fake.finished) == [1, 2]
+
+    def test_only_configured_upstreams_are_hedged(self):
+        """Hedging is limited to HEDGE_UPSTREAMS so LLM calls are not duplicated by default"""
+        with patch("app.core.resilience.settings.HEDGE_ENABLED", True), \
+                patch("app.core.resilience.settings.CIRCUIT_BREAKER_ENABLED", True), \
+                patch("app.core.resilience.settings.HEDGE_UPSTREAMS", "ragflow"):
+            assert wrap_transport("ragflow", httpx.AsyncHTTPTransport()).hedge is True
+            assert wrap_transport("one_api", httpx.AsyncHTTPTransport()).hedge is False
+
+    @pytest.mark.asyncio
+    async def test_streaming_requests_are_not_hedged(self):
+        """Streaming requests are never duplicated"""
+        async with FaultyUpstream() as upstream:
+            client, _ = _client(upstream, _breaker("stream"), hedge_min_delay=0.05, hedge_min_samples=1)
+            async with client:
+                await _post(client)
+                upstream.delays = [0.3]
+                await _post(client, stream=True)
+                assert upstream.requests == 2
+
+
+class TestCircuitAtCallSites:
+    """Test cases for failing fast with ServiceUnavailableException while a circuit is open"""
+
+    @pytest.mark.asyncio
+    async def test_knowledge_search_fails_fast(self):
+        """The RAGFlow tool raises ServiceUnavailableException without calling the upstream"""
+        from app.services.tools import ragflow_tools
+
+        breaker = _breaker("ragflow")
+        for _ in range(4):
+            breaker.record(False, 0.1)
+        with patch("app.services.tools.ragflow_tools.get_circuit_breaker", return_value=breaker), \
+                patch("app.services.tools.ragflow_tools.get_semantic_cache", return_value=None), \
+                patch("app.services.tools.ragflow_tools.get_ragflow_client") as get_client:
+            with pytest.raises(ServiceUnavailableException):
+                await ragflow_tools.ragflow_knowledge_search.ainvoke({"query": "PPEC 是什么？"})
+        get_client.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_stream_search_reports_open_circuit(self):
+        """The streaming tool reports an open circuit as text, and its raising variant raises"""
+        from app.services.tools import ragflow_tools
+
+        breaker = _breaker("ragflow")
+        for _ in range(4):
+            breaker.record(False, 0.1)
+        with patch("app.services.tools.ragflow_tools.get_circuit_breaker", return_value=breaker), \
+                patch("app.services.tools.ragflow_tools.get_semantic_cache", return_value=None), \
+                patch("app.services.tools.ragflow_tools.get_ragflow_client") as get_client:
+            parts = [part async for part in ragflow_tools.ragflow_stream_search("PPEC 是什么？")]
+            with pytest.raises(CircuitOpenException):
+                [part async for part in ragflow_tools.ragflow_stream_answer("PPEC 是什么？")]
+        assert len(parts) == 1 and "熔断" in parts[0]
+        get_client.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_ragflow_proxy_returns_503(self):
+        """The /ragflow-stream proxy answers 503 while the RAGFlow circuit is open"""
+        from fastapi import FastAPI
+        from app.api.endpoints.v1 import chat
+        from app.api.exception_handlers import service_unavailable_handler
+
+        app = FastAPI()
+        app.include_router(chat.router)
+        app.add_exception_handler(ServiceUnavailableException, service_unavailable_handler)
+        breaker = _breaker("ragflow")
+        for _ in range(4):
+            breaker.record(False, 0.1)
+
+        payload = {"model": "model", "messages": [{"role": "user", "content": "PPEC 是什么？"}], "stream": True}
+        with patch("app.api.endpoints.v1.chat.get_circuit_breaker", return_value=breaker), \
+                patch("app.api.endpoints.v1.chat.get_semantic_cache", return_value=None):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                response = await client.post("/ragflow-stream", json=payload)
+        assert response.status_code == 503
@@ -68,7 +68,8 @@ class TestPlanStep:
             "step_id": 1,
             "instruction": "Test instruction",
             "status": "complete",
-            "result": "Test result"
+            "result": "Test result",
+            "depends_on": []
         }
         assert step_dict == expected_dict
         
@@ -158,13 +159,15 @@ class TestPlan:
                     "step_id": 1,
                     "instruction": "Step 1",
                     "status": "pending",
-                    "result": None
+                    "result": None,
+                    "depends_on": []
                 },
                 {
                     "step_id": 2,
                     "instruction": "Step 2",
                     "status": "complete",
-                    "result": "Done"
+                    "result": "Done",
+                    "depends_on": []
                 }
             ],
             "final_summary": "Test summary"
@@ -0,0 +1,277 @@
+# tests/unit/test_semantic_cache.py
+import json
+import pytest
+from unittest.mock import patch, MagicMock, AsyncMock
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from app.services.semantic_cache import (
+    CacheGeneration,
+    LocalVectorIndex,
+    SemanticCache,
+    NAMESPACE_KNOWLEDGE_SEARCH,
+    normalize_query,
+    replay_chunks,
+)
+from app.services.tools.ragflow_tools import ragflow_knowledge_search
+
+
+class FakeEmbedder:
+    """Deterministic local embedder: fixed vectors for known texts, character counts otherwise"""
+
+    def __init__(self, vectors=None):
+        self.vectors = vectors or {}
+        self.calls = []
+
+    async def embed(self, text):
+        self.calls.append(text)
+        if text in self.vectors:
+            return self.vectors[text]
+        vector = [0.0] * 64
+        for ch in text:
+            vector[ord(ch) % 64] += 1.0
+        return vector
+
+
+def _cache(threshold=0.9, ttl=60.0, max_entries=100, vectors=None):
+    return SemanticCache(FakeEmbedder(vectors), LocalVectorIndex(max_entries), threshold=threshold, ttl=ttl)
+
+
+class TestSemanticCache:
+    """Tests for the semantic answer cache"""
+
+    @pytest.mark.asyncio
+    async def test_hit_on_similar_query(self):
+        """A paraphrase above the cosine threshold returns the cached answer"""
+        cache = _cache(vectors={
+            "如何配置PWM模块？": [1.0, 0.0, 0.1],
+            "PWM 模块怎么配置": [0.98, 0.0, 0.15],
+        })
+        await cache.store("如何配置PWM模块？", "answer", NAMESPACE_KNOWLEDGE_SEARCH)
+
+        assert await cache.lookup("PWM 模块怎么配置", NAMESPACE_KNOWLEDGE_SEARCH) == "answer"
+
+    @pytest.mark.asyncio
+    async def test_miss_below_threshold(self):
+        """Unrelated questions do not reuse an answer"""
+        cache = _cache(vectors={"a": [1.0, 0.0], "b": [0.0, 1.0]})
+        await cache.store("a", "answer", NAMESPACE_KNOWLEDGE_SEARCH)
+
+        assert await cache.lookup("b", NAMESPACE_KNOWLEDGE_SEARCH) is None
+
+    @pytest.mark.asyncio
+    async def test_namespaces_are_isolated(self):
+        """Answers cached for one entry point are not served to another"""
+        cache = _cache()
+        await cache.store("question", "answer", "one")
+
+        assert await cache.lookup("question", "two") is None
+        assert await cache.lookup("question", "one") == "answer"
+
+    @pytest.mark.asyncio
+    async def test_expired_entry_is_a_miss(self):
+        """Entries past their TTL never match and are dropped on the next store"""
+        cache = _cache(ttl=0.0)
+        await cache.store("question", "answer", NAMESPACE_KNOWLEDGE_SEARCH)
+
+        assert await cache.lookup("question", NAMESPACE_KNOWLEDGE_SEARCH) is None
+        await cache.store("other", "answer", NAMESPACE_KNOWLEDGE_SEARCH)
+        assert len(cache.index) == 1
+
+    @pytest.mark.asyncio
+    async def test_expired_match_does_not_hide_valid_entry(self):
+        """An expired closest entry is skipped in favour of the best unexpired one"""
+        cache = _cache(vectors={"q": [1.0, 0.0], "stale": [1.0, 0.0], "fresh": [0.95, 0.05]})
+        await cache.store("fresh", "fresh answer", NAMESPACE_KNOWLEDGE_SEARCH)
+        cache.ttl = 0.0
+        await cache.store("stale", "stale answer", NAMESPACE_KNOWLEDGE_SEARCH)
+
+        assert await cache.lookup("q", NAMESPACE_KNOWLEDGE_SEARCH) == "fresh answer"
+
+    @pytest.mark.asyncio
+    async def test_index_failure_is_a_miss(self):
+        """Errors from the vector index degrade to a miss"""
+        cache = _cache()
+        cache.index = MagicMock()
+        cache.index.search = AsyncMock(side_effect=ConnectionError("qdrant down"))
+
+        assert await cache.lookup("question", NAMESPACE_KNOWLEDGE_SEARCH) is None
+
+    @pytest.mark.asyncio
+    async def test_invalidate(self):
+        """Manual invalidation clears every namespace"""
+        cache = _cache()
+        await cache.store("question", "answer", "one")
+        await cache.store("question", "answer", "two")
+
+        await cache.invalidate()
+
+        assert await cache.lookup("question", "one") is None
+        assert len(cache.index) == 0
+
+    @pytest.mark.asyncio
+    async def test_invalidate_reaches_other_workers(self, tmp_path):
+        """Workers sharing a generation file drop their local index after another worker invalidates"""
+        path = str(tmp_path / "semantic_cache.generation")
+        worker_a = SemanticCache(FakeEmbedder(), LocalVectorIndex(), threshold=0.9, generation=CacheGeneration(path))
+        worker_b = SemanticCache(FakeEmbedder(), LocalVectorIndex(), threshold=0.9, generation=CacheGeneration(path))
+        await worker_a.store("question", "answer", "one")
+        await worker_b.store("question", "answer", "one")
+
+        await worker_a.invalidate()
+
+        assert await worker_b.lookup("question", "one") is None
+        assert len(worker_b.index) == 0
+        await worker_b.store("question", "new answer", "one")
+        assert await worker_b.lookup("question", "one") == "new answer"
+
+    @pytest.mark.asyncio
+    async def test_capacity_evicts_oldest(self):
+        """The local index keeps at most max_entries per namespace"""
+        cache = _cache(max_entries=2, vectors={"a": [1, 0, 0], "b": [0, 1, 0], "c": [0, 0, 1]})
+        for text in ("a", "b", "c"):
+            await cache.store(text, text.upper(), NAMESPACE_KNOWLEDGE_SEARCH)
+
+        assert len(cache.index) == 2
+        assert await cache.lookup("a", NAMESPACE_KNOWLEDGE_SEARCH) is None
+        assert await cache.lookup("c", NAMESPACE_KNOWLEDGE_SEARCH) == "C"
+
+    @pytest.mark.asyncio
+    async def test_store_reuses_lookup_embedding(self):
+        """A miss followed by a store embeds the query only once"""
+        cache = _cache()
+        await cache.lookup("  question  ", NAMESPACE_KNOWLEDGE_SEARCH)
+        await cache.store("question", "answer", NAMESPACE_KNOWLEDGE_SEARCH)
+
+        assert cache.embedder.calls == ["question"]
+
+    @pytest.mark.asyncio
+    async def test_embedder_failure_is_a_miss(self):
+        """Embedding errors degrade to a miss instead of failing the request"""
+        cache = _cache()
+        cache.embedder.embed = AsyncMock(side_effect=RuntimeError("one-api down"))
+
+        assert await cache.lookup("question", NAMESPACE_KNOWLEDGE_SEARCH) is None
+        await cache.store("question", "answer", NAMESPACE_KNOWLEDGE_SEARCH)
+        assert len(cache.index) == 0
+
+    def test_normalize_query(self):
+        """Whitespace differences do not change the cache key"""
+        assert normalize_query("  a \n b\t c ") == "a b c"
+
+
+class TestReplayChunks:
+    """Tests for replaying cached answers in OpenAI chunk format"""
+
+    def test_replay_reassembles_answer(self):
+        """Replayed chunks are valid chat.completion.chunk frames that rebuild the answer"""
+        answer = "PPEC 平台支持多种 PWM 配置方式。" * 3
+        frames = [ChatCompletionChunk.model_validate_json(data) for data in replay_chunks(answer, chunk_chars=8)]
+
+        assert len(frames) > 1
+        assert len({frame.id for frame in frames}) == 1
+        assert "".join(frame.choices[0].delta.content for frame in frames) == answer
+        assert [frame.choices[0].finish_reason for frame in frames] == [None] * (len(frames) - 1) + ["stop"]
+
+    def test_replay_empty_answer(self):
+        """An empty answer still produces a terminating chunk"""
+        frames = list(replay_chunks(""))
+
+        assert len(frames) == 1
+        assert json.loads(frames[0])["choices"][0]["finish_reason"] == "stop"
+
+
+class TestKnowledgeSearchCache:
+    """Tests for the semantic cache in front of the RAGFlow tool"""
+
+    @pytest.mark.asyncio
+    async def test_second_call_served_from_cache(self):
+        """A repeated question is answered without calling RAGFlow again"""
+        cache = _cache()
+        mock_client = MagicMock()
+        mock_completion = MagicMock()
+        mock_completion.choices = [MagicMock()]
+        mock_completion.choices[0].message.content = "cached answer"
+        mock_completion.choices[0].message.reasoning_content = None
+        mock_client.chat.completions.create = AsyncMock(return_value=mock_completion)
+
+        with patch("app.services.tools.ragflow_tools.get_semantic_cache", return_value=cache), \
+                patch("app.services.tools.ragflow_tools.get_ragflow_client", return_value=mock_client):
+            first = await ragflow_knowledge_search.ainvoke({"query": "PPEC 是什么？"})
+            second = await ragflow_knowledge_search.ainvoke({"query": "PPEC 是什么？"})
+
+        assert first == second == "cached answer"
+        assert mock_client.chat.completions.create.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_empty_answer_not_cached(self):
+        """The "no answer found" fallback is never cached"""
+        cache = _cache()
+        mock_client = MagicMock()
+        mock_completion = MagicMock()
+        mock_completion.choices = [MagicMock()]
+        mock_completion.choices[0].message.content = None
+        mock_completion.choices[0].message.reasoning_content = None
+        mock_client.chat.completions.create = AsyncMock(return_value=mock_completion)
+
+        with patch("app.services.tools.ragflow_tools.get_semantic_cache", return_value=cache), \
+                patch("app.services.tools.ragflow_tools.get_ragflow_client", return_value=mock_client):
+            await ragflow_knowledge_search.ainvoke({"query": "PPEC 是什么？"})
+
+        assert len(cache.index) == 0
+
+
+class TestRagflowProxyCache:
+    """Tests for the semantic cache in front of the /ragflow-stream proxy"""
+
+    @pytest.mark.asyncio
+    async def test_hit_replays_without_upstream(self):
+        """A cached answer is replayed as an OpenAI stream ending with [DONE]"""
+        from app.api.endpoints.v1.chat import ragflow_stream
+        from app.api.endpoints.v1.models import ChatCompletionRequest
+        from app.services.prompt_registry import RAGFLOW_SYSTEM_PROMPT, prompt_registry
+        from app.services.semantic_cache import NAMESPACE_RAGFLOW_STREAM
+
+        cache = _cache()
+        namespace = f"{NAMESPACE_RAGFLOW_STREAM}:{prompt_registry.get(RAGFLOW_SYSTEM_PROMPT).version}"
+        await cache.store("PPEC 是什么？", "PPEC 是一个数字电源开发平台。", namespace)
+        request = ChatCompletionRequest(model="model", messages=[{"role": "user", "content": "PPEC 是什么？"}], stream=True)
+
+        with patch("app.api.endpoints.v1.chat.get_semantic_cache", return_value=cache), \
+                patch("app.api.endpoints.v1.chat.get_http_client") as mock_get_client:
+            response = await ragflow_stream(request)
+            body = b"".join([chunk async for chunk in response.body_iterator]).decode("utf-8")
+
+        mock_get_client.return_value.stream.assert_not_called()
+        frames = [line[len("data: "):] for line in body.split("\n") if line.startswith("data: ")]
+        assert frames[-1] == "[DONE]"
+        content = "".join(json.loads(frame)["choices"][0]["delta"]["content"] for frame in frames[:-1])
+        assert content == "PPEC 是一个数字电源开发平台。"
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("mode, cached", [("full", True), ("sampled", False), ("passthrough", False)])
+    async def test_only_fully_validated_streams_are_cached(self, mode, cached):
+        """Streams forwarded with unchecked frames never populate the cache"""
+        import httpx
+        from app.api.endpoints.v1.chat import ragflow_stream
+        from app.api.endpoints.v1.models import ChatCompletionRequest
+
+        frames = [
+            {"id": "c", "object": "chat.completion.chunk", "created": 1, "model": "m",
+             "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": finish}]}
+            for text, finish in (("PPEC ", None), ("是平台。", "stop"))
+        ]
+        body = "".join(f"data: {json.dumps(frame)}\n\n" for frame in frames) + "data: [DONE]\n\n"
+        client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, content=body.encode(), headers={"Content-Type": "text/event-stream"})
+        ))
+        cache = _cache()
+        request = ChatCompletionRequest(model="model", messages=[{"role": "user", "content": "PPEC 是什么？"}], stream=True)
+        try:
+            with patch("app.api.endpoints.v1.chat.get_semantic_cache", return_value=cache), \
+                    patch("app.api.endpoints.v1.chat.get_http_client", return_value=client), \
+                    patch("app.api.endpoints.v1.chat.settings.RAGFLOW_VALIDATION_MODE", mode):
+                response = await ragflow_stream(request)
+                [chunk async for chunk in response.body_iterator]
+        finally:
+            await client.aclose()
+
+        assert (len(cache.index) == 1) is cached
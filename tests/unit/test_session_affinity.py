@@ -0,0 +1,56 @@
+# tests/unit/test_session_affinity.py
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.core.metrics import metrics
+from app.core.session_affinity import SessionAffinityMiddleware, nginx_header_variable, parse_upstreams, render_nginx_upstream
+
+
+class TestNginxUpstream:
+    """Test cases for the generated nginx sticky-session upstream"""
+
+    def test_render_hashes_on_session_header(self):
+        """The upstream hashes consistently on the session header and lists every instance"""
+        config = render_nginx_upstream(["app1:8000", "app2:8000"], header="X-Session-Id")
+
+        assert "map $http_x_session_id $ppec_app_session_key {" in config
+        assert "hash $ppec_app_session_key consistent;" in config
+        assert "server app1:8000" in config and "server app2:8000" in config
+
+    def test_render_requires_servers(self):
+        """An empty instance list is rejected"""
+        with pytest.raises(ValueError):
+            render_nginx_upstream([])
+
+    def test_shipped_upstream_is_up_to_date(self):
+        """nginx/ppec_upstream.conf matches what the generator renders for the compose instances"""
+        path = Path(__file__).resolve().parents[2] / "nginx" / "ppec_upstream.conf"
+
+        assert path.read_text(encoding="utf-8") == render_nginx_upstream(["app1:8000", "app2:8000"])
+
+    def test_helpers(self):
+        """Header names map to nginx variables and upstream lists are parsed"""
+        assert nginx_header_variable("X-Session-Id") == "$http_x_session_id"
+        assert parse_upstreams(" app1:8000, ,app2:8000 ") == ["app1:8000", "app2:8000"]
+
+
+class TestSessionAffinityMiddleware:
+    """Test cases for the served-by header and session header metrics"""
+
+    def test_served_by_header_and_metric(self):
+        """Responses name the serving instance and requests are counted by session header presence"""
+        app = FastAPI()
+        app.add_middleware(SessionAffinityMiddleware, header="X-Session-Id")
+
+        @app.get("/ping")
+        async def ping():
+            return {"ok": True}
+
+        before = metrics.get_counter("session_affinity_requests_total", session_header="present")
+        response = TestClient(app).get("/ping", headers={"X-Session-Id": "s1"})
+
+        assert response.headers["x-served-by"]
+        assert metrics.get_counter("session_affinity_requests_total", session_header="present") == before + 1
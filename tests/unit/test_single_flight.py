@@ -0,0 +1,200 @@
+# tests/unit/test_single_flight.py
+import asyncio
+import json
+import os
+import httpx
+import pytest
+from unittest.mock import patch
+from app.services.single_flight import StreamSingleFlight, SubscriberOverflow, flight_key
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "fixtures", "ragflow_stream.sse")
+
+
+def _producer(items, delay=0.01, calls=None, fail_after=None):
+    """Build a stream factory that yields items with a delay between them"""
+    async def factory():
+        if calls is not None:
+            calls.append(1)
+        for i, item in enumerate(items):
+            if fail_after is not None and i == fail_after:
+                raise RuntimeError("upstream broke")
+            await asyncio.sleep(delay)
+            yield item
+    return factory
+
+
+async def _collect(flight, key, factory):
+    return [item async for item in flight.stream(key, factory)]
+
+
+class TestStreamSingleFlight:
+    """Test cases for coalescing identical concurrent streams"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_subscribers_share_upstream(self):
+        """Identical concurrent requests start the upstream once and all receive every frame"""
+        flight = StreamSingleFlight()
+        calls = []
+        factory = _producer(list(range(10)), calls=calls)
+
+        results = await asyncio.gather(*[_collect(flight, "k", factory) for _ in range(5)])
+
+        assert len(calls) == 1
+        assert all(result == list(range(10)) for result in results)
+        assert flight.active == 0
+
+    @pytest.mark.asyncio
+    async def test_late_joiner_gets_replay(self):
+        """A subscriber joining mid-stream first replays frames already received"""
+        flight = StreamSingleFlight()
+        calls = []
+        factory = _producer(list(range(10)), calls=calls)
+
+        leader = asyncio.create_task(_collect(flight, "k", factory))
+        await asyncio.sleep(0.055)
+        follower = await _collect(flight, "k", factory)
+
+        assert await leader == follower == list(range(10))
+        assert len(calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_different_keys_do_not_share(self):
+        """Requests with different keys get separate upstream streams"""
+        flight = StreamSingleFlight()
+        calls = []
+        factory = _producer([1, 2], calls=calls)
+
+        await asyncio.gather(_collect(flight, "a", factory), _collect(flight, "b", factory))
+
+        assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_slow_subscriber_is_detached(self):
+        """A subscriber that falls behind its buffer is detached without stalling the others"""
+        flight = StreamSingleFlight(subscriber_buffer=2)
+        factory = _producer(list(range(10)), delay=0.001)
+        received = []
+
+        async def slow():
+            with pytest.raises(SubscriberOverflow):
+                async for item in flight.stream("k", factory):
+                    received.append(item)
+                    await asyncio.sleep(0.1)
+
+        fast_result, _ = await asyncio.gather(_collect(flight, "k", factory), slow())
+
+        assert fast_result == list(range(10))
+        assert len(received) < 10
+
+    @pytest.mark.asyncio
+    async def test_upstream_cancelled_when_all_subscribers_leave(self):
+        """The shared upstream stream is cancelled once its last subscriber disconnects"""
+        flight = StreamSingleFlight()
+        cancelled = asyncio.Event()
+
+        async def factory():
+            try:
+                for i in range(100):
+                    await asyncio.sleep(0.01)
+                    yield i
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        stream = flight.stream("k", factory)
+        assert await stream.__anext__() == 0
+        await stream.aclose()
+
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        assert flight.active == 0
+
+    @pytest.mark.asyncio
+    async def test_upstream_error_reaches_every_subscriber(self):
+        """An upstream failure is raised to all subscribers after the frames received so far"""
+        flight = StreamSingleFlight()
+        factory = _producer([1, 2, 3], fail_after=2)
+
+        async def consume():
+            received = []
+            with pytest.raises(RuntimeError):
+                async for item in flight.stream("k", factory):
+                    received.append(item)
+            return received
+
+        assert await asyncio.gather(consume(), consume()) == [[1, 2], [1, 2]]
+
+    @pytest.mark.asyncio
+    async def test_in_flight_reports_joinable_stream(self):
+        """in_flight is true only while an upstream stream for the key is running"""
+        flight = StreamSingleFlight()
+        assert not flight.in_flight("k")
+        stream = flight.stream("k", _producer(["a", "b"]))
+        assert await stream.__anext__() == "a"
+        assert flight.in_flight("k")
+        assert [item async for item in stream] == ["b"]
+        assert not flight.in_flight("k")
+
+    def test_flight_key_normalizes_whitespace(self):
+        """Keys ignore whitespace differences but not content"""
+        assert flight_key("model", "system", "PPEC 是什么？") == flight_key("model", "system", "  PPEC  是什么？ ")
+        assert flight_key("model", "system", "PPEC 是什么？") != flight_key("model", "system", "PPEC 怎么用？")
+
+
+class TestRagflowProxySingleFlight:
+    """Test cases for coalescing in the /ragflow-stream proxy"""
+
+    @pytest.mark.asyncio
+    async def test_identical_requests_share_one_upstream_stream(self):
+        """Concurrent identical questions open a single RAGFlow stream with distinct chunk ids"""
+        from app.api.endpoints.v1.chat import ragflow_stream
+        from app.api.endpoints.v1.models import ChatCompletionRequest
+
+        with open(FIXTURE_PATH, "rb") as f:
+            raw = f.read()
+        upstream_requests = []
+
+        async def body():
+            for i in range(0, len(raw), 512):
+                await asyncio.sleep(0.001)
+                yield raw[i:i + 512]
+
+        def handler(request):
+            upstream_requests.append(request)
+            return httpx.Response(200, content=body(), headers={"Content-Type": "text/event-stream"})
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        request = ChatCompletionRequest(model="model", messages=[{"role": "user", "content": "PPEC 是什么？"}], stream=True)
+
+        async def consume():
+            response = await ragflow_stream(request)
+            return b"".join([chunk async for chunk in response.body_iterator]).decode("utf-8")
+
+        try:
+            with patch("app.api.endpoints.v1.chat.get_http_client", return_value=client), \
+                    patch("app.api.endpoints.v1.chat.get_semantic_cache", return_value=None):
+                bodies = await asyncio.gather(*[consume() for _ in range(4)])
+        finally:
+            await client.aclose()
+
+        assert len(upstream_requests) == 1
+        ids = []
+        for text in bodies:
+            frames = [line[len("data: "):] for line in text.split("\n") if line.startswith("data: ")]
+            assert frames[-1] == "[DONE]"
+            chunk_ids = {json.loads(frame)["id"] for frame in frames[:-1]}
+            assert len(chunk_ids) == 1
+            ids.extend(chunk_ids)
+        assert len(set(ids)) == 4
+        # The subscriber that started the flight keeps the upstream id
+        assert "chatcmpl-5f0e3c8a9b7d4e2f8a1c6b3d9e0f7a21" in ids
+
+    def test_completion_id_is_spliced_into_frame(self):
+        """The leading id field is replaced in place, keeping the rest of the frame byte-for-byte"""
+        from app.api.endpoints.v1.chat import _with_completion_id
+
+        frame = b'data: {"id": "chatcmpl-upstream", "choices": [{"delta": {"content": "\\"id\\""}}]}\n\n'
+        assert _with_completion_id(frame, b"chatcmpl-own") == frame.replace(b"chatcmpl-upstream", b"chatcmpl-own")
+
+        reordered = b'data: {"object": "chat.completion.chunk", "id": "chatcmpl-upstream"}\n\n'
+        assert json.loads(_with_completion_id(reordered, b"chatcmpl-own")[len("data: "):])["id"] == "chatcmpl-own"
+        assert _with_completion_id(b"data: [DONE]\n\n", b"chatcmpl-own") == b"data: [DONE]\n\n"
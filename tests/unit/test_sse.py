@@ -0,0 +1,350 @@
+# tests/unit/test_sse.py
+import asyncio
+import json
+import os
+import random
+import pytest
+
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, Choice, ChoiceDelta
+
+from app.core.metrics import metrics
+from app.core.sse import (
+    CONTENT_PLACEHOLDER,
+    DONE_FRAME,
+    ChunkTemplate,
+    SSEDecoder,
+    SSEEvent,
+    aiter_sse_events,
+    coalesce_frames,
+    encode_sse_data,
+    encode_sse_json,
+)
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "fixtures", "ragflow_stream.sse")
+
+
+def _load_fixture() -> bytes:
+    with open(FIXTURE_PATH, "rb") as f:
+        return f.read()
+
+
+def _split_randomly(data: bytes, rng: random.Random, max_size: int = 64):
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, max_size)
+        yield data[pos:pos + size]
+        pos += size
+
+
+def _decode_all(chunks) -> list:
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.flush())
+    return events
+
+
+class TestSSEDecoder:
+    """Test cases for the incremental SSE decoder"""
+
+    def test_single_chunk_multiple_events(self):
+        """Several complete frames in one read yield several events"""
+        events = _decode_all([b"data: a\n\ndata:b\n\n"])
+        assert [e.data for e in events] == ["a", "b"]
+
+    def test_frame_split_across_reads(self):
+        """A frame split across TCP reads is reassembled before dispatch"""
+        decoder = SSEDecoder()
+        assert decoder.feed(b'data: {"content": "hel') == []
+        assert decoder.feed(b'lo"}\n') == []
+        events = decoder.feed(b"\n")
+        assert events == [SSEEvent(data='{"content": "hello"}')]
+
+    def test_multibyte_character_split(self):
+        """A UTF-8 character cut at a chunk boundary is decoded correctly"""
+        payload = "data: 数字电源\n\n".encode("utf-8")
+        cut = payload.index("字".encode("utf-8")) + 1
+        events = _decode_all([payload[:cut], payload[cut:]])
+        assert events[0].data == "数字电源"
+
+    def test_multiline_data_field(self):
+        """Multiple data lines are joined with newlines"""
+        events = _decode_all([b"data: line1\ndata: line2\n\n"])
+        assert events[0].data == "line1\nline2"
+
+    def test_crlf_split_between_reads(self):
+        """A CRLF pair split between reads is treated as a single line break"""
+        events = _decode_all([b"data: a\r", b"\n\r", b"\ndata: b\r\n\r\n"])
+        assert [e.data for e in events] == ["a", "b"]
+
+    def test_comments_event_id_and_retry(self):
+        """Comment lines are skipped and event/id/retry fields are parsed"""
+        events = _decode_all([b": keep-alive\n\nevent: step_update\nid: 7\nretry: 500\ndata: {}\n\n"])
+        assert events == [SSEEvent(data="{}", event="step_update", id="7", retry=500)]
+
+    def test_unknown_lines_are_counted(self):
+        """Non-SSE lines are ignored and counted"""
+        decoder = SSEDecoder()
+        assert decoder.feed(b'{"code": 102, "message": "error"}\n\n') == []
+        assert decoder.ignored_lines == 1
+
+    def test_flush_dispatches_unterminated_event(self):
+        """A final frame without the trailing blank line is emitted on flush"""
+        decoder = SSEDecoder()
+        assert decoder.feed(b"data: [DONE]") == []
+        assert decoder.flush() == [SSEEvent(data="[DONE]")]
+
+    def test_random_boundaries_match_recorded_stream(self):
+        """Replaying a recorded RAGFlow stream at random boundaries yields identical events"""
+        raw = _load_fixture()
+        expected = _decode_all([raw])
+        assert expected[-1].data == "[DONE]"
+        assert all(json.loads(e.data)["object"] == "chat.completion.chunk" for e in expected[:-1])
+
+        rng = random.Random(20240601)
+        for _ in range(50):
+            assert _decode_all(_split_randomly(raw, rng)) == expected
+
+    @pytest.mark.asyncio
+    async def test_aiter_sse_events(self):
+        """The async adapter decodes an async byte stream"""
+        async def byte_stream():
+            for chunk in (b"data: 1\n", b"", b"\ndata: 2\n\n"):
+                yield chunk
+
+        events = [event.data async for event in aiter_sse_events(byte_stream())]
+        assert events == ["1", "2"]
+
+
+def _chunk(content: str) -> ChatCompletionChunk:
+    return ChatCompletionChunk(
+        id="chatcmpl-test",
+        choices=[Choice(delta=ChoiceDelta(content=content, role="assistant"), finish_reason=None, index=0, logprobs=None)],
+        created=1763648516,
+        model="qwen",
+        object="chat.completion.chunk",
+    )
+
+
+class TestSSEEncoder:
+    """Test cases for the bytes SSE encoder"""
+
+    def test_encode_sse_data(self):
+        """Frames are encoded with one data field per line"""
+        assert encode_sse_data("abc") == b"data: abc\n\n"
+        assert encode_sse_data(b"a\nb") == b"data: a\ndata: b\n\n"
+        assert encode_sse_data("[DONE]") == DONE_FRAME
+
+    def test_encode_sse_json_dict_with_event(self):
+        """Dict payloads are serialized as UTF-8 JSON under the named event"""
+        frame = encode_sse_json({"message_id": "m1", "delta": "数字\n电源"}, event="final_response_delta")
+
+        assert frame.startswith(b"event: final_response_delta\ndata: ")
+        assert frame.endswith(b"\n\n")
+        assert json.loads(frame[len(b"event: final_response_delta\ndata: "):]) == {"message_id": "m1", "delta": "数字\n电源"}
+        assert frame.count(b"\n") == 3
+
+    def test_encode_sse_json_pydantic_matches_model_dump_json(self):
+        """Pydantic payloads serialize exactly like model_dump_json"""
+        chunk = _chunk("你好")
+        assert encode_sse_json(chunk) == f"data: {chunk.model_dump_json()}\n\n".encode()
+
+    @pytest.mark.parametrize("content", ["你好", "", 'quote " and \\ backslash', "line\nbreak", "emoji 🚀", "\x00"])
+    def test_chunk_template_matches_full_serialization(self, content):
+        """Rendering a template is byte-identical to serializing the full chunk"""
+        template = ChunkTemplate(_chunk(CONTENT_PLACEHOLDER))
+        assert template.render(content) == encode_sse_json(_chunk(content))
+
+    def test_chunk_template_requires_single_placeholder(self):
+        """Templates without exactly one placeholder are rejected"""
+        with pytest.raises(ValueError):
+            ChunkTemplate(_chunk("no placeholder"))
+        with pytest.raises(ValueError):
+            ChunkTemplate({"a": CONTENT_PLACEHOLDER, "b": CONTENT_PLACEHOLDER})
+
+
+async def _deltas(items, delay=0.0):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+
+def _text(item):
+    return ("text", item) if isinstance(item, str) else None
+
+
+async def _coalesce(items, **kwargs):
+    return [item async for item in coalesce_frames(items, _text, lambda first, text: text, **kwargs)]
+
+
+class TestCoalesceFrames:
+    """Test cases for the adaptive delta coalescing stage"""
+
+    @pytest.mark.asyncio
+    async def test_passthrough_when_disabled(self):
+        """Without a time window every frame is forwarded as-is"""
+        assert await _coalesce(_deltas(["a", "b", b"END"])) == ["a", "b", b"END"]
+
+    @pytest.mark.asyncio
+    async def test_first_delta_is_not_delayed(self):
+        """The first delta goes out immediately and the burst behind it is merged"""
+        assert await _coalesce(_deltas(["数字", "电源", "的"]), max_delay=1) == ["数字", "电源的"]
+
+    @pytest.mark.asyncio
+    async def test_flush_by_size(self):
+        """Buffered deltas are flushed once they reach the UTF-8 byte limit"""
+        result = await _coalesce(_deltas(["数字", "电源", "的", "PWM", "模块"]), max_bytes=6, max_delay=1)
+
+        assert result == ["数字", "电源", "的PWM", "模块"]
+
+    @pytest.mark.asyncio
+    async def test_non_delta_frame_flushes_buffer(self):
+        """Finish frames flush pending deltas first and are never delayed or merged"""
+        assert await _coalesce(_deltas(["a", "b", b"END", "c"]), max_delay=1) == ["a", "b", b"END", "c"]
+
+    @pytest.mark.asyncio
+    async def test_different_keys_are_not_merged(self):
+        """Only consecutive deltas with the same key are merged"""
+        items = [("reasoning", "a"), ("reasoning", "b"), ("content", "c"), ("content", "d")]
+        result = [item async for item in coalesce_frames(
+            _deltas(items), lambda item: item, lambda first, text: (first[0], text), max_delay=1
+        )]
+
+        assert result == [("reasoning", "a"), ("reasoning", "b"), ("content", "cd")]
+
+    @pytest.mark.asyncio
+    async def test_flush_by_time_window(self):
+        """Deltas arriving within the window are merged into fewer frames"""
+        result = await _coalesce(_deltas(list("abcdefghij"), delay=0.01), max_delay=0.035)
+
+        assert "".join(result) == "abcdefghij"
+        assert 2 <= len(result) <= 6
+
+    @pytest.mark.asyncio
+    async def test_slow_stream_is_not_delayed(self):
+        """Deltas slower than the window are forwarded one by one"""
+        assert await _coalesce(_deltas(["a", "b", "c"], delay=0.05), max_delay=0.01) == ["a", "b", "c"]
+
+    @pytest.mark.asyncio
+    async def test_idle_upstream_flushes_on_deadline(self):
+        """Buffered text is flushed when the window expires even if the upstream stalls"""
+        async def stalled():
+            yield "a"
+            yield "b"
+            await asyncio.sleep(0.3)
+            yield "c"
+
+        received = []
+        start = asyncio.get_running_loop().time()
+        async for item in coalesce_frames(stalled(), _text, lambda first, text: text, max_delay=0.02):
+            received.append((item, asyncio.get_running_loop().time() - start))
+
+        assert [item for item, _ in received] == ["a", "b", "c"]
+        assert received[1][1] < 0.2
+
+    @pytest.mark.asyncio
+    async def test_frames_per_response_metric(self):
+        """The number of frames sent is recorded per stream"""
+        before = metrics.get_histogram("sse_frames_per_response", stream="test")
+        await _coalesce(_deltas(["a", "b", "c", b"END"]), max_delay=1, stream="test")
+        after = metrics.get_histogram("sse_frames_per_response", stream="test")
+
+        assert after["count"] == (before["count"] if before else 0) + 1
+        assert after["sum"] == (before["sum"] if before else 0) + 3
+
+    @pytest.mark.asyncio
+    async def test_early_close_stops_upstream(self):
+        """Closing the coalesced stream closes the upstream generator"""
+        closed = asyncio.Event()
+
+        async def upstream():
+            try:
+                while True:
+                    await asyncio.sleep(0.001)
+                    yield "x"
+            finally:
+                closed.set()
+
+        stream = coalesce_frames(upstream(), _text, lambda first, text: text, max_bytes=3, max_delay=1)
+        assert await stream.__anext__() == "x"
+        assert await stream.__anext__() == "xxx"
+        await stream.aclose()
+        assert closed.is_set()
+
+    @pytest.mark.asyncio
+    async def test_upstream_is_pulled_by_one_task(self):
+        """A single pump task reads the whole upstream instead of one task per frame"""
+        tasks = set()
+
+        async def upstream():
+            for text in "abcdefgh":
+                tasks.add(asyncio.current_task())
+                await asyncio.sleep(0.005)
+                yield text
+
+        result = await _coalesce(upstream(), max_delay=0.012)
+
+        assert "".join(result) == "abcdefgh"
+        assert len(tasks) == 1
+
+    @pytest.mark.asyncio
+    async def test_upstream_error_propagates(self):
+        """An upstream failure is raised to the consumer after the frames before it"""
+        async def upstream():
+            yield "a"
+            raise RuntimeError("upstream broke")
+
+        received = []
+        with pytest.raises(RuntimeError, match="upstream broke"):
+            async for item in coalesce_frames(upstream(), _text, lambda first, text: text, max_delay=1):
+                received.append(item)
+        assert received == ["a"]
+
+
+class TestRagflowProxyCoalescing:
+    """Test cases for delta coalescing in the /ragflow-stream proxy"""
+
+    async def _proxy_frames(self, coalesce):
+        import httpx
+        from unittest.mock import patch
+        from app.api.endpoints.v1.chat import ragflow_stream
+        from app.api.endpoints.v1.models import ChatCompletionRequest
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, content=_load_fixture(), headers={"Content-Type": "text/event-stream"})
+        ))
+        request = ChatCompletionRequest(model="model", messages=[{"role": "user", "content": "数字电源是什么？"}], coalesce=coalesce)
+        try:
+            with patch("app.api.endpoints.v1.chat.get_http_client", return_value=client), \
+                    patch("app.api.endpoints.v1.chat.get_semantic_cache", return_value=None):
+                response = await ragflow_stream(request)
+                body = b"".join([chunk async for chunk in response.body_iterator]).decode("utf-8")
+        finally:
+            await client.aclose()
+        return [line[len("data: "):] for line in body.split("\n") if line.startswith("data: ")]
+
+    @staticmethod
+    def _text(frames, field):
+        return "".join(json.loads(frame)["choices"][0]["delta"].get(field) or "" for frame in frames[:-1])
+
+    @pytest.mark.asyncio
+    async def test_coalesced_stream_keeps_text_and_finish_frame(self):
+        """Merged frames carry the same reasoning and answer text with fewer frames"""
+        upstream = [event.data for event in SSEDecoder().feed(_load_fixture()) if event.data.strip()]
+        frames = await self._proxy_frames(coalesce=True)
+
+        assert frames[-1] == "[DONE]"
+        assert len(frames) < len(upstream)
+        for field in ("reasoning_content", "content"):
+            assert self._text(frames, field) == self._text(upstream, field)
+        assert json.loads(frames[-2])["choices"][0]["finish_reason"] == json.loads(upstream[-2])["choices"][0]["finish_reason"]
+
+    @pytest.mark.asyncio
+    async def test_opt_out_forwards_every_frame(self):
+        """coalesce=false forwards one frame per upstream event"""
+        upstream = [event.data for event in SSEDecoder().feed(_load_fixture()) if event.data.strip()]
+        frames = await self._proxy_frames(coalesce=False)
+
+        assert len(frames) == len(upstream)
@@ -0,0 +1,74 @@
+# tests/unit/test_stream_validation.py
+import json
+import pytest
+
+from app.core.metrics import metrics
+from app.services.stream_validation import ChunkValidator
+
+
+def _chunk(content="hi", finish_reason=None) -> str:
+    return json.dumps({
+        "id": "chatcmpl-test",
+        "choices": [{
+            "delta": {"content": content, "role": "assistant"},
+            "finish_reason": finish_reason,
+            "index": 0,
+            "logprobs": None,
+        }],
+        "created": 1763648516,
+        "model": "model",
+        "object": "chat.completion.chunk",
+    })
+
+
+INVALID = json.dumps({"id": "chatcmpl-test", "choices": "not-a-list"})
+
+
+class TestChunkValidator:
+    """Test cases for the per-stream RAGFlow chunk validator"""
+
+    def test_unknown_mode_rejected(self):
+        """Unknown validation modes raise ValueError"""
+        with pytest.raises(ValueError):
+            ChunkValidator("strict")
+
+    def test_full_mode_validates_every_chunk(self):
+        """Full mode validates every frame and counts rejections"""
+        validator = ChunkValidator("full")
+        assert validator.check(_chunk()) is True
+        assert validator.check(INVALID) is False
+        assert validator.check("not json") is False
+        assert (validator.frames, validator.validated, validator.rejected) == (3, 3, 2)
+
+    def test_sampled_mode_validates_first_nth_and_last(self):
+        """Sampled mode validates the first, every Nth and the final chunk"""
+        validator = ChunkValidator("sampled", sample_rate=4)
+        for _ in range(9):
+            validator.check(_chunk())
+        validator.check(_chunk(content=None, finish_reason="stop"))
+        # frames 1, 4, 8 and the final frame 10
+        assert validator.frames == 10
+        assert validator.validated == 4
+
+    def test_sampled_mode_skips_unsampled_invalid_chunk(self):
+        """Unsampled frames are forwarded without being checked"""
+        validator = ChunkValidator("sampled", sample_rate=100)
+        assert validator.check(_chunk()) is True
+        assert validator.check(INVALID) is True
+        assert validator.rejected == 0
+
+    def test_passthrough_after_first_valid_chunk(self):
+        """Passthrough mode stops validating once a chunk has validated"""
+        validator = ChunkValidator("passthrough")
+        assert validator.check(INVALID) is False
+        assert validator.check(_chunk()) is True
+        assert validator.check(INVALID) is True
+        assert (validator.validated, validator.rejected) == (2, 1)
+
+    def test_rejections_exported_as_metrics(self):
+        """Rejected frames are counted per mode in the metrics registry"""
+        before = metrics.get_counter("ragflow_rejected_frames_total", mode="full")
+        validator = ChunkValidator("full")
+        validator.check(INVALID)
+        validator.finish()
+        assert metrics.get_counter("ragflow_rejected_frames_total", mode="full") == before + 1
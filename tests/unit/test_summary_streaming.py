@@ -0,0 +1,111 @@
+# tests/unit/test_summary_streaming.py
+import pytest
+from unittest.mock import patch, AsyncMock
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from app.core.agents.base_agent import AgentState
+from app.core.agents.planner_agent import PlannerAgent
+from app.schemas.graph_state import Plan, PlanStep
+
+
+class FakeSummarizer:
+    """Fake summarizer chain that streams fixed chunks and can fail mid-stream"""
+
+    def __init__(self, chunks, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+
+    async def astream(self, inputs):
+        for i, chunk in enumerate(self.chunks):
+            if self.fail_after is not None and i == self.fail_after:
+                raise ConnectionError("stream dropped")
+            yield AIMessageChunk(content=chunk)
+
+    async def ainvoke(self, inputs):
+        return AIMessage(content="".join(self.chunks))
+
+
+def _state():
+    plan = Plan(message_id="turn_1", goal="什么是数字电源", steps=[
+        PlanStep(step_id=1, instruction="search", status="complete", result="数字电源是……")
+    ])
+    return {"session_id": "test_session", "original_input": "什么是数字电源", "messages": [], "plan": plan}
+
+
+async def _run_session(summarizer, streaming=True):
+    agent = PlannerAgent("test_session")
+    state = _state()
+    agent._retrieve_memory_step = AsyncMock(return_value=state)
+    agent._plan_step = AsyncMock(return_value=state)
+    agent._update_memory_step = AsyncMock(return_value=state)
+    with patch("app.core.agents.planner_agent.summarizer_chain", summarizer), \
+            patch("app.core.agents.planner_agent.settings.SUMMARY_STREAMING_ENABLED", streaming):
+        events = [event async for event in agent._run_session_stream(state)]
+    return events, state["plan"]
+
+
+class TestSummaryStreaming:
+    """Test cases for token-level streaming of the final summary"""
+
+    @pytest.mark.asyncio
+    async def test_deltas_then_full_final_response(self):
+        """Deltas are forwarded as they arrive and final_response carries the full text"""
+        events, plan = await _run_session(FakeSummarizer(["数字电源", "是一种", "", "电源。"]))
+
+        deltas = [payload["delta"] for name, payload in events if name == "final_response_delta"]
+        finals = [payload for name, payload in events if name == "final_response"]
+        assert deltas == ["数字电源", "是一种", "电源。"]
+        assert finals == [{"message_id": "turn_1", "summary": "数字电源是一种电源。"}]
+        assert plan.final_summary == "数字电源是一种电源。"
+
+        names = [name for name, _ in events]
+        assert names.index("final_response") > max(i for i, n in enumerate(names) if n == "final_response_delta")
+
+    @pytest.mark.asyncio
+    async def test_stream_failure_keeps_partial_text(self):
+        """A dropped summarizer stream keeps what the user has already seen"""
+        events, plan = await _run_session(FakeSummarizer(["数字电源", "是一种", "电源。"], fail_after=2))
+        assert plan.final_summary == "数字电源是一种"
+        assert [p for n, p in events if n == "final_response"][0]["summary"] == "数字电源是一种"
+
+    @pytest.mark.asyncio
+    async def test_streaming_disabled(self):
+        """With streaming disabled the summary is generated in one call"""
+        events, plan = await _run_session(FakeSummarizer(["完整", "回答"]), streaming=False)
+        assert not any(name == "final_response_delta" for name, _ in events)
+        assert plan.final_summary == "完整回答"
+
+    @pytest.mark.asyncio
+    async def test_delta_sse_event(self):
+        """process_request maps deltas to final_response_delta SSE events"""
+        agent = PlannerAgent("test_session")
+
+        async def fake_stream(state):
+            yield ("final_response_delta", {"message_id": "turn_1", "delta": "数字"})
+            yield ("final_response", {"message_id": "turn_1", "summary": "数字电源"})
+
+        agent._run_session_stream = fake_stream
+        agent.state = AgentState.RUNNING
+        response = await agent.process_request("hi", "turn_1")
+        body = b"".join([chunk async for chunk in response.body_iterator]).decode("utf-8")
+        assert 'event: final_response_delta\ndata: {"message_id":"turn_1","delta":"数字"}\n\n' in body
+        assert body.index("final_response_delta") < body.index("event: final_response\n")
+
+    @pytest.mark.asyncio
+    async def test_delta_events_are_coalesced(self):
+        """A burst of deltas is merged behind the first one, and opting out keeps one event per delta"""
+        async def fake_stream(state):
+            for delta in ["数字", "电源", "是一种", "电源。"]:
+                yield ("final_response_delta", {"message_id": "turn_1", "delta": delta})
+            yield ("final_response", {"message_id": "turn_1", "summary": "数字电源是一种电源。"})
+
+        async def deltas(coalesce):
+            agent = PlannerAgent("test_session")
+            agent._run_session_stream = fake_stream
+            agent.state = AgentState.RUNNING
+            response = await agent.process_request("hi", "turn_1", coalesce=coalesce)
+            body = b"".join([chunk async for chunk in response.body_iterator]).decode("utf-8")
+            return [line for line in body.split("\n\n") if line.startswith("event: final_response_delta")]
+
+        assert [frame.split('"delta":')[1] for frame in await deltas(True)] == ['"数字"}', '"电源是一种电源。"}']
+        assert len(await deltas(False)) == 4